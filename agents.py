@@ -0,0 +1,290 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from time import monotonic
+
+import click
+import ovirtsdk4 as sdk
+import ovirtsdk4.types as types
+
+import helpers
+import ratelimit
+import report
+import sparse
+
+# Pool of agent virtual machines sharing the copy of the disks of the jobs.
+# Each disk is attached to one agent of the pool and copied there by a task,
+# the convert of a backup or the restore of an image: in this process for the
+# local agent, by the daemon of the agent (POST /tasks, see daemon.py) for
+# the others. The backup path is shared by the agents, the images of one
+# backup are written by several agents in the same directory. A disk goes to
+# an agent with a free attachment slot, an agent holding disks of the storage
+# domain of the disk first, then the least loaded.
+CONVERT = 'convert'
+RESTORE = 'restore'
+TASKS = (CONVERT, RESTORE)
+
+
+class AgentError(OSError):
+    pass
+
+
+class Agent:
+    """Agent virtual machine of a pool
+    Parameters:
+        vm: vm object of the agent
+        slots: disks attached to the agent at the same time
+        storage_domains: ids of the storage domains local to the agent
+        runner: function running a task on the agent and returning its
+            result, None to run the tasks in this process with runtask
+    """
+
+    def __init__(self, vm, slots=8, storage_domains=(), runner=None):
+        self.vm = vm
+        self.id = vm.id
+        self.name = vm.name
+        self.slots = slots
+        self.storage_domains = set(storage_domains)
+        self.runner = runner
+        self.used = 0
+        self.placed = 0
+        self.failures = 0
+
+    def free(self):
+        return self.slots - self.used
+
+    def load(self):
+        return self.used / self.slots
+
+    def run(self, task):
+        if self.runner is None:
+            return runtask(task)
+        return self.runner(task)
+
+
+class Pool:
+    """Agents sharing the disks of the jobs, a slot of an agent is taken
+    for each disk attached to it, agents whose tasks failed come last
+    Parameters:
+        agents: list of Agent
+    """
+
+    def __init__(self, agents):
+        self.agents = list(agents)
+        self._cond = threading.Condition()
+
+    def slots(self):
+        return sum(agent.slots for agent in self.agents)
+
+    def choose(self, storage_domain=None):
+        """Return agent for a disk of storage domain, None when every agent
+        is full"""
+        candidates = [agent for agent in self.agents if agent.free() > 0]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda agent: (
+            agent.failures, storage_domain not in agent.storage_domains, agent.load(), -agent.free(), agent.placed))
+
+    def acquire(self, storage_domain=None):
+        """Take a slot of the agent chosen for a disk, waiting for a free
+        slot"""
+        with self._cond:
+            agent = self.choose(storage_domain)
+            while agent is None:
+                self._cond.wait()
+                agent = self.choose(storage_domain)
+            agent.used += 1
+            agent.placed += 1
+            return agent
+
+    def release(self, agent):
+        with self._cond:
+            agent.used -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def placed(self, system_service, disk_id, storage_domain=None, snapshot_id=None, journal=None):
+        """Attach a disk to an agent of the pool for the time of the block,
+        the block gets the agent
+        Parameters:
+            storage_domain: id of storage domain of the disk
+            snapshot_id: id of snapshot of a backup, None for the disk
+                itself
+            journal: journal.Journal of the job, the agent and attachment
+                of the disk are saved until it is detached
+        """
+        agent = self.acquire(storage_domain)
+        try:
+            attachments_service = system_service.vms_service().vm_service(agent.id).disk_attachments_service()
+            attach = attachments_service.add(
+                attachment=types.DiskAttachment(
+                    disk=types.Disk(
+                        id=disk_id,
+                        snapshot=types.Snapshot(id=snapshot_id) if snapshot_id else None,
+                    ),
+                    active=True,
+                    bootable=False,
+                    interface=types.DiskInterface.VIRTIO_SCSI,
+                ),
+            )
+            if journal is not None:
+                journal.setdisk(disk_id, agent=agent.id, attachment=attach.id)
+            try:
+                yield agent
+            except AgentError:
+                agent.failures += 1
+                raise
+            finally:
+                attachments_service.attachment_service(attach.id).remove()
+                if journal is not None:
+                    journal.setdisk(disk_id, attachment=None)
+        finally:
+            self.release(agent)
+
+
+def locality(system_service, inventory, vm):
+    """Return ids of the storage domains holding the disks of an agent"""
+    storage_domains = set()
+    for attach in system_service.vms_service().vm_service(vm.id).disk_attachments_service().list():
+        disk = inventory.disk(attach.disk.id)
+        if disk is not None:
+            storage_domains.update(sd.id for sd in disk.storage_domains or ())
+    return storage_domains
+
+
+def checktask(task, backup_path):
+    """Return error message of an invalid task, None when it is valid, the
+    device must be the device of the disk and the path in the backup path"""
+    if not isinstance(task, dict):
+        return 'task must be an object'
+    if task.get('kind') not in TASKS:
+        return 'kind must be one of {}'.format(', '.join(TASKS))
+    if not isinstance(task.get('disk'), str) or not task['disk'] or '/' in task['disk']:
+        return 'disk must be a disk id'
+    if task.get('device') != helpers.DEVICE_PATH + task['disk']:
+        return 'device must be the device of the disk'
+    if not backup_path:
+        return 'tasks need the backup path'
+    if not isinstance(task.get('path'), str) or not os.path.realpath(task['path']).startswith(
+            os.path.realpath(backup_path) + os.sep):
+        return 'path must be in the backup path'
+    return None
+
+
+def runtask(task):
+    """Run a task on the agent of this process
+    Parameters:
+        task: dict with kind, event_id, disk, device and path, the rate
+            and iops of the share of the job reserved for the disk, the
+            disk_format of a convert and the expected checksums and
+            start_offset of a restore
+    Returns:
+        dict with code, seconds, size, read and written bytes and checksums
+        of a convert
+    """
+    event_id = task.get('event_id')
+    uuid = task['disk']
+    limiter = ratelimit.Limiter(task.get('rate') or 0, task.get('iops') or 0, parent=ratelimit.AGENT)
+    start = monotonic()
+    if task['kind'] == CONVERT:
+        path = task['path']
+        converter = helpers.PackConverter() if task.get('disk_format') == sparse.SPARSE else helpers.convertdisk
+        code = converter(event_id, uuid, task['device'], path, False, logging, click, limiter=limiter)
+        result = {'code': code, 'seconds': monotonic() - start}
+        if code == 0:
+            result['size'] = helpers.convertedsize(converter, uuid, task['device'])
+            result['read'] = result['size']
+            result['written'] = helpers.convertedbytes(converter, uuid, path)
+            result['checksums'] = helpers.convertedchecksums(converter, uuid, path)
+        return result
+    task_report = report.JobReport(RESTORE, uuid, event_id)
+    code = helpers.restoredata(task['device'], task['path'], False, logging, click, event_id, task_report,
+                               task.get('expected'), limiter, task.get('start_offset', 0))
+    result = {'code': code, 'seconds': monotonic() - start}
+    if code == 0:
+        disk = task_report.disks[Path(task['path']).stem]
+        result.update(seconds=disk['seconds'], read=disk['bytes_read'], written=disk['bytes_written'])
+    return result
+
+
+class PoolConverter:
+    """Converter for helpers.qemuconvert converting each disk on an agent
+    of a pool, the snapshot disk is attached to the agent for the time of
+    the convert
+    Parameters:
+        pool: Pool
+        system_service: root service of the connection
+        snapshot_id: id of snapshot of the backup
+        storages: dict of disk id and storage domain id
+        disk_format: format of the images written by the agents, see
+            sparse.FORMATS
+        journal: journal.Journal of the job
+    """
+
+    def __init__(self, pool, system_service, snapshot_id, storages=None, disk_format=sparse.RAW, journal=None):
+        self.pool = pool
+        self.system_service = system_service
+        self.snapshot_id = snapshot_id
+        self.storages = storages or {}
+        self.disk_format = disk_format
+        self.journal = journal
+        self.disks = {}
+        self.checksums = {}
+
+    def __call__(self, event_id, uuid, device, path, dbg, logging, clickecho, progress=False, limiter=None):
+        try:
+            with self.pool.placed(self.system_service, uuid, self.storages.get(uuid), self.snapshot_id,
+                                  self.journal) as agent:
+                logging.info('[{}] Converting uuid {} on agent {}'.format(event_id, uuid, agent.name))
+                if dbg:
+                    clickecho.echo('[{}] Converting uuid {} on agent {}'.format(event_id, uuid, agent.name))
+                with limiter.share() if limiter is not None else nullcontext((0, 0)) as limits:
+                    result = agent.run({'kind': CONVERT, 'event_id': event_id, 'disk': uuid, 'device': device,
+                                        'path': path, 'disk_format': self.disk_format, 'rate': limits[0],
+                                        'iops': limits[1]})
+        except sdk.Error as e:
+            logging.error('[{}] Error attaching disk {} to an agent: {}'.format(event_id, uuid, e))
+            return 1
+        if result['code'] == 0:
+            self.disks[uuid] = {'size': result['size'], 'written': result['written'], 'agent': agent.name}
+            self.checksums[uuid] = result['checksums']
+        return result['code']
+
+
+class PoolRestorer:
+    """Restorer for helpers.restoredisks restoring each disk on an agent of
+    a pool, the disk is attached to the agent for the time of the restore,
+    the offset reached is not saved while an agent copies
+    Parameters:
+        pool: Pool
+        system_service: root service of the connection
+        storage_domain: id of storage domain of the disks
+        journal: journal.Journal of the job
+    """
+
+    def __init__(self, pool, system_service, storage_domain=None, journal=None):
+        self.pool = pool
+        self.system_service = system_service
+        self.storage_domain = storage_domain
+        self.journal = journal
+
+    def __call__(self, device, path, dbg, logging=None, clickecho=None, e_id=None, report=None, expected=None,
+                 limiter=None, start_offset=0, checkpoint=None):
+        uuid = Path(path).stem
+        try:
+            with self.pool.placed(self.system_service, uuid, self.storage_domain, journal=self.journal) as agent:
+                logging.info('[{}] Restoring {} on agent {}'.format(e_id, path, agent.name))
+                if dbg:
+                    clickecho.echo('[{}] Restoring {} on agent {}'.format(e_id, path, agent.name))
+                with limiter.share() if limiter is not None else nullcontext((0, 0)) as limits:
+                    result = agent.run({'kind': RESTORE, 'event_id': e_id, 'disk': uuid, 'device': device,
+                                        'path': path, 'expected': expected, 'start_offset': start_offset,
+                                        'rate': limits[0], 'iops': limits[1]})
+        except (sdk.Error, OSError) as e:
+            logging.error('[{}] Error restoring {} on an agent: {}'.format(e_id, path, e))
+            return 1
+        if report is not None and result['code'] == 0:
+            report.disk(uuid, result['seconds'], result['read'], result['written'], 'copy')
+        return result['code']
@@ -0,0 +1,348 @@
+"""Benchmark of the backup and restore paths against a fake oVirt
+
+The ovirtsdk4 modules are replaced by fakeovirt, attached disks are sparse
+image files with data, text, zero and hole blocks linked in a temporary
+device directory. Stages are timed alone and end to end:
+
+    python benchmark.py --disks 2 --size 512 --codec gzip --codec zstd --json bench.json
+"""
+import filecmp
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from time import monotonic, sleep
+
+import click
+
+import fakeovirt
+import fakes3
+
+AGENT = 'bench-agent'
+VM_NAME = 'benchvm'
+TOKEN = 'bench'
+
+
+class Bench:
+    """Results of the stages of a benchmark
+    Parameters:
+        workdir: directory for images, backups and logs
+    """
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.results = []
+
+    def stage(self, name, nbytes, function, *args, **kwargs):
+        """Time function, nbytes is the logical size of the data moved"""
+        start = monotonic()
+        value = function(*args, **kwargs)
+        seconds = monotonic() - start
+        result = {
+            'stage': name,
+            'seconds': round(seconds, 3),
+            'mib': round(nbytes / 2**20, 1),
+            'mib_per_second': round(nbytes / 2**20 / seconds, 1) if seconds > 0 else None,
+        }
+        self.results.append(result)
+        click.echo('{:<32} {:>9.3f}s {:>9.1f} MiB {:>9} MiB/s'.format(
+            name, result['seconds'], result['mib'], result['mib_per_second']))
+        return value
+
+    def skip(self, name, reason):
+        self.results.append({'stage': name, 'skipped': reason})
+        click.echo('{:<32} skipped, {}'.format(name, reason))
+
+
+def nextsecond():
+    """Backup names have a timestamp in seconds, wait for a new one"""
+    sleep(1 - time.time() % 1)
+
+
+def lastbackup(backup_path, suffix=''):
+    """Return newest backup of the benchmark vm ending with suffix"""
+    backups = sorted(p for p in Path(backup_path).glob(VM_NAME + '-*' + suffix)
+                     if not p.name.endswith('.json'))
+    return backups[-1].as_posix()
+
+
+def mutate(images, percent, seed=1, block=2**20):
+    """Overwrite percent of the blocks of the images with random data"""
+    rnd = random.Random(seed)
+    for path in images.values():
+        size = os.path.getsize(path)
+        blocks = size // block
+        with open(path, 'rb+') as fd:
+            for index in rnd.sample(range(blocks), max(1, blocks * percent // 100)):
+                fd.seek(index * block)
+                fd.write(rnd.randbytes(block))
+
+
+def sameimage(sparse, source, target, block=8 * 2**20):
+    """Return True when target has the data of source image, restored disks
+    can be larger than the image and end with zeros"""
+    size = os.path.getsize(source)
+    with open(source, 'rb') as src, open(target, 'rb') as dst:
+        target_size = os.fstat(dst.fileno()).st_size
+        if target_size < size:
+            return False
+        while True:
+            data = src.read(block)
+            if not data:
+                break
+            if dst.read(len(data)) != data:
+                return False
+        for start, end in sparse.dataextents(dst.fileno(), target_size):
+            dst.seek(max(start, size))
+            for offset in range(max(start, size), end, block):
+                data = dst.read(min(block, end - offset))
+                if data.count(0) != len(data):
+                    return False
+    return True
+
+
+def differing(sparse, pairs):
+    """Return the targets of (source, target) pairs differing from their
+    source image"""
+    return sorted(target for source, target in pairs
+                  if not os.path.exists(target) or not sameimage(sparse, source, target))
+
+
+def available(helpers, codec):
+    command = helpers.CODECS[codec]['compress']
+    return command is None or shutil.which(command[0]) is not None
+
+
+@click.command()
+@click.option('--workdir', type=click.Path(file_okay=False), help='directory for the benchmark, temporary by default')
+@click.option('--keep', is_flag=True, default=False, help='keep the working directory')
+@click.option('--disks', type=click.IntRange(min=1), default=2, show_default=True, help='disks of the vm')
+@click.option('--size', type=click.IntRange(min=1), default=256, show_default=True, help='size of each disk in MiB')
+@click.option('--data', type=float, default=0.4, show_default=True, help='ratio of random data blocks')
+@click.option('--zeros', type=float, default=0.1, show_default=True, help='ratio of written zero blocks')
+@click.option('--text', type=float, default=0.2, show_default=True, help='ratio of compressible blocks, the rest are holes')
+@click.option('--latency', type=float, default=0.0, show_default=True, help='seconds added to every API call')
+@click.option('--snapshot-delay', type=float, default=0.0, show_default=True, help='seconds to create a snapshot')
+@click.option('--disk-delay', type=float, default=0.0, show_default=True, help='seconds to create a disk')
+@click.option('--attach-delay', type=float, default=0.0, show_default=True, help='seconds until an attached device appears')
+@click.option('--codec', '-z', 'codecs', multiple=True, default=['gzip'], show_default=True,
+              help='codecs to benchmark, can be repeated')
+@click.option('--mode', '-m', 'modes', multiple=True, type=click.Choice(['full', 'stream', 'incremental', 'dedup']),
+              default=['full', 'stream', 'incremental', 'dedup'], show_default=True,
+              help='end to end backup modes, can be repeated')
+@click.option('--workers', '-w', type=click.IntRange(min=1), default=4, show_default=True, help='disks copied at the same time')
+@click.option('--change', type=click.IntRange(min=0, max=100), default=10, show_default=True,
+              help='percent of blocks changed before the incremental backup')
+@click.option('--backend', type=click.Choice(['attach', 'transfer']), default='attach', show_default=True,
+              help='read disks attached to the agent or from image transfers')
+@click.option('--disk-format', type=click.Choice(['raw', 'sparse']), default='raw', show_default=True,
+              help='store the disks of full and stream backups as raw or sparse images')
+@click.option('--agents', 'agent_count', type=click.IntRange(min=1), default=1, show_default=True,
+              help='agents of the pool copying the disks of full backups and restores, the others than the first '
+                   'run the tasks sent to a local daemon')
+@click.option('--direct-io', is_flag=True, default=False, help='read the disks and images with O_DIRECT')
+@click.option('--io-block-size', help='size of the reads of disks and images as SIZE')
+@click.option('--io-depth', type=click.IntRange(min=1), help='reads in flight per disk')
+@click.option('--job-limit', help='bandwidth and IOPS of the end to end backups and restores as RATE[,IOPS]')
+@click.option('--offload', is_flag=True, default=False,
+              help='upload the archives to a local S3 stand-in and time their download')
+@click.option('--json', 'json_file', type=click.Path(dir_okay=False), help='write results to this JSON file')
+def benchmark(workdir, keep, disks, size, data, zeros, text, latency, snapshot_delay, disk_delay, attach_delay,
+              codecs, modes, workers, change, backend, disk_format, agent_count, direct_io, io_block_size, io_depth,
+              job_limit, offload, json_file):
+    """Benchmark backup and restore with a fake oVirt and synthetic disks"""
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix='cliobr-bench-'))
+    os.makedirs(workdir, exist_ok=True)
+    engine = fakeovirt.Engine(os.path.join(workdir, 'devices'), latency, snapshot_delay, disk_delay, attach_delay)
+    fakeovirt.install(engine)
+    # the fake sdk must be installed before the modules importing it
+    import agents
+    import cliobr
+    import daemon
+    import directio
+    import helpers
+    import jobs
+    import sparse
+    import verify
+    import offload as offload_module
+    from click.testing import CliRunner
+
+    helpers.DEVICE_PATH = engine.device_path + '/'
+    cliobr.AgentVM = AGENT
+    log_file = os.path.join(workdir, 'benchmark.log')
+    logging.basicConfig(level=logging.INFO, format=cliobr.FORMAT, filename=log_file)
+    directio.configure(direct_io, io_block_size, io_depth)
+
+    images_path = os.path.join(workdir, 'images')
+    backup_path = os.path.join(workdir, 'backups')
+    stages_path = os.path.join(workdir, 'stages')
+    for path in (images_path, backup_path, stages_path):
+        os.makedirs(path, exist_ok=True)
+
+    images = {}
+    for index in range(disks):
+        disk_id = '{:08x}-0000-4000-8000-{:012x}'.format(index, index)
+        images[disk_id] = os.path.join(images_path, disk_id + '.img')
+        fakeovirt.makeimage(images[disk_id], size * 2**20, index, data, zeros, text)
+    total = disks * size * 2**20
+    vm = engine.addvm(VM_NAME, images)
+    if offload:
+        s3 = fakes3.Server(os.path.join(workdir, 's3'))
+        offload_module.configure(s3.url + '/bench', 'bench', 'bench', workers=workers)
+    bench = Bench(workdir)
+    event_id = random.randrange(1, 10**8)
+    click.echo('{} disks of {} MiB in {}'.format(disks, size, workdir))
+
+    try:
+        # stages alone
+        raw_path = os.path.join(stages_path, 'raw')
+        os.makedirs(raw_path, exist_ok=True)
+        if shutil.which('qemu-img'):
+            results = bench.stage('qemuconvert', total, helpers.qemuconvert, event_id, images, raw_path + '/',
+                                  False, logging, click, workers=workers)
+            if helpers.returncode(results) != 0:
+                raise click.ClickException('qemuconvert failed: {}'.format(results))
+        else:
+            bench.skip('qemuconvert', 'qemu-img not found')
+            for disk_id, image in images.items():
+                helpers.sparsecopy(image, os.path.join(raw_path, disk_id + '.raw'))
+        for codec in codecs:
+            if not available(helpers, codec):
+                bench.skip('make_archive ' + codec, 'compressor not found')
+                continue
+            destination = os.path.join(stages_path, '{}-{}'.format(VM_NAME, codec))
+            os.makedirs(destination)
+            for raw in os.listdir(raw_path):
+                os.link(os.path.join(raw_path, raw), os.path.join(destination, raw))
+            bench.stage('make_archive ' + codec, total, helpers.make_archive, stages_path, destination,
+                        False, event_id, logging, codec=codec)
+            archive = helpers.archivename(destination, codec)
+            unpack_path = os.path.join(stages_path, 'unpack-' + codec)
+            os.makedirs(unpack_path)
+            bench.stage('unpack_archive ' + codec, total, helpers.unpack_archive, archive, unpack_path,
+                        logging, event_id)
+            shutil.rmtree(unpack_path)
+            destination = os.path.join(stages_path, '{}-stream-{}'.format(VM_NAME, codec))
+            os.makedirs(destination)
+            bench.stage('stream_archive ' + codec, total, helpers.stream_archive, stages_path, destination,
+                        images, False, event_id, logging, codec=codec, disk_format=disk_format)
+        targets = {}
+        for raw in os.listdir(raw_path):
+            target = os.path.join(stages_path, 'target-' + raw)
+            with open(target, 'wb') as fd:
+                fd.truncate(os.path.getsize(os.path.join(raw_path, raw)))
+            targets[os.path.join(raw_path, raw)] = target
+        results = bench.stage('restoredisks', total, helpers.restoredisks, targets, workers, False, logging,
+                              click, event_id)
+        if helpers.returncode(results) != 0:
+            raise click.ClickException('restoredisks failed: {}'.format(results))
+        differ = differing(sparse, targets.items())
+        if differ:
+            raise click.ClickException('restoredisks wrote targets differing from the images: {}'.format(differ))
+        shutil.rmtree(raw_path)
+
+        # end to end
+        connection = jobs.SharedConnection(url='https://engine.bench/ovirt-engine/api')
+        system_service = connection.system_service()
+        vms_service = system_service.vms_service()
+        agent = helpers.vmobj(vms_service, AGENT)
+        runner = CliRunner()
+        pool = None
+        agent_arguments = []
+        if agent_count > 1:
+            members = [agents.Agent(agent, workers)]
+            for index in range(2, agent_count + 1):
+                member = helpers.vmobj(vms_service, '{}-{}'.format(AGENT, index))
+                server = daemon.serve('127.0.0.1:0', daemon.JobQueue(':memory:'), backup_path, token=TOKEN)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+                listen = '127.0.0.1:{}'.format(server.server_address[1])
+                members.append(agents.Agent(member, workers, runner=daemon.taskrunner(listen, token=TOKEN)))
+                agent_arguments += ['--agent', '{}={}'.format(member.name, listen)]
+            pool = agents.Pool(members)
+            agent_arguments += ['--agent-slots', str(workers), '--token', TOKEN]
+        for codec in codecs:
+            if not available(helpers, codec):
+                continue
+            for mode in modes:
+                if mode == 'full' and backend == 'attach' and not shutil.which('qemu-img'):
+                    bench.skip('backup full ' + codec, 'qemu-img not found')
+                    continue
+                options = {'codec': codec, 'workers': workers, 'stream': mode == 'stream',
+                           'incremental_chain': 5 if mode == 'incremental' else 0,
+                           'dedup': mode == 'dedup', 'job_limit': job_limit, 'backend': backend,
+                           'disk_format': disk_format, 'pool': pool}
+                backup_mode = os.path.join(backup_path, '{}-{}'.format(mode, codec))
+                os.makedirs(backup_mode)
+                nextsecond()
+                code = bench.stage('backup {} {}'.format(mode, codec), total, jobs.backupvm, system_service,
+                                   vm, agent, backup_mode, event_id, False, **options)
+                if code != 0:
+                    raise click.ClickException('backup {} {} failed with {}'.format(mode, codec, code))
+                if mode == 'incremental':
+                    mutate(images, change)
+                    nextsecond()
+                    code = bench.stage('backup {} {} {}%'.format(mode, codec, change), total, jobs.backupvm,
+                                       system_service, vm, agent, backup_mode, event_id, False, **options)
+                    if code != 0:
+                        raise click.ClickException('incremental backup failed with {}'.format(code))
+                if mode == 'dedup':
+                    backup = lastbackup(backup_mode)
+                else:
+                    backup = lastbackup(backup_mode, helpers.CODECS[codec]['ext'])
+                if offload and mode != 'dedup':
+                    fetched = os.path.join(workdir, 'fetched')
+                    bench.stage('fetch {} {}'.format(mode, codec), os.path.getsize(backup), offload_module.fetch,
+                                offload_module.TARGET, offload_module.TARGET.key(Path(backup).name), fetched)
+                    if not filecmp.cmp(backup, fetched, shallow=False):
+                        raise click.ClickException('archive {} {} differs in the bucket'.format(mode, codec))
+                    os.remove(fetched)
+                results = bench.stage('verify {} {}'.format(mode, codec), total, verify.verifybackups,
+                                      [backup], logging, workers)
+                failed = [result for result in results if result[2] == verify.FAILED]
+                if failed:
+                    raise click.ClickException('verify {} {} failed: {}'.format(mode, codec, failed))
+                arguments = ['--password', 'bench', '--ca', os.devnull, '--api', 'https://engine.bench/ovirt-engine/api',
+                             '--storage-domain', 'sd-bench', '--cluster', 'Default', '--log', log_file,
+                             '--workers', str(workers)] + agent_arguments
+                if mode == 'stream':
+                    arguments.append('--stream')
+                if job_limit:
+                    arguments += ['--job-limit', job_limit]
+                if direct_io:
+                    arguments.append('--direct-io')
+                if io_block_size:
+                    arguments += ['--io-block-size', io_block_size]
+                if io_depth:
+                    arguments += ['--io-depth', str(io_depth)]
+                if offload:
+                    arguments += ['--offload', s3.url + '/bench', '--offload-access-key', 'bench',
+                                  '--offload-secret-key', 'bench']
+                result = bench.stage('restore {} {}'.format(mode, codec), total, runner.invoke, cliobr.restore,
+                                     arguments + [backup])
+                if result.exit_code != 0:
+                    raise click.ClickException('restore {} {} failed with {}: {}'.format(
+                        mode, codec, result.exit_code, result.exception))
+                differ = differing(sparse, ((images[disk_id], target) for disk_id, target in engine.targets.items()))
+                if len(engine.targets) != len(images) or differ:
+                    raise click.ClickException('restore {} {} wrote {} disks, differing from the images: {}'.format(
+                        mode, codec, len(engine.targets), differ))
+                for target in engine.targets.values():
+                    os.remove(target)
+                engine.targets.clear()
+    finally:
+        click.echo('{} API calls'.format(next(engine.calls)))
+        if json_file:
+            with open(json_file, 'w') as fd:
+                json.dump({'disks': disks, 'size_mib': size, 'latency': latency, 'workers': workers,
+                           'agents': agent_count, 'direct_io': direct_io, 'stages': bench.results}, fd, indent=2)
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,307 @@
+import datetime
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tarfile
+from pathlib import Path
+
+import descriptor
+import helpers
+import incremental
+import journal
+import offload
+import sparse
+
+# Index of the backups under the backup path, written at the end of each
+# backup so listing and pruning do not scan the backup tree
+CATALOG = '.catalog.db'
+TIMESTAMP = '%Y%m%d%H%M%S'
+NAME = re.compile(r'^(?P<vm>.+)-(?P<timestamp>\d{14})-(?P<vm_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                  r'[0-9a-f]{4}-[0-9a-f]{12})$')
+FULL = 'full'
+INCREMENTAL = 'incremental'
+DEDUP = 'dedup'
+
+
+class Catalog:
+    """SQLite catalog of backups
+    Parameters:
+        backup_path: path of backups, the catalog is <backup_path>/.catalog.db
+    """
+
+    def __init__(self, backup_path):
+        self.backup_path = backup_path
+        self._db = sqlite3.connect(os.path.join(backup_path, CATALOG), timeout=60)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS backups '
+                             '(name TEXT PRIMARY KEY, vm TEXT, vm_id TEXT, timestamp TEXT, file TEXT, kind TEXT, '
+                             'parent TEXT, codec TEXT, size INTEGER, seconds REAL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS disks '
+                             '(backup TEXT, disk TEXT, size INTEGER, written INTEGER, checksum TEXT, '
+                             'offset INTEGER, PRIMARY KEY (backup, disk))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS backups_vm ON backups (vm, timestamp)')
+            # url of the archive in the bucket, added after the first catalogs
+            if 'remote' not in [row['name'] for row in self._db.execute('PRAGMA table_info(backups)')]:
+                self._db.execute('ALTER TABLE backups ADD COLUMN remote TEXT')
+
+    def close(self):
+        self._db.close()
+
+    def add(self, backup, disks):
+        """Add or replace a backup
+        Parameters:
+            backup: dict with the columns of backups, remote is the url of
+                the archive in the bucket of offload
+            disks: dict of disk id and dict with size, written, checksum and
+                offset of the disk in the archive
+        """
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO backups VALUES '
+                             '(:name, :vm, :vm_id, :timestamp, :file, :kind, :parent, :codec, :size, :seconds, '
+                             ':remote)',
+                             dict({'parent': None, 'codec': None, 'size': None, 'seconds': None, 'remote': None},
+                                  **backup))
+            self._db.execute('DELETE FROM disks WHERE backup = ?', (backup['name'],))
+            self._db.executemany('INSERT INTO disks VALUES (?, ?, ?, ?, ?, ?)', (
+                (backup['name'], disk, values.get('size'), values.get('written'), values.get('checksum'),
+                 values.get('offset')) for disk, values in disks.items()))
+
+    def remove(self, name):
+        with self._db:
+            self._db.execute('DELETE FROM disks WHERE backup = ?', (name,))
+            self._db.execute('DELETE FROM backups WHERE name = ?', (name,))
+
+    def list(self, vm=None, since=None, limit=None):
+        """Return backups newest first
+        Parameters:
+            vm: name of vm, None for every vm
+            since: oldest timestamp as YYYYmmddHHMMSS
+        """
+        query = 'SELECT * FROM backups WHERE 1'
+        args = []
+        if vm:
+            query += ' AND vm = ?'
+            args.append(vm)
+        if since:
+            query += ' AND timestamp >= ?'
+            args.append(since)
+        query += ' ORDER BY timestamp DESC, name DESC'
+        if limit:
+            query += ' LIMIT ?'
+            args.append(limit)
+        return [dict(row) for row in self._db.execute(query, args)]
+
+    def get(self, name):
+        """Return backup with its disks by name or file, None if missing"""
+        row = self._db.execute('SELECT * FROM backups WHERE name = ? OR file = ?', (name, name)).fetchone()
+        if row is None:
+            return None
+        backup = dict(row)
+        backup['disks'] = {disk['disk']: {key: disk[key] for key in ('size', 'written', 'checksum', 'offset')}
+                           for disk in self._db.execute('SELECT * FROM disks WHERE backup = ? ORDER BY disk',
+                                                        (backup['name'],))}
+        return backup
+
+
+def backupfile(backup_path, name):
+    """Return file name of backup relative to backup path, the archive if it
+    exists, else the directory"""
+    for codec in helpers.CODECS:
+        archive = helpers.archivename(name, codec)
+        if os.path.exists(os.path.join(backup_path, archive)):
+            return archive, codec
+    return name, None
+
+
+def scan(catalog, backup_path, log):
+    """Add backups of the backup path missing in the catalog, e.g. backups
+    made before the catalog
+    Returns:
+        number of backups added
+    """
+    known = {backup['name'] for backup in catalog.list()}
+    added = 0
+    for entry in sorted(os.listdir(backup_path)):
+        name = helpers.archivebase(entry)
+        match = NAME.match(name)
+        if match is None or name in known or journal.find(backup_path, name) is not None:
+            # failed backups keep their journal until they are resumed
+            continue
+        file, codec = backupfile(backup_path, name)
+        path = os.path.join(backup_path, file)
+        kind = FULL
+        parent = None
+        try:
+            if os.path.isdir(path):
+                if list(Path(path).glob('*.chunks')):
+                    kind = DEDUP
+                elif os.path.exists(os.path.join(path, incremental.MANIFEST)):
+                    with open(os.path.join(path, incremental.MANIFEST)) as fd:
+                        parent = json.load(fd).get('parent')
+            else:
+                manifest = archivemanifest(path)
+                if manifest is not None:
+                    parent = manifest.get('parent')
+            if parent:
+                kind = INCREMENTAL
+        except (OSError, ValueError, tarfile.TarError) as e:
+            log.warning('Error reading backup {}, skipped: {}'.format(file, e))
+            continue
+        backup_descriptor = descriptor.read(os.path.join(backup_path, name))
+        disks = {}
+        if backup_descriptor is not None:
+            disks = {disk['id']: {'size': disk['size']} for disk in backup_descriptor['disks'] if not disk['parent']}
+        catalog.add({'name': name, 'vm': match['vm'], 'vm_id': match['vm_id'], 'timestamp': match['timestamp'],
+                     'file': file, 'kind': kind, 'parent': parent, 'codec': codec, 'size': filesize(path)}, disks)
+        known.add(name)
+        added += 1
+    log.info('Added {} backups of {} to the catalog'.format(added, backup_path))
+    return added
+
+
+def archivemanifest(file):
+    """Return manifest of an incremental backup archive, None for a full
+    backup, reading stops at the first disk image"""
+    with helpers.tarstream(file) as tar:
+        for member in tar:
+            if sparse.isimage(member.name):
+                return None
+            if member.name.endswith('/' + incremental.MANIFEST):
+                return json.load(tar.extractfile(member))
+    return None
+
+
+def filesize(path):
+    """Return size of file or of the files of a directory"""
+    if os.path.isdir(path):
+        return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+    return os.path.getsize(path)
+
+
+def retained(backups, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0):
+    """Return names of backups to keep, with the parents of the incremental
+    backups kept
+    Parameters:
+        backups: backups of one vm
+        keep_last: newest backups kept
+        keep_daily: days kept with their newest backup
+        keep_weekly: weeks kept with their newest backup
+        keep_monthly: months kept with their newest backup
+    """
+    backups = sorted(backups, key=lambda b: b['timestamp'], reverse=True)
+    keep = {b['name'] for b in backups[:keep_last]}
+    periods = [
+        (keep_daily, lambda d: d.date()),
+        (keep_weekly, lambda d: d.isocalendar()[:2]),
+        (keep_monthly, lambda d: (d.year, d.month)),
+    ]
+    for count, period in periods:
+        seen = set()
+        for backup in backups:
+            if len(seen) >= count:
+                break
+            key = period(datetime.datetime.strptime(backup['timestamp'], TIMESTAMP))
+            if key not in seen:
+                seen.add(key)
+                keep.add(backup['name'])
+    parents = {b['name']: b['parent'] for b in backups}
+    for name in list(keep):
+        while parents.get(name):
+            name = parents[name]
+            keep.add(name)
+    return keep
+
+
+def prune(catalog, backup_path, log, vm=None, dry_run=False, **keep):
+    """Remove backups not retained by the keep rules of retained()
+    Returns:
+        list of backups removed
+    """
+    backups = catalog.list(vm)
+    by_vm = {}
+    for backup in backups:
+        by_vm.setdefault(backup['vm_id'], []).append(backup)
+    removed = []
+    for vm_backups in by_vm.values():
+        keep_names = retained(vm_backups, **keep)
+        for backup in sorted(vm_backups, key=lambda b: b['timestamp']):
+            if backup['name'] in keep_names:
+                continue
+            removed.append(backup)
+            if dry_run:
+                continue
+            path = os.path.join(backup_path, backup['file'])
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            if backup['remote']:
+                key = offload.TARGET.keyof(backup['remote']) if offload.TARGET is not None else None
+                if key is None:
+                    log.warning('Archive {} of pruned backup is kept, its bucket is not configured'.format(
+                        backup['remote']))
+                else:
+                    try:
+                        offload.TARGET.delete(key)
+                    except offload.OffloadError as e:
+                        log.error('Error removing archive {} of pruned backup: {}'.format(backup['remote'], e))
+            for sidecar in (backup['name'] + '.report.json', descriptor.sidecar(backup['name'])):
+                if os.path.exists(os.path.join(backup_path, sidecar)):
+                    os.remove(os.path.join(backup_path, sidecar))
+            catalog.remove(backup['name'])
+            log.info('Pruned backup {}'.format(backup['file']))
+    if not dry_run and any(backup['kind'] == DEDUP for backup in removed):
+        log.info('Pruned deduplicated backups, their chunks are freed by gc')
+    return removed
+
+
+def evict(catalog, backup_path, log, vm_id, keep):
+    """Remove from the backup path the archives of a vm uploaded to the
+    bucket, except the newest keep backups and their parents
+    Returns:
+        list of backups removed from the backup path
+    """
+    backups = [backup for backup in catalog.list() if backup['vm_id'] == vm_id]
+    keep_names = retained(backups, keep_last=keep)
+    evicted = []
+    for backup in backups:
+        path = os.path.join(backup_path, backup['file'])
+        if backup['name'] in keep_names or not backup['remote'] or not os.path.isfile(path):
+            continue
+        os.remove(path)
+        evicted.append(backup)
+        log.info('Removed local archive {}, it is kept in {}'.format(backup['file'], backup['remote']))
+    return evicted
+
+
+def record(backup_path, backup, disks, log, e_id):
+    """Add a finished backup to the catalog of the backup path, errors are
+    logged and do not fail the backup"""
+    try:
+        catalog = Catalog(backup_path)
+        try:
+            catalog.add(backup, disks)
+        finally:
+            catalog.close()
+    except (OSError, sqlite3.Error) as e:
+        log.error('[{}] Error writing catalog: {}'.format(e_id, e))
+        return 1
+    return 0
+
+
+def lookup(backup_path, name):
+    """Return backup by name or file from the catalog of the backup path,
+    None without catalog"""
+    if not os.path.exists(os.path.join(backup_path, CATALOG)):
+        return None
+    try:
+        catalog = Catalog(backup_path)
+        try:
+            return catalog.get(name)
+        finally:
+            catalog.close()
+    except sqlite3.Error:
+        return None
@@ -0,0 +1,231 @@
+import hashlib
+import io
+import json
+import os
+
+# Checksums of the raw images of a backup, written as checksums.json next to
+# the OVF: the digest of every block of each disk and the digest of the list
+# of block digests. Blocks are checked while they are restored and disks are
+# checked in parallel, blocks of zeros have a known digest and are not hashed.
+# Disks are hashed while they are copied, except the raw images of attached
+# disks written by qemu-img: qemu-img runs out of process and cannot write to
+# a pipe, so these images are hashed once written, a second read of their
+# data extents.
+MANIFEST = 'checksums.json'
+ALGORITHM = 'blake2b'
+BLOCK_SIZE = 4 * 2**20
+DIGEST_SIZE = 16
+ZERO = bytes(BLOCK_SIZE)
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def blockdigest(block):
+    return hashlib.blake2b(block, digest_size=DIGEST_SIZE).digest()
+
+
+ZERO_DIGEST = blockdigest(ZERO)
+
+
+def diskdigest(digests):
+    """Return hex digest of a disk from the concatenated digests of its
+    blocks"""
+    return hashlib.blake2b(digests, digest_size=DIGEST_SIZE).hexdigest()
+
+
+class Hasher:
+    """Block digests of a disk computed from its data in order, fed with
+    buffers of any size
+    Parameters:
+        name: name of disk in errors
+        expected: checksums of the disk, each block is checked when it is
+            complete and ChecksumError is raised on the first difference
+    """
+
+    def __init__(self, name=None, expected=None, block_size=BLOCK_SIZE):
+        self.name = name
+        self.block_size = block_size
+        self.size = 0
+        self.digests = bytearray()
+        self._expected = None
+        if expected is not None:
+            self._expected = bytes.fromhex(''.join(expected['blocks']))
+        self._pending = bytearray()
+
+    def _block(self, block, digest=None):
+        if digest is None:
+            if len(block) == self.block_size and ZERO.startswith(block):
+                digest = ZERO_DIGEST
+            else:
+                digest = blockdigest(block)
+        if self._expected is not None:
+            start = len(self.digests)
+            if self._expected[start:start + DIGEST_SIZE] != digest:
+                raise ChecksumError('checksum mismatch in block {} at offset {} of disk {}'.format(
+                    start // DIGEST_SIZE, start // DIGEST_SIZE * self.block_size, self.name))
+        self.digests += digest
+
+    def update(self, data):
+        """Hash data following the data already hashed"""
+        view = memoryview(data).cast('B')
+        self.size += len(view)
+        if self._pending:
+            fill = min(len(view), self.block_size - len(self._pending))
+            self._pending += view[:fill]
+            view = view[fill:]
+            if len(self._pending) < self.block_size:
+                return
+            self._block(self._pending)
+            self._pending.clear()
+        while len(view) >= self.block_size:
+            self._block(view[:self.block_size])
+            view = view[self.block_size:]
+        self._pending += view
+
+    def zeros(self, length):
+        """Hash a hole of length bytes without reading it"""
+        if self._pending:
+            fill = min(length, self.block_size - len(self._pending))
+            self.update(bytes(fill))
+            length -= fill
+        blocks, length = divmod(length, self.block_size)
+        zero = ZERO_DIGEST if self.block_size == BLOCK_SIZE else blockdigest(bytes(self.block_size))
+        for _ in range(blocks):
+            self._block(None, zero)
+        self.size += blocks * self.block_size
+        if length:
+            self.update(bytes(length))
+
+    def result(self):
+        """Return checksums of the disk, the last block can be partial"""
+        if self._pending:
+            self._block(self._pending)
+            self._pending.clear()
+        if self._expected is not None and len(self._expected) != len(self.digests):
+            raise ChecksumError('disk {} has {} blocks, expected {}'.format(
+                self.name, len(self.digests) // DIGEST_SIZE, len(self._expected) // DIGEST_SIZE))
+        return fromdigests(self.size, bytes(self.digests))
+
+
+def fromdigests(size, digests):
+    """Return checksums of a disk from its size and concatenated block
+    digests"""
+    return {
+        'size': size,
+        'digest': diskdigest(digests),
+        'blocks': [digests[i:i + DIGEST_SIZE].hex() for i in range(0, len(digests), DIGEST_SIZE)],
+    }
+
+
+class HashingReader(io.RawIOBase):
+    """File object hashing the data read from fileobj"""
+
+    def __init__(self, fileobj, hasher):
+        self.fileobj = fileobj
+        self.hasher = hasher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        length = self.fileobj.readinto(buf)
+        if length:
+            self.hasher.update(memoryview(buf)[:length])
+        return length
+
+
+class Checksums:
+    """Checksums of the disks of a backup collected while they are copied,
+    or after for the raw images written by qemu-img, disks are the .raw
+    members or files named after their disk id"""
+
+    def __init__(self, disks=None):
+        self.disks = dict(disks or {})
+
+    def reader(self, name, fileobj):
+        """Return fileobj hashed as a disk when name is a raw image, the
+        checksums are kept by add()"""
+        if not name.endswith('.raw'):
+            return fileobj
+        return HashingReader(fileobj, Hasher(os.path.basename(name)[:-len('.raw')]))
+
+    def add(self, fileobj):
+        """Keep checksums of a file object returned by reader(), or of any
+        file object hashing a disk with a hasher attribute, once it is
+        read"""
+        hasher = getattr(fileobj, 'hasher', None)
+        if hasher is not None:
+            self.disks[hasher.name] = hasher.result()
+
+    def expected(self, uuid):
+        """Return checksums of disk, None when the disk has no checksums"""
+        return self.disks.get(uuid)
+
+    def manifest(self):
+        return {'algorithm': ALGORITHM, 'digest_size': DIGEST_SIZE, 'block_size': BLOCK_SIZE,
+                'disks': self.disks}
+
+    def dumps(self):
+        return json.dumps(self.manifest()).encode('utf-8')
+
+    def write(self, directory):
+        path = os.path.join(directory, MANIFEST)
+        with open(path, 'wb') as fd:
+            fd.write(self.dumps())
+        return path
+
+
+def loads(data):
+    """Return Checksums of a manifest, ChecksumError when its algorithm or
+    block size is not supported"""
+    manifest = json.loads(data)
+    if (manifest.get('algorithm') != ALGORITHM or manifest.get('digest_size') != DIGEST_SIZE
+            or manifest.get('block_size') != BLOCK_SIZE):
+        raise ChecksumError('unsupported checksums {} {} {}'.format(
+            manifest.get('algorithm'), manifest.get('digest_size'), manifest.get('block_size')))
+    return Checksums(manifest['disks'])
+
+
+def readmanifest(directory):
+    """Return Checksums of backup directory, None for a backup without
+    checksums"""
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fd:
+        return loads(fd.read())
+
+
+def hashfile(path, extents=None, size=None, hasher=None):
+    """Return checksums of a raw image reading only its data extents
+    Parameters:
+        extents: list of (start, end) of data, None to read the whole file
+        size: size of image, size of file if not set
+        hasher: Hasher to feed, a new one if not set
+    """
+    if hasher is None:
+        hasher = Hasher(os.path.basename(path))
+    buf = bytearray(BLOCK_SIZE * 2)
+    view = memoryview(buf)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if size is None:
+            size = os.fstat(fd).st_size
+        if extents is None:
+            extents = [(0, size)]
+        offset = 0
+        for start, end in extents:
+            hasher.zeros(start - offset)
+            offset = start
+            while offset < end:
+                length = os.preadv(fd, [view[:min(len(buf), end - offset)]], offset)
+                if not length:
+                    break
+                hasher.update(view[:length])
+                offset += length
+        hasher.zeros(size - offset)
+    finally:
+        os.close(fd)
+    return hasher.result()
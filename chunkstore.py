@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+import checksum
+import helpers
+import imagetransfer
+
+# Repository of chunks shared by every backup under the backup path, each
+# unique chunk is stored once in chunks/<2 first hex>/<sha256> with a one byte
+# header telling whether the data is zlib compressed. A backup references
+# each chunk it puts in the same transaction that finds the chunk, and gc
+# deletes chunks inside its transaction, so a running backup never keeps a
+# chunk gc is removing.
+STORE = '.chunks'
+CHUNK_SIZE = 4 * 2**20
+SUFFIX = '.chunks'
+RAW = b'R'
+ZLIB = b'Z'
+# seconds a backup waits for the store while gc runs
+TIMEOUT = 3600
+
+
+class ChunkStore:
+    """Content addressed store of disk chunks with an SQLite index
+    Parameters:
+        backup_path: path of backups, the store lives in <backup_path>/.chunks
+    """
+
+    def __init__(self, backup_path):
+        self.path = os.path.join(backup_path, STORE)
+        os.makedirs(os.path.join(self.path, 'chunks'), exist_ok=True)
+        self._lock = threading.Lock()
+        # transactions are begun explicitly, gc holds the store for a while
+        self._db = sqlite3.connect(os.path.join(self.path, 'index.db'), timeout=TIMEOUT,
+                                   isolation_level=None, check_same_thread=False)
+        with self.transaction():
+            self._db.execute('CREATE TABLE IF NOT EXISTS chunks '
+                             '(hash TEXT PRIMARY KEY, size INTEGER, stored INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS refs '
+                             '(backup TEXT, hash TEXT, PRIMARY KEY (backup, hash))')
+
+    def close(self):
+        self._db.close()
+
+    @contextmanager
+    def transaction(self):
+        """Hold the lock of the store and a write transaction of its index
+        for the time of the block"""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def chunkpath(self, digest):
+        return os.path.join(self.path, 'chunks', digest[:2], digest)
+
+    def has(self, digest):
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM chunks WHERE hash = ?', (digest,)).fetchone()
+        return row is not None
+
+    def put(self, chunk, backup=None):
+        """Store chunk if it is new
+        Parameters:
+            backup: name of backup referencing the chunk, the reference is
+                added with the lookup of a known chunk
+        Returns:
+            tuple of hex digest and bytes written, 0 for a known chunk
+        """
+        digest = hashlib.sha256(chunk).hexdigest()
+        with self.transaction():
+            known = self._db.execute('SELECT 1 FROM chunks WHERE hash = ?', (digest,)).fetchone() is not None
+            if known and backup is not None:
+                self._db.execute('INSERT OR IGNORE INTO refs VALUES (?, ?)', (backup, digest))
+        if known:
+            return digest, 0
+        data = zlib.compress(chunk, 1)
+        if len(data) < len(chunk):
+            data = ZLIB + data
+        else:
+            data = RAW + bytes(chunk)
+        path = self.chunkpath(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as fd:
+            fd.write(data)
+        os.replace(tmp, path)
+        # gc only deletes chunks of the index, the file is not one yet
+        with self.transaction():
+            self._db.execute('INSERT OR IGNORE INTO chunks VALUES (?, ?, ?)',
+                             (digest, len(chunk), len(data)))
+            if backup is not None:
+                self._db.execute('INSERT OR IGNORE INTO refs VALUES (?, ?)', (backup, digest))
+        return digest, len(data)
+
+    def get(self, digest):
+        with open(self.chunkpath(digest), 'rb') as fd:
+            data = fd.read()
+        if data[:1] == ZLIB:
+            return zlib.decompress(data[1:])
+        return data[1:]
+
+    def gc(self, backup_path, log):
+        """Drop references of removed backups and delete chunks without
+        references, backups putting chunks wait for the end of gc
+        Returns:
+            tuple of chunks and bytes freed
+        """
+        with self.transaction():
+            backups = [row[0] for row in self._db.execute('SELECT DISTINCT backup FROM refs')]
+            gone = [b for b in backups if not os.path.isdir(os.path.join(backup_path, b))]
+            self._db.executemany('DELETE FROM refs WHERE backup = ?', ((b,) for b in gone))
+            unused = self._db.execute('SELECT hash, stored FROM chunks WHERE hash NOT IN '
+                                      '(SELECT hash FROM refs)').fetchall()
+            self._db.executemany('DELETE FROM chunks WHERE hash = ?', ((d,) for d, _ in unused))
+            freed = 0
+            for digest, stored in unused:
+                try:
+                    os.remove(self.chunkpath(digest))
+                except FileNotFoundError:
+                    log.warning('Chunk {} already removed'.format(digest))
+                freed += stored
+        log.info('Removed references of {} backups, freed {} chunks and {} bytes'.format(
+            len(gone), len(unused), freed))
+        return len(unused), freed
+
+
+def storedisk(store, device, manifest_file, chunk_size=CHUNK_SIZE, hasher=None, limiter=None, backup=None):
+    """Split device in chunks, store new chunks and write the manifest
+    Parameters:
+        backup: name of backup referencing the chunks
+        hasher: checksum.Hasher fed with the chunks as they are read
+        limiter: ratelimit.Limiter charged for the chunks read
+    Returns:
+        tuple of disk size, digests of chunks and bytes written to the store
+    """
+    size = helpers.devicesize(device)
+    zero = bytes(chunk_size)
+    digests = []
+    written = 0
+    buf = bytearray(chunk_size)
+    with imagetransfer.opendisk(device) as src:
+        while True:
+            length = src.readinto(buf)
+            if not length:
+                break
+            chunk = memoryview(buf)[:length]
+            if limiter is not None:
+                limiter.take(length)
+            if hasher is not None:
+                hasher.update(chunk)
+            if zero.startswith(chunk):
+                digests.append(None)
+                continue
+            digest, stored = store.put(chunk, backup)
+            digests.append(digest)
+            written += stored
+    with open(manifest_file, 'w') as fd:
+        json.dump({'size': size, 'chunk_size': chunk_size, 'chunks': digests}, fd)
+    return size, digests, written
+
+
+def rebuilddisk(store, manifest_file, raw_file):
+    """Write sparse raw image of a disk from its manifest"""
+    with open(manifest_file) as fd:
+        manifest = json.load(fd)
+    with open(raw_file, 'wb') as dst:
+        dst.truncate(manifest['size'])
+        for index, digest in enumerate(manifest['chunks']):
+            if digest is None:
+                continue
+            dst.seek(index * manifest['chunk_size'])
+            dst.write(store.get(digest))
+
+
+class ChunkConverter:
+    """Converter for helpers.qemuconvert storing disks in the chunk store
+    Parameters:
+        store: ChunkStore
+        backup: name of backup directory
+    """
+
+    def __init__(self, store, backup):
+        self.store = store
+        self.backup = backup
+        self.disks = {}
+        self.checksums = {}
+
+    def __call__(self, event_id, uuid, device, path, dbg, logging, clickecho, progress=False, limiter=None):
+        if not helpers.waitdevice(device):
+            logging.error(
+                '[{}] Device {} not found for disk {}'.format(event_id, device, uuid))
+            return 1
+        logging.info('[{}] Storing chunks of uuid {}, device {}'.format(
+            event_id, uuid, device))
+        if dbg:
+            clickecho.echo('[{}] Storing chunks of uuid {}, device {}'.format(
+                event_id, uuid, device))
+        manifest_file = path + uuid + SUFFIX
+        hasher = checksum.Hasher(uuid)
+        try:
+            size, digests, written = storedisk(self.store, device, manifest_file, hasher=hasher, limiter=limiter,
+                                               backup=self.backup)
+        except (OSError, sqlite3.Error) as e:
+            logging.error('[{}] Error storing device {}: {}'.format(event_id, device, e))
+            return 1
+        self.disks[uuid] = {'size': size, 'chunks': len(digests), 'written': written}
+        self.checksums[uuid] = hasher.result()
+        logging.info('[{}] Stored {} chunks of disk {}, {} new bytes'.format(
+            event_id, len(digests), uuid, written))
+        return 0
+
+
+def rebuild(basedir, backup_path, log, e_id):
+    """Rebuild raw images of a chunked backup
+    Returns:
+        list of raw images written, None on error
+    """
+    store = ChunkStore(backup_path)
+    raws = []
+    try:
+        for manifest in Path(basedir).glob('*' + SUFFIX):
+            raw_file = manifest.with_suffix('.raw').as_posix()
+            rebuilddisk(store, manifest.as_posix(), raw_file)
+            raws.append(raw_file)
+            log.info('[{}] Rebuilt disk {} from chunks'.format(e_id, manifest.stem))
+    except (OSError, ValueError, zlib.error) as e:
+        log.error('[{}] Error rebuilding chunked backup: {}'.format(e_id, e))
+        return None
+    finally:
+        store.close()
+    return raws
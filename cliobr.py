@@ -1,26 +1,36 @@
+import atexit
+import json
 import logging
 import os
-import re
-import shutil
-import subprocess
-import time
 import random
 from pathlib import Path
-from time import sleep
 
 import click
-import ovirtsdk4 as sdk
-import ovirtsdk4.types as types
 import platform
 from click_shell import shell
 
+import agents
+import catalog
+import chunkstore
+import daemon
+import directio
 import helpers
+import imagetransfer
+import jobs
+import journal
+import offload
+import ratelimit
+import seekable
+import sparse
+import verify
 
 FORMAT = '%(asctime)s %(levelname)s %(message)s'
 AgentVM = platform.node()
-Description = 'cli-ovirt-backup'
+Description = jobs.Description
 VERSION = '0.8.5'
 ONERROR = 0
+# API sessions of the shell, reused by the next commands
+SESSIONS = {}
 
 
 def print_version(ctx, param, value):
@@ -30,6 +40,101 @@ def print_version(ctx, param, value):
     ctx.exit()
 
 
+def check_limit(ctx, param, value):
+    try:
+        ratelimit.parselimit(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
+
+
+def check_level(codec, level):
+    """Check --compression-level against the levels of the codec of
+    --compression"""
+    try:
+        helpers.checklevel(codec, level)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="'--compression-level'")
+
+
+def configure_limits(agent_limit, limit_profile, ionice, cgroup):
+    """Apply the options shared by every job of the process"""
+    try:
+        ratelimit.configure(agent_limit, limit_profile, ionice, cgroup)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    except OSError as e:
+        raise click.UsageError('Error setting I/O priority or cgroup: {}'.format(e))
+
+
+def check_size(ctx, param, value):
+    for size in value if isinstance(value, tuple) else [value]:
+        try:
+            if size:
+                directio.parsesize(size)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
+def configure_io(direct_io, io_block_size, io_depth, readahead, qemu_cache, qemu_aio):
+    """Set the I/O engine of the copies of the process"""
+    try:
+        directio.configure(direct_io, io_block_size, io_depth, readahead, qemu_cache, qemu_aio)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+def check_agents(ctx, param, value):
+    for spec in value:
+        name, sep, listen = spec.partition('=')
+        if not name or not sep or ':' not in listen:
+            raise click.BadParameter('{} is not NAME=HOST:PORT'.format(spec))
+    return value
+
+
+def agent_pool(api_session, agent_specs, slots, token=None, ca_file=None):
+    """Return agents.Pool of the agent of this host and the agents of
+    --agent, None without --agent, their daemons need token"""
+    if not agent_specs:
+        return None
+    system_service = api_session.system_service()
+    inventory = api_session.inventory()
+    members = [agents.Agent(api_session.agent(), slots,
+                            agents.locality(system_service, inventory, api_session.agent()))]
+    for spec in agent_specs:
+        name, _, listen = spec.partition('=')
+        vm = inventory.vm(name)
+        if vm is None:
+            raise click.UsageError('Agent virtual machine {} not found'.format(name))
+        members.append(agents.Agent(vm, slots, agents.locality(system_service, inventory, vm),
+                                    daemon.taskrunner(listen, token=token, ca_file=ca_file)))
+    logging.info('Pool of agents {}'.format(', '.join(agent.name for agent in members)))
+    return agents.Pool(members)
+
+
+def configure_offload(url, access_key, secret_key, region, workers=offload.WORKERS, keep=0):
+    """Set the bucket of the archives, UsageError for an invalid url or
+    missing keys"""
+    if url and not (access_key and secret_key):
+        raise click.UsageError('--offload needs --offload-access-key and --offload-secret-key')
+    try:
+        offload.configure(url, access_key, secret_key, region, workers, keep)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+def session(api, username, password, ca, debug):
+    """Return API session for the credentials, connecting on first use"""
+    key = (api, username, password, ca)
+    if key not in SESSIONS:
+        SESSIONS[key] = daemon.Session(api, username, password, ca, debug, AgentVM)
+        atexit.register(SESSIONS[key].close)
+    else:
+        SESSIONS[key].check()
+    return SESSIONS[key]
+
+
 # @click.group()
 @shell(prompt='cliobr => ', intro='Starting cliobr shell...')
 @click.option('--version', '-v', is_flag=True, callback=print_version, expose_value=False, is_eager=True)
@@ -59,17 +164,117 @@ def cli():
 )
 @click.option('--debug', '-d', is_flag=True, default=False, help='debug mode')
 @click.option('--unarchive', '-n', is_flag=True, default=False, help='archive backup')
-def backup(username, password, ca, vmname, api, debug, backup_path, log, unarchive):
+@click.option('--stream', '-S', is_flag=True, default=False, help='copy disks straight into the archive without raw files')
+@click.option(
+    '--incremental', '-i', 'incremental_chain', type=click.IntRange(min=0), default=0, show_default=True,
+    help='copy only blocks changed since the last backup, with a full backup after this number of incremental backups, 0 for full backups'
+)
+@click.option('--dedup', '-D', is_flag=True, default=False, help='store disks in the deduplicated chunk store of backup path')
+@click.option(
+    '--abandon-failed', is_flag=True, default=False,
+    help='abandon the failed backups of the vm instead of keeping them to resume, see cleanup --abandon'
+)
+@click.option(
+    '--prometheus-dir', envvar='OVIRTPROMDIR', type=click.Path(exists=True, file_okay=False), help='directory of node exporter textfile collector for job metrics'
+)
+@click.option(
+    '--compression', '-z', envvar='OVIRTCOMPRESSION', type=click.Choice(sorted(helpers.CODECS)), default='gzip', show_default=True, help='compression codec of archive'
+)
+@click.option('--compression-level', type=click.IntRange(min=1), help='compression level, default of codec if not set')
+@click.option(
+    '--compression-threads', type=click.IntRange(min=0), default=0, show_default=True, help='compression threads, 0 for all cores'
+)
+@click.option(
+    '--disk-format', envvar='OVIRTDISKFORMAT', type=click.Choice(sparse.FORMATS), default=sparse.RAW, show_default=True,
+    help='store disks as raw images or as sparse images with only their data'
+)
+@click.option(
+    '--workers', '-w', envvar='OVIRTWORKERS', type=click.IntRange(min=1), default=4, show_default=True, help='disks converted at the same time'
+)
+@click.option(
+    '--storage-workers', envvar='OVIRTSDWORKERS', type=click.IntRange(min=0), default=2, show_default=True, help='disks converted at the same time per storage domain, 0 for no limit'
+)
+@click.option(
+    '--disk-limit', envvar='OVIRTDISKLIMIT', callback=check_limit, help='bandwidth and IOPS of each disk as RATE[,IOPS], e.g. 50M,1000'
+)
+@click.option(
+    '--job-limit', envvar='OVIRTJOBLIMIT', callback=check_limit, help='bandwidth and IOPS of the job as RATE[,IOPS], e.g. 200M'
+)
+@click.option(
+    '--agent-limit', envvar='OVIRTAGENTLIMIT', callback=check_limit, help='bandwidth and IOPS of every job together as RATE[,IOPS]'
+)
+@click.option(
+    '--limit-profile', multiple=True, help='agent limit for a time of day as HH:MM-HH:MM=RATE[,IOPS], can be repeated'
+)
+@click.option(
+    '--ionice', envvar='OVIRTIONICE', help='I/O class of copies and subprocesses: idle, best-effort[:LEVEL] or realtime[:LEVEL]'
+)
+@click.option(
+    '--cgroup', envvar='OVIRTCGROUP', type=click.Path(file_okay=False), help='cgroup v2 directory limiting the devices read and written by subprocesses'
+)
+@click.option(
+    '--direct-io', envvar='OVIRTDIRECTIO', is_flag=True, default=False, help='read disks with O_DIRECT and keep the copies out of the page cache of the agent'
+)
+@click.option(
+    '--io-block-size', envvar='OVIRTIOBLOCKSIZE', callback=check_size, help='size of the reads of disks and images as SIZE, see io-bench, 8M if not set'
+)
+@click.option(
+    '--io-depth', envvar='OVIRTIODEPTH', type=click.IntRange(min=1), help='reads in flight per disk and coroutines of qemu-img, 2 reads and the qemu-img default if not set'
+)
+@click.option('--readahead', callback=check_size, help='read-ahead of the devices read as SIZE, unchanged if not set')
+@click.option(
+    '--qemu-cache', type=click.Choice(directio.QEMU_CACHES), help='cache mode of the devices read by qemu-img, none with --direct-io if not set'
+)
+@click.option('--qemu-aio', type=click.Choice(directio.QEMU_AIOS), help='aio of the devices read by qemu-img')
+@click.option(
+    '--backend', envvar='OVIRTBACKEND', type=click.Choice(imagetransfer.BACKENDS), default=imagetransfer.ATTACH, show_default=True,
+    help='read disks attached to the agent or from image transfers of the manager'
+)
+@click.option(
+    '--transfer-connections', type=click.IntRange(min=1), default=imagetransfer.CONNECTIONS, show_default=True,
+    help='connections reading each disk of an image transfer'
+)
+@click.option(
+    '--agent', 'agent_specs', multiple=True, callback=check_agents,
+    help='agent vm copying disks too as NAME=HOST:PORT of its daemon, the backup path is shared, can be repeated'
+)
+@click.option(
+    '--agent-slots', type=click.IntRange(min=1), default=8, show_default=True, help='disks attached to each agent of --agent and to this agent'
+)
+@click.option('--token', envvar='OVIRTTOKEN', help='token of the daemons of --agent')
+@click.option(
+    '--tls-ca', type=click.Path(exists=True, dir_okay=False), help='CA certificate of the daemons of --agent, connect with HTTPS when set'
+)
+@click.option(
+    '--offload', 'offload_url', envvar='OVIRTOFFLOAD', help='bucket of an S3 compatible storage for a copy of the archives as https://HOST/BUCKET[/PREFIX]'
+)
+@click.option('--offload-access-key', envvar='AWS_ACCESS_KEY_ID', help='access key of the offload bucket')
+@click.option('--offload-secret-key', envvar='AWS_SECRET_ACCESS_KEY', help='secret key of the offload bucket')
+@click.option(
+    '--offload-region', envvar='AWS_DEFAULT_REGION', default='us-east-1', show_default=True, help='region of the offload bucket'
+)
+@click.option(
+    '--offload-workers', type=click.IntRange(min=1), default=offload.WORKERS, show_default=True, help='parts of an archive uploaded at the same time'
+)
+@click.option(
+    '--offload-keep', type=click.IntRange(min=0), default=0, show_default=True,
+    help='newest backups of each vm kept in the backup path once uploaded, with their parents, 0 to keep all'
+)
+def backup(username, password, ca, vmname, api, debug, backup_path, log, unarchive, stream, incremental_chain, dedup,
+           abandon_failed, prometheus_dir, compression,
+           compression_level, compression_threads, disk_format, workers, storage_workers, disk_limit, job_limit,
+           agent_limit, limit_profile, ionice, cgroup, direct_io, io_block_size, io_depth, readahead, qemu_cache,
+           qemu_aio, backend, transfer_connections, agent_specs, agent_slots, token, tls_ca,
+           offload_url, offload_access_key, offload_secret_key, offload_region, offload_workers, offload_keep):
+    check_level(compression, compression_level)
     logging.basicConfig(level=logging.DEBUG, format=FORMAT,
                         filename=log)
-    connection = sdk.Connection(
-        url=api,
-        username=username,
-        password=password,
-        ca_file=ca,
-        debug=debug,
-        log=logging.getLogger(),
-    )
+    configure_limits(agent_limit, limit_profile, ionice, cgroup)
+    configure_io(direct_io, io_block_size, io_depth, readahead, qemu_cache, qemu_aio)
+    configure_offload(offload_url, offload_access_key, offload_secret_key, offload_region, offload_workers, offload_keep)
+    imagetransfer.CA_FILE = ca
+    imagetransfer.CONNECTIONS = transfer_connections
+    api_session = session(api, username, password, ca, debug)
 
     # id for event in virt manager
     event_id = random.randrange(1, 10**8)
@@ -79,43 +284,14 @@ def backup(username, password, ca, vmname, api, debug, backup_path, log, unarchi
         click.echo('[{}] Connected to the server.'.format(event_id))
 
     # Get the reference to the root of the services tree:
-    system_service = connection.system_service()
-
-    # Get the reference to the service that we will use to send events to
-    # the audit log:
-    events_service = system_service.events_service()
+    system_service = api_session.system_service()
 
-    # Get the reference to the service that manages the virtual machines:
-    vms_service = system_service.vms_service()
-
-    vm = helpers.vmobj(vms_service, vmname)
-
-    message = (
-        '[{}] Backup of virtual machine \'{}\' using snapshot \'{}\' is '
-        'starting.'.format(event_id, vm.name, Description)
-    )
-    helpers.send_events(events_service, event_id,
-                        types, Description, message, vm)
-
-    timestamp = time.strftime("%Y%m%d%H%M%S")
-    backup_path_obj = Path(backup_path)
-    backup_name_obj = Path(vmname + '-' + timestamp + '-' + vm.id)
-    vm_backup_obj = backup_path_obj / backup_name_obj
-    vm_backup_absolute = vm_backup_obj.absolute().as_posix()
-
-    if not backup_path_obj.exists():
-        logging.error("[{}] Mount point {} not exists".format(
-            event_id, backup_path_obj.name))
+    vm = api_session.inventory().vm(vmname)
+    if vm is None:
+        logging.error('[{}] Virtual machine \'{}\' not found'.format(event_id, vmname))
         exit(1)
 
-    logging.info(
-        '[{}] Found data virtual machine \'{}\', the id is \'{}\'.'.format(
-            event_id, vm.name, vm.id)
-    )
-    if debug:
-        click.echo(
-            '[{}] Found data virtual machine \'{}\', the id is \'{}\'.'.format(event_id, vmname, vm.id))
-    vmAgent = helpers.vmobj(vms_service, AgentVM)
+    vmAgent = api_session.agent()
     logging.info(
         '[{}] Found agent virtual machine \'{}\', the id is \'{}\'.'.format(event_id,
                                                                             vmAgent.name, vmAgent.id)
@@ -124,118 +300,202 @@ def backup(username, password, ca, vmname, api, debug, backup_path, log, unarchi
         click.echo(
             '[{}] Found agent virtual machine \'{}\', the id is \'{}\'.'.format(event_id, vmAgent.name, vmAgent.id))
 
-    helpers.createdir(vm_backup_absolute)
-    logging.info('[{}] Creating directory {}.'.format(
-        event_id, vm_backup_absolute))
-    if debug:
-        click.echo('[{}] Creating directory {}.'.format(
-            event_id, vm_backup_absolute))
-    # Find the services that manage the data and agent virtual machines:
-    data_vm_service = vms_service.vm_service(vm.id)
-    agent_vm_service = vms_service.vm_service(vmAgent.id)
-
-    ovf_file = helpers.writeconfig(vm, vm_backup_absolute + '/')
-    logging.info('[{}] Wrote OVF to file \'{}\''.format(event_id, ovf_file))
-    if debug:
-        click.echo('[{}] Wrote OVF to file \'{}\''.format(event_id, ovf_file))
+    ONERROR = jobs.backupvm(system_service, vm, vmAgent, backup_path, event_id, debug,
+                            unarchive=unarchive, stream=stream, incremental_chain=incremental_chain, dedup=dedup,
+                            prometheus_dir=prometheus_dir,
+                            codec=compression, level=compression_level,
+                            threads=compression_threads, workers=workers, storage_workers=storage_workers,
+                            disk_limit=disk_limit, job_limit=job_limit, backend=backend, disk_format=disk_format,
+                            pool=agent_pool(api_session, agent_specs, agent_slots, token, tls_ca),
+                            abandon_failed=abandon_failed)
 
-    snaps_service = data_vm_service.snapshots_service()
+    exit(ONERROR)
 
-    snap = helpers.createsnapshot(snaps_service, types, Description)
-    logging.info('[{}] Sent request to create snapshot \'{}\', the id is \'{}\'.'.format(
-        event_id, snap.description, snap.id))
-    if debug:
-        click.echo('[{}] Sent request to create snapshot \'{}\', the id is \'{}\'.'.format(
-            event_id, snap.description, snap.id))
-
-    snap_service = snaps_service.snapshot_service(snap.id)
-    helpers.waitingsnapshot(snap, types, logging, time,
-                            snap_service, click, debug, event_id)
-
-    # Retrieve the descriptions of the disks of the snapshot:
-    snap_disks_service = snap_service.disks_service()
-    snap_disks = snap_disks_service.list()
-
-    # Attach disk service
-    attachments_service = agent_vm_service.disk_attachments_service()
-
-    attachments = helpers.populateattachments(
-        snap_disks, snap, attachments_service, types, logging, click, debug)
-
-    for attach in attachments:
-        logging.info(
-            '[{}] Attached disk \'{}\' to the agent virtual machine.'.format(
-                event_id, attach.disk.id)
-        )
-        if debug:
-            click.echo(
-                '[{}] Attached disk \'{}\' to the agent virtual machine.'.format(
-                    event_id, attach.disk.id)
-            )
-
-    devices = {}
-    for i in range(len(attachments)):
-        devices[attachments[i].disk.id] = '/dev/backup/' + \
-            attachments[i].disk.id
-
-    ONERROR = helpers.qemuconvert(event_id, devices,
-                                  vm_backup_absolute + '/', debug, logging, click)
-
-    for attach in attachments:
-        attachment_service = attachments_service.attachment_service(attach.id)
-        attachment_service.remove()
-        logging.info(
-            '[{}] Detached disk \'{}\' to from the agent virtual machine.'.format(event_id, attach.disk.id))
-        if debug:
-            click.echo(
-                '[{}] Detached disk \'{}\' to from the agent virtual machine.'.format(
-                    event_id, attach.disk.id)
-            )
-    # Remove the snapshot:
-    snap_service.remove()
-    logging.info('[{}] Removed the snapshot \'{}\'.'.format(
-        event_id, snap.description))
+
+@cli.command('backup-batch')
+@click.argument('vmnames', nargs=-1)
+@click.option(
+    '--username', '-u', envvar='OVIRTUSER', default='admin@internal', show_default=True, help='username for oVirt API'
+)
+@click.option(
+    '--password', '-p', envvar='OVIRTPASS', required=True, help='password for oVirt user'
+)
+@click.option(
+    '--ca', '-c', envvar='OVIRTCA', required=True, type=click.Path(), help='path for ca certificate of Manager'
+)
+@click.option(
+    '--api', '-a', envvar='OVIRTURL', required=True, help='url for oVirt API https://manager.example.com/ovirt-engine/api'
+)
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+@click.option('--search', '-q', help='oVirt search query of virtual machines, e.g. "cluster=prod"')
+@click.option('--tag', '-t', help='backup virtual machines with tag')
+@click.option('--debug', '-d', is_flag=True, default=False, help='debug mode')
+@click.option('--unarchive', '-n', is_flag=True, default=False, help='archive backup')
+@click.option('--stream', '-S', is_flag=True, default=False, help='copy disks straight into the archive without raw files')
+@click.option(
+    '--incremental', '-i', 'incremental_chain', type=click.IntRange(min=0), default=0, show_default=True,
+    help='copy only blocks changed since the last backup, with a full backup after this number of incremental backups, 0 for full backups'
+)
+@click.option('--dedup', '-D', is_flag=True, default=False, help='store disks in the deduplicated chunk store of backup path')
+@click.option(
+    '--abandon-failed', is_flag=True, default=False,
+    help='abandon the failed backups of the vm instead of keeping them to resume, see cleanup --abandon'
+)
+@click.option(
+    '--prometheus-dir', envvar='OVIRTPROMDIR', type=click.Path(exists=True, file_okay=False), help='directory of node exporter textfile collector for job metrics'
+)
+@click.option(
+    '--compression', '-z', envvar='OVIRTCOMPRESSION', type=click.Choice(sorted(helpers.CODECS)), default='gzip', show_default=True, help='compression codec of archive'
+)
+@click.option('--compression-level', type=click.IntRange(min=1), help='compression level, default of codec if not set')
+@click.option(
+    '--compression-threads', type=click.IntRange(min=0), default=0, show_default=True, help='compression threads, 0 for all cores'
+)
+@click.option(
+    '--disk-format', envvar='OVIRTDISKFORMAT', type=click.Choice(sparse.FORMATS), default=sparse.RAW, show_default=True,
+    help='store disks as raw images or as sparse images with only their data'
+)
+@click.option(
+    '--jobs', '-j', 'max_jobs', type=click.IntRange(min=1), default=4, show_default=True, help='virtual machines in progress at the same time'
+)
+@click.option(
+    '--workers', '-w', envvar='OVIRTWORKERS', type=click.IntRange(min=1), default=4, show_default=True, help='disks converted at the same time per virtual machine'
+)
+@click.option(
+    '--storage-workers', envvar='OVIRTSDWORKERS', type=click.IntRange(min=0), default=2, show_default=True, help='disks converted at the same time per storage domain, 0 for no limit'
+)
+@click.option('--max-snapshots', type=click.IntRange(min=1), default=2, show_default=True, help='snapshots created at the same time')
+@click.option('--max-attachments', type=click.IntRange(min=1), default=8, show_default=True, help='disks attached to the agent at the same time')
+@click.option('--max-disks', type=click.IntRange(min=1), default=8, show_default=True, help='disks converted at the same time')
+@click.option('--max-archives', type=click.IntRange(min=1), default=2, show_default=True, help='archives written at the same time')
+@click.option(
+    '--disk-limit', envvar='OVIRTDISKLIMIT', callback=check_limit, help='bandwidth and IOPS of each disk as RATE[,IOPS], e.g. 50M,1000'
+)
+@click.option(
+    '--job-limit', envvar='OVIRTJOBLIMIT', callback=check_limit, help='bandwidth and IOPS of the job as RATE[,IOPS], e.g. 200M'
+)
+@click.option(
+    '--agent-limit', envvar='OVIRTAGENTLIMIT', callback=check_limit, help='bandwidth and IOPS of every job together as RATE[,IOPS]'
+)
+@click.option(
+    '--limit-profile', multiple=True, help='agent limit for a time of day as HH:MM-HH:MM=RATE[,IOPS], can be repeated'
+)
+@click.option(
+    '--ionice', envvar='OVIRTIONICE', help='I/O class of copies and subprocesses: idle, best-effort[:LEVEL] or realtime[:LEVEL]'
+)
+@click.option(
+    '--cgroup', envvar='OVIRTCGROUP', type=click.Path(file_okay=False), help='cgroup v2 directory limiting the devices read and written by subprocesses'
+)
+@click.option(
+    '--direct-io', envvar='OVIRTDIRECTIO', is_flag=True, default=False, help='read disks with O_DIRECT and keep the copies out of the page cache of the agent'
+)
+@click.option(
+    '--io-block-size', envvar='OVIRTIOBLOCKSIZE', callback=check_size, help='size of the reads of disks and images as SIZE, see io-bench, 8M if not set'
+)
+@click.option(
+    '--io-depth', envvar='OVIRTIODEPTH', type=click.IntRange(min=1), help='reads in flight per disk and coroutines of qemu-img, 2 reads and the qemu-img default if not set'
+)
+@click.option('--readahead', callback=check_size, help='read-ahead of the devices read as SIZE, unchanged if not set')
+@click.option(
+    '--qemu-cache', type=click.Choice(directio.QEMU_CACHES), help='cache mode of the devices read by qemu-img, none with --direct-io if not set'
+)
+@click.option('--qemu-aio', type=click.Choice(directio.QEMU_AIOS), help='aio of the devices read by qemu-img')
+@click.option(
+    '--backend', envvar='OVIRTBACKEND', type=click.Choice(imagetransfer.BACKENDS), default=imagetransfer.ATTACH, show_default=True,
+    help='read disks attached to the agent or from image transfers of the manager'
+)
+@click.option(
+    '--transfer-connections', type=click.IntRange(min=1), default=imagetransfer.CONNECTIONS, show_default=True,
+    help='connections reading each disk of an image transfer'
+)
+@click.option(
+    '--agent', 'agent_specs', multiple=True, callback=check_agents,
+    help='agent vm copying disks too as NAME=HOST:PORT of its daemon, the backup path is shared, can be repeated'
+)
+@click.option(
+    '--agent-slots', type=click.IntRange(min=1), default=8, show_default=True, help='disks attached to each agent of --agent and to this agent'
+)
+@click.option('--token', envvar='OVIRTTOKEN', help='token of the daemons of --agent')
+@click.option(
+    '--tls-ca', type=click.Path(exists=True, dir_okay=False), help='CA certificate of the daemons of --agent, connect with HTTPS when set'
+)
+@click.option(
+    '--offload', 'offload_url', envvar='OVIRTOFFLOAD', help='bucket of an S3 compatible storage for a copy of the archives as https://HOST/BUCKET[/PREFIX]'
+)
+@click.option('--offload-access-key', envvar='AWS_ACCESS_KEY_ID', help='access key of the offload bucket')
+@click.option('--offload-secret-key', envvar='AWS_SECRET_ACCESS_KEY', help='secret key of the offload bucket')
+@click.option(
+    '--offload-region', envvar='AWS_DEFAULT_REGION', default='us-east-1', show_default=True, help='region of the offload bucket'
+)
+@click.option(
+    '--offload-workers', type=click.IntRange(min=1), default=offload.WORKERS, show_default=True, help='parts of an archive uploaded at the same time'
+)
+@click.option(
+    '--offload-keep', type=click.IntRange(min=0), default=0, show_default=True,
+    help='newest backups of each vm kept in the backup path once uploaded, with their parents, 0 to keep all'
+)
+def backup_batch(username, password, ca, vmnames, api, debug, backup_path, log, search, tag, unarchive, stream,
+                 incremental_chain, dedup, abandon_failed, prometheus_dir, compression, compression_level, compression_threads,
+                 disk_format, max_jobs,
+                 workers, storage_workers, max_snapshots, max_attachments, max_disks, max_archives, disk_limit,
+                 job_limit, agent_limit, limit_profile, ionice, cgroup, direct_io, io_block_size, io_depth,
+                 readahead, qemu_cache, qemu_aio, backend, transfer_connections, agent_specs,
+                 agent_slots, token, tls_ca, offload_url, offload_access_key, offload_secret_key, offload_region,
+                 offload_workers, offload_keep):
+    check_level(compression, compression_level)
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    configure_limits(agent_limit, limit_profile, ionice, cgroup)
+    configure_io(direct_io, io_block_size, io_depth, readahead, qemu_cache, qemu_aio)
+    configure_offload(offload_url, offload_access_key, offload_secret_key, offload_region, offload_workers, offload_keep)
+    imagetransfer.CA_FILE = ca
+    imagetransfer.CONNECTIONS = transfer_connections
+    if not vmnames and not search and not tag:
+        raise click.UsageError('Give virtual machine names, --search or --tag')
+    if not Path(backup_path).exists():
+        logging.error("Mount point {} not exists".format(backup_path))
+        exit(1)
+
+    # One connection for all jobs, requests of the jobs are serialized
+    api_session = session(api, username, password, ca, debug)
+    logging.info('Connected to the server.')
     if debug:
-        click.echo('[{}] Removed the snapshot \'{}\'.'.format(
-            event_id, snap.description))
-
-    if not unarchive:
-        logging.info('[{}] Archiving \'{}\' in \'{}.tar.gz\''.format(
-            event_id, vm_backup_absolute, vm_backup_absolute))
-        # making archiving
-        ONERROR = helpers.make_archive(backup_path, vm_backup_absolute,
-                                       debug, event_id, logging)
-
-        if debug:
-            click.echo('[{}] Archiving \'{}\' in \'{}.tar.gz\''.format(
-                event_id, vm_backup_absolute, vm_backup_absolute))
-
-    if ONERROR == 0:
-        message = (
-            '[{}] Backup of virtual machine \'{}\' using snapshot \'{}\' is '
-            'completed.'.format(event_id, vm.name, Description)
-        )
-        helpers.send_events(events_service, event_id + 1,
-                            types, Description, message, vm)
-        logging.info(message)
-        if debug:
-            click.echo(message)
-    else:
-        message = (
-            '[{}] Backup of virtual machine \'{}\' terminating with return code \'{}\''.format(
-                event_id, vm.name, ONERROR)
-        )
-        helpers.send_events(events_service, event_id + 1,
-                            types, Description, message, vm)
-        logging.info(message)
-        if debug:
-            click.echo(message)
-    # Finish the connection to the VM Manager
-    connection.close()
-    logging.info('[{}] Disconnected to the server.'.format(event_id))
+        click.echo('Connected to the server.')
+
+    system_service = api_session.system_service()
+    vms_service = api_session.vms_service()
+
+    vmAgent = api_session.agent()
+    vms = helpers.vmsearch(vms_service, vmnames, search, tag, api_session.inventory())
+    vms = [vm for vm in vms if vm.id != vmAgent.id]
+    logging.info('Backup of {} virtual machines with {} jobs'.format(
+        len(vms), max_jobs))
     if debug:
-        click.echo('[{}] Disconnected to the server.'.format(event_id))
-    exit(ONERROR)
+        click.echo('Backup of {} virtual machines with {} jobs'.format(
+            len(vms), max_jobs))
+
+    limits = jobs.Limits(snapshots=max_snapshots, attachments=max_attachments,
+                         disks=max_disks, archives=max_archives)
+    results = jobs.backupbatch(system_service, vms, vmAgent, backup_path, debug, max_jobs, limits,
+                               unarchive=unarchive, stream=stream, incremental_chain=incremental_chain, dedup=dedup,
+                               prometheus_dir=prometheus_dir, codec=compression, level=compression_level,
+                               threads=compression_threads, workers=workers, storage_workers=storage_workers,
+                               disk_limit=disk_limit, job_limit=job_limit, backend=backend, disk_format=disk_format,
+                               pool=agent_pool(api_session, agent_specs, agent_slots, token, tls_ca),
+                               abandon_failed=abandon_failed)
+
+    failed = [name for name, code in results.items() if code != 0]
+    message = 'Batch backup finished, {} of {} virtual machines failed{}'.format(
+        len(failed), len(results), ': ' + ', '.join(failed) if failed else '')
+    logging.info(message)
+    click.echo(message)
+
+    exit(1 if failed else 0)
 
 
 @cli.command()
@@ -262,35 +522,81 @@ def backup(username, password, ca, vmname, api, debug, backup_path, log, unarchi
     '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-restore.log', show_default=True, help='path log file'
 )
 @click.option('--debug', '-d', is_flag=True, default=False, help='debug mode')
-def restore(username, password, file, ca, api, storage_domain, log, debug, cluster):
+@click.option(
+    '--workers', '-w', envvar='OVIRTWORKERS', type=click.IntRange(min=1), default=4, show_default=True, help='disks restored at the same time'
+)
+@click.option('--stream', '-S', is_flag=True, default=False, help='write disks straight from the archive without extracting it')
+@click.option(
+    '--disk-timeout', type=click.IntRange(min=1), default=3600, show_default=True, help='seconds to wait for the creation of disks'
+)
+@click.option(
+    '--prometheus-dir', envvar='OVIRTPROMDIR', type=click.Path(exists=True, file_okay=False), help='directory of node exporter textfile collector for job metrics'
+)
+@click.option('--disk', 'disk_ids', multiple=True, help='restore only this disk id without the vm, can be repeated')
+@click.option(
+    '--disk-limit', envvar='OVIRTDISKLIMIT', callback=check_limit, help='bandwidth and IOPS of each disk as RATE[,IOPS], e.g. 50M,1000'
+)
+@click.option(
+    '--job-limit', envvar='OVIRTJOBLIMIT', callback=check_limit, help='bandwidth and IOPS of the job as RATE[,IOPS], e.g. 200M'
+)
+@click.option(
+    '--agent-limit', envvar='OVIRTAGENTLIMIT', callback=check_limit, help='bandwidth and IOPS of every job together as RATE[,IOPS]'
+)
+@click.option(
+    '--limit-profile', multiple=True, help='agent limit for a time of day as HH:MM-HH:MM=RATE[,IOPS], can be repeated'
+)
+@click.option(
+    '--ionice', envvar='OVIRTIONICE', help='I/O class of copies and subprocesses: idle, best-effort[:LEVEL] or realtime[:LEVEL]'
+)
+@click.option(
+    '--cgroup', envvar='OVIRTCGROUP', type=click.Path(file_okay=False), help='cgroup v2 directory limiting the devices read and written by subprocesses'
+)
+@click.option(
+    '--direct-io', envvar='OVIRTDIRECTIO', is_flag=True, default=False, help='read disks with O_DIRECT and keep the copies out of the page cache of the agent'
+)
+@click.option(
+    '--io-block-size', envvar='OVIRTIOBLOCKSIZE', callback=check_size, help='size of the reads of disks and images as SIZE, see io-bench, 8M if not set'
+)
+@click.option(
+    '--io-depth', envvar='OVIRTIODEPTH', type=click.IntRange(min=1), help='reads in flight per disk and coroutines of qemu-img, 2 reads and the qemu-img default if not set'
+)
+@click.option('--readahead', callback=check_size, help='read-ahead of the devices read as SIZE, unchanged if not set')
+@click.option(
+    '--qemu-cache', type=click.Choice(directio.QEMU_CACHES), help='cache mode of the devices read by qemu-img, none with --direct-io if not set'
+)
+@click.option('--qemu-aio', type=click.Choice(directio.QEMU_AIOS), help='aio of the devices read by qemu-img')
+@click.option(
+    '--agent', 'agent_specs', multiple=True, callback=check_agents,
+    help='agent vm copying disks too as NAME=HOST:PORT of its daemon, the backup path is shared, can be repeated'
+)
+@click.option(
+    '--agent-slots', type=click.IntRange(min=1), default=8, show_default=True, help='disks attached to each agent of --agent and to this agent'
+)
+@click.option('--token', envvar='OVIRTTOKEN', help='token of the daemons of --agent')
+@click.option(
+    '--tls-ca', type=click.Path(exists=True, dir_okay=False), help='CA certificate of the daemons of --agent, connect with HTTPS when set'
+)
+@click.option(
+    '--offload', 'offload_url', envvar='OVIRTOFFLOAD', help='bucket of an S3 compatible storage for a copy of the archives as https://HOST/BUCKET[/PREFIX]'
+)
+@click.option('--offload-access-key', envvar='AWS_ACCESS_KEY_ID', help='access key of the offload bucket')
+@click.option('--offload-secret-key', envvar='AWS_SECRET_ACCESS_KEY', help='secret key of the offload bucket')
+@click.option(
+    '--offload-region', envvar='AWS_DEFAULT_REGION', default='us-east-1', show_default=True, help='region of the offload bucket'
+)
+def restore(username, password, file, ca, api, storage_domain, log, debug, cluster, workers, stream, disk_timeout,
+            prometheus_dir, disk_ids, disk_limit, job_limit, agent_limit, limit_profile, ionice, cgroup, direct_io,
+            io_block_size, io_depth, readahead, qemu_cache, qemu_aio, agent_specs, agent_slots, token, tls_ca,
+            offload_url, offload_access_key, offload_secret_key, offload_region):
 
     logging.basicConfig(level=logging.DEBUG, format=FORMAT,
                         filename=log)
-    connection = sdk.Connection(
-        url=api,
-        username=username,
-        password=password,
-        ca_file=ca,
-        debug=debug,
-        log=logging.getLogger(),
-    )
-    # oVirt Services API
-    #
-    #
-    #
-    #
-    # Get the reference to the root of the services tree:
-    system_service = connection.system_service()
-
-    # Get the reference to the service that we will use to send events to
-    # the audit log:
-    events_service = system_service.events_service()
-    # Get the reference to the disks services:
-    disks_service = system_service.disks_service()
-    # Get the reference to the service that manages the virtual machines:
-    vms_service = system_service.vms_service()
-
-    vmAgent = helpers.vmobj(vms_service, AgentVM)
+    configure_limits(agent_limit, limit_profile, ionice, cgroup)
+    configure_io(direct_io, io_block_size, io_depth, readahead, qemu_cache, qemu_aio)
+    configure_offload(offload_url, offload_access_key, offload_secret_key, offload_region)
+    api_session = session(api, username, password, ca, debug)
+    system_service = api_session.system_service()
+    vmAgent = api_session.agent()
 
     # id for event in virt manager
     event_id = random.randrange(1, 10**8)
@@ -299,228 +605,547 @@ def restore(username, password, file, ca, api, storage_domain, log, debug, clust
     if debug:
         click.echo('[{}] Connected to the server.'.format(event_id))
 
-    p = Path(file)
+    ONERROR = jobs.restorevm(system_service, vmAgent, file, storage_domain, cluster, event_id, debug,
+                             workers=workers, stream=stream, disk_timeout=disk_timeout,
+                             prometheus_dir=prometheus_dir, inventory=api_session.inventory(),
+                             disk_ids=list(disk_ids), disk_limit=disk_limit, job_limit=job_limit,
+                             pool=agent_pool(api_session, agent_specs, agent_slots, token, tls_ca))
+    exit(ONERROR)
 
-    if not p.exists():
-        logging.error("[{}] File backup {} not exists".format(
-            event_id, p.name))
-        exit(1)
 
-    # Get absolute path of restore "file" variable
-    tar_file = p.absolute().as_posix()
-    # Get full path of parent related to "file" variable
-    parent_path = p.absolute().parent.as_posix()
+@cli.command()
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+def gc(backup_path, log):
+    """Remove chunks not used by any backup of the chunk store"""
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    store = chunkstore.ChunkStore(backup_path)
+    try:
+        chunks, freed = store.gc(backup_path, logging)
+    finally:
+        store.close()
+    click.echo('Removed {} chunks, freed {} bytes'.format(chunks, freed))
 
-    basedir = tar_file.split('.tar.gz')[0]
-    xml_file = ''
 
-    basedir_obj = Path(basedir)
+@cli.command('io-bench')
+@click.argument('devices', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--block-size', 'block_sizes', multiple=True, callback=check_size, help='block size to read as SIZE, can be repeated, 256K to 16M if not set'
+)
+@click.option(
+    '--depth', 'depths', multiple=True, type=click.IntRange(min=1), help='reads in flight to try, can be repeated, 1 to 8 if not set'
+)
+@click.option('--sample', default='256M', show_default=True, callback=check_size, help='bytes read for each block size and depth')
+def io_bench(devices, block_sizes, depths, sample):
+    """Read the devices attached to the agent, or DEVICES, with several
+    block sizes and depths and print the fastest --io-block-size and
+    --io-depth"""
+    if not devices:
+        devices = [os.path.join(helpers.DEVICE_PATH, name) for name in sorted(os.listdir(helpers.DEVICE_PATH))] \
+            if os.path.isdir(helpers.DEVICE_PATH) else []
+        if not devices:
+            raise click.ClickException('No device in {}, attach a disk or give a device'.format(helpers.DEVICE_PATH))
+    sizes = [directio.parsesize(size) for size in block_sizes] or directio.BLOCK_SIZES
+    if any(size % directio.ALIGNMENT for size in sizes):
+        raise click.UsageError('block sizes must be multiples of {}'.format(directio.ALIGNMENT))
+    for device in devices:
+        try:
+            results = directio.probe(device, sizes, depths or directio.DEPTHS, directio.parsesize(sample))
+        except (OSError, ValueError) as e:
+            raise click.ClickException('Error reading {}: {}'.format(device, e))
+        click.echo('{} ({})'.format(device, 'O_DIRECT' if results[0]['direct'] else 'page cache dropped'))
+        for result in results:
+            click.echo('{:>10} {:>6} {:>10.1f} MiB/s'.format(
+                directio.formatsize(result['block_size']), result['depth'], result['rate'] / 2**20))
+        click.echo('Fastest: --io-block-size {} --io-depth {}'.format(
+            directio.formatsize(results[0]['block_size']), results[0]['depth']))
 
-    vm_name = re.sub(r"\-.*$", '', basedir_obj.name)
 
-    message = (
-        '[{}] Restore of virtual machine \'{}\' using file \'{}\' is '
-        'starting.'.format(event_id, vm_name, tar_file)
-    )
+@cli.command()
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('member', required=False)
+@click.option('--offset', type=click.IntRange(min=0), default=0, show_default=True, help='first byte of member to read')
+@click.option('--length', type=click.IntRange(min=0), help='bytes to read, to the end of member if not set')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='file to write, standard output if not set')
+def extract(file, member, offset, length, output):
+    """List members of a seekable archive or read a byte range of a member
+    without decompressing the archive"""
+    try:
+        reader = seekable.Reader(file)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    with reader:
+        if member is None:
+            for name, (_, size, *disk) in sorted(reader.members.items()):
+                # a GNU sparse member is listed with the size of its disk
+                click.echo('{:>14} {}'.format(disk[0] if disk else size, name))
+            return
+        try:
+            src = reader.open(member)
+        except KeyError as e:
+            raise click.ClickException(e.args[0])
+        src.seek(offset)
+        if length is None:
+            length = max(0, src.size - offset)
+        with click.open_file(output or '-', 'wb') as dst:
+            while length > 0:
+                chunk = src.read(min(length, 8 * 2**20))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                length -= len(chunk)
+
+
+@cli.command('list')
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option('--vm', help='show only backups of virtual machine')
+@click.option('--since', help='show only backups newer than YYYYmmdd[HHMMSS]')
+@click.option('--limit', type=click.IntRange(min=1), help='backups shown')
+@click.option('--failed', is_flag=True, default=False, help='show failed jobs to resume instead of backups')
+def list_backups(backup_path, vm, since, limit, failed):
+    """List backups of the catalog, newest first"""
+    if failed:
+        for job_journal in journal.journals(backup_path):
+            click.echo('{:<8} {:<14} {:>3}/{:<3} {}'.format(
+                job_journal.get('kind'), job_journal.get('updated'), len(job_journal.done()),
+                len(job_journal.get('sizes') or job_journal.get('created') or ()), job_journal.name))
+        return
+    backup_catalog = catalog.Catalog(backup_path)
+    try:
+        backups = backup_catalog.list(vm, since, limit)
+    finally:
+        backup_catalog.close()
+    for backup in backups:
+        click.echo('{:<20} {:<14} {:<11} {:<5} {:>12} {}'.format(
+            backup['vm'], backup['timestamp'], backup['kind'], backup['codec'] or '-',
+            backup['size'] if backup['size'] is not None else '-', backup['file']))
+
+
+@cli.command('show')
+@click.argument('name')
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+def show_backup(name, backup_path):
+    """Show backup of the catalog by name or file"""
+    backup_catalog = catalog.Catalog(backup_path)
+    try:
+        backup = backup_catalog.get(Path(name).name)
+    finally:
+        backup_catalog.close()
+    if backup is None:
+        raise click.ClickException('Backup {} not found in catalog'.format(name))
+    click.echo(json.dumps(backup, indent=2))
+
+
+@cli.command('prune')
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+@click.option('--vm', help='prune only backups of virtual machine')
+@click.option('--keep-last', type=click.IntRange(min=0), default=0, show_default=True, help='newest backups kept')
+@click.option('--keep-daily', type=click.IntRange(min=0), default=0, show_default=True, help='days kept with their newest backup')
+@click.option('--keep-weekly', type=click.IntRange(min=0), default=0, show_default=True, help='weeks kept with their newest backup')
+@click.option('--keep-monthly', type=click.IntRange(min=0), default=0, show_default=True, help='months kept with their newest backup')
+@click.option('--dry-run', '-N', is_flag=True, default=False, help='show backups to remove without removing them')
+@click.option(
+    '--offload', 'offload_url', envvar='OVIRTOFFLOAD', help='bucket of an S3 compatible storage for a copy of the archives as https://HOST/BUCKET[/PREFIX]'
+)
+@click.option('--offload-access-key', envvar='AWS_ACCESS_KEY_ID', help='access key of the offload bucket')
+@click.option('--offload-secret-key', envvar='AWS_SECRET_ACCESS_KEY', help='secret key of the offload bucket')
+@click.option(
+    '--offload-region', envvar='AWS_DEFAULT_REGION', default='us-east-1', show_default=True, help='region of the offload bucket'
+)
+def prune_backups(backup_path, log, vm, keep_last, keep_daily, keep_weekly, keep_monthly, dry_run, offload_url,
+                  offload_access_key, offload_secret_key, offload_region):
+    """Remove backups of the catalog outside of the retention, parents of
+    kept incremental backups are kept, with their archive in the offload
+    bucket"""
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    configure_offload(offload_url, offload_access_key, offload_secret_key, offload_region)
+    if not any((keep_last, keep_daily, keep_weekly, keep_monthly)):
+        raise click.UsageError('Give at least one of --keep-last, --keep-daily, --keep-weekly or --keep-monthly')
+    backup_catalog = catalog.Catalog(backup_path)
+    try:
+        removed = catalog.prune(backup_catalog, backup_path, logging, vm, dry_run, keep_last=keep_last,
+                                keep_daily=keep_daily, keep_weekly=keep_weekly, keep_monthly=keep_monthly)
+    finally:
+        backup_catalog.close()
+    for backup in removed:
+        click.echo('{} {}'.format('Would remove' if dry_run else 'Removed', backup['file']))
+    click.echo('{} {} backups'.format('Would remove' if dry_run else 'Removed', len(removed)))
 
-    logging.info(message)
-    if debug:
-        click.echo(message)
-
-    helpers.send_events(events_service, event_id,
-                        types, Description, message)
-
-    if not basedir_obj.exists():
-        logging.info("[{}] File {} is compressed".format(event_id, tar_file))
-        if debug:
-            click.echo("[{}] File {} is compressed".format(event_id, tar_file))
-        # Getting name of extracted directory
-        logging.info('[{}] Init descompress'.format(event_id))
-        if debug:
-            click.echo('[{}] Init descompress'.format(event_id))
-
-        ONERROR = helpers.unpack_archive(
-            tar_file, parent_path, logging, event_id)
-
-        logging.info('[{}] Finish decompress'.format(event_id))
-        if debug:
-            click.echo('[{}] Finish decompress'.format(event_id))
-
-    qcow_disks = []
-
-    if basedir_obj.exists():
-        for f in basedir_obj.glob('**/*.ovf'):
-            xml_file = Path(f).absolute().as_posix()
-        logging.info('[{}] Configuration file is [{}]'.format(
-            event_id, xml_file))
-        if debug:
-            click.echo('[{}] Configuration file is [{}]'.format(
-                event_id, xml_file))
-        for qcow in basedir_obj.glob('**/*.raw'):
-            qcow_disks.append(qcow.absolute().as_posix())
-    else:
-        logging.info('failed to decompress')
-        exit(1)
 
-    ovf, ovf_str = helpers.ovf_parse(xml_file)
+@cli.command()
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+def reindex(backup_path, log):
+    """Add backups of the backup path missing in the catalog"""
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    backup_catalog = catalog.Catalog(backup_path)
+    try:
+        added = catalog.scan(backup_catalog, backup_path, logging)
+    finally:
+        backup_catalog.close()
+    click.echo('Added {} backups to the catalog'.format(added))
+
 
-    disks = []  # disks attachments
-    namespace = '{http://schemas.dmtf.org/ovf/envelope/1/}'
+@cli.command('verify')
+@click.argument('files', nargs=-1, type=click.Path(exists=True))
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+@click.option('--vm', help='verify only backups of virtual machine when no file is given')
+@click.option('--since', help='verify only backups newer than YYYYmmdd[HHMMSS] when no file is given')
+@click.option('--workers', '-w', type=click.IntRange(min=0), default=0, show_default=True, help='disks or archives read at the same time, 0 for all cores')
+def verify_backups(files, backup_path, log, vm, since, workers):
+    """Check backups against the checksums of their disks, the backups of
+    the catalog when no file is given"""
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    if not files:
+        backup_catalog = catalog.Catalog(backup_path)
+        try:
+            # backups only kept in the offload bucket are not read
+            files = [os.path.join(backup_path, backup['file']) for backup in backup_catalog.list(vm, since)
+                     if os.path.exists(os.path.join(backup_path, backup['file']))]
+        finally:
+            backup_catalog.close()
+    results = verify.verifybackups(files, logging, workers)
+    for path, uuid, status, message in results:
+        click.echo('{:<7} {} {} {}'.format(status, Path(path).name, uuid or '-', message))
+    failed = sum(1 for result in results if result[2] == verify.FAILED)
+    click.echo('Verified {} backups, {} disks failed'.format(len(files), failed))
+    exit(1 if failed else 0)
 
-    metadata = []
-    metas = {}
-    elements = ["boot", "volume-format", "diskId",
-                "disk-alias", "disk-description", "size", "fileRef", "parentRef"]
 
-    logging.info('[{}] Extracting ovf data'.format(event_id))
-    if debug:
-        click.echo('[{}] Extracting ovf data'.format(event_id))
-    for disk in ovf.iter('Disk'):
-        for element in elements:
-            if element == 'size':
-                metas[str(element)] = int(disk.get(namespace+element)) * 2**30
-            elif element == 'fileRef':
-                metas[str(element)] = str(
-                    disk.get(namespace+element)).split("/")[0]
-                metas[str(element)+'_image'] = str(
-                    disk.get(namespace+element)).split("/")[1]
-            else:
-                metas[str(element)] = disk.get(namespace+element)
-        metadata.append(metas.copy())
-
-    logging.info('[{}] Defining disks'.format(event_id))
-    if debug:
-        click.echo('[{}] Defining disks'.format(event_id))
-    for meta in metadata:
-        if meta["parentRef"]:
+@cli.command()
+@click.argument('names', nargs=-1, required=True)
+@click.option(
+    '--username', '-u', envvar='OVIRTUSER', default='admin@internal', show_default=True, help='username for oVirt API'
+)
+@click.option(
+    '--password', '-p', envvar='OVIRTPASS', required=True, help='password for oVirt user'
+)
+@click.option(
+    '--ca', '-c', envvar='OVIRTCA', required=True, type=click.Path(), help='path for ca certificate of Manager'
+)
+@click.option(
+    '--api', '-a', envvar='OVIRTURL', required=True, help='url for oVirt API https://manager.example.com/ovirt-engine/api'
+)
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+@click.option('--debug', '-d', is_flag=True, default=False, help='debug mode')
+@click.option(
+    '--transfer-connections', type=click.IntRange(min=1), default=imagetransfer.CONNECTIONS, show_default=True,
+    help='connections reading each disk of an image transfer'
+)
+@click.option(
+    '--offload', 'offload_url', envvar='OVIRTOFFLOAD', help='bucket of an S3 compatible storage for a copy of the archives as https://HOST/BUCKET[/PREFIX]'
+)
+@click.option('--offload-access-key', envvar='AWS_ACCESS_KEY_ID', help='access key of the offload bucket')
+@click.option('--offload-secret-key', envvar='AWS_SECRET_ACCESS_KEY', help='secret key of the offload bucket')
+@click.option(
+    '--offload-region', envvar='AWS_DEFAULT_REGION', default='us-east-1', show_default=True, help='region of the offload bucket'
+)
+@click.option(
+    '--offload-workers', type=click.IntRange(min=1), default=offload.WORKERS, show_default=True, help='parts of an archive uploaded at the same time'
+)
+@click.option(
+    '--offload-keep', type=click.IntRange(min=0), default=0, show_default=True,
+    help='newest backups of each vm kept in the backup path once uploaded, with their parents, 0 to keep all'
+)
+def resume(names, username, password, ca, api, backup_path, log, debug, transfer_connections, offload_url,
+           offload_access_key, offload_secret_key, offload_region, offload_workers, offload_keep):
+    """Resume failed backups and restores with the options they were
+    started with, see list --failed"""
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    configure_offload(offload_url, offload_access_key, offload_secret_key, offload_region, offload_workers, offload_keep)
+    imagetransfer.CA_FILE = ca
+    imagetransfer.CONNECTIONS = transfer_connections
+    api_session = session(api, username, password, ca, debug)
+    system_service = api_session.system_service()
+    vmAgent = api_session.agent()
+
+    ONERROR = 0
+    for name in names:
+        # id for event in virt manager
+        event_id = random.randrange(1, 10**8)
+        job_journal = journal.find(backup_path, name)
+        if job_journal is None:
+            logging.error('[{}] Failed job \'{}\' not found in {}'.format(event_id, name, backup_path))
+            click.echo('Failed job \'{}\' not found in {}'.format(name, backup_path), err=True)
+            ONERROR = 1
             continue
-        logging.info('[{}] Defining disk {} with image {} and size {}'.format(
-            event_id, meta['fileRef'], meta['fileRef_image'], meta['size']))
-
-        if debug:
-            click.echo('[{}] Defining disk {}'.format(
-                event_id, meta['fileRef']))
-        if meta['volume-format'] == 'COW':
-            disk_format = types.DiskFormat.COW
-            sparse = True
-        else:
-            disk_format = types.DiskFormat.RAW
-            sparse = False
-        if meta['boot']:
-            boot = True
-        new_disk = disks_service.add(
-            disk=types.Disk(
-                id=meta['fileRef'],
-                name=meta['disk-alias'],
-                description=meta['disk-description'],
-                format=disk_format,
-                provisioned_size=meta['size'],
-                storage_domains=[
-                    types.StorageDomain(name=storage_domain)
-                ],
-                bootable=boot,
-                image_id=meta['fileRef_image'],
-                sparse=sparse
-            )
-        )
-
-        disk_service = disks_service.disk_service(new_disk.id)
-        while disk_service.get().status != types.DiskStatus.OK:
-            time.sleep(5)
-            logging.info('[{}] Waiting till the disk is created, the satus is \'{}\'.'.format(event_id,
-                                                                                              disk_service.get().status))
-            if debug:
-                click.echo('[{}] Waiting till the disk is created, the satus is \'{}\'.'.format(event_id,
-                                                                                                disk_service.get().status))
-        disks.append(new_disk)
-
-    # Init copy data process
-    # data_vm_service = vms_service.vm_service(vm.id)
-    agent_vm_service = vms_service.vm_service(vmAgent.id)
-    # Attach disk service
-    agent_disks_attachment = agent_vm_service.disk_attachments_service()
-    attachments = []
-    for disk in disks:
-        attach = agent_disks_attachment.add(
-            attachment=types.DiskAttachment(
-                disk=types.Disk(
-                    id=disk.id
-                ),
-                active=True,
-                bootable=False,
-                interface=types.DiskInterface.VIRTIO_SCSI,
-            ),
-        )
-        attachments.append(attach)
-        logging.info(
-            '[{}] Attached disk \'{}\' to the agent virtual machine.'.format(
-                event_id, attach.disk.id)
-        )
-        if debug:
-            click.echo(
-                '[{}] Attached disk \'{}\' to the agent virtual machine.'.format(
-                    event_id, attach.disk.id)
-            )
-
-    devices = {}
-    for i in range(len(attachments)):
-        device = '/dev/backup/' + attachments[i].disk.id
-        fileqcow = qcow_disks[i]
-        if attachments[i].disk.id in fileqcow:
-            devices[fileqcow] = device
-        else:
-            i -= 1
-
-    for path, device in devices.items():
-        logging.info('[{}] Waiting 10s for convert'.format(event_id))
-        sleep(10)
-        logging.info('[{}] Converting file {}, device {}'.format(
-            event_id, path, device))
-        ONERROR = helpers.restoredata(device, path, debug)
-        if ONERROR != 0:
-            logging.error(
-                '[{}] Error unpacking file errcode: {}'.format(event_id, ONERROR))
-
-    for attach in attachments:
-        attachment_service = agent_disks_attachment.attachment_service(
-            attach.id)
-        attachment_service.remove()
-        logging.info(
-            '[{}] Detached disk \'{}\' to from the agent virtual machine.'.format(event_id, attach.disk.id))
-        if debug:
-            click.echo(
-                '[{}] Detached disk \'{}\' to from the agent virtual machine.'.format(
-                    event_id, attach.disk.id)
-            )
-    vm = vms_service.add(
-        types.Vm(
-            cluster=types.Cluster(
-                name=cluster,
-            ),
-            initialization=types.Initialization(
-                configuration=types.Configuration(
-                    type=types.ConfigurationType.OVF,
-                    data=ovf_str
-                )
-            ),
-        ),
-    )
-
-    if ONERROR == 0:
-        shutil.rmtree(basedir_obj.absolute().as_posix())
-        message = ('[{}] Restore of virtual machine \'{}\' using file \'{}\' is completed.'.format(
-            event_id, vm_name, tar_file))
-        helpers.send_events(events_service, event_id + 1,
-                            types, Description, message)
-        logging.info(message)
-        if debug:
-            click.echo(message)
-    else:
-        message = ('[{}] Restore of vm: {} terminate with return code \'{}\''.format(
-            event_id, vm.name, ONERROR))
-        helpers.send_events(events_service, event_id + 1,
-                            types, Description, message)
-        logging.info(message)
-        if debug:
-            click.echo(message)
+        ONERROR = jobs.resumejob(system_service, vmAgent, backup_path, job_journal, event_id, debug,
+                                 inventory=api_session.inventory()) or ONERROR
     exit(ONERROR)
+
+
+@cli.command()
+@click.option(
+    '--username', '-u', envvar='OVIRTUSER', default='admin@internal', show_default=True, help='username for oVirt API'
+)
+@click.option(
+    '--password', '-p', envvar='OVIRTPASS', required=True, help='password for oVirt user'
+)
+@click.option(
+    '--ca', '-c', envvar='OVIRTCA', required=True, type=click.Path(), help='path for ca certificate of Manager'
+)
+@click.option(
+    '--api', '-a', envvar='OVIRTURL', required=True, help='url for oVirt API https://manager.example.com/ovirt-engine/api'
+)
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+@click.option('--abandon', is_flag=True, default=False, help='undo the failed jobs too, they can not be resumed anymore')
+@click.option(
+    '--older-than', type=click.IntRange(min=0), default=24, show_default=True, help='hours since the creation of an orphaned snapshot before it is removed'
+)
+@click.option('--dry-run', '-N', is_flag=True, default=False, help='show what would be done without doing it')
+def cleanup(username, password, ca, api, backup_path, log, abandon, older_than, dry_run):
+    """Detach disks left attached to the agent by failed jobs and remove
+    backup snapshots without a job to resume"""
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    api_session = session(api, username, password, ca, False)
+    actions = jobs.cleanup(api_session.system_service(), api_session.agent(), backup_path, logging,
+                           abandon=abandon, older_than=older_than * 3600, dry_run=dry_run)
+    for action in actions:
+        click.echo('{}{}'.format('Would: ' if dry_run else '', action))
+    click.echo('{} {} actions'.format('Would do' if dry_run else 'Done', len(actions)))
+
+
+@cli.command('daemon')
+@click.option(
+    '--username', '-u', envvar='OVIRTUSER', default='admin@internal', show_default=True, help='username for oVirt API'
+)
+@click.option(
+    '--password', '-p', envvar='OVIRTPASS', required=True, help='password for oVirt user'
+)
+@click.option(
+    '--ca', '-c', envvar='OVIRTCA', required=True, type=click.Path(), help='path for ca certificate of Manager'
+)
+@click.option(
+    '--api', '-a', envvar='OVIRTURL', required=True, help='url for oVirt API https://manager.example.com/ovirt-engine/api'
+)
+@click.option(
+    '--backup-path', '-b', envvar='BACKUPPATH', type=click.Path(exists=True), default='/ovirt-backup', show_default=True, help='path of backups'
+)
+@click.option(
+    '--log', '-l', envvar='OVIRTLOG', type=click.Path(), default='/var/log/cli-ovirt-backup.log', show_default=True, help='path log file'
+)
+@click.option('--debug', '-d', is_flag=True, default=False, help='debug mode')
+@click.option(
+    '--listen', envvar='OVIRTLISTEN', default='/run/cliobr.sock', show_default=True, help='unix socket path or host:port of the job API'
+)
+@click.option('--queue', type=click.Path(dir_okay=False), help='job queue database, <backup-path>/.queue.db if not set')
+@click.option('--storage-domain', '-s', envvar='OVIRTSD', help='default storage domain of restore jobs')
+@click.option('--cluster', '-C', envvar='OVIRTCLUSTER', help='default cluster of restore jobs')
+@click.option(
+    '--jobs', '-j', 'max_jobs', type=click.IntRange(min=1), default=4, show_default=True, help='jobs in progress at the same time'
+)
+@click.option('--max-snapshots', type=click.IntRange(min=1), default=2, show_default=True, help='snapshots created at the same time')
+@click.option('--max-attachments', type=click.IntRange(min=1), default=8, show_default=True, help='disks attached to the agent at the same time')
+@click.option('--max-disks', type=click.IntRange(min=1), default=8, show_default=True, help='disks converted at the same time')
+@click.option('--max-archives', type=click.IntRange(min=1), default=2, show_default=True, help='archives written at the same time')
+@click.option(
+    '--inventory-ttl', type=click.IntRange(min=0), default=300, show_default=True, help='seconds before vms, disks and storage domains are listed again'
+)
+@click.option(
+    '--disk-limit', envvar='OVIRTDISKLIMIT', callback=check_limit, help='bandwidth and IOPS of each disk by default as RATE[,IOPS], e.g. 50M,1000'
+)
+@click.option(
+    '--job-limit', envvar='OVIRTJOBLIMIT', callback=check_limit, help='bandwidth and IOPS of each job as RATE[,IOPS] by default'
+)
+@click.option(
+    '--agent-limit', envvar='OVIRTAGENTLIMIT', callback=check_limit, help='bandwidth and IOPS of every job together as RATE[,IOPS]'
+)
+@click.option(
+    '--limit-profile', multiple=True, help='agent limit for a time of day as HH:MM-HH:MM=RATE[,IOPS], can be repeated'
+)
+@click.option(
+    '--ionice', envvar='OVIRTIONICE', help='I/O class of copies and subprocesses: idle, best-effort[:LEVEL] or realtime[:LEVEL]'
+)
+@click.option(
+    '--cgroup', envvar='OVIRTCGROUP', type=click.Path(file_okay=False), help='cgroup v2 directory limiting the devices read and written by subprocesses'
+)
+@click.option(
+    '--direct-io', envvar='OVIRTDIRECTIO', is_flag=True, default=False, help='read disks with O_DIRECT and keep the copies out of the page cache of the agent'
+)
+@click.option(
+    '--io-block-size', envvar='OVIRTIOBLOCKSIZE', callback=check_size, help='size of the reads of disks and images as SIZE, see io-bench, 8M if not set'
+)
+@click.option(
+    '--io-depth', envvar='OVIRTIODEPTH', type=click.IntRange(min=1), help='reads in flight per disk and coroutines of qemu-img, 2 reads and the qemu-img default if not set'
+)
+@click.option('--readahead', callback=check_size, help='read-ahead of the devices read as SIZE, unchanged if not set')
+@click.option(
+    '--qemu-cache', type=click.Choice(directio.QEMU_CACHES), help='cache mode of the devices read by qemu-img, none with --direct-io if not set'
+)
+@click.option('--qemu-aio', type=click.Choice(directio.QEMU_AIOS), help='aio of the devices read by qemu-img')
+@click.option(
+    '--backend', envvar='OVIRTBACKEND', type=click.Choice(imagetransfer.BACKENDS), default=imagetransfer.ATTACH, show_default=True,
+    help='read disks attached to the agent or from image transfers of the manager'
+)
+@click.option(
+    '--transfer-connections', type=click.IntRange(min=1), default=imagetransfer.CONNECTIONS, show_default=True,
+    help='connections reading each disk of an image transfer'
+)
+@click.option(
+    '--agent', 'agent_specs', multiple=True, callback=check_agents,
+    help='agent vm copying disks too as NAME=HOST:PORT of its daemon, the backup path is shared, can be repeated'
+)
+@click.option(
+    '--agent-slots', type=click.IntRange(min=1), default=8, show_default=True, help='disks attached to each agent of --agent and to this agent'
+)
+@click.option(
+    '--token', envvar='OVIRTTOKEN', help='token of the job API and of the daemons of --agent, needed to listen on host:port'
+)
+@click.option(
+    '--tls-cert', type=click.Path(exists=True, dir_okay=False), help='certificate of the job API, HTTPS on host:port when set'
+)
+@click.option('--tls-key', type=click.Path(exists=True, dir_okay=False), help='private key of --tls-cert, in the certificate if not set')
+@click.option(
+    '--tls-ca', type=click.Path(exists=True, dir_okay=False), help='CA certificate of the daemons of --agent, connect with HTTPS when set'
+)
+@click.option(
+    '--offload', 'offload_url', envvar='OVIRTOFFLOAD', help='bucket of an S3 compatible storage for a copy of the archives as https://HOST/BUCKET[/PREFIX]'
+)
+@click.option('--offload-access-key', envvar='AWS_ACCESS_KEY_ID', help='access key of the offload bucket')
+@click.option('--offload-secret-key', envvar='AWS_SECRET_ACCESS_KEY', help='secret key of the offload bucket')
+@click.option(
+    '--offload-region', envvar='AWS_DEFAULT_REGION', default='us-east-1', show_default=True, help='region of the offload bucket'
+)
+@click.option(
+    '--offload-workers', type=click.IntRange(min=1), default=offload.WORKERS, show_default=True, help='parts of an archive uploaded at the same time'
+)
+@click.option(
+    '--offload-keep', type=click.IntRange(min=0), default=0, show_default=True,
+    help='newest backups of each vm kept in the backup path once uploaded, with their parents, 0 to keep all'
+)
+def run_daemon(username, password, ca, api, backup_path, log, debug, listen, queue, storage_domain, cluster, max_jobs,
+               max_snapshots, max_attachments, max_disks, max_archives, inventory_ttl, disk_limit, job_limit,
+               agent_limit, limit_profile, ionice, cgroup, direct_io, io_block_size, io_depth, readahead, qemu_cache,
+               qemu_aio, backend, transfer_connections, agent_specs, agent_slots, token, tls_cert, tls_key, tls_ca,
+               offload_url, offload_access_key, offload_secret_key, offload_region, offload_workers, offload_keep):
+    """Run queued backup and restore jobs with one persistent session"""
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT,
+                        filename=log)
+    configure_limits(agent_limit, limit_profile, ionice, cgroup)
+    configure_io(direct_io, io_block_size, io_depth, readahead, qemu_cache, qemu_aio)
+    configure_offload(offload_url, offload_access_key, offload_secret_key, offload_region, offload_workers, offload_keep)
+    imagetransfer.CA_FILE = ca
+    imagetransfer.CONNECTIONS = transfer_connections
+    job_queue = daemon.JobQueue(queue or str(Path(backup_path) / '.queue.db'))
+    limits = jobs.Limits(snapshots=max_snapshots, attachments=max_attachments,
+                         disks=max_disks, archives=max_archives)
+    api_session = session(api, username, password, ca, debug)
+    api_session.ttl = inventory_ttl
+    runner = daemon.Daemon(api_session, job_queue, backup_path, debug, max_jobs,
+                           limits, {'storage_domain': storage_domain, 'cluster': cluster,
+                                    'disk_limit': disk_limit, 'job_limit': job_limit, 'backend': backend},
+                           agent_pool(api_session, agent_specs, agent_slots, token, tls_ca))
+    try:
+        server = daemon.serve(listen, job_queue, backup_path, token, tls_cert, tls_key)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    except OSError as e:
+        raise click.UsageError('Error listening on {}: {}'.format(listen, e))
+    runner.start()
+    logging.info('Daemon listening on {} with {} jobs'.format(listen, max_jobs))
+    click.echo('Daemon listening on {} with {} jobs'.format(listen, max_jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        runner.stop()
+        job_queue.close()
+    logging.info('Daemon stopped')
+
+
+def option_value(value):
+    """Decode value of --option as JSON, plain strings as they are"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+@cli.command()
+@click.argument('kind', type=click.Choice(sorted(daemon.KINDS)))
+@click.argument('targets', nargs=-1, required=True)
+@click.option(
+    '--listen', envvar='OVIRTLISTEN', default='/run/cliobr.sock', show_default=True, help='unix socket path or host:port of the job API'
+)
+@click.option('--token', envvar='OVIRTTOKEN', help='token of the job API')
+@click.option(
+    '--tls-ca', type=click.Path(exists=True, dir_okay=False), help='CA certificate of the job API, connect with HTTPS when set'
+)
+@click.option('--priority', '-P', type=int, default=0, show_default=True, help='jobs with higher priority run first')
+@click.option('--option', '-o', 'options', multiple=True, help='option of the jobs as name=value, e.g. codec=zstd')
+def submit(kind, targets, listen, token, tls_ca, priority, options):
+    """Queue backup jobs of vms or restore jobs of backup files in the daemon"""
+    job_options = {}
+    for option in options:
+        name, sep, value = option.partition('=')
+        if not sep:
+            raise click.UsageError('Option {} is not name=value'.format(option))
+        job_options[name.replace('-', '_')] = option_value(value)
+    status, body = daemon.request(listen, 'POST', '/jobs', [
+        {'kind': kind, 'target': target, 'priority': priority, 'options': job_options} for target in targets],
+        token=token, ca_file=tls_ca)
+    if status != 201:
+        raise click.ClickException(body['error'])
+    click.echo('Queued jobs {}'.format(', '.join(str(job_id) for job_id in body['ids'])))
+
+
+@cli.command('queue')
+@click.option(
+    '--listen', envvar='OVIRTLISTEN', default='/run/cliobr.sock', show_default=True, help='unix socket path or host:port of the job API'
+)
+@click.option('--token', envvar='OVIRTTOKEN', help='token of the job API')
+@click.option(
+    '--tls-ca', type=click.Path(exists=True, dir_okay=False), help='CA certificate of the job API, connect with HTTPS when set'
+)
+@click.option('--state', type=click.Choice([daemon.PENDING, daemon.RUNNING, daemon.DONE, daemon.FAILED]), help='show only jobs in state')
+@click.option('--limit', type=click.IntRange(min=1), default=100, show_default=True, help='jobs shown')
+def show_queue(listen, token, tls_ca, state, limit):
+    """Show jobs of the daemon"""
+    path = '/jobs?limit={}'.format(limit) + ('&state={}'.format(state) if state else '')
+    status, body = daemon.request(listen, 'GET', path, token=token, ca_file=tls_ca)
+    if status != 200:
+        raise click.ClickException(body['error'])
+    for job in body:
+        click.echo('{:>6} {:<8} {:<8} {:>4} {} {}'.format(
+            job['id'], job['kind'], job['state'], job['priority'],
+            job['code'] if job['code'] is not None else '-', job['target']))
@@ -0,0 +1,521 @@
+import hmac
+import http.client
+import http.server
+import json
+import logging
+import os
+import random
+import socket
+import socketserver
+import sqlite3
+import ssl
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import ovirtsdk4 as sdk
+
+import agents
+import helpers
+import imagetransfer
+import inventory
+import jobs
+import ratelimit
+import sparse
+
+# Options a submitted job may set, the other arguments of the jobs come from
+# the daemon
+BACKUP_OPTIONS = {'unarchive', 'stream', 'incremental_chain', 'dedup', 'prometheus_dir', 'codec', 'level',
+                  'threads', 'workers', 'storage_workers', 'disk_limit', 'job_limit', 'backend', 'disk_format',
+                  'abandon_failed'}
+RESTORE_OPTIONS = {'storage_domain', 'cluster', 'workers', 'stream', 'disk_timeout', 'prometheus_dir', 'disk_ids',
+                   'disk_limit', 'job_limit'}
+KINDS = {'backup': BACKUP_OPTIONS, 'restore': RESTORE_OPTIONS}
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Session:
+    """API session kept open between jobs, the connection is shared by the
+    threads of the daemon and the commands of the shell
+    Parameters:
+        url: url of oVirt API
+        username: username for oVirt API
+        password: password for oVirt user
+        ca_file: path for ca certificate of Manager
+        agent_name: name of agent virtual machine
+        ttl: seconds before the inventory is listed again
+    """
+
+    def __init__(self, url, username, password, ca_file, debug=False, agent_name=None, ttl=300):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.ca_file = ca_file
+        self.debug = debug
+        self.agent_name = agent_name
+        self.ttl = ttl
+        self._connection = None
+        self._services = {}
+        self._inventory = None
+        self._agent = None
+        self._lock = threading.RLock()
+
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                self._connection = jobs.SharedConnection(
+                    url=self.url,
+                    username=self.username,
+                    password=self.password,
+                    ca_file=self.ca_file,
+                    debug=self.debug,
+                    log=logging.getLogger(),
+                )
+                logging.info('Connected to the server {}.'.format(self.url))
+            return self._connection
+
+    def service(self, name):
+        """Return cached service of the root of the services tree, e.g.
+        vms_service"""
+        with self._lock:
+            if name not in self._services:
+                self._services[name] = getattr(self.system_service(), name)()
+            return self._services[name]
+
+    def system_service(self):
+        with self._lock:
+            if 'system' not in self._services:
+                self._services['system'] = self.connection().system_service()
+            return self._services['system']
+
+    def vms_service(self):
+        return self.service('vms_service')
+
+    def inventory(self):
+        with self._lock:
+            if self._inventory is None:
+                self._inventory = inventory.Inventory(self.system_service(), self.ttl)
+            return self._inventory
+
+    def agent(self):
+        """Return vm object of the agent, resolved once per connection"""
+        with self._lock:
+            if self._agent is None:
+                self._agent = self.inventory().vm(self.agent_name)
+                if self._agent is None:
+                    raise LookupError('Agent virtual machine {} not found'.format(self.agent_name))
+            return self._agent
+
+    def check(self):
+        """Reconnect when the session is no longer valid, e.g. the SSO token
+        expired"""
+        with self._lock:
+            if self._connection is None:
+                return
+            try:
+                alive = self._connection.test()
+            except sdk.Error:
+                alive = False
+            if not alive:
+                logging.warning('Session of {} is not valid, connecting again.'.format(self.url))
+                self.close()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                try:
+                    self._connection.close()
+                except sdk.Error as e:
+                    logging.warning('Error closing connection: {}'.format(e))
+                logging.info('Disconnected to the server {}.'.format(self.url))
+            self._connection = None
+            self._services.clear()
+            self._inventory = None
+            self._agent = None
+
+
+class JobQueue:
+    """Queue of jobs kept in SQLite, pending jobs survive a restart
+    Parameters:
+        path: path of database
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS jobs '
+                             '(id INTEGER PRIMARY KEY, kind TEXT, target TEXT, options TEXT, priority INTEGER, '
+                             'state TEXT, submitted REAL, started REAL, finished REAL, code INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS pending ON jobs (state, priority DESC, id)')
+
+    def close(self):
+        self._db.close()
+
+    def submit(self, jobs_list):
+        """Add jobs to the queue
+        Parameters:
+            jobs_list: list of dict with kind, target and optional priority
+                and options
+        Returns:
+            list of job ids
+        """
+        now = time.time()
+        ids = []
+        with self._lock, self._db:
+            for job in jobs_list:
+                cursor = self._db.execute(
+                    'INSERT INTO jobs (kind, target, options, priority, state, submitted) VALUES (?, ?, ?, ?, ?, ?)',
+                    (job['kind'], job['target'], json.dumps(job.get('options', {})), job.get('priority', 0),
+                     PENDING, now))
+                ids.append(cursor.lastrowid)
+            self._ready.notify(len(ids))
+        return ids
+
+    def take(self, timeout=None):
+        """Mark the pending job with the highest priority as running, jobs
+        of a target already running wait for it
+        Returns:
+            dict of job, None after timeout
+        """
+        with self._ready:
+            while True:
+                row = self._db.execute('SELECT * FROM jobs WHERE state = ? AND target NOT IN '
+                                       '(SELECT target FROM jobs WHERE state = ?) '
+                                       'ORDER BY priority DESC, id LIMIT 1', (PENDING, RUNNING)).fetchone()
+                if row is not None:
+                    with self._db:
+                        self._db.execute('UPDATE jobs SET state = ?, started = ? WHERE id = ?',
+                                         (RUNNING, time.time(), row['id']))
+                    job = self._job(row)
+                    job['state'] = RUNNING
+                    return job
+                if not self._ready.wait(timeout):
+                    return None
+
+    def finish(self, job_id, code):
+        with self._lock, self._db:
+            self._db.execute('UPDATE jobs SET state = ?, finished = ?, code = ? WHERE id = ?',
+                             (DONE if code == 0 else FAILED, time.time(), code, job_id))
+            self._ready.notify_all()
+
+    def recover(self):
+        """Queue again the jobs left running by a stopped daemon
+        Returns:
+            number of jobs queued again
+        """
+        with self._lock, self._db:
+            count = self._db.execute('UPDATE jobs SET state = ?, started = NULL WHERE state = ?',
+                                     (PENDING, RUNNING)).rowcount
+        return count
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def list(self, state=None, limit=100):
+        with self._lock:
+            if state:
+                rows = self._db.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id DESC LIMIT ?',
+                                        (state, limit)).fetchall()
+            else:
+                rows = self._db.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    @staticmethod
+    def _job(row):
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        return job
+
+
+def checkjob(job):
+    """Return error message of an invalid job, None when it is valid"""
+    if not isinstance(job, dict):
+        return 'job must be an object'
+    if job.get('kind') not in KINDS:
+        return 'kind must be one of {}'.format(', '.join(sorted(KINDS)))
+    if not isinstance(job.get('target'), str) or not job['target']:
+        return 'target must be a vm name or backup file'
+    if not isinstance(job.get('priority', 0), int):
+        return 'priority must be an integer'
+    unknown = set(job.get('options', {})) - KINDS[job['kind']]
+    if unknown:
+        return 'unknown options for {}: {}'.format(job['kind'], ', '.join(sorted(unknown)))
+    for key in ('disk_limit', 'job_limit'):
+        try:
+            ratelimit.parselimit(job.get('options', {}).get(key))
+        except (ValueError, AttributeError) as e:
+            return '{}: {}'.format(key, e)
+    if job.get('options', {}).get('backend', imagetransfer.ATTACH) not in imagetransfer.BACKENDS:
+        return 'backend must be one of {}'.format(', '.join(imagetransfer.BACKENDS))
+    if job.get('options', {}).get('disk_format', sparse.RAW) not in sparse.FORMATS:
+        return 'disk_format must be one of {}'.format(', '.join(sparse.FORMATS))
+    codec = job.get('options', {}).get('codec', 'gzip')
+    if codec not in helpers.CODECS:
+        return 'codec must be one of {}'.format(', '.join(sorted(helpers.CODECS)))
+    try:
+        helpers.checklevel(codec, job.get('options', {}).get('level'))
+    except (ValueError, TypeError) as e:
+        return 'level: {}'.format(e)
+    return None
+
+
+class Daemon:
+    """Run queued jobs with a persistent session
+    Parameters:
+        session: Session
+        queue: JobQueue
+        backup_path: path of backups
+        max_jobs: jobs in progress at the same time
+        limits: jobs.Limits shared by the jobs
+        defaults: default options of the jobs, e.g. storage_domain
+        pool: agents.Pool shared by the jobs, None to copy the disks on the
+            agent of the session
+    """
+
+    def __init__(self, session, queue, backup_path, dbg, max_jobs, limits, defaults=None, pool=None):
+        self.session = session
+        self.queue = queue
+        self.backup_path = backup_path
+        self.dbg = dbg
+        self.max_jobs = max_jobs
+        self.limits = limits
+        self.defaults = defaults or {}
+        self.pool = pool
+        self._stop = threading.Event()
+        self._threads = []
+
+    def run(self, job):
+        event_id = random.randrange(1, 10**8)
+        options = {key: value for key, value in self.defaults.items() if key in KINDS[job['kind']]}
+        options.update(job['options'])
+        self.session.check()
+        system_service = self.session.system_service()
+        logging.info('[{}] Starting {} job {} of \'{}\''.format(event_id, job['kind'], job['id'], job['target']))
+        if job['kind'] == 'backup':
+            vm = self.session.inventory().vm(job['target'])
+            if vm is None:
+                logging.error('[{}] Virtual machine \'{}\' not found'.format(event_id, job['target']))
+                return 1
+            return jobs.backupvm(system_service, vm, self.session.agent(), self.backup_path, event_id, self.dbg,
+                                 limits=self.limits, pool=self.pool, **options)
+        storage_domain = options.pop('storage_domain', None)
+        cluster = options.pop('cluster', None)
+        if not storage_domain or not cluster:
+            logging.error('[{}] Restore job {} needs storage_domain and cluster'.format(event_id, job['id']))
+            return 1
+        return jobs.restorevm(system_service, self.session.agent(), job['target'], storage_domain, cluster,
+                              event_id, self.dbg, inventory=self.session.inventory(), pool=self.pool, **options)
+
+    def worker(self):
+        while not self._stop.is_set():
+            job = self.queue.take(timeout=1)
+            if job is None:
+                continue
+            try:
+                code = self.run(job)
+            except Exception as e:
+                logging.exception('Job {} of \'{}\' failed: {}'.format(job['id'], job['target'], e))
+                code = 1
+            self.queue.finish(job['id'], code)
+            logging.info('Job {} of \'{}\' finished with return code {}'.format(job['id'], job['target'], code))
+
+    def start(self):
+        recovered = self.queue.recover()
+        if recovered:
+            logging.info('Queued again {} interrupted jobs'.format(recovered))
+        for _ in range(self.max_jobs):
+            thread = threading.Thread(target=self.worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """HTTP API of the daemon
+
+    POST /jobs with a job or a list of jobs, GET /jobs?state=pending and
+    GET /jobs/<id>. POST /tasks runs a task of agents.runtask for the
+    coordinator of a pool and answers with its result. Requests carry the
+    token of the server as Authorization: Bearer TOKEN when it has one.
+    """
+
+    def authorized(self):
+        if self.server.token is None:
+            return True
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(token.encode('utf-8'), self.server.token.encode('utf-8')):
+            return True
+        self.reply(401, {'error': 'invalid token'})
+        return False
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts == ['jobs']:
+            query = parse_qs(url.query)
+            self.reply(200, self.server.queue.list(query.get('state', [None])[0],
+                                                   int(query.get('limit', [100])[0])))
+        elif len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            job = self.server.queue.get(int(parts[1]))
+            if job is None:
+                self.reply(404, {'error': 'job {} not found'.format(parts[1])})
+            else:
+                self.reply(200, job)
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        path = urlparse(self.path).path.strip('/')
+        if path not in ('jobs', 'tasks'):
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or 'null')
+        except ValueError as e:
+            self.reply(400, {'error': 'invalid JSON: {}'.format(e)})
+            return
+        if path == 'tasks':
+            error = agents.checktask(body, self.server.backup_path)
+            if error:
+                self.reply(400, {'error': error})
+                return
+            try:
+                self.reply(200, agents.runtask(body))
+            except (OSError, ValueError) as e:
+                logging.error('Task {} of disk {} failed: {}'.format(body['kind'], body['disk'], e))
+                self.reply(500, {'error': str(e)})
+            return
+        jobs_list = body if isinstance(body, list) else [body]
+        for job in jobs_list:
+            error = checkjob(job)
+            if error:
+                self.reply(400, {'error': error})
+                return
+        self.reply(201, {'ids': self.server.queue.submit(jobs_list)})
+
+    def address_string(self):
+        # clients of the unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logging.info('API {} {}'.format(self.address_string(), format % args))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+
+def serve(listen, queue, backup_path=None, token=None, cert_file=None, key_file=None):
+    """Return HTTP server of the API, tasks are refused without backup path
+    Parameters:
+        listen: path of a unix socket or host:port
+        token: shared secret of the clients, needed on host:port
+        cert_file: certificate of the server, HTTPS on host:port when set
+        key_file: private key of cert_file, in cert_file when not set
+    """
+    if listen.startswith('/'):
+        server = UnixHTTPServer(listen, Handler)
+    else:
+        if not token:
+            raise ValueError('listening on {} needs a token'.format(listen))
+        host, port = listen.rsplit(':', 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)), Handler)
+        if cert_file:
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            try:
+                context.load_cert_chain(cert_file, key_file)
+            except OSError:
+                server.server_close()
+                raise
+            # the handshake is done by the thread of each request
+            server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    server.queue = queue
+    server.backup_path = backup_path
+    server.token = token or None
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(listen, method, path, body=None, timeout=60, token=None, ca_file=None):
+    """Send request to the API of the daemon
+    Parameters:
+        token: token of the daemon
+        ca_file: CA certificate of the daemon, HTTPS on host:port when set
+    Returns:
+        tuple of HTTP status and decoded JSON body
+    """
+    if listen.startswith('/'):
+        connection = UnixHTTPConnection(listen, timeout)
+    else:
+        host, port = listen.rsplit(':', 1)
+        if ca_file:
+            connection = http.client.HTTPSConnection(host, int(port), timeout=timeout,
+                                                     context=ssl.create_default_context(cafile=ca_file))
+        else:
+            connection = http.client.HTTPConnection(host, int(port), timeout=timeout)
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = 'Bearer {}'.format(token)
+    try:
+        data = json.dumps(body) if body is not None else None
+        connection.request(method, path, body=data, headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or 'null')
+    finally:
+        connection.close()
+
+
+def taskrunner(listen, timeout=24 * 3600, token=None, ca_file=None):
+    """Return runner of agents.Agent sending the tasks to the daemon of the
+    agent listening on listen, see request"""
+    def run(task):
+        try:
+            status, body = request(listen, 'POST', '/tasks', task, timeout, token, ca_file)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            raise agents.AgentError('task {} of disk {} on {} failed: {}'.format(task['kind'], task['disk'], listen, e))
+        if status != 200:
+            raise agents.AgentError('task {} of disk {} on {} failed with status {}: {}'.format(
+                task['kind'], task['disk'], listen, status, body.get('error') if isinstance(body, dict) else body))
+        return body
+    return run
@@ -0,0 +1,93 @@
+import io
+import json
+import os
+
+from lxml import etree
+
+# Descriptor of a backup, the vm and disks of its OVF parsed once and written
+# as <backup>.descriptor.json next to the backup. The OVF is parsed
+# incrementally keeping only the Disk elements and the name of the vm, jobs
+# and the catalog read the descriptor instead of the OVF from then on.
+SUFFIX = '.descriptor.json'
+VERSION = 1
+NAMESPACE = '{http://schemas.dmtf.org/ovf/envelope/1/}'
+
+
+def parse(source):
+    """Return descriptor of an OVF
+    Parameters:
+        source: path or binary file object of the OVF
+    Returns:
+        dict with the name of the vm and the list of its disks, each disk
+        with its id, image, alias, description, size in bytes, format,
+        boot flag and parent image
+    """
+    vm_name = None
+    disks = []
+    for _, element in etree.iterparse(source, events=('end',), tag=('Disk', 'Name')):
+        if element.tag == 'Name':
+            if vm_name is None:
+                vm_name = element.text
+        else:
+            disk_id, _, image = (element.get(NAMESPACE + 'fileRef') or '').partition('/')
+            disks.append({
+                'id': disk_id,
+                'image': image,
+                'alias': element.get(NAMESPACE + 'disk-alias'),
+                'description': element.get(NAMESPACE + 'disk-description'),
+                'size': int(element.get(NAMESPACE + 'size')) * 2**30,
+                'format': element.get(NAMESPACE + 'volume-format'),
+                'boot': element.get(NAMESPACE + 'boot') == 'true',
+                'parent': element.get(NAMESPACE + 'parentRef') or None,
+            })
+        # only the disks are kept, not the tree
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return {'version': VERSION, 'vm': vm_name, 'disks': disks}
+
+
+def fromstring(data):
+    """Return descriptor of the OVF of a vm, data as str"""
+    return parse(io.BytesIO(data.encode('utf-8')))
+
+
+def sidecar(base):
+    """Return path of the descriptor of a backup, base is the path of the
+    backup without the archive extension"""
+    return base + SUFFIX
+
+
+def write(base, descriptor):
+    path = sidecar(base)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(descriptor, fd)
+    os.replace(tmp, path)
+    return path
+
+
+def read(base):
+    """Return descriptor of a backup, None when it is missing or of another
+    version"""
+    try:
+        with open(sidecar(base)) as fd:
+            descriptor = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    if descriptor.get('version') != VERSION:
+        return None
+    return descriptor
+
+
+def load(base, ovf_file):
+    """Return descriptor of a backup, the OVF is parsed and the descriptor
+    written when the backup has none"""
+    descriptor = read(base)
+    if descriptor is None:
+        descriptor = parse(ovf_file)
+        try:
+            write(base, descriptor)
+        except OSError:
+            pass
+    return descriptor
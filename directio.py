@@ -0,0 +1,342 @@
+import errno
+import fcntl
+import io
+import mmap
+import os
+import re
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import ratelimit
+
+# Engine reading the disks and images copied in process. Reads go in blocks
+# of BLOCK_SIZE into page aligned buffers, DEPTH reads in flight per disk on
+# threads (os.preadv releases the GIL). With DIRECT the files are opened with
+# O_DIRECT so the copies do not fill the page cache of the agent, files that
+# refuse O_DIRECT, like tmpfs, are read through the cache and dropped from it
+# after each block. Writes of restores are synced and dropped from the cache
+# every WRITE_BEHIND bytes. qemu-img reads the devices with QEMU_CACHE and
+# QEMU_AIO. probe() reads a device with several block sizes and depths.
+ALIGNMENT = 4096
+BLOCK_SIZE = 8 * 2**20
+DEPTH = None  # None for DEFAULT_DEPTH and the coroutines of qemu-img
+DEFAULT_DEPTH = 2
+DIRECT = False
+READAHEAD = None  # bytes of read-ahead of block devices, None to keep
+WRITE_BEHIND = 64 * 2**20
+QEMU_CACHES = ('none', 'directsync', 'writeback', 'writethrough', 'unsafe')
+QEMU_AIOS = ('threads', 'native', 'io_uring')
+QEMU_CACHE = None
+QEMU_AIO = None
+# qemu-img convert runs at most 16 coroutines
+QEMU_COROUTINES = 16
+BLKRASET = 0x1262
+SIZE = re.compile(r'^(?P<size>\d+)(?P<unit>[KMG]?)(?:i?B)?$', re.IGNORECASE)
+BLOCK_SIZES = (256 * 2**10, 2**20, 4 * 2**20, 8 * 2**20, 16 * 2**20)
+DEPTHS = (1, 2, 4, 8)
+
+
+def parsesize(text):
+    """Return bytes of a size with a K, M or G suffix, e.g. 4M"""
+    match = SIZE.match(text.strip())
+    if match is None:
+        raise ValueError('invalid size {}, expected SIZE like 4M'.format(text))
+    return int(match['size']) * ratelimit.UNITS[(match['unit'] or '').upper()]
+
+
+def formatsize(size):
+    for unit in ('G', 'M', 'K'):
+        if size % ratelimit.UNITS[unit] == 0:
+            return '{}{}'.format(size // ratelimit.UNITS[unit], unit)
+    return str(size)
+
+
+def configure(direct=False, block_size=None, depth=None, readahead=None, qemu_cache=None, qemu_aio=None):
+    """Set the engine of the copies of this process
+    Parameters:
+        direct: read with O_DIRECT and keep the copies out of the page cache
+        block_size: size of the reads as SIZE, a multiple of ALIGNMENT
+        depth: reads in flight per disk, and coroutines of qemu-img
+        readahead: read-ahead of the block devices read as SIZE
+        qemu_cache: cache mode of the devices read by qemu-img, none with
+            direct when not set
+        qemu_aio: aio of the devices read by qemu-img
+    """
+    global DIRECT, BLOCK_SIZE, DEPTH, READAHEAD, QEMU_CACHE, QEMU_AIO
+    if block_size:
+        size = parsesize(block_size)
+        if not size or size % ALIGNMENT:
+            raise ValueError('block size {} is not a multiple of {}'.format(block_size, ALIGNMENT))
+        BLOCK_SIZE = size
+    if depth is not None and depth < 1:
+        raise ValueError('depth must be at least 1')
+    if qemu_cache is not None and qemu_cache not in QEMU_CACHES:
+        raise ValueError('invalid qemu-img cache {}, expected one of {}'.format(qemu_cache, ', '.join(QEMU_CACHES)))
+    if qemu_aio is not None and qemu_aio not in QEMU_AIOS:
+        raise ValueError('invalid qemu-img aio {}, expected one of {}'.format(qemu_aio, ', '.join(QEMU_AIOS)))
+    if qemu_cache is None and direct:
+        qemu_cache = 'none'
+    if qemu_aio == 'native' and qemu_cache not in ('none', 'directsync'):
+        raise ValueError('qemu-img aio native needs cache none or directsync')
+    DIRECT = direct
+    DEPTH = depth
+    READAHEAD = parsesize(readahead) if readahead else None
+    QEMU_CACHE = qemu_cache
+    QEMU_AIO = qemu_aio
+
+
+def queuedepth():
+    return DEPTH or DEFAULT_DEPTH
+
+
+def qemuoptions():
+    """Return options of qemu-img convert reading the devices with the
+    cache, aio and coroutines of the engine"""
+    options = []
+    if QEMU_CACHE:
+        options += ['-T', QEMU_CACHE]
+    if DEPTH:
+        options += ['-m', str(min(DEPTH, QEMU_COROUTINES))]
+    if QEMU_AIO:
+        options.append('--image-opts')
+    return options
+
+
+def qemuimage(device):
+    """Return source image of qemu-img convert for device, see
+    qemuoptions"""
+    if QEMU_AIO:
+        return 'driver=raw,file.filename={},file.aio={}'.format(device.replace(',', ',,'), QEMU_AIO)
+    return device
+
+
+def buffer(size):
+    """Return page aligned buffer for O_DIRECT reads"""
+    return mmap.mmap(-1, size)
+
+
+def openread(path, direct=None):
+    """Open file or device for reading with the engine
+    Returns:
+        tuple of fd and True when it is read with O_DIRECT
+    """
+    if direct is None:
+        direct = DIRECT
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+        else:
+            readahead(fd)
+            return fd, True
+    fd = os.open(path, os.O_RDONLY)
+    readahead(fd)
+    advise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+    return fd, False
+
+
+def readahead(fd):
+    """Set the read-ahead of a block device to READAHEAD, the agent may
+    lack the capability"""
+    if READAHEAD is None or not stat.S_ISBLK(os.fstat(fd).st_mode):
+        return
+    try:
+        fcntl.ioctl(fd, BLKRASET, READAHEAD // 512)
+    except OSError:
+        pass
+
+
+def advise(fd, offset, length, advice):
+    if hasattr(os, advice):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def chunks(fd, extents, direct=False, block_size=None, depth=None, drop=None):
+    """Yield offset and data of the extents of a file read by the engine,
+    the data is a view of a buffer reused once the next chunk is asked
+    Parameters:
+        fd: file descriptor of openread
+        extents: list of (start, end) to read
+        direct: fd is opened with O_DIRECT, reads are aligned to ALIGNMENT
+        block_size: size of the reads, BLOCK_SIZE when not set
+        depth: reads in flight, queuedepth() when not set
+        drop: drop the data read without O_DIRECT from the page cache,
+            DIRECT when not set
+    """
+    block_size = block_size or BLOCK_SIZE
+    if direct:
+        block_size = -(-block_size // ALIGNMENT) * ALIGNMENT
+    depth = depth or queuedepth()
+    drop = DIRECT if drop is None else drop
+
+    def blocks():
+        for start, end in extents:
+            offset = start
+            while offset < end:
+                # the aligned read of a direct block fits in block_size
+                length = min(block_size - offset % ALIGNMENT if direct else block_size, end - offset)
+                yield offset, offset + length
+                offset += length
+
+    def read(buf, start, end):
+        offset = start - start % ALIGNMENT if direct else start
+        length = -(-(end - offset) // ALIGNMENT) * ALIGNMENT if direct else end - start
+        view = memoryview(buf)
+        done = 0
+        while offset + done < end:
+            count = os.preadv(fd, [view[done:length]], offset + done)
+            if not count:
+                break
+            done += count
+        if drop and not direct:
+            advise(fd, offset, done, 'POSIX_FADV_DONTNEED')
+        return view[start - offset:max(start - offset, min(done, end - offset))]
+
+    todo = blocks()
+    free = [buffer(block_size + ALIGNMENT) for _ in range(depth + 1)]
+    pending = []
+    executor = ThreadPoolExecutor(max_workers=depth) if depth > 1 else None
+    try:
+        held = None
+        while True:
+            while free and len(pending) < depth:
+                block = next(todo, None)
+                if block is None:
+                    break
+                buf = free.pop()
+                future = executor.submit(read, buf, *block) if executor is not None else None
+                pending.append((buf, block, future))
+            if not pending:
+                break
+            buf, (start, end), future = pending.pop(0)
+            data = read(buf, start, end) if future is None else future.result()
+            if len(data) < end - start:
+                raise OSError(errno.EIO, 'file ends at offset {} of extent {}-{}'.format(start + len(data), start, end))
+            if held is not None:
+                free.append(held)
+            held = buf
+            yield start, data
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+class Reader(io.RawIOBase):
+    """Unbuffered file object reading a file or device with the engine,
+    reads are filled unless the end of the file is reached
+    Parameters:
+        path: path of file or device
+        direct: read with O_DIRECT, DIRECT when not set
+    """
+
+    def __init__(self, path, direct=None):
+        self.path = path
+        self.fd = None
+        self._chunks = None
+        self._view = memoryview(b'')
+        self.fd, self.direct = openread(path, direct)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+
+    def fileno(self):
+        return self.fd
+
+    def readable(self):
+        return True
+
+    def chunks(self, extents, block_size=None):
+        """Yield offset and data of extents, see chunks()"""
+        return chunks(self.fd, extents, self.direct, block_size)
+
+    def readinto(self, buf):
+        if self._chunks is None:
+            self._chunks = self.chunks([(0, self.size)])
+        view = memoryview(buf).cast('B')
+        done = 0
+        while done < len(view):
+            if not self._view:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._view = chunk[1]
+            length = min(len(view) - done, len(self._view))
+            view[done:done + length] = self._view[:length]
+            self._view = self._view[length:]
+            done += length
+        return done
+
+    def close(self):
+        if not self.closed and self.fd is not None:
+            if self._chunks is not None:
+                self._chunks.close()
+            self._view = None
+            os.close(self.fd)
+        super().close()
+
+
+class WriteBehind:
+    """Writes of a copy synced and dropped from the page cache every
+    WRITE_BEHIND bytes with DIRECT, so a restore does not fill the cache
+    Parameters:
+        fd: file descriptor written
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.start = None
+        self.end = 0
+
+    def add(self, offset, length):
+        if not DIRECT or not length:
+            return
+        self.start = offset if self.start is None else min(self.start, offset)
+        self.end = max(self.end, offset + length)
+        if self.end - self.start >= WRITE_BEHIND:
+            self.flush()
+
+    def flush(self):
+        if self.start is None:
+            return
+        os.fdatasync(self.fd)
+        advise(self.fd, self.start, self.end - self.start, 'POSIX_FADV_DONTNEED')
+        self.start = None
+        self.end = 0
+
+
+def probe(path, block_sizes=BLOCK_SIZES, depths=DEPTHS, sample=256 * 2**20):
+    """Read a file or device with each block size and depth
+    Parameters:
+        sample: bytes read for each block size and depth, each run reads
+            another part of the device
+    Returns:
+        list of dict with block_size, depth, bytes, seconds and rate in
+        bytes per second, fastest first
+    """
+    results = []
+    fd, direct = openread(path, True)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        sample = min(sample, size - size % ALIGNMENT)
+        if not sample:
+            raise ValueError('{} is too small to probe'.format(path))
+        slots = max(size // sample, 1)
+        run = 0
+        for block_size in block_sizes:
+            for run_depth in depths:
+                start = (run % slots) * sample
+                run += 1
+                began = monotonic()
+                done = 0
+                for _, data in chunks(fd, [(start, start + sample)], direct, block_size, run_depth, True):
+                    done += len(data)
+                seconds = max(monotonic() - began, 1e-6)
+                results.append({'block_size': block_size, 'depth': run_depth, 'bytes': done,
+                                'seconds': seconds, 'rate': done / seconds, 'direct': direct})
+    finally:
+        os.close(fd)
+    return sorted(results, key=lambda result: -result['rate'])
@@ -0,0 +1,539 @@
+"""In-process stand-in of the ovirtsdk4 services used by cliobr
+
+install() puts fake ovirtsdk4 and ovirtsdk4.types modules in sys.modules, it
+must run before cliobr, jobs or helpers are imported. Attached disks show up
+as files in Engine.device_path like udev links them in /dev/backup, image
+transfers are served by a local HTTP stand-in of the imageio daemon.
+"""
+import enum
+import errno
+import http.server
+import itertools
+import json
+import os
+import re
+import random
+import sys
+import threading
+import types as pytypes
+import uuid
+from datetime import datetime
+from time import monotonic, sleep
+
+NAMESPACE = 'http://schemas.dmtf.org/ovf/envelope/1/'
+
+
+class Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+class SnapshotStatus(enum.Enum):
+    OK = 'ok'
+    LOCKED = 'locked'
+    IN_PREVIEW = 'in_preview'
+
+
+class DiskStatus(enum.Enum):
+    OK = 'ok'
+    LOCKED = 'locked'
+    ILLEGAL = 'illegal'
+
+
+class DiskInterface(enum.Enum):
+    VIRTIO_SCSI = 'virtio_scsi'
+    VIRTIO = 'virtio'
+
+
+class LogSeverity(enum.Enum):
+    NORMAL = 'normal'
+    WARNING = 'warning'
+    ERROR = 'error'
+
+
+class DiskFormat(enum.Enum):
+    COW = 'cow'
+    RAW = 'raw'
+
+
+class ConfigurationType(enum.Enum):
+    OVF = 'ovf'
+
+
+class ImageTransferDirection(enum.Enum):
+    DOWNLOAD = 'download'
+    UPLOAD = 'upload'
+
+
+class ImageTransferPhase(enum.Enum):
+    INITIALIZING = 'initializing'
+    TRANSFERRING = 'transferring'
+    FINALIZING_SUCCESS = 'finalizing_success'
+    FINISHED_SUCCESS = 'finished_success'
+    CANCELLED = 'cancelled'
+
+
+TYPES = ['Snapshot', 'Disk', 'DiskAttachment', 'Event', 'Vm', 'StorageDomain', 'Cluster',
+         'Initialization', 'Configuration', 'Tag', 'ImageTransfer', 'DiskSnapshot']
+ENUMS = [SnapshotStatus, DiskStatus, DiskInterface, LogSeverity, DiskFormat, ConfigurationType,
+         ImageTransferDirection, ImageTransferPhase]
+
+
+def makeimage(path, size, seed=0, data=0.4, zeros=0.1, text=0.2, block=2**20):
+    """Write a sparse synthetic disk image, each block is a hole, written
+    zeros, random data or compressible text by the given ratios"""
+    rnd = random.Random(seed)
+    words = b'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    text_block = (words * (block // len(words) + 1))[:block]
+    with open(path, 'wb') as fd:
+        fd.truncate(size)
+        for offset in range(0, size, block):
+            length = min(block, size - offset)
+            kind = rnd.random()
+            if kind < data:
+                chunk = rnd.randbytes(length)
+            elif kind < data + zeros:
+                chunk = bytes(length)
+            elif kind < data + zeros + text:
+                chunk = text_block[:length]
+            else:
+                continue
+            fd.seek(offset)
+            fd.write(chunk)
+
+
+def makeovf(vm_name, vm_id, disks):
+    """Return OVF of a vm with the disks, dict of disk id and size in GiB"""
+    items = []
+    for index, (disk_id, size) in enumerate(disks.items()):
+        items.append(
+            '<Disk ovf:diskId="{image}" ovf:size="{size}" ovf:actual_size="{size}" '
+            'ovf:vm_snapshot_id="{snap}" ovf:parentRef="" ovf:fileRef="{disk}/{image}" '
+            'ovf:format="http://www.vmware.com/specifications/vmdk.html#sparse" '
+            'ovf:volume-format="RAW" ovf:volume-type="Sparse" ovf:disk-interface="VirtIO_SCSI" '
+            'ovf:boot="{boot}" ovf:pass-discard="false" ovf:disk-alias="{name}_Disk{n}" '
+            'ovf:disk-description="" ovf:wipe-after-delete="false"/>'.format(
+                image=uuid.uuid4(), size=size, snap=uuid.uuid4(), disk=disk_id,
+                boot='true' if index == 0 else 'false', name=vm_name, n=index + 1))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<ovf:Envelope xmlns:ovf="{ns}" ovf:version="4.4.0.0">'
+        '<References/><Section xsi:type="ovf:DiskSection_Type" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">{disks}</Section>'
+        '<Content ovf:id="out" xsi:type="ovf:VirtualSystem_Type" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+        '<Name>{name}</Name><TemplateId>00000000-0000-0000-0000-000000000000</TemplateId>'
+        '</Content></ovf:Envelope>'.format(ns=NAMESPACE, disks=''.join(items), name=vm_name))
+
+
+class Engine:
+    """State of the fake manager
+    Parameters:
+        device_path: directory where attached disks appear
+        latency: seconds added to every API call
+        snapshot_delay: seconds until a new snapshot is OK
+        disk_delay: seconds until a new disk is OK
+        attach_delay: seconds until the device of an attachment appears
+    """
+
+    def __init__(self, device_path, latency=0.0, snapshot_delay=0.0, disk_delay=0.0, attach_delay=0.0):
+        self.device_path = device_path
+        self.latency = latency
+        self.snapshot_delay = snapshot_delay
+        self.disk_delay = disk_delay
+        self.attach_delay = attach_delay
+        self.vms = {}
+        self.disks = {}
+        self.images = {}
+        self.targets = {}
+        self.snapshots = {}
+        self.attachments = {}
+        self.volumes = {}
+        self.transfers = {}
+        self.imageio = None
+        self.events = []
+        self.calls = itertools.count()
+        self.lock = threading.Lock()
+        os.makedirs(device_path, exist_ok=True)
+
+    def call(self):
+        next(self.calls)
+        if self.latency:
+            sleep(self.latency)
+
+    def addvm(self, name, images=None, storage_domain='sd-bench'):
+        """Register a vm, images is a dict of disk id and image path"""
+        vm_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, name))
+        images = images or {}
+        sizes = {}
+        for disk_id, path in images.items():
+            size = os.path.getsize(path)
+            self.images[disk_id] = path
+            image_id = str(uuid.uuid4())
+            self.volumes[image_id] = disk_id
+            self.disks[disk_id] = Obj(id=disk_id, image_id=image_id, provisioned_size=size, status=DiskStatus.OK,
+                                      ready=0, storage_domains=[Obj(id=storage_domain, name=storage_domain)])
+            sizes[disk_id] = max(1, -(-size // 2**30))
+        self.vms[vm_id] = Obj(
+            id=vm_id, name=name, disks=list(images),
+            initialization=Obj(configuration=Obj(data=makeovf(name, vm_id, sizes))))
+        return self.vms[vm_id]
+
+    def link(self, disk_id, path):
+        device = os.path.join(self.device_path, disk_id)
+
+        def create():
+            if self.attach_delay:
+                sleep(self.attach_delay)
+            if os.path.lexists(device):
+                os.remove(device)
+            os.symlink(path, device)
+
+        if self.attach_delay:
+            threading.Thread(target=create, daemon=True).start()
+        else:
+            create()
+
+    def imageio_url(self):
+        """Return url of the imageio stand-in, started on first use"""
+        with self.lock:
+            if self.imageio is None:
+                self.imageio = ImageioServer(('127.0.0.1', 0), ImageioHandler)
+                self.imageio.engine = self
+                threading.Thread(target=self.imageio.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}/images/'.format(self.imageio.server_address[1])
+
+
+def imageextents(path):
+    """Return imageio zero extents of an image, holes are zero"""
+    extents = []
+    size = os.path.getsize(path)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                start = size
+            if start > offset:
+                extents.append({'start': offset, 'length': start - offset, 'zero': True, 'hole': True})
+            if start >= size:
+                break
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append({'start': start, 'length': end - start, 'zero': False, 'hole': False})
+            offset = end
+    finally:
+        os.close(fd)
+    return extents
+
+
+class ImageioServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    engine = None
+
+
+class ImageioHandler(http.server.BaseHTTPRequestHandler):
+    """Downloads of the images of transfers with ranged GET requests and
+    their extents"""
+    protocol_version = 'HTTP/1.1'
+    RANGE = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.engine.call()
+        match = re.match(r'^/images/([^/?]+)(/extents)?', self.path)
+        transfer = self.server.engine.transfers.get(match[1]) if match else None
+        if transfer is None or transfer.phase != ImageTransferPhase.TRANSFERRING:
+            return self.reply(404, b'no such ticket')
+        path = self.server.engine.images[transfer.disk_id]
+        if match[2]:
+            return self.reply(200, json.dumps(imageextents(path)).encode('utf-8'))
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        if 'Range' in self.headers:
+            ranged = self.RANGE.match(self.headers['Range'])
+            if ranged is None:
+                return self.reply(416, b'invalid range')
+            start, end = int(ranged[1]), min(int(ranged[2]), size - 1)
+        with open(path, 'rb') as fd:
+            fd.seek(start)
+            body = fd.read(end - start + 1)
+        self.send_response(206 if 'Range' in self.headers else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Service:
+    def __init__(self, engine, **kwargs):
+        self.engine = engine
+        self.__dict__.update(kwargs)
+
+
+class SystemService(Service):
+    def vms_service(self):
+        return VmsService(self.engine)
+
+    def disks_service(self):
+        return DisksService(self.engine)
+
+    def events_service(self):
+        return EventsService(self.engine)
+
+    def storage_domains_service(self):
+        return StorageDomainsService(self.engine)
+
+    def image_transfers_service(self):
+        return ImageTransfersService(self.engine)
+
+
+class StorageDomainsService(Service):
+    def list(self, **kwargs):
+        self.engine.call()
+        names = {sd.name for disk in self.engine.disks.values() for sd in disk.storage_domains or ()}
+        return [Obj(id=name, name=name) for name in sorted(names)]
+
+
+class EventsService(Service):
+    def add(self, event=None):
+        self.engine.call()
+        self.engine.events.append(event)
+        return event
+
+
+class VmsService(Service):
+    def list(self, search=None, all_content=False, **kwargs):
+        self.engine.call()
+        vms = list(self.engine.vms.values())
+        if search and search.startswith('name='):
+            name = search[len('name='):]
+            vms = [vm for vm in vms if vm.name == name]
+            if not vms:
+                # every other vm, e.g. the agent, exists without disks
+                vms = [self.engine.addvm(name)]
+        elif search and search.startswith('id='):
+            vms = [vm for vm in vms if vm.id == search[len('id='):]]
+        return vms
+
+    def add(self, vm=None, **kwargs):
+        self.engine.call()
+        vm_id = str(uuid.uuid4())
+        self.engine.vms[vm_id] = Obj(id=vm_id, name='restored-' + vm_id[:8], disks=[])
+        return self.engine.vms[vm_id]
+
+    def vm_service(self, vm_id):
+        return VmService(self.engine, vm_id=vm_id)
+
+
+class VmService(Service):
+    def get(self, **kwargs):
+        self.engine.call()
+        return self.engine.vms[self.vm_id]
+
+    def snapshots_service(self):
+        return SnapshotsService(self.engine, vm_id=self.vm_id)
+
+    def disk_attachments_service(self):
+        return DiskAttachmentsService(self.engine, vm_id=self.vm_id)
+
+
+class SnapshotsService(Service):
+    def add(self, snapshot=None):
+        self.engine.call()
+        snap_id = str(uuid.uuid4())
+        self.engine.snapshots[snap_id] = Obj(
+            id=snap_id, vm=self.vm_id, description=snapshot.description, date=datetime.now(),
+            ready=monotonic() + self.engine.snapshot_delay)
+        return self.snapshot_service(snap_id).get()
+
+    def list(self, **kwargs):
+        self.engine.call()
+        return [self.snapshot_service(snap_id).get() for snap_id, snap in self.engine.snapshots.items()
+                if snap.vm == self.vm_id]
+
+    def snapshot_service(self, snap_id):
+        return SnapshotService(self.engine, snap_id=snap_id)
+
+
+class SnapshotService(Service):
+    def get(self):
+        self.engine.call()
+        snap = self.engine.snapshots[self.snap_id]
+        status = SnapshotStatus.OK if monotonic() >= snap.ready else SnapshotStatus.LOCKED
+        return Obj(id=snap.id, description=snap.description, date=snap.date, snapshot_status=status)
+
+    def remove(self):
+        self.engine.call()
+        self.engine.snapshots.pop(self.snap_id, None)
+
+    def disks_service(self):
+        return SnapshotDisksService(self.engine, snap_id=self.snap_id)
+
+
+class SnapshotDisksService(Service):
+    def list(self):
+        self.engine.call()
+        vm = self.engine.vms[self.engine.snapshots[self.snap_id].vm]
+        return [self.engine.disks[disk_id] for disk_id in vm.disks]
+
+
+class DiskAttachmentsService(Service):
+    def add(self, attachment=None):
+        self.engine.call()
+        disk_id = attachment.disk.id
+        if attachment.disk.snapshot is not None:
+            path = self.engine.images[disk_id]
+        else:
+            # new disk of a restore, the device is an empty sparse file
+            path = os.path.join(self.engine.device_path, '.' + disk_id + '.img')
+            with open(path, 'wb') as fd:
+                fd.truncate(self.engine.disks[disk_id].provisioned_size)
+            self.engine.targets[disk_id] = path
+        attach_id = str(uuid.uuid4())
+        self.engine.attachments[attach_id] = Obj(id=attach_id, vm=self.vm_id, disk=Obj(id=disk_id))
+        self.engine.link(disk_id, path)
+        return self.engine.attachments[attach_id]
+
+    def list(self, **kwargs):
+        self.engine.call()
+        return [attach for attach in self.engine.attachments.values() if attach.vm == self.vm_id]
+
+    def attachment_service(self, attach_id):
+        return AttachmentService(self.engine, attach_id=attach_id)
+
+
+class AttachmentService(Service):
+    def remove(self, **kwargs):
+        self.engine.call()
+        attach = self.engine.attachments.pop(self.attach_id)
+        device = os.path.join(self.engine.device_path, attach.disk.id)
+        if os.path.lexists(device):
+            os.remove(device)
+
+
+class DisksService(Service):
+    def add(self, disk=None):
+        self.engine.call()
+        disk_id = disk.id or str(uuid.uuid4())
+        image_id = str(uuid.uuid4())
+        self.engine.volumes[image_id] = disk_id
+        self.engine.disks[disk_id] = Obj(
+            id=disk_id, image_id=image_id, name=disk.name, provisioned_size=disk.provisioned_size,
+            ready=monotonic() + self.engine.disk_delay, storage_domains=disk.storage_domains)
+        return self.disk_service(disk_id).get()
+
+    def list(self, search=None, **kwargs):
+        self.engine.call()
+        ids = None
+        if search:
+            ids = {term.strip()[len('id='):] for term in search.split(' or ')}
+        return [self.disk_service(disk_id).get() for disk_id in self.engine.disks
+                if ids is None or disk_id in ids]
+
+    def disk_service(self, disk_id):
+        return DiskService(self.engine, disk_id=disk_id)
+
+
+class DiskService(Service):
+    def get(self):
+        self.engine.call()
+        disk = self.engine.disks[self.disk_id]
+        status = DiskStatus.OK if monotonic() >= (disk.ready or 0) else DiskStatus.LOCKED
+        return Obj(id=disk.id, name=disk.name, provisioned_size=disk.provisioned_size, status=status,
+                   storage_domains=disk.storage_domains)
+
+    def remove(self):
+        self.engine.call()
+        self.engine.disks.pop(self.disk_id, None)
+
+
+class ImageTransfersService(Service):
+    def add(self, transfer=None):
+        self.engine.call()
+        transfer_id = str(uuid.uuid4())
+        self.engine.transfers[transfer_id] = Obj(
+            id=transfer_id, disk_id=self.engine.volumes[transfer.snapshot.id],
+            phase=ImageTransferPhase.INITIALIZING, ready=monotonic() + self.engine.attach_delay,
+            transfer_url=self.engine.imageio_url() + transfer_id)
+        return self.image_transfer_service(transfer_id).get()
+
+    def image_transfer_service(self, transfer_id):
+        return ImageTransferService(self.engine, transfer_id=transfer_id)
+
+
+class ImageTransferService(Service):
+    def get(self):
+        self.engine.call()
+        transfer = self.engine.transfers[self.transfer_id]
+        if transfer.phase == ImageTransferPhase.INITIALIZING and monotonic() >= transfer.ready:
+            transfer.phase = ImageTransferPhase.TRANSFERRING
+        return Obj(id=transfer.id, phase=transfer.phase, transfer_url=transfer.transfer_url)
+
+    def finalize(self):
+        self.engine.call()
+        self.engine.transfers[self.transfer_id].phase = ImageTransferPhase.FINISHED_SUCCESS
+
+    def cancel(self):
+        self.engine.call()
+        self.engine.transfers[self.transfer_id].phase = ImageTransferPhase.CANCELLED
+
+
+class Connection:
+    """Stand-in of sdk.Connection bound to the installed engine"""
+    engine = None
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def system_service(self):
+        return SystemService(self.engine)
+
+    def send(self, *args, **kwargs):
+        pass
+
+    def wait(self, *args, **kwargs):
+        pass
+
+    def test(self, raise_exception=False):
+        return True
+
+    def close(self):
+        pass
+
+
+class Error(Exception):
+    pass
+
+
+def install(engine):
+    """Install fake ovirtsdk4 modules bound to engine"""
+    sdk = pytypes.ModuleType('ovirtsdk4')
+    sdk_types = pytypes.ModuleType('ovirtsdk4.types')
+    for name in TYPES:
+        setattr(sdk_types, name, type(name, (Obj,), {}))
+    for cls in ENUMS:
+        setattr(sdk_types, cls.__name__, cls)
+    Connection.engine = engine
+    sdk.Connection = Connection
+    sdk.Error = Error
+    sdk.types = sdk_types
+    sys.modules['ovirtsdk4'] = sdk
+    sys.modules['ovirtsdk4.types'] = sdk_types
+    return sdk
@@ -0,0 +1,157 @@
+"""Local stand-in of an S3 compatible object storage for offload.py
+
+Objects are files under a directory, multipart uploads keep their parts in
+a directory until they are completed. Requests without a signature are
+refused and failures of part uploads can be injected to exercise retries:
+
+    server = fakes3.Server('/tmp/s3', fail_every=7)
+    offload.configure(server.url + '/backups', 'key', 'secret')
+"""
+import hashlib
+import http.server
+import itertools
+import os
+import re
+import shutil
+import threading
+import uuid
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def parse(self):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query, keep_blank_values=True).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if not self.headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 '):
+            self.reply(403, b'<Error><Code>AccessDenied</Code></Error>')
+            return None
+        if self.headers.get('x-amz-content-sha256') != hashlib.sha256(body).hexdigest():
+            self.reply(400, b'<Error><Code>XAmzContentSHA256Mismatch</Code></Error>')
+            return None
+        return path.lstrip('/'), query, body
+
+    def do_POST(self):
+        request = self.parse()
+        if request is None:
+            return
+        key, query, body = request
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.server.root, 'uploads', upload_id))
+            self.reply(200, '<InitiateMultipartUploadResult><Key>{}</Key><UploadId>{}</UploadId>'
+                            '</InitiateMultipartUploadResult>'.format(key, upload_id).encode('utf-8'))
+            return
+        upload = os.path.join(self.server.root, 'uploads', query.get('uploadId', ''))
+        if not os.path.isdir(upload):
+            self.reply(404, b'<Error><Code>NoSuchUpload</Code></Error>')
+            return
+        numbers = [int(number) for number in re.findall(rb'<PartNumber>(\d+)</PartNumber>', body)]
+        if numbers != list(range(1, len(numbers) + 1)):
+            self.reply(400, b'<Error><Code>InvalidPartOrder</Code></Error>')
+            return
+        os.makedirs(os.path.dirname(self.server.objectpath(key)), exist_ok=True)
+        with open(self.server.objectpath(key), 'wb') as dst:
+            for number in numbers:
+                with open(os.path.join(upload, str(number)), 'rb') as src:
+                    shutil.copyfileobj(src, dst)
+        shutil.rmtree(upload)
+        self.reply(200, '<CompleteMultipartUploadResult><Key>{}</Key></CompleteMultipartUploadResult>'.format(
+            key).encode('utf-8'))
+
+    def do_PUT(self):
+        request = self.parse()
+        if request is None:
+            return
+        key, query, body = request
+        if self.server.fail_every and next(self.server.requests) % self.server.fail_every == 0:
+            self.reply(503, b'<Error><Code>SlowDown</Code></Error>')
+            return
+        upload = os.path.join(self.server.root, 'uploads', query.get('uploadId', ''))
+        if not os.path.isdir(upload):
+            self.reply(404, b'<Error><Code>NoSuchUpload</Code></Error>')
+            return
+        with open(os.path.join(upload, query['partNumber']), 'wb') as fd:
+            fd.write(body)
+        self.server.parts += 1
+        self.reply(200, headers={'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+    def do_DELETE(self):
+        request = self.parse()
+        if request is None:
+            return
+        key, query, _ = request
+        if 'uploadId' in query:
+            shutil.rmtree(os.path.join(self.server.root, 'uploads', query['uploadId']), ignore_errors=True)
+        elif os.path.exists(self.server.objectpath(key)):
+            os.remove(self.server.objectpath(key))
+        self.reply(204)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        request = self.parse()
+        if request is None:
+            return
+        key, _, _ = request
+        path = self.server.objectpath(key)
+        if not os.path.exists(path):
+            self.reply(404, b'<Error><Code>NoSuchKey</Code></Error>')
+            return
+        size = os.path.getsize(path)
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match is None:
+            if self.command == 'HEAD':
+                self.send_response(200)
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                return
+            with open(path, 'rb') as fd:
+                self.reply(200, fd.read())
+            return
+        start, end = int(match.group(1)), min(int(match.group(2)), size - 1)
+        with open(path, 'rb') as fd:
+            fd.seek(start)
+            data = fd.read(end - start + 1)
+        self.reply(206, data, {'Content-Range': 'bytes {}-{}/{}'.format(start, end, size)})
+
+
+class Server(http.server.ThreadingHTTPServer):
+    """S3 stand-in listening on a free local port
+    Parameters:
+        root: directory of the objects and uploads
+        fail_every: answer 503 to one part upload out of this number, 0 to
+            never fail
+    """
+    daemon_threads = True
+
+    def __init__(self, root, fail_every=0):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.root = root
+        self.fail_every = fail_every
+        self.requests = itertools.count(1)
+        self.parts = 0
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'uploads'), exist_ok=True)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def objectpath(self, key):
+        return os.path.join(self.root, 'objects', key.replace('/', '%2F'))
@@ -1,12 +1,27 @@
+import io
 import json
 import os
 import shutil
+import stat
 import subprocess
 import tarfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from time import sleep
+from time import monotonic, time
 
-from lxml import etree
+import checksum
+import directio
+import imagetransfer
+import ratelimit
+import seekable
+import sparse
+import wait
+
+# udev links attached disks here by serial, see installer/files/01-local.rules
+DEVICE_PATH = '/dev/backup/'
 
 
 def vmobj(vmservice, vm_name):
@@ -24,6 +39,36 @@ def vmobj(vmservice, vm_name):
     return data_vm
 
 
+def vmsearch(vmservice, vm_names=(), query=None, tag=None, inventory=None):
+    """Search for vms by names, search query or tag, the vms come without
+    the OVF
+    Parameters:
+        vmservice: vm service object
+        vm_names: names of virtual machines
+        query: oVirt search query
+        tag: name of tag
+        inventory: Inventory to find the vms by name, None to search them
+    Returns:
+        list of vm objects without duplicates
+    """
+    found = {}
+    searches = []
+    for vm_name in vm_names:
+        data_vm = inventory.vm(vm_name) if inventory is not None else None
+        if data_vm is not None:
+            found.setdefault(data_vm.id, data_vm)
+        else:
+            searches.append('name=%s' % vm_name)
+    if query:
+        searches.append(query)
+    if tag:
+        searches.append('tag=%s' % tag)
+    for search in searches:
+        for data_vm in vmservice.list(search=search):
+            found.setdefault(data_vm.id, data_vm)
+    return list(found.values())
+
+
 def send_events(e_service, e_id, types, desc, message, data_vm=None):
     """Send events to manager for tasks
     Parameters:
@@ -82,15 +127,28 @@ def createsnapshot(s_service, types, snap_description):
     return snap
 
 
-def waitingsnapshot(snap, types, logging, time, s_service, clickecho, dbg, e_id):
-    while snap.snapshot_status != types.SnapshotStatus.OK:
+def findsnapshot(s_service, snap_id):
+    """Return snapshot of a vm by id, None when it was removed"""
+    for snap in s_service.list():
+        if snap.id == snap_id:
+            return snap
+    return None
+
+
+def waitingsnapshot(snap, types, logging, time, s_service, clickecho, dbg, e_id, timeout=3600):
+    def ready():
+        current = s_service.get()
+        if current.snapshot_status == types.SnapshotStatus.OK:
+            return True
         logging.info(
-            '[{}] Waiting till the snapshot is created, the status is \'{}\'.'.format(e_id, snap.snapshot_status))
+            '[{}] Waiting till the snapshot is created, the status is \'{}\'.'.format(e_id, current.snapshot_status))
         if dbg:
             clickecho.echo('[{}] Waiting till the snapshot is created, the status is \'{}\'.'.format(e_id,
-                                                                                                     snap.snapshot_status))
-        time.sleep(10)
-        snap = s_service.get()
+                                                                                                     current.snapshot_status))
+        return False
+
+    if snap.snapshot_status != types.SnapshotStatus.OK:
+        wait.waitfor(ready, timeout, 'snapshot {}'.format(snap.id), logging, initial=1, maximum=10)
     logging.info('[{}] The snapshot is now complete.'.format(e_id))
     if dbg:
         clickecho.echo('[{}] The snapshot is now complete.'.format(e_id))
@@ -140,62 +198,939 @@ def disksattachments(attachments, logging, dbg, clickecho):
     return diskarray
 
 
-def qemuconvert(event_id, devices, path, dbg, logging, clickecho):
-    for uuid, device in devices.items():
-        sleep(10)
+def waitdevice(device, timeout=120):
+    """Wait until udev creates the device symlink of an attached disk
+    Parameters:
+        device: path of device, DEVICE_PATH/<disk-id>
+        timeout: seconds to wait before giving up
+    Returns:
+        True if the device exists, False on timeout
+    """
+    if imagetransfer.isurl(device):
+        return True
+    return wait.waitpath(device, timeout)
+
+
+def convertdisk(event_id, uuid, device, path, dbg, logging, clickecho, progress=False, limiter=None):
+    """Convert one attached disk to a raw image, the image is hashed by
+    convertedchecksums once written and not while qemu-img writes it
+    Parameters:
+        uuid: id of disk
+        device: path of device
+        path: directory of backup with trailing slash
+        progress: show qemu-img progress bar
+        limiter: ratelimit.Limiter of the disk, qemu-img copies at the
+            share of the disk, job and agent limits it reserves, and reads
+            the device with the cache and aio of directio
+    Returns:
+        return code of qemu-img
+    """
+    if not waitdevice(device):
+        logging.error(
+            '[{}] Device {} not found for disk {}'.format(event_id, device, uuid))
+        return 1
+    logging.info('[{}] Converting uuid {}, device {}'.format(
+        event_id, uuid, device))
+    if dbg:
+        clickecho.echo(
+            '[{}] Converting uuid {}, device {}'.format(event_id, uuid, device))
+    command = ['qemu-img', 'convert']
+    if progress:
+        command.append('-p')
+    with limiter.share() if limiter is not None else nullcontext((0, 0)) as limits:
+        if limits[0]:
+            command += ['-r', str(limits[0])]
+        command += directio.qemuoptions() + ['-O', 'raw', directio.qemuimage(device), path + uuid + '.raw']
+        return ratelimit.popen(command, [device], limits).wait()
+
+
+class PackConverter:
+    """Converter for qemuconvert writing the sparse image of each disk
+    straight from the data extents of its device or image transfer url,
+    without a raw image, the disk is hashed while it is read"""
+
+    def __init__(self):
+        self.disks = {}
+        self.checksums = {}
+
+    def __call__(self, event_id, uuid, device, path, dbg, logging, clickecho, progress=False, limiter=None):
+        if not waitdevice(device):
+            logging.error('[{}] Device {} not found for disk {}'.format(event_id, device, uuid))
+            return 1
+        logging.info('[{}] Packing uuid {}, device {}'.format(event_id, uuid, device))
         if dbg:
-            clickecho.echo(
-                '[{}] Converting uuid {}, device {}'.format(event_id, uuid, device))
-            command = subprocess.call(['qemu-img', 'convert', '-p', '-O',
-                                       'raw', device, path + uuid + '.raw'])
-        else:
-            logging.info('[{}] Converting uuid {}, device {}'.format(
-                event_id, uuid, device))
-            command = subprocess.call(['qemu-img', 'convert', '-O', 'raw',
-                                       device, path + uuid + '.raw'])
-        if command != 0:
-            logging.error(
-                '[{}] Error converting device: {} with return code: {}'.format(event_id, device, command))
-            return command
-
-
-def ovf_parse(file):
-    with open(file) as f:
-        ovf_str = f.read()
-        ovf = etree.fromstring(bytes(ovf_str, encoding='utf8'))
-    return ovf, ovf_str
-
-
-def make_archive(workingdir, destination, dbg, e_id, log):
-    os.chdir(workingdir)
-    tar_name = destination + '.tar.gz'
+            clickecho.echo('[{}] Packing uuid {}, device {}'.format(event_id, uuid, device))
+        hasher = checksum.Hasher(uuid)
+        try:
+            written = sparse.pack(device, path + uuid + sparse.SUFFIX, hasher, limiter=limiter)
+        except (OSError, ValueError) as e:
+            logging.error('[{}] Error packing disk {}: {}'.format(event_id, uuid, e))
+            return 1
+        self.checksums[uuid] = hasher.result()
+        self.disks[uuid] = {'size': self.checksums[uuid]['size'], 'written': written}
+        logging.info('[{}] Packed disk {} in {} bytes'.format(event_id, uuid, written))
+        return 0
+
+
+def qemuconvert(event_id, devices, path, dbg, logging, clickecho, workers=1, storages=None, storage_workers=0,
+                limit=None, converter=convertdisk, report=None, checksums=None, limiter=None, journal=None):
+    """Convert attached disks concurrently
+    Parameters:
+        devices: dict of disk id and device path
+        path: directory of backup with trailing slash
+        workers: number of disks converted at the same time
+        storages: dict of disk id and storage domain id
+        storage_workers: max disks converted at the same time per storage
+            domain, 0 for no limit
+        limit: semaphore shared with other jobs, None for no limit
+        converter: function converting one disk, with the arguments of
+            convertdisk
+        report: JobReport for the bytes and time of each disk
+        checksums: Checksums filled with the checksums of each disk, from
+            the converter, or for convertdisk from the raw image read again
+            once written
+        limiter: ratelimit.Limiter of the job, each disk is converted with
+            its own limiter
+        journal: journal.Journal of the job, each disk converted is saved
+            with its checksums and the statistics of the converter
+    Returns:
+        dict of disk id and return code
+    """
+    storages = storages or {}
+    limits = {}
+    if storage_workers > 0:
+        for sd in set(storages.values()):
+            limits[sd] = threading.BoundedSemaphore(storage_workers)
+    workers = max(1, min(workers, len(devices) or 1))
+
+    def convert(uuid, device):
+        locks = [lock for lock in (limits.get(storages.get(uuid)), limit)
+                 if lock is not None]
+        for lock in locks:
+            lock.acquire()
+        try:
+            start = monotonic()
+            code = converter(event_id, uuid, device, path, dbg, logging,
+                             clickecho, progress=dbg and workers == 1,
+                             limiter=limiter.disk() if limiter is not None else None)
+            if report is not None and code == 0:
+                report.disk(uuid, monotonic() - start, convertedsize(converter, uuid, device),
+                            convertedbytes(converter, uuid, path), 'copy')
+            if checksums is not None and code == 0:
+                checksums.disks[uuid] = convertedchecksums(converter, uuid, path)
+            if journal is not None and code == 0:
+                journal.setdisk(uuid, done=True, checksum=checksums.disks.get(uuid) if checksums else None,
+                                stats=getattr(converter, 'disks', {}).get(uuid))
+            return code
+        finally:
+            for lock in locks:
+                lock.release()
+
+    results = {}
+    with limiter.running(workers) if limiter is not None else nullcontext(), \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(convert, uuid, device): uuid
+                   for uuid, device in devices.items()}
+        for future in as_completed(futures):
+            uuid = futures[future]
+            try:
+                results[uuid] = future.result()
+            except OSError as e:
+                logging.error(
+                    '[{}] Error converting disk {}: {}'.format(event_id, uuid, e))
+                results[uuid] = 1
+            if results[uuid] != 0:
+                logging.error('[{}] Error converting device: {} with return code: {}'.format(
+                    event_id, devices[uuid], results[uuid]))
+            else:
+                logging.info('[{}] Converted disk {}'.format(event_id, uuid))
+    return results
+
+
+def convertedsize(converter, uuid, device):
+    """Return size of a disk converted by converter, size of the device
+    for convertdisk"""
+    stats = getattr(converter, 'disks', {}).get(uuid)
+    if stats and 'size' in stats:
+        return stats['size']
+    return devicesize(device)
+
+
+def convertedbytes(converter, uuid, path):
+    """Return bytes written for a disk by converter, allocated size of the
+    raw image for convertdisk"""
+    stats = getattr(converter, 'disks', {}).get(uuid)
+    if stats and 'written' in stats:
+        return stats['written']
+    raw = path + uuid + '.raw'
+    if os.path.exists(raw):
+        return os.stat(raw).st_blocks * 512
+    return 0
+
+
+def convertedchecksums(converter, uuid, path):
+    """Return checksums of a disk computed by converter while it copied the
+    disk, qemu-img runs out of process so the raw image of convertdisk is
+    hashed after it is written, a second read of its data extents"""
+    sums = getattr(converter, 'checksums', {}).get(uuid)
+    if sums is not None:
+        return sums
+    raw = path + uuid + '.raw'
+    fd = os.open(raw, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        extents = sparse.dataextents(fd, size)
+    finally:
+        os.close(fd)
+    return checksum.hashfile(raw, extents, size)
+
+
+def returncode(results):
+    """Return first non zero return code of a dict of results, or 0"""
+    for code in results.values():
+        if code:
+            return code
+    return 0
+
+
+# Compression codecs of archives, the compress command gets the level and
+# threads appended, threads 0 means all cores
+CODECS = {
+    'gzip': {'ext': '.tar.gz', 'magic': b'\x1f\x8b', 'compress': ['gzip', '-c'],
+             'decompress': ['gzip', '-dc'], 'level': '-{}', 'levels': (1, 9), 'threads': None},
+    'pigz': {'ext': '.tar.gz', 'magic': b'\x1f\x8b', 'compress': ['pigz', '-c'],
+             'decompress': ['pigz', '-dc'], 'level': '-{}', 'levels': (1, 11), 'threads': '-p{}'},
+    'zstd': {'ext': '.tar.zst', 'magic': b'\x28\xb5\x2f\xfd', 'compress': ['zstd', '-c', '-q'],
+             'decompress': ['zstd', '-dc', '-q'], 'level': '-{}', 'levels': (1, 19), 'threads': '-T{}'},
+    'lz4': {'ext': '.tar.lz4', 'magic': b'\x04\x22\x4d\x18', 'compress': ['lz4', '-c', '-q'],
+            'decompress': ['lz4', '-dc', '-q'], 'level': '-{}', 'levels': (1, 12), 'threads': None},
+    'none': {'ext': '.tar', 'magic': None, 'compress': None,
+             'decompress': None, 'level': None, 'levels': None, 'threads': None},
+    # gzip frames compressed in process with an index, see seekable.py
+    'seekable': {'ext': '.tar.gz', 'magic': b'\x1f\x8b', 'compress': None,
+                 'decompress': ['gzip', '-dc'], 'level': None, 'levels': (1, 9), 'threads': None,
+                 'frames': True},
+}
+
+
+def checklevel(codec, level):
+    """Raise ValueError when level is not in the range of levels of codec,
+    None uses the default level of codec"""
+    levels = CODECS[codec]['levels']
+    if level is None:
+        return
+    if levels is None:
+        raise ValueError('codec {} has no compression level'.format(codec))
+    if not levels[0] <= level <= levels[1]:
+        raise ValueError('{} is not in the range {}-{} of codec {}'.format(level, levels[0], levels[1], codec))
+
+
+def compresscommand(codec, level=None, threads=0):
+    """Return command line of compressor for codec, None for no compression"""
+    settings = CODECS[codec]
+    if settings['compress'] is None:
+        return None
+    command = list(settings['compress'])
+    if level is not None and settings['level']:
+        command.append(settings['level'].format(level))
+    if settings['threads']:
+        command.append(settings['threads'].format(threads or os.cpu_count()))
+    return command
+
+
+def detectcodec(file):
+    """Detect codec of archive by magic number
+    Parameters:
+        file: path of archive
+    Returns:
+        name of codec, pigz for gzip archives when pigz is installed
+    """
+    with open(file, 'rb') as fd:
+        head = fd.read(4)
+    for codec, settings in CODECS.items():
+        if settings['magic'] and head.startswith(settings['magic']):
+            if codec == 'gzip' and shutil.which('pigz'):
+                return 'pigz'
+            return codec
+    return 'none'
+
+
+def archivebase(file):
+    """Return path of archive without the archive extension"""
+    for ext in sorted({c['ext'] for c in CODECS.values()}, key=len, reverse=True):
+        if file.endswith(ext):
+            return file[:-len(ext)]
+    return file
+
+
+def archivename(destination, codec):
+    return destination + CODECS[codec]['ext']
+
+
+class CountingWriter(io.RawIOBase):
+    """Write to a pipe counting the bytes, tarfile needs tell() to write
+    without the stream mode, whose buffer copies every block it writes"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+
+def archivefiles(destination):
+    """Return names and paths of the files of a backup directory, OVF first
+    and disk images last, so the metadata is read before the disks"""
+    files = sorted(Path(destination).iterdir(), key=lambda f: (f.suffix != '.ovf', sparse.isimage(f.name), f.name))
+    return [(f.name, f.as_posix()) for f in files if f.is_file()]
+
+
+def waitprocesses(processes):
+    """Close the pipes of processes and wait for every one of them
+    Returns:
+        first non zero return code, or 0
+    """
+    codes = []
+    for process in processes:
+        for pipe in (process.stdin, process.stdout):
+            if pipe is not None:
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+        codes.append(process.wait())
+    return next((code for code in codes if code), 0)
+
+
+def make_archive(workingdir, destination, dbg, e_id, log, codec='gzip', level=None, threads=0, limiter=None):
+    tar_name = archivename(destination, codec)
     tmp_dir = Path(destination).name
+    if CODECS[codec].get('frames'):
+        try:
+            with open(tar_name, 'wb') as tar_fd:
+                seekable.writearchive(tar_fd, tmp_dir, archivefiles(destination), level, threads,
+                                      limiter=limiter)
+            command = 0
+        except (OSError, tarfile.TarError) as e:
+            log.error('[{}] Error writing seekable archive: {}'.format(e_id, e))
+            command = 1
+        return archived(destination, tar_name, command)
+    names = [tmp_dir + '/' + name for name, _ in archivefiles(destination)]
     if dbg:
-        command = subprocess.call(['tar', '-czvSf', tar_name, tmp_dir])
+        tar_command = ['tar', '-C', workingdir, '-cvSf', '-'] + names
     else:
-        command = subprocess.call(['tar', '-czSf', tar_name, tmp_dir])
+        tar_command = ['tar', '-C', workingdir, '-cSf', '-'] + names
+    compress = compresscommand(codec, level, threads)
+    processes = []
+    command = 0
+    try:
+        with open(tar_name, 'wb') as tar_fd:
+            if limiter is not None and limiter.limited():
+                # the tar stream is copied through the limiter of the job
+                tar = ratelimit.popen(tar_command, stdout=subprocess.PIPE)
+                processes.append(tar)
+                output = tar_fd
+                if compress is not None:
+                    compressor = ratelimit.popen(compress, stdin=subprocess.PIPE, stdout=tar_fd)
+                    processes.append(compressor)
+                    output = compressor.stdin
+                shutil.copyfileobj(ratelimit.Reader(tar.stdout, limiter), output, 8 * 2**20)
+            elif compress is None:
+                processes.append(ratelimit.popen(tar_command, stdout=tar_fd))
+            else:
+                tar = ratelimit.popen(tar_command, stdout=subprocess.PIPE)
+                processes.append(tar)
+                processes.append(ratelimit.popen(compress, stdin=tar.stdout, stdout=tar_fd))
+                tar.stdout.close()
+    except OSError as e:
+        log.error('[{}] Error packing file: {}'.format(e_id, e))
+        command = 1
+    command = waitprocesses(processes) or command
+    if command != 0:
+        log.error(
+            '[{}] Error packing file with return code: {}'.format(e_id, command))
+    return archived(destination, tar_name, command)
+
+
+def archived(destination, tar_name, command):
+    """Remove the backup directory of an archive once it is written, or the
+    partial archive when it failed so the backup can be archived again"""
+    if command == 0:
+        shutil.rmtree(destination)
+    elif os.path.exists(tar_name):
+        os.remove(tar_name)
+    return command
+
+
+def devicesize(device):
+    """Return size in bytes of a block device, file or image transfer"""
+    if imagetransfer.isurl(device):
+        client = imagetransfer.Client(device)
+        try:
+            return client.size()
+        finally:
+            client.close()
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+def stream_archive(workingdir, destination, devices, dbg, e_id, log, bufsize=None, codec='gzip',
+                   level=None, threads=0, report=None, members=None, checksums=None, limiter=None,
+                   disk_format=sparse.RAW):
+    """Write backup directory and devices straight into a compressed tar
+    without intermediate raw files
+    Parameters:
+        workingdir: path of backups
+        destination: backup directory with the OVF, removed at the end
+        devices: dict of disk id and device path, stored as <disk-id>.raw
+            GNU sparse members without their holes, or <disk-id>.sparse
+            with only their data for sparse.SPARSE
+        bufsize: size of read buffer, directio.BLOCK_SIZE when not set
+        codec: name of codec in CODECS
+        report: JobReport for the bytes and time of each disk
+        members: dict filled with disk id and offset of its data in the
+            uncompressed tar
+        checksums: Checksums filled while the disks are read, written in the
+            archive after the disks
+        limiter: ratelimit.Limiter of the job, each disk is read with its
+            own limiter
+        disk_format: sparse.RAW or sparse.SPARSE
+    Returns:
+        return code, 0 on success
+    """
+    bufsize = bufsize or directio.BLOCK_SIZE
+    tar_name = archivename(destination, codec)
+    tmp_dir = Path(destination).name
+    suffix = sparse.SUFFIX if disk_format == sparse.SPARSE else '.raw'
+    if checksums is None:
+        checksums = checksum.Checksums()
+    if CODECS[codec].get('frames'):
+        return stream_seekable(tar_name, destination, devices, e_id, log, level, threads, report, members,
+                               checksums, limiter, disk_format)
+    compress = compresscommand(codec, level, threads)
+    command = 0
+    with open(tar_name, 'wb') as tar_fd:
+        compressor = None
+        output = tar_fd
+        if compress is not None:
+            compressor = ratelimit.popen(compress, stdin=subprocess.PIPE, stdout=tar_fd)
+            output = compressor.stdin
+        try:
+            with tarfile.open(fileobj=CountingWriter(output), mode='w', format=tarfile.PAX_FORMAT,
+                              copybufsize=bufsize) as tar:
+                tar.add(destination, arcname=tmp_dir)
+                for uuid, device in devices.items():
+                    if not waitdevice(device):
+                        log.error('[{}] Device {} not found for disk {}'.format(
+                            e_id, device, uuid))
+                        command = 1
+                        break
+                    log.info('[{}] Streaming uuid {}, device {}'.format(
+                        e_id, uuid, device))
+                    member = tarfile.TarInfo('{}/{}{}'.format(tmp_dir, uuid, suffix))
+                    member.mtime = int(time())
+                    start = monotonic()
+                    disk_limiter = limiter.disk() if limiter is not None else None
+                    # raw images are GNU sparse members, holes are not stored
+                    layout = sparse.header if disk_format == sparse.SPARSE else sparse.tarmap
+                    # the packer hashes the disk, not the image
+                    with sparse.opendisk(device, checksum.Hasher(uuid), bufsize, disk_limiter, layout) as reader:
+                        member.size = reader.length
+                        if disk_format != sparse.SPARSE:
+                            sparse.tarmember(member, reader.size)
+                        tar.addfile(member, reader)
+                        checksums.add(reader)
+                    if members is not None:
+                        members[uuid] = seekable.dataoffset(tar, member)
+                    if report is not None:
+                        report.disk(uuid, monotonic() - start, member.size, 0, 'copy')
+                if command == 0:
+                    data = checksums.dumps()
+                    member = tarfile.TarInfo('{}/{}'.format(tmp_dir, checksum.MANIFEST))
+                    member.size = len(data)
+                    member.mtime = int(time())
+                    tar.addfile(member, io.BytesIO(data))
+        except (OSError, tarfile.TarError) as e:
+            log.error('[{}] Error streaming archive: {}'.format(e_id, e))
+            command = 1
+        finally:
+            if compressor is not None:
+                compressor.stdin.close()
+                command = compressor.wait() or command
     shutil.rmtree(destination)
     if command != 0:
         log.error(
             '[{}] Error packing file with return code: {}'.format(e_id, command))
-        return command
     return command
 
-def unpack_archive(file, destination, log, e_id):
+
+def stream_seekable(tar_name, destination, devices, e_id, log, level=None, threads=0, report=None, members=None,
+                    checksums=None, limiter=None, disk_format=sparse.RAW):
+    """Write backup directory and devices in a seekable archive, see
+    stream_archive
+    Returns:
+        return code, 0 on success
+    """
+    files = archivefiles(destination)
+    suffix = sparse.SUFFIX if disk_format == sparse.SPARSE else '.raw'
+    packed = set()
+    for uuid, device in devices.items():
+        if not waitdevice(device):
+            log.error('[{}] Device {} not found for disk {}'.format(e_id, device, uuid))
+            shutil.rmtree(destination)
+            return 1
+        files.append((uuid + suffix, device))
+        if disk_format == sparse.SPARSE:
+            packed.add(uuid + suffix)
+
+    def progress(name, seconds, size):
+        log.info('[{}] Streamed {} of {} bytes'.format(e_id, name, size))
+        if report is not None and sparse.isimage(name):
+            report.disk(Path(name).stem, seconds, size, 0, 'copy')
+
+    offsets = {}
+    command = 0
     try:
-        tar = tarfile.open(file)
-        tar.extractall(destination)
-        tar.close()
-    except tarfile.TarError as e:
+        with open(tar_name, 'wb') as tar_fd:
+            seekable.writearchive(tar_fd, Path(destination).name, files, level, threads, offsets, progress,
+                                  checksums, limiter, packed)
+    except (OSError, tarfile.TarError) as e:
+        log.error('[{}] Error streaming archive: {}'.format(e_id, e))
+        command = 1
+    shutil.rmtree(destination)
+    if members is not None:
+        for name, offset in offsets.items():
+            if sparse.isimage(name):
+                members[Path(name).stem] = offset
+    return command
+
+
+def unpack_archive(file, destination, log, e_id, limiter=None):
+    codec = detectcodec(file)
+    decompress = CODECS[codec]['decompress']
+    try:
+        if decompress is None:
+            with open(file, 'rb') as tar_fd:
+                source = ratelimit.Reader(tar_fd, limiter) if limiter is not None else tar_fd
+                with tarfile.open(fileobj=source, mode='r|') as tar:
+                    tar.extractall(destination)
+        else:
+            with open(file, 'rb') as tar_fd:
+                decompressor = ratelimit.popen(decompress, stdin=tar_fd, stdout=subprocess.PIPE)
+                source = decompressor.stdout
+                if limiter is not None:
+                    source = ratelimit.Reader(source, limiter)
+                with tarfile.open(fileobj=source, mode='r|') as tar:
+                    tar.extractall(destination)
+                decompressor.stdout.close()
+                command = decompressor.wait()
+            if command != 0:
+                log.error('[{}] Error decompressing file {} with {}, return code: {}'.format(
+                    e_id, file, codec, command))
+                return command
+    except (OSError, tarfile.TarError) as e:
         log.error('[{}] Error unpacking file: {}'.format(e_id, e))
         return e
 
 
-def restoredata(device, path, dbg):
-    if dbg:
-        command = subprocess.call(
-            ['dd', 'if=' + path, 'of=' + device, 'bs=8M', 'conv=sparse'])
-    else:
-        command = subprocess.call(
-            ['dd', 'if=' + path, 'of=' + device, 'bs=8M', 'conv=sparse', 'status=none'])
-    return command
+def sparsecopy(src_path, dst_path, bufsize=None, progress=None, interval=10, hasher=None, limiter=None,
+               start_offset=0, checkpoint=None):
+    """Copy data extents of src to dst skipping holes and zero blocks, dst
+    is not truncated so it can be a block device
+    Parameters:
+        bufsize: size of copy buffer, directio.BLOCK_SIZE when not set
+        progress: function called with bytes done, total and seconds
+        interval: seconds between progress and checkpoint calls
+        hasher: checksum.Hasher checking the data before it is written,
+            holes are hashed as zeros
+        limiter: ratelimit.Limiter charged for the data read
+        start_offset: bytes of dst copied by a former copy, they are
+            hashed from src and not copied again
+        checkpoint: function called with the offset copied once dst is
+            synced
+    Returns:
+        tuple of bytes read and bytes written
+    """
+    bufsize = bufsize or directio.BLOCK_SIZE
+    zero = bytes(bufsize)
+    with directio.Reader(src_path) as src:
+        dst = os.open(dst_path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            size = src.size
+            extents = sparse.dataextents(src.fileno(), size)
+            total = sum(end - start for start, end in extents)
+            regular = stat.S_ISREG(os.fstat(dst).st_mode)
+            behind = directio.WriteBehind(dst)
+            start_time = last = monotonic()
+            done = written = offset = 0
+            for start, data in src.chunks(extents, bufsize):
+                if hasher is not None:
+                    hasher.zeros(start - offset)
+                offset = start
+                length = len(data)
+                if offset + length > start_offset:
+                    if limiter is not None:
+                        limiter.take(length)
+                    if not zero.startswith(data):
+                        written += os.pwritev(dst, [data], offset)
+                        behind.add(offset, length)
+                if hasher is not None:
+                    hasher.update(data)
+                offset += length
+                done += length
+                if monotonic() - last >= interval:
+                    last = monotonic()
+                    if checkpoint is not None and offset > start_offset:
+                        os.fsync(dst)
+                        checkpoint(offset)
+                    if progress is not None:
+                        progress(done, total, last - start_time)
+            if hasher is not None:
+                hasher.zeros(size - offset)
+                hasher.result()
+            if regular and os.fstat(dst).st_size < size:
+                os.ftruncate(dst, size)
+            behind.flush()
+            os.fsync(dst)
+            if progress is not None:
+                progress(done, total, monotonic() - start_time)
+        finally:
+            os.close(dst)
+    return done, written
+
+
+def restoredata(device, path, dbg, logging=None, clickecho=None, e_id=None, report=None, expected=None,
+                limiter=None, start_offset=0, checkpoint=None):
+    """Copy raw or sparse image to device
+    Parameters:
+        expected: checksums of the disk checked while it is copied, None to
+            copy without checking
+        limiter: ratelimit.Limiter of the disk
+        start_offset: bytes of device restored by a former copy
+        checkpoint: function called with the offset restored, see
+            sparsecopy
+    Returns:
+        return code, 0 on success
+    """
+    if not waitdevice(device):
+        if logging is not None:
+            logging.error('[{}] Device {} not found'.format(e_id, device))
+        return 1
+
+    def progress(done, total, seconds):
+        message = '[{}] Restored {} of {} MiB of {} at {:.1f} MiB/s'.format(
+            e_id, done // 2**20, total // 2**20, device, done / 2**20 / max(seconds, 0.001))
+        if logging is not None:
+            logging.info(message)
+        if dbg and clickecho is not None:
+            clickecho.echo(message)
+
+    try:
+        start = monotonic()
+        hasher = checksum.Hasher(Path(path).stem, expected) if expected is not None else None
+        if path.endswith(sparse.SUFFIX):
+            with directio.Reader(path) as src:
+                done, written = sparse.unpack(src, device, directio.BLOCK_SIZE, hasher, limiter, start_offset,
+                                              checkpoint)
+            progress(done, done, monotonic() - start)
+        else:
+            done, written = sparsecopy(path, device, progress=progress, hasher=hasher, limiter=limiter,
+                                       start_offset=start_offset, checkpoint=checkpoint)
+        if report is not None:
+            report.disk(Path(path).stem, monotonic() - start, done, written, 'copy')
+    except (OSError, ValueError) as e:
+        if logging is not None:
+            logging.error('[{}] Error restoring {} to {}: {}'.format(e_id, path, device, e))
+        return 1
+    return 0
+
+
+def restoredisks(devices, workers, dbg, logging, clickecho, e_id, report=None, checksums=None, limiter=None,
+                 journal=None, restorer=restoredata):
+    """Copy raw images to devices concurrently
+    Parameters:
+        devices: dict of raw image path and device path, or wait.Ready of
+            them to start each copy as soon as its device is ready
+        workers: number of disks restored at the same time
+        checksums: Checksums of the backup, None to copy without checking
+        limiter: ratelimit.Limiter of the job, each disk is copied with its
+            own limiter
+        journal: journal.Journal of the job, the offset reached in each disk
+            is saved and a disk is resumed from its offset
+        restorer: function copying one image, with the arguments of
+            restoredata
+    Returns:
+        dict of raw image path and return code
+    """
+    def restore(path, device):
+        uuid = Path(path).stem
+        logging.info('[{}] Converting file {}, device {}'.format(
+            e_id, path, device))
+        expected = checksums.expected(uuid) if checksums is not None else None
+        start_offset = 0
+        checkpoint = None
+        if journal is not None:
+            start_offset = journal.disk(uuid).get('offset', 0)
+            if start_offset:
+                logging.info('[{}] Resuming restore of {} at offset {}'.format(e_id, uuid, start_offset))
+
+            def checkpoint(offset):
+                journal.setdisk(uuid, offset=offset)
+        code = restorer(device, path, dbg, logging, clickecho, e_id, report, expected,
+                        limiter.disk() if limiter is not None else None, start_offset, checkpoint)
+        if journal is not None and code == 0:
+            journal.setdisk(uuid, done=True)
+        return code
+
+    results = {}
+    workers = max(1, min(workers, len(devices) or 1))
+    with limiter.running(workers) if limiter is not None else nullcontext(), \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(restore, path, device): path
+                   for path, device in devices.items()}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+@contextmanager
+def tarstream(file):
+    """Open archive as a tar stream read through the decompressor of its
+    codec, reading can stop before the end of the archive"""
+    decompress = CODECS[detectcodec(file)]['decompress']
+    with open(file, 'rb') as tar_fd:
+        if decompress is None:
+            with tarfile.open(fileobj=tar_fd, mode='r|') as tar:
+                yield tar
+            return
+        decompressor = ratelimit.popen(decompress, stdin=tar_fd, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=decompressor.stdout, mode='r|') as tar:
+                yield tar
+        finally:
+            decompressor.stdout.close()
+            if decompressor.poll() is None:
+                decompressor.terminate()
+            decompressor.wait()
+
+
+def unpack_metadata(file, destination, log, e_id):
+    """Extract every member of archive except disk images, reading stops at
+    the first disk image after the OVF
+    Returns:
+        return code, 0 on success
+    """
+    ovf = False
+    try:
+        with tarstream(file) as tar:
+            for member in tar:
+                if sparse.isimage(member.name):
+                    if ovf:
+                        break
+                    continue
+                ovf = ovf or member.name.endswith('.ovf')
+                tar.extract(member, destination)
+    except (OSError, tarfile.TarError) as e:
+        log.error('[{}] Error reading archive {}: {}'.format(e_id, file, e))
+        return 1
+    if not ovf:
+        log.error('[{}] No OVF found in archive {}'.format(e_id, file))
+        return 1
+    return 0
+
+
+def writedevice(src, device, bufsize=None, hasher=None, limiter=None):
+    """Copy file object to device, zero blocks are skipped
+    Parameters:
+        hasher: checksum.Hasher checking the data before it is written
+        limiter: ratelimit.Limiter charged for the data copied
+    Returns:
+        tuple of bytes read and bytes written
+    """
+    bufsize = bufsize or directio.BLOCK_SIZE
+    zero = bytes(bufsize)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    dst = os.open(device, os.O_WRONLY)
+    behind = directio.WriteBehind(dst)
+    try:
+        offset = written = 0
+        while True:
+            length = src.readinto(buf)
+            if not length:
+                break
+            if limiter is not None:
+                limiter.take(length)
+            if hasher is not None:
+                hasher.update(view[:length])
+            if not zero.startswith(view[:length]):
+                written += os.pwrite(dst, view[:length], offset)
+                behind.add(offset, length)
+            offset += length
+        if hasher is not None:
+            hasher.result()
+        behind.flush()
+        os.fsync(dst)
+    finally:
+        os.close(dst)
+    return offset, written
+
+
+def stream_restore(file, devices, dbg, logging, clickecho, e_id, bufsize=None, report=None, checksums=None,
+                   limiter=None):
+    """Write raw or sparse images of archive straight to devices without
+    extracting them, zero blocks are skipped
+    Parameters:
+        file: path of archive
+        devices: dict of disk id and device path, or wait.Ready of them,
+            a disk waits for its device when its member is reached
+        checksums: Checksums read before the disks, checked block by block,
+            when None the checksums written after the disks are checked at
+            the end of the archive
+        limiter: ratelimit.Limiter of the job, each disk is copied with its
+            own limiter
+    Returns:
+        dict of disk id and return code
+    """
+    bufsize = bufsize or directio.BLOCK_SIZE
+    results = {uuid: 1 for uuid in devices}
+    hashed = {}
+    try:
+        with tarstream(file) as tar:
+            for member in tar:
+                uuid = Path(member.name).stem
+                if checksums is None and member.name.endswith('/' + checksum.MANIFEST):
+                    checksums = checksum.loads(tar.extractfile(member).read())
+                    continue
+                if not sparse.isimage(member.name) or uuid not in devices:
+                    continue
+                device = devices.get(uuid)
+                if device is None:
+                    logging.error('[{}] No device for disk {}'.format(e_id, uuid))
+                    continue
+                if not waitdevice(device):
+                    logging.error('[{}] Device {} not found'.format(e_id, device))
+                    continue
+                logging.info('[{}] Streaming {} to device {}'.format(
+                    e_id, member.name, device))
+                if dbg:
+                    clickecho.echo('[{}] Streaming {} to device {}'.format(
+                        e_id, member.name, device))
+                start = monotonic()
+                expected = checksums.expected(uuid) if checksums is not None else None
+                hasher = checksum.Hasher(uuid, expected)
+                disk_limiter = limiter.disk() if limiter is not None else None
+                try:
+                    if member.name.endswith(sparse.SUFFIX):
+                        offset, written = sparse.unpack(tar.extractfile(member), device, bufsize, hasher,
+                                                        disk_limiter)
+                    else:
+                        offset, written = writedevice(tar.extractfile(member), device, bufsize, hasher,
+                                                      disk_limiter)
+                except checksum.ChecksumError as e:
+                    logging.error('[{}] Error restoring {} from {}: {}'.format(e_id, uuid, file, e))
+                    continue
+                if expected is None:
+                    hashed[uuid] = hasher.result()
+                results[uuid] = 0
+                if report is not None:
+                    report.disk(uuid, monotonic() - start, offset, written, 'copy')
+                logging.info('[{}] Restored {} MiB of {} at {:.1f} MiB/s'.format(
+                    e_id, offset // 2**20, device, offset / 2**20 / max(monotonic() - start, 0.001)))
+    except (OSError, ValueError, tarfile.TarError) as e:
+        logging.error('[{}] Error streaming archive {}: {}'.format(e_id, file, e))
+    for uuid, sums in hashed.items():
+        expected = checksums.expected(uuid) if checksums is not None else None
+        if expected is not None and expected['digest'] != sums['digest']:
+            logging.error('[{}] Checksum mismatch of disk {} restored from {}'.format(e_id, uuid, file))
+            results[uuid] = 1
+    return results
+
+
+def seekable_metadata(file, destination, log, e_id):
+    """Extract every member of a seekable archive except disk images
+    Returns:
+        return code, 0 on success
+    """
+    try:
+        with seekable.Reader(file) as reader:
+            for name in reader.members:
+                if sparse.isimage(name):
+                    continue
+                path = os.path.join(destination, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with reader.open(name) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+    except (OSError, ValueError, tarfile.TarError, zlib.error) as e:
+        log.error('[{}] Error reading archive {}: {}'.format(e_id, file, e))
+        return 1
+    return 0
+
+
+def seekable_restore(file, devices, workers, dbg, logging, clickecho, e_id, bufsize=None, report=None,
+                     checksums=None, limiter=None):
+    """Write raw or sparse images of a seekable archive to devices
+    concurrently, reading only the frames of each image
+    Parameters:
+        file: path of archive
+        devices: dict of disk id and device path, or wait.Ready of them to
+            start each copy as soon as its device is ready
+        workers: number of disks restored at the same time
+        checksums: Checksums of the backup, None to copy without checking
+        limiter: ratelimit.Limiter of the job, each disk is copied with its
+            own limiter
+    Returns:
+        dict of disk id and return code
+    """
+    bufsize = bufsize or directio.BLOCK_SIZE
+
+    def restore(uuid, device):
+        if not waitdevice(device):
+            logging.error('[{}] Device {} not found'.format(e_id, device))
+            return 1
+        logging.info('[{}] Reading disk {} to device {}'.format(e_id, uuid, device))
+        if dbg:
+            clickecho.echo('[{}] Reading disk {} to device {}'.format(e_id, uuid, device))
+        start = monotonic()
+        expected = checksums.expected(uuid) if checksums is not None else None
+        hasher = checksum.Hasher(uuid, expected) if expected is not None else None
+        disk_limiter = limiter.disk() if limiter is not None else None
+        try:
+            with seekable.Reader(file) as reader:
+                if any(Path(name).name == uuid + sparse.SUFFIX for name in reader.members):
+                    offset, written = sparse.unpack(reader.open(uuid + sparse.SUFFIX), device, bufsize, hasher,
+                                                    disk_limiter)
+                elif reader.disksize(uuid + '.raw') is not None:
+                    offset, written = sparse.unpack(reader.open(uuid + '.raw', True), device, bufsize, hasher,
+                                                    disk_limiter, size=reader.disksize(uuid + '.raw'))
+                else:
+                    offset, written = writedevice(reader.open(uuid + '.raw'), device, bufsize, hasher,
+                                                  disk_limiter)
+        except (OSError, KeyError, ValueError, tarfile.TarError, zlib.error) as e:
+            logging.error('[{}] Error restoring {} from {}: {}'.format(e_id, uuid, file, e))
+            return 1
+        if report is not None:
+            report.disk(uuid, monotonic() - start, offset, written, 'copy')
+        logging.info('[{}] Restored {} MiB of {} at {:.1f} MiB/s'.format(
+            e_id, offset // 2**20, device, offset / 2**20 / max(monotonic() - start, 0.001)))
+        return 0
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(devices) or 1))) as executor:
+        futures = {executor.submit(restore, uuid, device): uuid
+                   for uuid, device in devices.items()}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
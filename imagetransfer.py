@@ -0,0 +1,365 @@
+import http.client
+import io
+import json
+import os
+import ssl
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from urllib.parse import urlsplit
+
+import checksum
+import directio
+import wait
+
+# Disks read over the image transfer API instead of attaching the snapshot
+# disks to the agent. The engine opens a ticket on the imageio daemon of a
+# host and the disk is read from the transfer url with ranged requests, the
+# next chunks of data are requested on several connections while the current
+# one is consumed and the zero extents reported by the daemon are not read.
+ATTACH = 'attach'
+TRANSFER = 'transfer'
+BACKENDS = (ATTACH, TRANSFER)
+CHUNK_SIZE = 8 * 2**20
+# connections per disk and CA certificate of the imageio daemons
+CONNECTIONS = 4
+CA_FILE = None
+
+
+class TransferError(OSError):
+    pass
+
+
+def isurl(path):
+    return path.startswith(('https://', 'http://'))
+
+
+class Client:
+    """HTTP client of the image of a transfer, each thread uses its own
+    connection
+    Parameters:
+        url: transfer url of the image
+        ca: CA certificate of an https url, CA_FILE if not set
+    """
+
+    def __init__(self, url, ca=None):
+        parts = urlsplit(url)
+        self.url = url
+        self.path = parts.path
+        self.netloc = parts.netloc
+        self._context = None
+        if parts.scheme == 'https':
+            self._context = ssl.create_default_context(cafile=ca or CA_FILE)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            if self._context is not None:
+                conn = http.client.HTTPSConnection(self.netloc, context=self._context)
+            else:
+                conn = http.client.HTTPConnection(self.netloc)
+            self._local.connection = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def request(self, method, path, headers=None, buf=None):
+        """Send a request, once more on a new connection when the server
+        closed the connection kept alive
+        Parameters:
+            buf: buffer receiving the body, the body is returned if not set
+        Returns:
+            body or bytes received in buf
+        """
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+                if response.status >= 300:
+                    raise TransferError('{} {} failed with status {}: {}'.format(
+                        method, self.url, response.status, response.read(512).decode('utf-8', 'replace')))
+                if buf is None:
+                    return response.read()
+                length = 0
+                view = memoryview(buf)
+                while length < len(buf):
+                    received = response.readinto(view[length:])
+                    if not received:
+                        break
+                    length += received
+                return length
+            except (http.client.HTTPException, ConnectionError) as e:
+                conn.close()
+                if attempt:
+                    raise TransferError('{} {} failed: {}'.format(method, self.url, e))
+
+    def extents(self):
+        """Return list of start, end and zero flag of the extents of the
+        image"""
+        data = json.loads(self.request('GET', self.path + '/extents?context=zero'))
+        return [(extent['start'], extent['start'] + extent['length'], extent['zero']) for extent in data]
+
+    def size(self):
+        extents = self.extents()
+        return extents[-1][1] if extents else 0
+
+    def readinto(self, buf, offset):
+        """Read the range of the image at offset filling buf"""
+        length = self.request('GET', self.path, {'Range': 'bytes={}-{}'.format(offset, offset + len(buf) - 1)}, buf)
+        if length != len(buf):
+            raise TransferError('short read of {} bytes at offset {} of {}, expected {}'.format(
+                length, offset, self.url, len(buf)))
+        return length
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+class Reader(io.RawIOBase):
+    """File object reading an image in order, up to twice connections
+    chunks of data are requested ahead on their own connections and zero
+    extents are read as zeros without requests
+    Parameters:
+        url: transfer url of the image
+        connections: connections to the image, CONNECTIONS if not set
+    """
+
+    def __init__(self, url, connections=None, chunk_size=CHUNK_SIZE):
+        self.url = url
+        self.client = Client(url)
+        self.chunk_size = chunk_size
+        self.connections = connections or CONNECTIONS
+        self.extents = self.client.extents()
+        self.size = self.extents[-1][1] if self.extents else 0
+        self._executor = None
+        self._chunks = None
+        self._zero = memoryview(bytes(chunk_size))
+        self._view = self._zero[:0]
+
+    def readable(self):
+        return True
+
+    def _read(self, offset, length):
+        buf = bytearray(length)
+        self.client.readinto(buf, offset)
+        return buf
+
+    def chunks(self, offset=0):
+        """Yield offset, length and data of each chunk of the image in
+        order from offset, data is None for zeros"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.connections)
+        ranges = ((start, min(end, start + self.chunk_size), zero)
+                  for first, end, zero in self.extents if end > offset
+                  for start in range(max(first, offset), end, self.chunk_size))
+        pending = deque()
+        while True:
+            for start, end, zero in ranges:
+                future = None if zero else self._executor.submit(self._read, start, end - start)
+                pending.append((start, end - start, future))
+                if len(pending) >= 2 * self.connections:
+                    break
+            if not pending:
+                return
+            start, length, future = pending.popleft()
+            yield start, length, future.result() if future is not None else None
+
+    def readinto(self, buf):
+        """Fill buf like a read of a file, short only at the end of the
+        image so the blocks of the callers stay aligned"""
+        view = memoryview(buf).cast('B')
+        done = 0
+        while done < len(view):
+            if not self._view:
+                if self._chunks is None:
+                    self._chunks = self.chunks()
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                _, length, data = chunk
+                self._view = self._zero[:length] if data is None else memoryview(data)
+            length = min(len(view) - done, len(self._view))
+            view[done:done + length] = self._view[:length]
+            self._view = self._view[length:]
+            done += length
+        return done
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        self.client.close()
+        super().close()
+
+
+def opendisk(path):
+    """Return unbuffered file object reading a file, device or transfer
+    url, files and devices are read by directio"""
+    if isurl(path):
+        return Reader(path)
+    return directio.Reader(path)
+
+
+def disksize(fileobj):
+    """Return size of a file object of opendisk"""
+    if isinstance(fileobj, (Reader, directio.Reader)):
+        return fileobj.size
+    size = os.lseek(fileobj.fileno(), 0, os.SEEK_END)
+    os.lseek(fileobj.fileno(), 0, os.SEEK_SET)
+    return size
+
+
+def download(url, raw_file, connections=None, chunk_size=CHUNK_SIZE, hasher=None, limiter=None, offset=0,
+             checkpoint=None, interval=10):
+    """Write image of transfer url to a sparse raw image
+    Parameters:
+        connections: connections to the image, CONNECTIONS if not set
+        hasher: checksum.Hasher fed with the image in order
+        limiter: ratelimit.Limiter charged for the data read
+        offset: bytes of raw_file written by a former download of the same
+            image, they are hashed from raw_file and not downloaded again
+        checkpoint: function called with the bytes written every interval
+            seconds, once they are synced
+    Returns:
+        tuple of image size and bytes written
+    """
+    written = 0
+    zero = bytes(chunk_size)
+    with Reader(url, connections, chunk_size) as reader, open(raw_file, 'r+b' if offset else 'wb') as dst:
+        dst.truncate(offset)
+        if hasher is not None:
+            done = 0
+            while done < offset:
+                data = os.pread(dst.fileno(), min(chunk_size, offset - done), done)
+                if not data:
+                    raise TransferError('{} is shorter than offset {}'.format(raw_file, offset))
+                hasher.update(data)
+                done += len(data)
+        last = monotonic()
+        for start, length, data in reader.chunks(offset):
+            if data is not None:
+                if limiter is not None:
+                    limiter.take(length)
+                if hasher is not None:
+                    hasher.update(data)
+                if not zero.startswith(data):
+                    written += os.pwrite(dst.fileno(), data, start)
+            elif hasher is not None:
+                hasher.zeros(length)
+            if checkpoint is not None and monotonic() - last >= interval:
+                os.fsync(dst.fileno())
+                checkpoint(start + length)
+                last = monotonic()
+        dst.truncate(reader.size)
+    return reader.size, written
+
+
+class TransferConverter:
+    """Converter for helpers.qemuconvert downloading the image transfer url
+    of each disk to a raw image
+    Parameters:
+        connections: connections per disk, CONNECTIONS if not set
+        journal: journal.Journal of the job, the offset reached in each disk
+            is saved and a disk is resumed from its offset
+    """
+
+    def __init__(self, connections=None, journal=None):
+        self.connections = connections
+        self.journal = journal
+        self.disks = {}
+        self.checksums = {}
+
+    def __call__(self, event_id, uuid, url, path, dbg, logging, clickecho, progress=False, limiter=None):
+        logging.info('[{}] Downloading uuid {}, transfer {}'.format(event_id, uuid, url))
+        if dbg:
+            clickecho.echo('[{}] Downloading uuid {}, transfer {}'.format(event_id, uuid, url))
+        hasher = checksum.Hasher(uuid)
+        offset = 0
+        checkpoint = None
+        if self.journal is not None:
+            offset = self.journal.disk(uuid).get('offset', 0)
+            if offset and not os.path.exists(path + uuid + '.raw'):
+                offset = 0
+            if offset:
+                logging.info('[{}] Resuming download of uuid {} at offset {}'.format(event_id, uuid, offset))
+
+            def checkpoint(done):
+                self.journal.setdisk(uuid, offset=done)
+        try:
+            size, written = download(url, path + uuid + '.raw', self.connections, hasher=hasher, limiter=limiter,
+                                     offset=offset, checkpoint=checkpoint)
+        except (OSError, ValueError) as e:
+            logging.error('[{}] Error downloading disk {}: {}'.format(event_id, uuid, e))
+            return 1
+        self.disks[uuid] = {'size': size, 'written': written}
+        self.checksums[uuid] = hasher.result()
+        return 0
+
+
+def starttransfers(system_service, snap_disks, types, logging, timeout=300):
+    """Start a download of each disk of a snapshot, the started transfers
+    are cancelled when one fails
+    Parameters:
+        snap_disks: disks of the snapshot
+        timeout: seconds to wait for each transfer to be ready
+    Returns:
+        dict of disk id and image transfer
+    """
+    transfers_service = system_service.image_transfers_service()
+    transfers = {}
+    try:
+        for snap_disk in snap_disks:
+            transfers[snap_disk.id] = transfers_service.add(types.ImageTransfer(
+                snapshot=types.DiskSnapshot(id=snap_disk.image_id),
+                direction=types.ImageTransferDirection.DOWNLOAD,
+                format=types.DiskFormat.RAW,
+            ))
+        for disk_id, transfer in transfers.items():
+            transfers[disk_id] = waittransfer(transfers_service, transfer, types, logging, timeout)
+    except BaseException:
+        for transfer in transfers.values():
+            try:
+                transfers_service.image_transfer_service(transfer.id).cancel()
+            except Exception as e:
+                logging.error('Error cancelling image transfer {}: {}'.format(transfer.id, e))
+        raise
+    return transfers
+
+
+def waittransfer(transfers_service, transfer, types, logging, timeout=300):
+    """Return image transfer once its url can be read"""
+    transfer_service = transfers_service.image_transfer_service(transfer.id)
+
+    def ready():
+        current = transfer_service.get()
+        if current.phase == types.ImageTransferPhase.TRANSFERRING:
+            return current
+        if current.phase != types.ImageTransferPhase.INITIALIZING:
+            raise TransferError('image transfer {} is {}'.format(transfer.id, current.phase))
+        return None
+
+    return wait.waitfor(ready, timeout, 'image transfer {}'.format(transfer.id), logging, initial=0.2, maximum=2)
+
+
+def transferurl(transfer):
+    """Return url of the host of a transfer, the url of the proxy of the
+    engine when the host is not reachable"""
+    return transfer.transfer_url or transfer.proxy_url
+
+
+def finishtransfers(system_service, transfers, logging):
+    """Finalize transfers, the disks are unlocked by the engine"""
+    transfers_service = system_service.image_transfers_service()
+    for disk_id, transfer in transfers.items():
+        try:
+            transfers_service.image_transfer_service(transfer.id).finalize()
+        except Exception as e:
+            logging.error('Error finalizing image transfer {} of disk {}: {}'.format(transfer.id, disk_id, e))
@@ -0,0 +1,265 @@
+import json
+import os
+import shutil
+import struct
+from pathlib import Path
+
+import checksum
+import helpers
+import imagetransfer
+
+# Delta file of a disk, header followed by records of changed blocks, data
+# records carry the block, zero records only mark the block as zeroed
+MAGIC = b'CLIOBRD1'
+HEADER = struct.Struct('<8sIQ')  # magic, block size, disk size
+RECORD = struct.Struct('<QIB')  # block index, length, kind
+DATA = 0
+ZERO = 1
+BLOCK_SIZE = checksum.BLOCK_SIZE
+DIGEST_SIZE = checksum.DIGEST_SIZE
+MANIFEST = 'manifest.json'
+CHECKPOINTS = '.checkpoints'
+
+
+def blockdigest(block):
+    return checksum.blockdigest(block)
+
+
+def checkpointdir(backup_path, vm_id):
+    return os.path.join(backup_path, CHECKPOINTS, vm_id)
+
+
+def loadcheckpoint(backup_path, vm_id):
+    """Return last checkpoint of vm, None if there is no checkpoint"""
+    path = os.path.join(checkpointdir(backup_path, vm_id), 'checkpoint.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def savecheckpoint(backup_path, vm_id, backup_name, disks, depth):
+    """Make the block hashes of a finished backup the new checkpoint
+    Parameters:
+        backup_name: name of backup directory
+        disks: ids of disks in the backup
+        depth: number of incremental backups since the full backup
+    """
+    path = checkpointdir(backup_path, vm_id)
+    for disk in disks:
+        os.replace(os.path.join(path, disk + '.hashes.new'),
+                   os.path.join(path, disk + '.hashes'))
+    with open(os.path.join(path, 'checkpoint.json.new'), 'w') as fd:
+        json.dump({'backup': backup_name, 'disks': sorted(disks), 'depth': depth}, fd)
+    os.replace(os.path.join(path, 'checkpoint.json.new'),
+               os.path.join(path, 'checkpoint.json'))
+
+
+def parentbackup(backup_path, vm_id, max_chain):
+    """Return checkpoint to use as parent of the next backup, None when the
+    next backup must be full
+    Parameters:
+        max_chain: incremental backups before a new full backup
+    """
+    checkpoint = loadcheckpoint(backup_path, vm_id)
+    if checkpoint is None or checkpoint['depth'] >= max_chain:
+        return None
+    if findbackup(backup_path, checkpoint['backup']) is None:
+        return None
+    return checkpoint
+
+
+def dropcheckpoint(backup_path, vm_id):
+    """Remove block hashes left by a failed backup"""
+    path = Path(checkpointdir(backup_path, vm_id))
+    for new in path.glob('*.new'):
+        new.unlink()
+
+
+def findbackup(backup_path, name):
+    """Return path of backup directory or archive by name, None if missing"""
+    path = os.path.join(backup_path, name)
+    if os.path.isdir(path):
+        return path
+    for codec in helpers.CODECS:
+        archive = helpers.archivename(path, codec)
+        if os.path.exists(archive):
+            return archive
+    return None
+
+
+def writemanifest(directory, manifest):
+    with open(os.path.join(directory, MANIFEST), 'w') as fd:
+        json.dump(manifest, fd, indent=2)
+
+
+def readmanifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as fd:
+        return json.load(fd)
+
+
+def deltadisk(device, delta_file, old_hashes, hashes_file, block_size=BLOCK_SIZE, limiter=None):
+    """Copy blocks of device changed since checkpoint to delta file
+    Parameters:
+        device: path of device
+        delta_file: path of delta file to write
+        old_hashes: block hashes of checkpoint, empty for a full copy
+        hashes_file: path to write block hashes of this copy
+        limiter: ratelimit.Limiter charged for the blocks read
+    Returns:
+        tuple of disk size and blocks written
+    """
+    size = helpers.devicesize(device)
+    zero = bytes(block_size)
+    written = 0
+    buf = bytearray(block_size)
+    with imagetransfer.opendisk(device) as src, open(delta_file, 'wb') as dst, \
+            open(hashes_file, 'wb') as hashes:
+        dst.write(HEADER.pack(MAGIC, block_size, size))
+        index = 0
+        while True:
+            length = src.readinto(buf)
+            if not length:
+                break
+            block = memoryview(buf)[:length]
+            if limiter is not None:
+                limiter.take(length)
+            digest = blockdigest(block)
+            hashes.write(digest)
+            old = old_hashes[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+            if digest != old:
+                if block == zero[:length]:
+                    # new blocks of the file start as zeros
+                    if old:
+                        dst.write(RECORD.pack(index, length, ZERO))
+                        written += 1
+                else:
+                    dst.write(RECORD.pack(index, length, DATA))
+                    dst.write(block)
+                    written += 1
+            index += 1
+    return size, written
+
+
+def applydelta(delta_file, raw_file):
+    """Apply delta file over a raw image, the image is created if missing"""
+    if not os.path.exists(raw_file):
+        open(raw_file, 'wb').close()
+    with open(delta_file, 'rb') as src, open(raw_file, 'rb+') as dst:
+        magic, block_size, size = HEADER.unpack(src.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('{} is not a delta file'.format(delta_file))
+        dst.truncate(size)
+        while True:
+            record = src.read(RECORD.size)
+            if not record:
+                break
+            index, length, kind = RECORD.unpack(record)
+            dst.seek(index * block_size)
+            if kind == DATA:
+                dst.write(src.read(length))
+            else:
+                dst.write(bytes(length))
+
+
+class DeltaConverter:
+    """Converter for helpers.qemuconvert writing delta files of the disks
+    against the checkpoint of the vm
+    Parameters:
+        backup_path: path of backups
+        vm_id: id of vm
+        checkpoint: disks of the checkpoint, disks not in the checkpoint are
+            copied in full
+    """
+
+    def __init__(self, backup_path, vm_id, checkpoint=(), block_size=BLOCK_SIZE):
+        self.path = checkpointdir(backup_path, vm_id)
+        self.checkpoint = set(checkpoint)
+        self.block_size = block_size
+        self.disks = {}
+        self.checksums = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def __call__(self, event_id, uuid, device, path, dbg, logging, clickecho, progress=False, limiter=None):
+        if not helpers.waitdevice(device):
+            logging.error(
+                '[{}] Device {} not found for disk {}'.format(event_id, device, uuid))
+            return 1
+        old_hashes = b''
+        hashes_file = os.path.join(self.path, uuid + '.hashes')
+        if uuid in self.checkpoint and os.path.exists(hashes_file):
+            with open(hashes_file, 'rb') as fd:
+                old_hashes = fd.read()
+        logging.info('[{}] Copying changed blocks of uuid {}, device {}'.format(
+            event_id, uuid, device))
+        if dbg:
+            clickecho.echo('[{}] Copying changed blocks of uuid {}, device {}'.format(
+                event_id, uuid, device))
+        try:
+            size, written = deltadisk(device, path + uuid + '.delta', old_hashes,
+                                      hashes_file + '.new', self.block_size, limiter)
+        except OSError as e:
+            logging.error('[{}] Error copying device {}: {}'.format(event_id, device, e))
+            return 1
+        self.disks[uuid] = {'file': uuid + '.delta', 'size': size, 'blocks': written,
+                            'written': os.path.getsize(path + uuid + '.delta'),
+                            'incremental': bool(old_hashes)}
+        if self.block_size == checksum.BLOCK_SIZE:
+            # the block hashes of the whole disk are its checksums
+            with open(hashes_file + '.new', 'rb') as fd:
+                self.checksums[uuid] = checksum.fromdigests(size, fd.read())
+        logging.info('[{}] Wrote {} changed blocks of disk {}'.format(
+            event_id, written, uuid))
+        return 0
+
+
+def rebuild(basedir, parent_path, log, e_id):
+    """Rebuild raw images of an incremental backup from its chain
+    Parameters:
+        basedir: extracted directory of the backup to restore
+        parent_path: directory with the parent backups
+    Returns:
+        return code, 0 on success
+    """
+    chain = [basedir]
+    unpacked = []
+    try:
+        manifest = readmanifest(basedir)
+        manifests = [manifest]
+        while manifest.get('parent'):
+            parent = findbackup(parent_path, manifest['parent'])
+            if parent is None:
+                log.error('[{}] Parent backup {} not found in {}'.format(
+                    e_id, manifest['parent'], parent_path))
+                return 1
+            if not os.path.isdir(parent):
+                log.info('[{}] Unpacking parent backup {}'.format(e_id, parent))
+                error = helpers.unpack_archive(parent, parent_path, log, e_id)
+                if error:
+                    return 1
+                parent = helpers.archivebase(parent)
+                unpacked.append(parent)
+            chain.append(parent)
+            manifest = readmanifest(parent)
+            manifests.append(manifest)
+        for disk in manifests[0]['disks']:
+            # deltas from the last full copy of the disk to the target
+            deltas = []
+            for directory, manifest in zip(chain, manifests):
+                if disk not in manifest['disks']:
+                    break
+                deltas.insert(0, os.path.join(directory, manifest['disks'][disk]['file']))
+                if not manifest['disks'][disk]['incremental']:
+                    break
+            raw_file = os.path.join(basedir, disk + '.raw')
+            for delta in deltas:
+                applydelta(delta, raw_file)
+            log.info('[{}] Rebuilt disk {} from {} backups'.format(
+                e_id, disk, len(deltas)))
+    except (OSError, ValueError) as e:
+        log.error('[{}] Error rebuilding incremental backup: {}'.format(e_id, e))
+        return 1
+    finally:
+        for directory in unpacked:
+            shutil.rmtree(directory, ignore_errors=True)
+    return 0
@@ -0,0 +1,86 @@
+import logging
+import threading
+from time import monotonic
+
+
+class Inventory:
+    """Index of vms, disks and storage domains by name and id
+
+    The objects are listed in bulk without all_content and kept until the
+    ttl expires, the OVF of a vm is fetched only by content().
+
+    Parameters:
+        system_service: root service of the connection
+        ttl: seconds before the index is listed again
+    """
+
+    def __init__(self, system_service, ttl=300):
+        self.system_service = system_service
+        self.ttl = ttl
+        self._vms = {}
+        self._disks = {}
+        self._storage_domains = {}
+        self._loaded = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _index(objects):
+        index = {}
+        for obj in objects:
+            index[obj.id] = obj
+            if obj.name:
+                index.setdefault(obj.name, obj)
+        return index
+
+    def refresh(self):
+        """List vms, disks and storage domains again"""
+        with self._lock:
+            start = monotonic()
+            self._vms = self._index(self.system_service.vms_service().list())
+            self._disks = self._index(self.system_service.disks_service().list())
+            self._storage_domains = self._index(self.system_service.storage_domains_service().list())
+            self._loaded = monotonic()
+            logging.info('Listed {} vms, {} disks and {} storage domains in {:.1f}s'.format(
+                len({vm.id for vm in self._vms.values()}), len({disk.id for disk in self._disks.values()}),
+                len({sd.id for sd in self._storage_domains.values()}), self._loaded - start))
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = None
+
+    def _fresh(self):
+        if self._loaded is None or monotonic() - self._loaded > self.ttl:
+            self.refresh()
+
+    def vm(self, key):
+        """Return vm by name or id, None if it does not exist"""
+        with self._lock:
+            self._fresh()
+            vm = self._vms.get(key)
+            if vm is None:
+                # created after the last listing
+                found = self.system_service.vms_service().list(search='name={}'.format(key))
+                if found:
+                    vm = found[0]
+                    self._vms[vm.id] = vm
+                    self._vms[vm.name] = vm
+            return vm
+
+    def disk(self, key):
+        """Return disk by name or id, None if it does not exist"""
+        with self._lock:
+            self._fresh()
+            return self._disks.get(key)
+
+    def storagedomain(self, key):
+        """Return storage domain by name or id, None if it does not exist"""
+        with self._lock:
+            self._fresh()
+            return self._storage_domains.get(key)
+
+
+def content(vms_service, vm):
+    """Return vm with all content, the vm itself when it has the OVF"""
+    if vm.initialization is not None and vm.initialization.configuration is not None:
+        return vm
+    return vms_service.vm_service(vm.id).get(all_content=True)
@@ -0,0 +1,1306 @@
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import click
+import ovirtsdk4 as sdk
+import ovirtsdk4.types as types
+from lxml import etree
+
+import agents
+import catalog
+import checksum
+import chunkstore
+import descriptor
+import helpers
+import imagetransfer
+import incremental
+import inventory
+import journal
+import offload
+import ratelimit
+import report
+import seekable
+import sparse
+import wait
+
+Description = 'cli-ovirt-backup'
+
+
+def info(message, dbg):
+    logging.info(message)
+    if dbg:
+        click.echo(message)
+
+
+class SharedConnection(sdk.Connection):
+    """Connection shared by several backup jobs
+
+    The SDK connection drives one curl multi handle, requests sent from
+    different threads are serialized with a lock.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.RLock()
+
+    def send(self, *args, **kwargs):
+        with self._lock:
+            return super().send(*args, **kwargs)
+
+    def wait(self, *args, **kwargs):
+        with self._lock:
+            return super().wait(*args, **kwargs)
+
+
+class Slots:
+    """Counting semaphore that takes several slots at once"""
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, count=1):
+        count = min(count, self.size)
+        with self._cond:
+            while self.used + count > self.size:
+                self._cond.wait()
+            self.used += count
+        return count
+
+    def release(self, count=1):
+        with self._cond:
+            self.used -= count
+            self._cond.notify_all()
+
+
+class Limits:
+    """Global limits shared by the jobs of a batch
+    Parameters:
+        snapshots: snapshots created at the same time
+        attachments: disks attached to the agent at the same time
+        disks: disks converted at the same time
+        archives: archives written at the same time
+    """
+
+    def __init__(self, snapshots=2, attachments=8, disks=4, archives=2):
+        self.snapshots = threading.BoundedSemaphore(snapshots)
+        self.attachments = Slots(attachments)
+        self.disks = threading.BoundedSemaphore(disks)
+        self.archives = threading.BoundedSemaphore(archives)
+
+
+def backupvm(system_service, vm, vm_agent, backup_path, event_id, dbg, unarchive=False, workers=4,
+             storage_workers=2, limits=None, stream=False, codec='gzip', level=None, threads=0,
+             incremental_chain=0, dedup=False, prometheus_dir=None, disk_limit=None, job_limit=None,
+             backend=imagetransfer.ATTACH, disk_format=sparse.RAW, pool=None, resume=None, abandon_failed=False):
+    """Backup one virtual machine
+    Parameters:
+        system_service: root service of the connection
+        vm: vm object, the OVF is fetched when the vm has no content
+        vm_agent: vm object of the agent
+        backup_path: path of backups
+        event_id: id for events in manager
+        limits: Limits shared with other jobs, None for no limits
+        stream: copy the disks straight into the archive
+        codec: compression codec of archive, see helpers.CODECS
+        level: compression level, None for default of codec
+        threads: compression threads, 0 for all cores
+        incremental_chain: copy only blocks changed since the last backup,
+            with a full backup after this number of incremental backups,
+            0 to copy the disks in full with qemu-img
+        dedup: store the disks in the chunk store of backup path, the
+            backup directory keeps the OVF and chunk manifests
+        prometheus_dir: directory for a Prometheus textfile of the job, the
+            JSON report is always written next to the backup
+        disk_limit: bandwidth and IOPS of each disk as RATE[,IOPS], see
+            ratelimit.parselimit
+        job_limit: bandwidth and IOPS of the job as RATE[,IOPS]
+        backend: imagetransfer.ATTACH to read the snapshot disks attached
+            to the agent, imagetransfer.TRANSFER to read them from image
+            transfer urls without attaching them
+        disk_format: sparse.RAW to store the disks as raw images,
+            sparse.SPARSE to store only their data with an extent map, the
+            disks of incremental and dedup backups are stored in their own
+            formats
+        pool: agents.Pool converting the disks of full backups on several
+            agents, None to convert them on vm_agent
+        resume: journal.Journal of a failed run of the backup, the disks
+            copied from its snapshot are kept and the others are copied
+        abandon_failed: abandon the failed backups of the vm, see abandonjob,
+            they are kept to resume them by default
+    Returns:
+        return code of backup
+    """
+    events_service = system_service.events_service()
+    vms_service = system_service.vms_service()
+    vm = inventory.content(vms_service, vm)
+    limiter = ratelimit.joblimiter(job_limit, disk_limit)
+    job_report = report.JobReport('backup', vm.name, event_id)
+
+    message = (
+        '[{}] Backup of virtual machine \'{}\' using snapshot \'{}\' is '
+        'starting.'.format(event_id, vm.name, Description)
+    )
+    helpers.send_events(events_service, event_id,
+                        types, Description, message, vm)
+
+    timestamp = time.strftime("%Y%m%d%H%M%S") if resume is None else resume.get('timestamp')
+    backup_path_obj = Path(backup_path)
+    backup_name_obj = Path(vm.name + '-' + timestamp + '-' + vm.id)
+    vm_backup_obj = backup_path_obj / backup_name_obj
+    vm_backup_absolute = vm_backup_obj.absolute().as_posix()
+
+    if not backup_path_obj.exists():
+        logging.error("[{}] Mount point {} not exists".format(
+            event_id, backup_path_obj.name))
+        return 1
+
+    if resume is None:
+        failed = failedbackups(backup_path, vm.id)
+        if failed and abandon_failed:
+            abandonbackups(system_service, vm_agent, backup_path, failed, event_id)
+        elif failed and incremental_chain and not dedup and any(
+                (f.get('options') or {}).get('incremental_chain') and not (f.get('options') or {}).get('dedup')
+                for f in failed):
+            # the failed backup keeps the block hashes of its disks until it
+            # is resumed, a new checkpoint would make its deltas wrong
+            logging.error('[{}] Failed backups {} of virtual machine \'{}\' have block hashes to resume, resume '
+                          'them with: cliobr resume NAME, or abandon them with --abandon-failed'.format(
+                              event_id, ', '.join(f.name for f in failed), vm.name))
+            if dbg:
+                click.echo('[{}] Failed backups {} of virtual machine \'{}\' must be resumed or abandoned'.format(
+                    event_id, ', '.join(f.name for f in failed), vm.name))
+            return 1
+        elif failed:
+            info('[{}] Kept failed backups {}, resume them with: cliobr resume NAME'.format(
+                event_id, ', '.join(f.name for f in failed)), dbg)
+        job_journal = journal.create(backup_path, backup_name_obj.name, journal.BACKUP, vm=vm.name, vm_id=vm.id,
+                                     timestamp=timestamp, options={
+                                         'unarchive': unarchive, 'workers': workers,
+                                         'storage_workers': storage_workers, 'stream': stream, 'codec': codec,
+                                         'level': level, 'threads': threads, 'incremental_chain': incremental_chain,
+                                         'dedup': dedup, 'prometheus_dir': prometheus_dir, 'disk_limit': disk_limit,
+                                         'job_limit': job_limit, 'backend': backend, 'disk_format': disk_format})
+    elif not resume.lock():
+        logging.error('[{}] Backup \'{}\' is already running'.format(event_id, resume.name))
+        return 1
+    else:
+        job_journal = resume
+        info('[{}] Resuming backup \'{}\''.format(event_id, job_journal.name), dbg)
+
+    info('[{}] Found data virtual machine \'{}\', the id is \'{}\'.'.format(
+        event_id, vm.name, vm.id), dbg)
+
+    # Find the services that manage the data and agent virtual machines:
+    data_vm_service = vms_service.vm_service(vm.id)
+    agent_vm_service = vms_service.vm_service(vm_agent.id)
+
+    checkpoint = None
+    if incremental_chain and not dedup:
+        if resume is None:
+            checkpoint = incremental.parentbackup(backup_path, vm.id, incremental_chain)
+            job_journal.update(checkpoint=checkpoint)
+        else:
+            checkpoint = job_journal.get('checkpoint')
+    streaming = stream and not unarchive and not dedup and not incremental_chain
+    # the stream, the chunk store and the block hashes are written by this
+    # process, only the copies of full backups go to the agents of the pool
+    pooled = pool is not None and backend == imagetransfer.ATTACH and not streaming and not dedup \
+        and not incremental_chain
+    members = {}
+    onerror = 0
+    upload = None
+    archive = helpers.archivename(vm_backup_absolute, codec)
+    checksums = checksum.Checksums()
+    if job_journal.get('copied') and os.path.isdir(vm_backup_absolute):
+        checksums = checksum.readmanifest(vm_backup_absolute) or checksums
+    if not job_journal.get('copied'):
+        if not os.path.isdir(vm_backup_absolute):
+            helpers.createdir(vm_backup_absolute)
+            info('[{}] Creating directory {}.'.format(
+                event_id, vm_backup_absolute), dbg)
+
+        ovf_file = helpers.writeconfig(vm, vm_backup_absolute + '/')
+        info('[{}] Wrote OVF to file \'{}\''.format(event_id, ovf_file), dbg)
+
+        snaps_service = data_vm_service.snapshots_service()
+
+        snap = None
+        if job_journal.get('snapshot'):
+            snap = helpers.findsnapshot(snaps_service, job_journal.get('snapshot'))
+            if snap is None:
+                info('[{}] Snapshot \'{}\' of the failed backup is gone, copying every disk'.format(
+                    event_id, job_journal.get('snapshot')), dbg)
+                job_journal.update(snapshot=None, disks={})
+            detachleftovers(system_service, vm_agent, job_journal, logging)
+
+        if limits is not None:
+            limits.snapshots.acquire()
+        try:
+            with job_report.phase('snapshot'):
+                if snap is None:
+                    snap = helpers.createsnapshot(snaps_service, types, Description)
+                    job_journal.update(snapshot=snap.id)
+                    info('[{}] Sent request to create snapshot \'{}\', the id is \'{}\'.'.format(
+                        event_id, snap.description, snap.id), dbg)
+
+                snap_service = snaps_service.snapshot_service(snap.id)
+                helpers.waitingsnapshot(snap, types, logging, time,
+                                        snap_service, click, dbg, event_id)
+        except TimeoutError as e:
+            # the snapshot is kept, a resume waits for it again
+            logging.error('[{}] Error waiting for the snapshot: {}'.format(event_id, e))
+            onerror = 1
+        finally:
+            if limits is not None:
+                limits.snapshots.release()
+
+        if onerror == 0:
+            # Retrieve the descriptions of the disks of the snapshot:
+            snap_disks_service = snap_service.disks_service()
+            snap_disks = snap_disks_service.list()
+            job_journal.update(sizes={snap_disk.id: snap_disk.provisioned_size for snap_disk in snap_disks})
+            # disks copied by a failed run, the archive of a stream is written again
+            done = set() if streaming else job_journal.done()
+            if done:
+                info('[{}] Keeping {} disks copied by the failed backup'.format(event_id, len(done)), dbg)
+            pending = [snap_disk for snap_disk in snap_disks if snap_disk.id not in done]
+
+            # Attach disk service
+            attachments_service = agent_vm_service.disk_attachments_service()
+
+            slots = 0
+            if limits is not None and backend == imagetransfer.ATTACH and not pooled:
+                slots = limits.attachments.acquire(len(pending))
+            attachments = []
+            transfers = {}
+            try:
+                devices = {}
+                if backend == imagetransfer.TRANSFER:
+                    with job_report.phase('attach'):
+                        transfers = imagetransfer.starttransfers(system_service, pending, types, logging)
+                    job_journal.update(transfers=[transfer.id for transfer in transfers.values()])
+                    for disk_id, transfer in transfers.items():
+                        devices[disk_id] = imagetransfer.transferurl(transfer)
+                        info('[{}] Started image transfer \'{}\' of disk \'{}\'.'.format(
+                            event_id, transfer.id, disk_id), dbg)
+                elif pooled:
+                    # each disk is attached to its agent when it is converted
+                    for snap_disk in pending:
+                        devices[snap_disk.id] = helpers.DEVICE_PATH + snap_disk.id
+                else:
+                    with job_report.phase('attach'):
+                        attachments = helpers.populateattachments(
+                            pending, snap, attachments_service, types, logging, click, dbg)
+                    job_journal.update(attachments=[attach.id for attach in attachments])
+
+                    for attach in attachments:
+                        info('[{}] Attached disk \'{}\' to the agent virtual machine.'.format(
+                            event_id, attach.disk.id), dbg)
+
+                    for i in range(len(attachments)):
+                        devices[attachments[i].disk.id] = helpers.DEVICE_PATH + \
+                            attachments[i].disk.id
+
+                storages = {}
+                for snap_disk in snap_disks:
+                    if snap_disk.storage_domains:
+                        storages[snap_disk.id] = snap_disk.storage_domains[0].id
+
+                checksums = checksum.Checksums({uuid: job_journal.disk(uuid)['checksum'] for uuid in done
+                                                if job_journal.disk(uuid).get('checksum')})
+                stats = {uuid: job_journal.disk(uuid)['stats'] for uuid in done
+                         if job_journal.disk(uuid).get('stats')}
+                with job_report.phase('copy'):
+                    if dedup:
+                        store = chunkstore.ChunkStore(backup_path)
+                        converter = chunkstore.ChunkConverter(store, backup_name_obj.name)
+                        converter.disks.update(stats)
+                        try:
+                            results = helpers.qemuconvert(event_id, devices, vm_backup_absolute + '/', dbg, logging,
+                                                          click, workers=workers, storages=storages,
+                                                          storage_workers=storage_workers,
+                                                          limit=limits.disks if limits is not None else None,
+                                                          converter=converter, report=job_report, checksums=checksums,
+                                                          limiter=limiter, journal=job_journal)
+                        finally:
+                            store.close()
+                        onerror = helpers.returncode(results)
+                        info('[{}] Stored disks in chunk store, {} new bytes'.format(
+                            event_id, sum(disk['written'] for disk in converter.disks.values())), dbg)
+                    elif incremental_chain:
+                        converter = incremental.DeltaConverter(
+                            backup_path, vm.id, checkpoint['disks'] if checkpoint else ())
+                        converter.disks.update(stats)
+                        info('[{}] {} backup, parent is \'{}\''.format(
+                            event_id, 'Incremental' if checkpoint else 'Full',
+                            checkpoint['backup'] if checkpoint else None), dbg)
+                        results = helpers.qemuconvert(event_id, devices, vm_backup_absolute + '/', dbg, logging,
+                                                      click, workers=workers, storages=storages,
+                                                      storage_workers=storage_workers,
+                                                      limit=limits.disks if limits is not None else None,
+                                                      converter=converter, report=job_report, checksums=checksums,
+                                                      limiter=limiter, journal=job_journal)
+                        onerror = helpers.returncode(results)
+                        incremental.writemanifest(vm_backup_absolute, {
+                            'vm': vm.id,
+                            'timestamp': timestamp,
+                            'parent': checkpoint['backup'] if checkpoint else None,
+                            'block_size': converter.block_size,
+                            'disks': converter.disks,
+                        })
+                    elif streaming:
+                        info('[{}] Streaming disks in \'{}\''.format(
+                            event_id, helpers.archivename(vm_backup_absolute, codec)), dbg)
+                        if limits is not None:
+                            limits.archives.acquire()
+                        try:
+                            upload = startupload(archive, sum(job_journal.get('sizes').values()), event_id, dbg)
+                            onerror = helpers.stream_archive(backup_path, vm_backup_absolute, devices,
+                                                             dbg, event_id, logging, codec=codec, level=level,
+                                                             threads=threads, report=job_report, members=members,
+                                                             checksums=checksums, limiter=limiter,
+                                                             disk_format=disk_format)
+                        finally:
+                            if limits is not None:
+                                limits.archives.release()
+                    else:
+                        converter = helpers.convertdisk
+                        packed = disk_format
+                        if backend == imagetransfer.TRANSFER:
+                            converter = imagetransfer.TransferConverter(journal=job_journal)
+                            converter.disks.update(stats)
+                        elif pooled:
+                            # the agents pack the images they write
+                            converter = agents.PoolConverter(pool, system_service, snap.id, storages, disk_format,
+                                                             job_journal)
+                            packed = sparse.RAW
+                            info('[{}] Converting disks on {} agents'.format(event_id, len(pool.agents)), dbg)
+                        if packed == sparse.SPARSE:
+                            # the sparse images are written straight from the data extents of the disks
+                            converter = helpers.PackConverter()
+                            converter.disks.update(stats)
+                        results = helpers.qemuconvert(event_id, devices, vm_backup_absolute + '/', dbg, logging,
+                                                      click, workers=workers, storages=storages,
+                                                      storage_workers=storage_workers,
+                                                      limit=limits.disks if limits is not None else None,
+                                                      converter=converter, report=job_report, checksums=checksums,
+                                                      limiter=limiter, journal=job_journal)
+                        for uuid, code in results.items():
+                            info('[{}] Disk \'{}\' converted with return code \'{}\''.format(
+                                event_id, uuid, code), dbg)
+                        onerror = helpers.returncode(results)
+                    if os.path.isdir(vm_backup_absolute):
+                        checksums.write(vm_backup_absolute)
+
+                with job_report.phase('detach'):
+                    imagetransfer.finishtransfers(system_service, transfers, logging)
+                    for attach in attachments:
+                        attachment_service = attachments_service.attachment_service(
+                            attach.id)
+                        attachment_service.remove()
+                        info('[{}] Detached disk \'{}\' to from the agent virtual machine.'.format(
+                            event_id, attach.disk.id), dbg)
+                    job_journal.update(attachments=[], transfers=[])
+            finally:
+                if slots:
+                    limits.attachments.release(slots)
+
+        if onerror == 0:
+            # Remove the snapshot:
+            with job_report.phase('snapshot_remove'):
+                snap_service.remove()
+            info('[{}] Removed the snapshot \'{}\'.'.format(
+                event_id, snap.description), dbg)
+            job_journal.update(copied=True, snapshot=None)
+        else:
+            info('[{}] Kept the snapshot \'{}\', resume the backup with: cliobr resume {}'.format(
+                event_id, snap.description, job_journal.name), dbg)
+
+    if onerror == 0 and not unarchive and not dedup and (not stream or incremental_chain) \
+            and not job_journal.get('archived') and not os.path.isdir(vm_backup_absolute):
+        logging.error('[{}] Directory {} of the copied disks is missing, the backup cannot be archived, '
+                      'abandon it with: cliobr cleanup --abandon'.format(event_id, vm_backup_absolute))
+        if dbg:
+            click.echo('[{}] Directory {} of the copied disks is missing'.format(event_id, vm_backup_absolute))
+        onerror = 1
+    if onerror == 0 and not unarchive and not dedup and (not stream or incremental_chain) \
+            and not job_journal.get('archived'):
+        info('[{}] Archiving \'{}\' in \'{}\''.format(
+            event_id, vm_backup_absolute, helpers.archivename(vm_backup_absolute, codec)), dbg)
+        # making archiving
+        if limits is not None:
+            limits.archives.acquire()
+        try:
+            upload = startupload(archive, sum(job_journal.get('sizes').values()), event_id, dbg)
+            with job_report.phase('archive', lambda: os.path.getsize(archive)):
+                onerror = helpers.make_archive(backup_path, vm_backup_absolute,
+                                               dbg, event_id, logging, codec=codec, level=level,
+                                               threads=threads, limiter=limiter) or onerror
+        finally:
+            if limits is not None:
+                limits.archives.release()
+        job_journal.update(archived=onerror == 0)
+
+    if upload is None and onerror == 0 and not unarchive and not dedup:
+        # archive written by the failed run
+        upload = startupload(archive, 0, event_id, dbg, written=True)
+    onerror, remote = finishupload(upload, onerror, job_report, event_id, dbg)
+
+    if incremental_chain and not dedup and onerror == 0:
+        # the block hashes of a failed backup are kept to resume it
+        incremental.savecheckpoint(backup_path, vm.id, backup_name_obj.name, list(job_journal.get('sizes')),
+                                   checkpoint['depth'] + 1 if checkpoint else 0)
+
+    if onerror == 0:
+        message = (
+            '[{}] Backup of virtual machine \'{}\' using snapshot \'{}\' is '
+            'completed.'.format(event_id, vm.name, Description)
+        )
+    else:
+        message = (
+            '[{}] Backup of virtual machine \'{}\' terminating with return code \'{}\''.format(
+                event_id, vm.name, onerror)
+        )
+    helpers.send_events(events_service, event_id + 1,
+                        types, Description, message, vm)
+    info(message, dbg)
+
+    job_report.finish(onerror)
+    try:
+        info('[{}] Wrote report \'{}\''.format(
+            event_id, job_report.write(vm_backup_absolute + '.report.json')), dbg)
+        if prometheus_dir:
+            job_report.prometheus(prometheus_dir)
+    except OSError as e:
+        logging.error('[{}] Error writing report: {}'.format(event_id, e))
+
+    if onerror == 0:
+        try:
+            descriptor.write(vm_backup_absolute, descriptor.fromstring(vm.initialization.configuration.data))
+        except (OSError, ValueError, etree.LxmlError) as e:
+            logging.error('[{}] Error writing descriptor of backup: {}'.format(event_id, e))
+        archived = not unarchive and not dedup
+        backup_file = helpers.archivename(vm_backup_absolute, codec) if archived else vm_backup_absolute
+        kind = catalog.FULL
+        parent = None
+        if dedup:
+            kind = catalog.DEDUP
+        elif incremental_chain and checkpoint:
+            kind = catalog.INCREMENTAL
+            parent = checkpoint['backup']
+        disks = {uuid: {'size': size} for uuid, size in job_journal.get('sizes').items()}
+        for uuid, disk in job_report.disks.items():
+            disks.setdefault(uuid, {})['written'] = disk['bytes_written']
+        for uuid, offset in members.items():
+            disks.setdefault(uuid, {})['offset'] = offset
+        for uuid, sums in checksums.disks.items():
+            disks.setdefault(uuid, {})['checksum'] = sums['digest']
+        catalog.record(backup_path, {
+            'name': backup_name_obj.name,
+            'vm': vm.name,
+            'vm_id': vm.id,
+            'timestamp': timestamp,
+            'file': Path(backup_file).name,
+            'kind': kind,
+            'parent': parent,
+            'codec': codec if archived else None,
+            'size': catalog.filesize(backup_file),
+            'seconds': job_report.duration,
+            'remote': remote,
+        }, disks, logging, event_id)
+        if remote and offload.KEEP_LOCAL:
+            evictlocal(backup_path, vm.id, event_id)
+        job_journal.remove()
+    else:
+        job_journal.unlock()
+    return onerror
+
+
+def startupload(archive, size_hint, event_id, dbg, written=False):
+    """Start the upload of an archive to the offload bucket while it is
+    written
+    Parameters:
+        size_hint: expected size of the archive
+        written: the archive is already written, else it is about to be
+            written and the archive of a failed run is removed first
+    Returns:
+        offload.Upload, None without bucket
+    """
+    if offload.TARGET is None:
+        return None
+    if not written and os.path.exists(archive):
+        os.remove(archive)
+    info('[{}] Uploading \'{}\' to \'{}\''.format(event_id, archive, offload.TARGET.url), dbg)
+    return offload.Upload(offload.TARGET, archive, offload.TARGET.key(Path(archive).name), size_hint)
+
+
+def finishupload(upload, onerror, job_report, event_id, dbg):
+    """Wait for the end of the upload of an archive, it is stopped when the
+    archive failed
+    Returns:
+        tuple of return code and url of the archive in the bucket
+    """
+    if upload is None:
+        return onerror, None
+    if onerror != 0:
+        upload.abort()
+        return onerror, None
+    try:
+        with job_report.phase('offload', lambda: upload.size):
+            remote = upload.finish()
+    except offload.OffloadError as e:
+        logging.error('[{}] Error uploading archive: {}'.format(event_id, e))
+        return 1, None
+    info('[{}] Uploaded archive to \'{}\''.format(event_id, remote), dbg)
+    return 0, remote
+
+
+def evictlocal(backup_path, vm_id, event_id):
+    """Remove the uploaded archives of a vm outside of the local cache"""
+    try:
+        backup_catalog = catalog.Catalog(backup_path)
+        try:
+            catalog.evict(backup_catalog, backup_path, logging, vm_id, offload.KEEP_LOCAL)
+        finally:
+            backup_catalog.close()
+    except (OSError, sqlite3.Error) as e:
+        logging.error('[{}] Error removing uploaded archives: {}'.format(event_id, e))
+
+
+def fetchbackup(backup_path, name, event_id, dbg):
+    """Download the archive of a backup only kept in the offload bucket and
+    the missing archives of its parents
+    Returns:
+        return code
+    """
+    while name:
+        backup = catalog.lookup(backup_path, name)
+        if backup is None or not backup['remote']:
+            return 0
+        path = os.path.join(backup_path, backup['file'])
+        if not os.path.exists(path):
+            key = offload.TARGET.keyof(backup['remote'])
+            if key is None:
+                logging.error('[{}] Archive {} is not in the offload bucket'.format(event_id, backup['remote']))
+                return 1
+            info('[{}] Downloading \'{}\' from \'{}\''.format(event_id, backup['file'], backup['remote']), dbg)
+            try:
+                offload.fetch(offload.TARGET, key, path)
+            except offload.OffloadError as e:
+                logging.error('[{}] Error downloading archive {}: {}'.format(event_id, backup['remote'], e))
+                return 1
+        name = backup['parent']
+    return 0
+
+
+def restorevm(system_service, vm_agent, file, storage_domain, cluster, event_id, dbg, workers=4, stream=False,
+              disk_timeout=3600, prometheus_dir=None, inventory=None, disk_ids=None, disk_limit=None, job_limit=None,
+              pool=None, resume=None):
+    """Restore one virtual machine from a backup
+    Parameters:
+        system_service: root service of the connection
+        vm_agent: vm object of the agent
+        file: path of backup archive or directory
+        storage_domain: name of storage domain for the disks
+        cluster: name of cluster for the vm
+        event_id: id for events in manager
+        workers: disks restored at the same time
+        stream: write disks straight from the archive without extracting it
+        disk_timeout: seconds to wait for the creation of disks
+        prometheus_dir: directory for a Prometheus textfile of the job
+        inventory: Inventory to check the storage domain before the restore
+        disk_ids: restore only these disks, without creating the vm
+        disk_limit: bandwidth and IOPS of each disk as RATE[,IOPS]
+        job_limit: bandwidth and IOPS of the job as RATE[,IOPS]
+        pool: agents.Pool restoring the disks of extracted backups on
+            several agents, None to restore them on vm_agent
+        resume: journal.Journal of a failed run of the restore, the disks it
+            created are kept and the disks not restored yet are restored
+    Returns:
+        return code of restore
+    """
+    events_service = system_service.events_service()
+    limiter = ratelimit.joblimiter(job_limit, disk_limit)
+    disks_service = system_service.disks_service()
+    vms_service = system_service.vms_service()
+
+    p = Path(file)
+
+    if not p.exists() and offload.TARGET is not None:
+        fetchbackup(p.absolute().parent.as_posix(), p.name, event_id, dbg)
+
+    if not p.exists():
+        logging.error("[{}] File backup {} not exists".format(
+            event_id, p.name))
+        return 1
+
+    if inventory is not None and inventory.storagedomain(storage_domain) is None:
+        logging.error("[{}] Storage domain {} not exists".format(
+            event_id, storage_domain))
+        return 1
+
+    # Get absolute path of restore "file" variable
+    tar_file = p.absolute().as_posix()
+    # Get full path of parent related to "file" variable
+    parent_path = p.absolute().parent.as_posix()
+
+    basedir = helpers.archivebase(tar_file)
+    xml_file = ''
+
+    basedir_obj = Path(basedir)
+
+    if disk_ids and resume is None:
+        # checked before the archive is read when the backup has a
+        # descriptor or a catalog entry, else once its OVF is extracted
+        known = backupdisks(parent_path, p.name, basedir)
+        missing = set(disk_ids) - known if known is not None else None
+        if missing:
+            logging.error('[{}] Disks {} not found in backup'.format(event_id, ', '.join(sorted(missing))))
+            return 1
+
+    if resume is None:
+        job_journal = journal.find(parent_path, basedir_obj.name + '.restore')
+        if job_journal is not None:
+            if not job_journal.lock():
+                logging.error('[{}] Restore of \'{}\' is already running'.format(event_id, tar_file))
+                return 1
+            logging.info('[{}] Abandoning failed restore \'{}\''.format(event_id, job_journal.name))
+            abandonjob(system_service, vm_agent, parent_path, job_journal, logging)
+        job_journal = journal.create(parent_path, basedir_obj.name + '.restore', journal.RESTORE, file=tar_file,
+                                     storage_domain=storage_domain, cluster=cluster, options={
+                                         'workers': workers, 'stream': stream, 'disk_timeout': disk_timeout,
+                                         'prometheus_dir': prometheus_dir, 'disk_ids': disk_ids,
+                                         'disk_limit': disk_limit, 'job_limit': job_limit})
+    elif not resume.lock():
+        logging.error('[{}] Restore \'{}\' is already running'.format(event_id, resume.name))
+        return 1
+    else:
+        job_journal = resume
+        info('[{}] Resuming restore \'{}\''.format(event_id, job_journal.name), dbg)
+
+    backup = catalog.lookup(parent_path, p.name)
+    if backup is not None:
+        vm_name = backup['vm']
+    else:
+        vm_name = re.sub(r"\-.*$", '', basedir_obj.name)
+
+    message = (
+        '[{}] Restore of virtual machine \'{}\' using file \'{}\' is '
+        'starting.'.format(event_id, vm_name, tar_file)
+    )
+
+    logging.info(message)
+    if dbg:
+        click.echo(message)
+
+    helpers.send_events(events_service, event_id,
+                        types, Description, message)
+    job_report = report.JobReport('restore', vm_name, event_id)
+
+    streamed = False
+    # disks of seekable archives are always read from the archive
+    framed = not basedir_obj.exists() and seekable.isseekable(tar_file)
+    if job_journal.get('streamed') and basedir_obj.exists():
+        # the configuration was read from the archive by the failed restore
+        streamed, framed = True, job_journal.get('framed')
+    elif not basedir_obj.exists() and (stream or framed):
+        logging.info('[{}] Reading configuration from archive'.format(event_id))
+        if dbg:
+            click.echo('[{}] Reading configuration from archive'.format(event_id))
+        with job_report.phase('unpack_metadata'):
+            if framed:
+                streamed = helpers.seekable_metadata(
+                    tar_file, parent_path, logging, event_id) == 0
+            else:
+                streamed = helpers.unpack_metadata(
+                    tar_file, parent_path, logging, event_id) == 0
+        if streamed and (basedir_obj / incremental.MANIFEST).exists():
+            # deltas need their chain, extract the archive
+            streamed = False
+            shutil.rmtree(basedir)
+        if not streamed:
+            logging.info('[{}] Archive can not be streamed, extracting'.format(event_id))
+        job_journal.update(streamed=streamed, framed=framed)
+
+    if not basedir_obj.exists():
+        logging.info("[{}] File {} is compressed".format(event_id, tar_file))
+        if dbg:
+            click.echo("[{}] File {} is compressed".format(event_id, tar_file))
+        # Getting name of extracted directory
+        logging.info('[{}] Init descompress'.format(event_id))
+        if dbg:
+            click.echo('[{}] Init descompress'.format(event_id))
+
+        with job_report.phase('unpack', lambda: os.path.getsize(tar_file)):
+            onerror = helpers.unpack_archive(
+                tar_file, parent_path, logging, event_id, limiter)
+
+        logging.info('[{}] Finish decompress'.format(event_id))
+        if dbg:
+            click.echo('[{}] Finish decompress'.format(event_id))
+
+    if (basedir_obj / incremental.MANIFEST).exists() and not job_journal.get('rebuilt'):
+        logging.info('[{}] Rebuilding disks of incremental backup'.format(event_id))
+        if dbg:
+            click.echo('[{}] Rebuilding disks of incremental backup'.format(event_id))
+        with job_report.phase('rebuild'):
+            if incremental.rebuild(basedir, parent_path, logging, event_id) != 0:
+                return finishrestore(events_service, job_journal, job_report, basedir, vm_name, tar_file, event_id,
+                                     dbg, 1, prometheus_dir)
+
+    chunked = list(basedir_obj.glob('*' + chunkstore.SUFFIX))
+    if chunked and job_journal.get('rebuilt'):
+        chunked = [manifest.with_suffix('.raw').as_posix() for manifest in chunked]
+    elif chunked:
+        logging.info('[{}] Rebuilding disks from chunk store'.format(event_id))
+        if dbg:
+            click.echo('[{}] Rebuilding disks from chunk store'.format(event_id))
+        with job_report.phase('rebuild'):
+            chunked = chunkstore.rebuild(basedir, parent_path, logging, event_id)
+        if chunked is None:
+            return finishrestore(events_service, job_journal, job_report, basedir, vm_name, tar_file, event_id, dbg,
+                                 1, prometheus_dir)
+    job_journal.update(rebuilt=True)
+
+    qcow_disks = []
+
+    if basedir_obj.exists():
+        for f in basedir_obj.glob('**/*.ovf'):
+            xml_file = Path(f).absolute().as_posix()
+        logging.info('[{}] Configuration file is [{}]'.format(
+            event_id, xml_file))
+        if dbg:
+            click.echo('[{}] Configuration file is [{}]'.format(
+                event_id, xml_file))
+        for qcow in basedir_obj.glob('**/*'):
+            if sparse.isimage(qcow.name):
+                qcow_disks.append(qcow.absolute().as_posix())
+    else:
+        logging.info('failed to decompress')
+        return finishrestore(events_service, job_journal, job_report, basedir, vm_name, tar_file, event_id, dbg, 1,
+                             prometheus_dir)
+
+    try:
+        checksums = checksum.readmanifest(basedir)
+    except (OSError, ValueError) as e:
+        logging.warning('[{}] Checksums of backup not used: {}'.format(event_id, e))
+        checksums = None
+    if checksums is None and not (streamed and not framed):
+        logging.info('[{}] Backup has no checksums, disks are not checked'.format(event_id))
+
+    disks = []  # disks attachments
+
+    logging.info('[{}] Extracting ovf data'.format(event_id))
+    if dbg:
+        click.echo('[{}] Extracting ovf data'.format(event_id))
+    try:
+        backup_descriptor = descriptor.load(basedir, xml_file)
+    except (OSError, ValueError, etree.LxmlError) as e:
+        logging.error('[{}] Error reading configuration file {}: {}'.format(event_id, xml_file, e))
+        return finishrestore(events_service, job_journal, job_report, basedir, vm_name, tar_file, event_id, dbg, 1,
+                             prometheus_dir)
+
+    if disk_ids:
+        missing = set(disk_ids) - {meta['id'] for meta in backup_descriptor['disks']}
+        if missing:
+            logging.error('[{}] Disks {} not found in backup'.format(
+                event_id, ', '.join(sorted(missing))))
+            return finishrestore(events_service, job_journal, job_report, basedir, vm_name, tar_file, event_id, dbg,
+                                 1, prometheus_dir)
+
+    logging.info('[{}] Defining disks'.format(event_id))
+    if dbg:
+        click.echo('[{}] Defining disks'.format(event_id))
+    created = list(job_journal.get('created') or ())
+    for meta in backup_descriptor['disks']:
+        if meta['parent']:
+            continue
+        if disk_ids and meta['id'] not in disk_ids:
+            continue
+        if meta['id'] in created:
+            try:
+                disks.append(disks_service.disk_service(meta['id']).get())
+                logging.info('[{}] Disk {} created by the failed restore'.format(event_id, meta['id']))
+                continue
+            except sdk.Error:
+                # removed since, its data is restored again
+                job_journal.setdisk(meta['id'], offset=0, done=False)
+        logging.info('[{}] Defining disk {} with image {} and size {}'.format(
+            event_id, meta['id'], meta['image'], meta['size']))
+
+        if dbg:
+            click.echo('[{}] Defining disk {}'.format(
+                event_id, meta['id']))
+        if meta['format'] == 'COW':
+            disk_format = types.DiskFormat.COW
+            thin = True
+        else:
+            disk_format = types.DiskFormat.RAW
+            thin = False
+        new_disk = disks_service.add(
+            disk=types.Disk(
+                id=meta['id'],
+                name=meta['alias'],
+                description=meta['description'],
+                format=disk_format,
+                provisioned_size=meta['size'],
+                storage_domains=[
+                    types.StorageDomain(name=storage_domain)
+                ],
+                bootable=meta['boot'],
+                image_id=meta['image'],
+                sparse=thin
+            )
+        )
+        if new_disk.id not in created:
+            created.append(new_disk.id)
+            job_journal.update(created=created)
+
+        disks.append(new_disk)
+
+    # Init copy data process
+    # data_vm_service = vms_service.vm_service(vm.id)
+    agent_vm_service = vms_service.vm_service(vm_agent.id)
+    # Attach disk service
+    agent_disks_attachment = agent_vm_service.disk_attachments_service()
+    detachleftovers(system_service, vm_agent, job_journal, logging)
+    done = job_journal.done()
+    if done:
+        info('[{}] Keeping {} disks restored by the failed restore'.format(event_id, len(done)), dbg)
+
+    # keys of the device of each disk for the copy
+    disk_keys = {}
+    for disk in disks:
+        if disk.id in done:
+            continue
+        disk_keys[disk.id] = [disk.id] if streamed else [
+            fileqcow for fileqcow in qcow_disks if Path(fileqcow).stem == disk.id]
+    # disks of the configuration without image in the backup are not
+    # attached and fail the restore, like missing members of a stream
+    missing = [disk_id for disk_id, keys in disk_keys.items() if not keys]
+    for disk_id in missing:
+        logging.error('[{}] No image of disk {} in backup'.format(event_id, disk_id))
+        del disk_keys[disk_id]
+    devices = wait.Ready(key for keys in disk_keys.values() for key in keys)
+    attachments = []
+    # archives are read by this process, only the images go to the agents
+    # of the pool
+    restorer = helpers.restoredata
+    if pool is not None and not streamed:
+        sd = inventory.storagedomain(storage_domain) if inventory is not None else None
+        restorer = agents.PoolRestorer(pool, system_service, sd.id if sd is not None else None, job_journal)
+        info('[{}] Restoring disks on {} agents'.format(event_id, len(pool.agents)), dbg)
+    logging.info('[{}] Waiting till the disks are created'.format(event_id))
+    if dbg:
+        click.echo('[{}] Waiting till the disks are created'.format(event_id))
+    # each disk is attached and copied once it is created, while the others
+    # are still being created and attached
+    provisioning = threading.Thread(target=attachready, args=(
+        disks_service, agent_disks_attachment if restorer is helpers.restoredata else None, disk_keys, devices,
+        attachments, job_journal, disk_timeout, job_report, event_id, dbg), daemon=True)
+    provisioning.start()
+
+    with job_report.phase('copy'):
+        if streamed and framed:
+            results = helpers.seekable_restore(
+                tar_file, devices, workers, dbg, logging, click, event_id, report=job_report,
+                checksums=checksums, limiter=limiter)
+        elif streamed:
+            results = helpers.stream_restore(
+                tar_file, devices, dbg, logging, click, event_id, report=job_report, checksums=checksums,
+                limiter=limiter)
+        else:
+            results = helpers.restoredisks(
+                devices, workers, dbg, logging, click, event_id, report=job_report, checksums=checksums,
+                limiter=limiter, journal=job_journal, restorer=restorer)
+    provisioning.join()
+    for key in devices.failed:
+        results[key] = 1
+    for disk_id in missing:
+        results[disk_id] = 1
+    for path, code in results.items():
+        if code != 0:
+            logging.error(
+                '[{}] Error restoring {} errcode: {}'.format(event_id, path, code))
+        elif streamed:
+            job_journal.setdisk(path, done=True)
+    onerror = helpers.returncode(results)
+
+    with job_report.phase('detach'):
+        for attach in attachments:
+            attachment_service = agent_disks_attachment.attachment_service(
+                attach.id)
+            attachment_service.remove()
+            logging.info(
+                '[{}] Detached disk \'{}\' to from the agent virtual machine.'.format(event_id, attach.disk.id))
+            if dbg:
+                click.echo(
+                    '[{}] Detached disk \'{}\' to from the agent virtual machine.'.format(
+                        event_id, attach.disk.id)
+                )
+        job_journal.update(attachments=[])
+
+    if onerror != 0:
+        info('[{}] Virtual machine not created, resume the restore with: cliobr resume {}'.format(
+            event_id, job_journal.name), dbg)
+    elif disk_ids:
+        logging.info('[{}] Restored disks {} without virtual machine'.format(
+            event_id, ', '.join(disk_ids)))
+    else:
+        with job_report.phase('vm_create'):
+            vms_service.add(
+                types.Vm(
+                    cluster=types.Cluster(
+                        name=cluster,
+                    ),
+                    initialization=types.Initialization(
+                        configuration=types.Configuration(
+                            type=types.ConfigurationType.OVF,
+                            data=Path(xml_file).read_text()
+                        )
+                    ),
+                ),
+            )
+
+    if onerror == 0:
+        if chunked:
+            # the backup lives in the chunk store, keep its manifests
+            for raw in chunked:
+                os.remove(raw)
+        else:
+            shutil.rmtree(basedir_obj.absolute().as_posix())
+    return finishrestore(events_service, job_journal, job_report, basedir, vm_name, tar_file, event_id, dbg, onerror,
+                         prometheus_dir)
+
+
+def backupdisks(backup_path, name, basedir):
+    """Return ids of the disks of a backup from its descriptor or catalog
+    entry, None when they are only known from its OVF
+    Parameters:
+        name: file name of the backup
+        basedir: path of the backup without the archive extension
+    """
+    backup_descriptor = descriptor.read(basedir)
+    if backup_descriptor is not None:
+        return {disk['id'] for disk in backup_descriptor['disks']}
+    backup = catalog.lookup(backup_path, name)
+    if backup is not None and backup['disks']:
+        return set(backup['disks'])
+    return None
+
+
+def finishrestore(events_service, job_journal, job_report, basedir, vm_name, tar_file, event_id, dbg, onerror,
+                  prometheus_dir=None):
+    """Send the last event of a restore, write its report and remove its
+    journal, or unlock it so the restore can be resumed
+    Returns:
+        onerror
+    """
+    if onerror == 0:
+        message = ('[{}] Restore of virtual machine \'{}\' using file \'{}\' is completed.'.format(
+            event_id, vm_name, tar_file))
+    else:
+        message = ('[{}] Restore of vm: {} terminate with return code \'{}\''.format(
+            event_id, vm_name, onerror))
+    helpers.send_events(events_service, event_id + 1,
+                        types, Description, message)
+    logging.info(message)
+    if dbg:
+        click.echo(message)
+
+    job_report.finish(onerror)
+    try:
+        job_report.write('{}.restore-{}.json'.format(basedir, event_id))
+        if prometheus_dir:
+            job_report.prometheus(prometheus_dir)
+    except OSError as e:
+        logging.error('[{}] Error writing report: {}'.format(event_id, e))
+    if onerror == 0:
+        job_journal.remove()
+    else:
+        job_journal.unlock()
+    return onerror
+
+
+def attachready(disks_service, agent_disks_attachment, disk_keys, devices, attachments, job_journal, timeout,
+                job_report, event_id, dbg):
+    """Attach each new disk to the agent as soon as it is created and
+    publish its device, the disks that are not created or not attached are
+    marked failed in devices
+    Parameters:
+        agent_disks_attachment: disk attachments service of the agent, None
+            when the disks are attached by the agents of a pool
+        disk_keys: dict of disk id and keys of its device in devices
+        devices: wait.Ready of the copy
+        attachments: list receiving the attachments of the agent
+        timeout: seconds to wait for the creation of the disks
+    """
+    try:
+        with job_report.phase('provision'):
+            for disk in wait.iterstatuses(disks_service, disk_keys, types.DiskStatus.OK, timeout,
+                                          'disks of restore {}'.format(event_id), logging):
+                if agent_disks_attachment is None:
+                    for key in disk_keys[disk.id]:
+                        devices.set(key, helpers.DEVICE_PATH + disk.id)
+                    continue
+                try:
+                    attach = agent_disks_attachment.add(
+                        attachment=types.DiskAttachment(
+                            disk=types.Disk(
+                                id=disk.id
+                            ),
+                            active=True,
+                            bootable=False,
+                            interface=types.DiskInterface.VIRTIO_SCSI,
+                        ),
+                    )
+                except sdk.Error as e:
+                    logging.error('[{}] Error attaching disk \'{}\': {}'.format(event_id, disk.id, e))
+                    for key in disk_keys[disk.id]:
+                        devices.fail(key)
+                    continue
+                attachments.append(attach)
+                job_journal.update(attachments=[attach.id for attach in attachments])
+                info('[{}] Attached disk \'{}\' to the agent virtual machine.'.format(event_id, attach.disk.id), dbg)
+                for key in disk_keys[disk.id]:
+                    devices.set(key, helpers.DEVICE_PATH + disk.id)
+    except (TimeoutError, sdk.Error) as e:
+        logging.error('[{}] Error waiting for the disks: {}'.format(event_id, e))
+    finally:
+        devices.close()
+
+
+def backupbatch(system_service, vms, vm_agent, backup_path, dbg, max_jobs, limits, **options):
+    """Backup several virtual machines, the stages of the jobs overlap
+    within the limits
+    Parameters:
+        vms: list of vm objects, the OVF is fetched when each job starts
+        max_jobs: virtual machines in progress at the same time
+        limits: Limits shared by the jobs
+        options: options of backupvm
+    Returns:
+        dict of vm name and return code
+    """
+    def job(vm):
+        event_id = random.randrange(1, 10**8)
+        try:
+            return backupvm(system_service, vm, vm_agent, backup_path, event_id, dbg,
+                            limits=limits, **options)
+        except Exception as e:
+            logging.exception(
+                '[{}] Backup of virtual machine \'{}\' failed: {}'.format(event_id, vm.name, e))
+            return 1
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {executor.submit(job, vm): vm.name for vm in vms}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def detachleftovers(system_service, vm_agent, job_journal, log, dry_run=False):
+    """Detach the disks a failed job left attached to the agent and to the
+    agents of a pool and cancel its image transfers
+    Parameters:
+        job_journal: journal.Journal of the job
+        dry_run: return the actions without doing them
+    Returns:
+        list of actions
+    """
+    actions = []
+    attachments_service = system_service.vms_service().vm_service(vm_agent.id).disk_attachments_service()
+    leftovers = set(job_journal.get('attachments') or ())
+    for attach in attachments_service.list():
+        if attach.id in leftovers:
+            actions.append('Detach disk {} of job {}'.format(attach.disk.id, job_journal.name))
+            if not dry_run:
+                attachments_service.attachment_service(attach.id).remove()
+                log.info(actions[-1])
+    # disks attached to the agents of a pool
+    for uuid, disk in job_journal.get('disks', {}).items():
+        if not disk.get('attachment'):
+            continue
+        actions.append('Detach disk {} of job {} from agent {}'.format(uuid, job_journal.name, disk['agent']))
+        if not dry_run:
+            try:
+                system_service.vms_service().vm_service(disk['agent']).disk_attachments_service().attachment_service(
+                    disk['attachment']).remove()
+                log.info(actions[-1])
+            except sdk.Error as e:
+                log.warning('Disk {} of job {} not detached: {}'.format(uuid, job_journal.name, e))
+            job_journal.setdisk(uuid, attachment=None)
+    transfers_service = system_service.image_transfers_service()
+    for transfer_id in job_journal.get('transfers') or ():
+        actions.append('Cancel image transfer {} of job {}'.format(transfer_id, job_journal.name))
+        if not dry_run:
+            try:
+                transfers_service.image_transfer_service(transfer_id).cancel()
+                log.info(actions[-1])
+            except sdk.Error as e:
+                log.warning('Image transfer {} of job {} not cancelled: {}'.format(
+                    transfer_id, job_journal.name, e))
+    if not dry_run and (leftovers or job_journal.get('transfers')):
+        job_journal.update(attachments=[], transfers=[])
+    return actions
+
+
+def abandonjob(system_service, vm_agent, backup_path, job_journal, log, dry_run=False):
+    """Undo a failed job that will not be resumed, the snapshot and the
+    partial backup of a backup or the disks created by a restore are removed
+    Parameters:
+        backup_path: path of backups holding the journal
+        job_journal: journal.Journal of the job, locked by the caller
+        dry_run: return the actions without doing them
+    Returns:
+        list of actions
+    """
+    actions = detachleftovers(system_service, vm_agent, job_journal, log, dry_run)
+    options = job_journal.get('options') or {}
+    if job_journal.get('kind') == journal.RESTORE:
+        disks_service = system_service.disks_service()
+        for disk_id in job_journal.get('created') or ():
+            actions.append('Remove disk {} of restore {}'.format(disk_id, job_journal.name))
+            if not dry_run:
+                try:
+                    disks_service.disk_service(disk_id).remove()
+                    log.info(actions[-1])
+                except sdk.Error as e:
+                    log.warning('Disk {} of restore {} not removed: {}'.format(disk_id, job_journal.name, e))
+    else:
+        if job_journal.get('snapshot'):
+            snaps_service = system_service.vms_service().vm_service(job_journal.get('vm_id')).snapshots_service()
+            if helpers.findsnapshot(snaps_service, job_journal.get('snapshot')) is not None:
+                actions.append('Remove snapshot {} of backup {}'.format(job_journal.get('snapshot'),
+                                                                        job_journal.name))
+                if not dry_run:
+                    snaps_service.snapshot_service(job_journal.get('snapshot')).remove()
+                    log.info(actions[-1])
+        if options.get('incremental_chain') and not options.get('dedup'):
+            actions.append('Drop block hashes of backup {}'.format(job_journal.name))
+            if not dry_run:
+                incremental.dropcheckpoint(backup_path, job_journal.get('vm_id'))
+        vm_backup_absolute = os.path.join(backup_path, job_journal.name)
+        if os.path.isdir(vm_backup_absolute):
+            # the archive is partial while the directory is there
+            archive = helpers.archivename(vm_backup_absolute, options.get('codec', 'gzip'))
+            actions.append('Remove partial backup {}'.format(vm_backup_absolute))
+            if not dry_run:
+                shutil.rmtree(vm_backup_absolute)
+                if os.path.exists(archive):
+                    os.remove(archive)
+                log.info(actions[-1])
+    if not dry_run:
+        job_journal.remove()
+    return actions
+
+
+def failedbackups(backup_path, vm_id):
+    """Return journals of the failed backups of a vm, without the running
+    ones"""
+    failed = []
+    for job_journal in journal.journals(backup_path):
+        if job_journal.get('kind') != journal.BACKUP or job_journal.get('vm_id') != vm_id:
+            continue
+        if not job_journal.lock():
+            continue
+        job_journal.unlock()
+        failed.append(job_journal)
+    return failed
+
+
+def abandonbackups(system_service, vm_agent, backup_path, failed, event_id):
+    """Abandon failed backups of a vm before a new backup of the vm
+    Parameters:
+        failed: journals of the backups, see failedbackups
+    """
+    for job_journal in failed:
+        if not job_journal.lock():
+            continue
+        logging.info('[{}] Abandoning failed backup \'{}\''.format(event_id, job_journal.name))
+        abandonjob(system_service, vm_agent, backup_path, job_journal, logging)
+
+
+def cleanup(system_service, vm_agent, backup_path, log, abandon=False, older_than=24 * 3600, dry_run=False):
+    """Remove what failed jobs left behind: the disks attached to the agent
+    and the snapshots of backups without journal
+    Parameters:
+        abandon: abandon the failed jobs too, see abandonjob, they can not
+            be resumed anymore
+        older_than: seconds since the creation of an orphaned snapshot
+            before it is removed
+        dry_run: return the actions without doing them
+    Returns:
+        list of actions
+    """
+    actions = []
+    # snapshots of running jobs and of jobs to resume
+    protected = set()
+    for job_journal in journal.journals(backup_path):
+        if not job_journal.lock():
+            protected.add(job_journal.get('snapshot'))
+            continue
+        try:
+            if abandon:
+                actions += abandonjob(system_service, vm_agent, backup_path, job_journal, log, dry_run)
+            else:
+                actions += detachleftovers(system_service, vm_agent, job_journal, log, dry_run)
+                protected.add(job_journal.get('snapshot'))
+        finally:
+            job_journal.unlock()
+
+    vms_service = system_service.vms_service()
+    attachments_service = vms_service.vm_service(vm_agent.id).disk_attachments_service()
+    attached = {attach.disk.id: attach for attach in attachments_service.list()}
+    limit = time.time() - older_than
+    for vm in vms_service.list():
+        if vm.id == vm_agent.id:
+            continue
+        snaps_service = vms_service.vm_service(vm.id).snapshots_service()
+        for snap in snaps_service.list():
+            if snap.description != Description or snap.id in protected:
+                continue
+            if snap.date is not None and snap.date.timestamp() > limit:
+                continue
+            snap_service = snaps_service.snapshot_service(snap.id)
+            for disk in snap_service.disks_service().list():
+                attach = attached.pop(disk.id, None)
+                if attach is not None:
+                    actions.append('Detach disk {} of snapshot {} of vm {}'.format(disk.id, snap.id, vm.name))
+                    if not dry_run:
+                        attachments_service.attachment_service(attach.id).remove()
+                        log.info(actions[-1])
+            actions.append('Remove snapshot {} of vm {}'.format(snap.id, vm.name))
+            if not dry_run:
+                snap_service.remove()
+                log.info(actions[-1])
+    return actions
+
+
+def resumejob(system_service, vm_agent, backup_path, job_journal, event_id, dbg, inventory=None):
+    """Resume a failed backup or restore with the options it was started
+    with
+    Parameters:
+        backup_path: path of backups holding the journal
+        job_journal: journal.Journal of the job
+        inventory: Inventory to check the storage domain of a restore
+    Returns:
+        return code of the job
+    """
+    options = job_journal.get('options') or {}
+    if job_journal.get('kind') == journal.RESTORE:
+        return restorevm(system_service, vm_agent, job_journal.get('file'), job_journal.get('storage_domain'),
+                         job_journal.get('cluster'), event_id, dbg, inventory=inventory, resume=job_journal,
+                         **options)
+    vm = system_service.vms_service().vm_service(job_journal.get('vm_id')).get()
+    return backupvm(system_service, vm, vm_agent, backup_path, event_id, dbg, resume=job_journal, **options)
@@ -0,0 +1,133 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Journal of a job, <backup_path>/.journal/<name>.json, written after each
+# step: the snapshot, the attachments, the disks copied and the offset reached
+# in a disk being copied. A failed job keeps its journal and its snapshot and
+# is resumed from them, the job holds a lock on <name>.lock while it runs.
+DIRECTORY = '.journal'
+BACKUP = 'backup'
+RESTORE = 'restore'
+
+
+class Journal:
+    """Steps done by a job, each change is written at once
+    Parameters:
+        path: path of journal file
+        state: content of the journal
+    """
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.name = Path(path).stem
+        self._lock = threading.Lock()
+        self._lockfd = None
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **fields):
+        with self._lock:
+            self.state.update(fields)
+            self._write()
+
+    def disk(self, uuid):
+        """Return steps done for a disk"""
+        return self.state['disks'].get(uuid, {})
+
+    def setdisk(self, uuid, **fields):
+        with self._lock:
+            self.state['disks'].setdefault(uuid, {}).update(fields)
+            self._write()
+
+    def done(self):
+        """Return ids of the disks copied"""
+        return {uuid for uuid, disk in self.state['disks'].items() if disk.get('done')}
+
+    def _write(self):
+        self.state['updated'] = time.strftime('%Y%m%d%H%M%S')
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self.state, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp, self.path)
+
+    def lockpath(self):
+        return self.path[:-len('.json')] + '.lock'
+
+    def lock(self):
+        """Take the lock of the job
+        Returns:
+            False when another job holds it
+        """
+        if self._lockfd is not None:
+            return True
+        fd = os.open(self.lockpath(), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lockfd = fd
+        return True
+
+    def unlock(self):
+        if self._lockfd is not None:
+            os.close(self._lockfd)
+            self._lockfd = None
+
+    def __del__(self):
+        self.unlock()
+
+    def remove(self):
+        """Remove the journal of a finished job"""
+        for path in (self.path, self.lockpath()):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.unlock()
+
+
+def journaldir(backup_path):
+    return os.path.join(backup_path, DIRECTORY)
+
+
+def create(backup_path, name, kind, **fields):
+    """Write the journal of a new job and take its lock
+    Parameters:
+        name: name of the backup, unique for the job
+        kind: BACKUP or RESTORE
+        fields: fields of the job needed to resume it
+    """
+    os.makedirs(journaldir(backup_path), exist_ok=True)
+    state = {'kind': kind, 'name': name, 'created': time.strftime('%Y%m%d%H%M%S'), 'disks': {}}
+    state.update(fields)
+    job_journal = Journal(os.path.join(journaldir(backup_path), name + '.json'), state)
+    job_journal.lock()
+    job_journal.update()
+    return job_journal
+
+
+def load(path):
+    with open(path) as fd:
+        return Journal(path, json.load(fd))
+
+
+def find(backup_path, name):
+    """Return journal of a job by name, None when it is missing"""
+    path = os.path.join(journaldir(backup_path), name + '.json')
+    if not os.path.exists(path):
+        return None
+    return load(path)
+
+
+def journals(backup_path):
+    """Return journals of the jobs of backup path, oldest first"""
+    return [load(path.as_posix()) for path in sorted(Path(journaldir(backup_path)).glob('*.json'))]
@@ -0,0 +1,363 @@
+import hashlib
+import hmac
+import http.client
+import os
+import re
+import ssl
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import monotonic, sleep
+from urllib.parse import quote, urlsplit
+
+import wait
+
+# Archives copied to an S3 compatible object storage while they are written:
+# each part of the archive is uploaded as soon as the file holds it, on
+# several connections, and a failed part is sent again. The newest backups of
+# each vm stay in the backup path as a local cache, the older ones are only
+# kept in the bucket and are downloaded again to be restored.
+PART_SIZE = 32 * 2**20
+# S3 takes up to 10000 parts, the part size grows with the expected size
+MAX_PARTS = 9000
+WORKERS = 4
+RETRIES = 5
+POLL = 0.5
+# seconds without growth of a file before its writer is deemed gone
+IDLE = 3600
+# bucket of the archives, backups kept in the backup path once uploaded
+TARGET = None
+KEEP_LOCAL = 0
+
+
+class OffloadError(OSError):
+    pass
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, text):
+    return hmac.new(key, text.encode('utf-8'), hashlib.sha256).digest()
+
+
+class Target:
+    """Bucket of an S3 compatible endpoint addressed by path, each thread
+    uses its own connection
+    Parameters:
+        url: endpoint, bucket and prefix of keys as
+            https://s3.example.com/bucket/prefix
+        access_key: access key id
+        secret_key: secret access key
+        region: region of the signatures
+    """
+
+    def __init__(self, url, access_key, secret_key, region='us-east-1'):
+        parts = urlsplit(url.rstrip('/'))
+        if parts.scheme not in ('http', 'https') or not parts.path.strip('/'):
+            raise ValueError('invalid offload url {}, expected https://HOST/BUCKET[/PREFIX]'.format(url))
+        self.url = url.rstrip('/')
+        self.netloc = parts.netloc
+        self.bucket, _, self.prefix = parts.path.strip('/').partition('/')
+        self.base = '{}://{}/{}/'.format(parts.scheme, parts.netloc, self.bucket)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self._context = ssl.create_default_context() if parts.scheme == 'https' else None
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            if self._context is not None:
+                conn = http.client.HTTPSConnection(self.netloc, context=self._context, timeout=300)
+            else:
+                conn = http.client.HTTPConnection(self.netloc, timeout=300)
+            self._local.connection = conn
+        return conn
+
+    def key(self, name):
+        """Return key of a file of the backup path"""
+        return self.prefix + '/' + name if self.prefix else name
+
+    def objecturl(self, key):
+        return self.base + key
+
+    def keyof(self, url):
+        """Return key of an object url of this bucket, None for the objects
+        of another bucket"""
+        if not url.startswith(self.base):
+            return None
+        return url[len(self.base):]
+
+    def sign(self, method, path, query, headers, payload_hash):
+        """Add the headers of an AWS signature version 4 to headers"""
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        scope = '{}/{}/s3/aws4_request'.format(now.strftime('%Y%m%d'), self.region)
+        headers.update({'host': self.netloc, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+        names = sorted(headers)
+        canonical = '\n'.join([
+            method,
+            quote(path, safe='/-_.~'),
+            '&'.join('{}={}'.format(quote(k, safe='-_.~'), quote(v, safe='-_.~')) for k, v in sorted(query.items())),
+            ''.join('{}:{}\n'.format(name, str(headers[name]).strip()) for name in names),
+            ';'.join(names),
+            payload_hash,
+        ])
+        text = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, sha256(canonical.encode('utf-8'))])
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for part in scope.split('/'):
+            key = _hmac(key, part)
+        headers['authorization'] = 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            self.access_key, scope, ';'.join(names), hmac.new(key, text.encode('utf-8'), hashlib.sha256).hexdigest())
+
+    def request(self, method, key, query=None, headers=None, body=b'', buf=None):
+        """Send a signed request, again after a delay when the connection
+        fails or the endpoint answers 429 or 5xx
+        Parameters:
+            buf: buffer receiving the body, the body is returned if not set
+        Returns:
+            tuple of response and body or bytes received in buf
+        """
+        path = '/{}/{}'.format(self.bucket, key)
+        query = query or {}
+        target = quote(path, safe='/-_.~')
+        if query:
+            target += '?' + '&'.join('{}={}'.format(quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+                                     for k, v in sorted(query.items()))
+        delays = wait.backoff(1, 30)
+        payload_hash = sha256(body)
+        for attempt in range(RETRIES + 1):
+            signed = {name.lower(): value for name, value in (headers or {}).items()}
+            self.sign(method, path, query, signed, payload_hash)
+            conn = self.connection()
+            try:
+                conn.request(method, target, body=body, headers=signed)
+                response = conn.getresponse()
+                if buf is not None and response.status < 300:
+                    view = memoryview(buf)
+                    length = 0
+                    while length < len(buf):
+                        received = response.readinto(view[length:])
+                        if not received:
+                            break
+                        length += received
+                    data = length
+                else:
+                    data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                self._local.connection = None
+                error = OffloadError('{} {} failed: {}'.format(method, path, e))
+            else:
+                if response.status < 300:
+                    return response, data
+                error = OffloadError('{} {} failed with status {}: {}'.format(
+                    method, path, response.status, data[:512].decode('utf-8', 'replace')))
+                if response.status != 429 and response.status < 500:
+                    raise error
+            if attempt < RETRIES:
+                sleep(next(delays))
+        raise error
+
+    def create(self, key):
+        """Start a multipart upload
+        Returns:
+            upload id
+        """
+        _, body = self.request('POST', key, {'uploads': ''})
+        match = re.search(rb'<UploadId>([^<]+)</UploadId>', body)
+        if match is None:
+            raise OffloadError('no upload id for {} in {}'.format(key, body[:512]))
+        return match.group(1).decode('utf-8')
+
+    def uploadpart(self, key, upload_id, number, data):
+        """Upload a part, the same part can be sent again
+        Returns:
+            ETag of the part
+        """
+        response, _ = self.request('PUT', key, {'partNumber': str(number), 'uploadId': upload_id}, body=data)
+        return response.getheader('ETag')
+
+    def complete(self, key, upload_id, etags):
+        """Finish a multipart upload from the ETags of its parts in order"""
+        body = '<CompleteMultipartUpload>{}</CompleteMultipartUpload>'.format(''.join(
+            '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(number, etag)
+            for number, etag in enumerate(etags, 1))).encode('utf-8')
+        _, data = self.request('POST', key, {'uploadId': upload_id}, body=body)
+        # the endpoint answers 200 with an error when it fails late
+        if b'<Error>' in data:
+            raise OffloadError('completing upload of {} failed: {}'.format(key, data[:512]))
+
+    def abort(self, key, upload_id):
+        self.request('DELETE', key, {'uploadId': upload_id})
+
+    def size(self, key):
+        response, _ = self.request('HEAD', key)
+        return int(response.getheader('Content-Length'))
+
+    def readinto(self, key, buf, offset):
+        """Read the range of the object at offset filling buf"""
+        _, length = self.request('GET', key, headers={
+            'Range': 'bytes={}-{}'.format(offset, offset + len(buf) - 1)}, buf=buf)
+        if length != len(buf):
+            raise OffloadError('short read of {} bytes at offset {} of {}'.format(length, offset, key))
+        return length
+
+    def delete(self, key):
+        self.request('DELETE', key)
+
+
+def configure(url=None, access_key=None, secret_key=None, region='us-east-1', workers=WORKERS, keep_local=0):
+    """Set the bucket archives are uploaded to, no upload when url is not
+    set
+    Parameters:
+        workers: parts uploaded at the same time for each archive
+        keep_local: newest backups of each vm kept in the backup path once
+            uploaded, with their parents, 0 to keep every backup
+    """
+    global TARGET, WORKERS, KEEP_LOCAL
+    TARGET = Target(url, access_key, secret_key, region) if url else None
+    WORKERS = workers
+    KEEP_LOCAL = keep_local
+
+
+def partsize(size_hint):
+    """Return part size for a file of about size_hint bytes"""
+    return max(PART_SIZE, -(-size_hint // MAX_PARTS // 2**20) * 2**20)
+
+
+class Upload:
+    """Multipart upload of a file while it is written, every part the file
+    holds is sent and the last one once the writer is done
+    Parameters:
+        target: Target
+        path: file written after the upload starts
+        key: key of the object
+        size_hint: expected size of the file for the part size
+        workers: parts uploaded at the same time, WORKERS if not set
+    """
+
+    def __init__(self, target, path, key, size_hint=0, workers=None):
+        self.target = target
+        self.path = path
+        self.key = key
+        self.part_size = partsize(size_hint)
+        self.workers = workers or WORKERS
+        self.size = 0
+        self.error = None
+        self._done = threading.Event()
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, name='upload ' + key, daemon=True)
+        self._thread.start()
+
+    def finish(self):
+        """Upload the rest of the file once written
+        Returns:
+            url of the object
+        Raises:
+            OffloadError: the upload failed
+        """
+        self._done.set()
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.target.objecturl(self.key)
+
+    def abort(self):
+        """Stop the upload of a file whose writer failed"""
+        self._failed = True
+        self._done.set()
+        self._thread.join()
+
+    def _part(self, fd, number, offset, length):
+        data = os.pread(fd, length, offset)
+        if len(data) != length:
+            raise OffloadError('{} shrank while it was uploaded'.format(self.path))
+        return self.target.uploadpart(self.key, self.upload_id, number, data)
+
+    def _run(self):
+        self.upload_id = None
+        fd = None
+        try:
+            self.upload_id = self.target.create(self.key)
+            pending = deque()
+            etags = []
+            offset = 0
+            last_size = 0
+            last_growth = monotonic()
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                while True:
+                    done = self._done.is_set()
+                    if self._failed:
+                        raise OffloadError('writer of {} failed'.format(self.path))
+                    if fd is None and os.path.exists(self.path):
+                        fd = os.open(self.path, os.O_RDONLY)
+                    size = os.fstat(fd).st_size if fd is not None else 0
+                    if size != last_size:
+                        last_size, last_growth = size, monotonic()
+                    elif not done and monotonic() - last_growth > IDLE:
+                        raise OffloadError('{} not written for {}s'.format(self.path, IDLE))
+                    while size - offset >= self.part_size or (done and (offset < size or not etags and not pending)):
+                        if fd is None:
+                            raise OffloadError('{} was not written'.format(self.path))
+                        # parts in flight hold their data, wait for the oldest
+                        while len(pending) >= self.workers:
+                            etags.append(pending.popleft().result())
+                        length = min(self.part_size, size - offset)
+                        pending.append(executor.submit(self._part, fd, len(etags) + len(pending) + 1, offset,
+                                                       length))
+                        offset += length
+                        if not length:
+                            break
+                    if done:
+                        break
+                    self._done.wait(POLL)
+                while pending:
+                    etags.append(pending.popleft().result())
+            self.target.complete(self.key, self.upload_id, etags)
+            self.size = offset
+        except Exception as e:
+            self.error = e if isinstance(e, OffloadError) else OffloadError('upload of {} failed: {}'.format(
+                self.key, e))
+            if self.upload_id is not None:
+                try:
+                    self.target.abort(self.key, self.upload_id)
+                except OffloadError:
+                    pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+
+def fetch(target, key, path, workers=None, chunk_size=PART_SIZE):
+    """Download an object to path with ranged requests on several
+    connections
+    Returns:
+        size of the object
+    """
+    size = target.size(key)
+    tmp = path + '.part'
+
+    def read(offset):
+        buf = bytearray(min(chunk_size, size - offset))
+        target.readinto(key, buf, offset)
+        os.pwrite(fd, buf, offset)
+
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=workers or WORKERS) as executor:
+            for future in [executor.submit(read, offset) for offset in range(0, size, chunk_size)]:
+                future.result()
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp)
+        raise
+    os.close(fd)
+    os.replace(tmp, path)
+    return size
@@ -0,0 +1,300 @@
+import io
+import logging
+import os
+import re
+import stat
+import subprocess
+import threading
+from contextlib import contextmanager
+from time import localtime, monotonic, sleep
+
+# Limits of bandwidth and I/O operations per second. Each disk is copied
+# through a Limiter charging the limiter of its job, which charges AGENT, the
+# limiter shared by every job of the process. The agent limit can change with
+# the time of day. Copies done by subprocesses, like qemu-img, cannot be
+# charged, they reserve a share of each limiter for their whole run: the
+# limit divided by the copies the jobs run at the same time. Subprocesses run
+# under IONICE and start in CGROUP when set.
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30}
+# one operation per request of the largest size the block layer usually sends
+OP_SIZE = 512 * 2**10
+LIMIT = re.compile(r'^(?:(?P<rate>\d+)(?P<unit>[KMG]?)(?:i?B)?)?(?:,(?P<iops>\d+))?$', re.IGNORECASE)
+PROFILE = re.compile(r'^(?P<start>\d{1,2}):(?P<start_minute>\d{2})-(?P<end>\d{1,2}):(?P<end_minute>\d{2})'
+                     r'=(?P<limit>.*)$')
+IONICE_CLASSES = {'realtime': '1', 'best-effort': '2', 'idle': '3'}
+
+IONICE = []
+CGROUP = None
+# shares reserved by the copies of subprocesses
+SHARES = threading.Condition()
+
+
+def parselimit(text):
+    """Return bytes and operations per second of a limit as RATE[,IOPS],
+    RATE in bytes with a K, M or G suffix, 0 or empty for no limit, e.g.
+    100M,2000 or ,500"""
+    if not text:
+        return 0, 0
+    match = LIMIT.match(text.strip())
+    if match is None:
+        raise ValueError('invalid limit {}, expected RATE[,IOPS] like 100M,2000'.format(text))
+    rate = int(match['rate'] or 0) * UNITS[(match['unit'] or '').upper()]
+    return rate, int(match['iops'] or 0)
+
+
+def parseprofile(text):
+    """Return start and end minute of the day and limit of a profile as
+    HH:MM-HH:MM=RATE[,IOPS], the window can cross midnight"""
+    match = PROFILE.match(text.strip())
+    if match is None:
+        raise ValueError('invalid profile {}, expected HH:MM-HH:MM=RATE[,IOPS]'.format(text))
+    start = int(match['start']) * 60 + int(match['start_minute'])
+    end = int(match['end']) * 60 + int(match['end_minute'])
+    if start >= 24 * 60 or end > 24 * 60:
+        raise ValueError('invalid time in profile {}'.format(text))
+    return start, end, parselimit(match['limit'])
+
+
+class Bucket:
+    """Token bucket holding at most one second of tokens, a request larger
+    than the tokens left waits for the missing ones"""
+
+    def __init__(self):
+        self.tokens = 0.0
+        self.last = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount, rate):
+        """Take amount of tokens
+        Returns:
+            seconds to wait before using them
+        """
+        with self._lock:
+            now = monotonic()
+            if rate <= 0:
+                self.tokens = 0.0
+                self.last = now
+                return 0
+            self.tokens = min(rate, self.tokens + (now - self.last) * rate) - amount
+            self.last = now
+            return -self.tokens / rate if self.tokens < 0 else 0
+
+
+class Limiter:
+    """Bandwidth and IOPS limit charged for every buffer copied
+    Parameters:
+        bps: bytes per second, 0 for no limit
+        iops: operations per second, 0 for no limit
+        parent: Limiter charged too, the limiter of the job or the agent
+        profiles: list of start minute, end minute and limit of the day
+            replacing bps and iops in their window
+    """
+
+    def __init__(self, bps=0, iops=0, parent=None, profiles=()):
+        self.bps = bps
+        self.iops = iops
+        self.parent = parent
+        self.profiles = list(profiles)
+        self.disk_limit = (0, 0)
+        self.copies = 0
+        self.reserved = [0, 0]
+        self._bytes = Bucket()
+        self._ops = Bucket()
+
+    def limits(self):
+        """Return bytes and operations per second in force now"""
+        if self.profiles:
+            now = localtime()
+            minute = now.tm_hour * 60 + now.tm_min
+            for start, end, limit in self.profiles:
+                if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                    return limit
+        return self.bps, self.iops
+
+    def take(self, nbytes):
+        """Wait until nbytes can be copied within the limits of this limiter
+        and its parents, less the shares reserved by subprocesses"""
+        bps, iops = self.free()
+        ops = max(1, -(-nbytes // OP_SIZE))
+        wait = max(self._bytes.reserve(nbytes, bps), self._ops.reserve(ops, iops))
+        if wait > 0:
+            sleep(wait)
+        if self.parent is not None:
+            self.parent.take(nbytes)
+
+    def free(self):
+        """Return bytes and operations per second in force now less the
+        shares reserved, at least one share of each limit"""
+        with SHARES:
+            return tuple(limit and max(limit - reserved, limit // max(self.copies, 1), 1)
+                         for limit, reserved in zip(self.limits(), self.reserved))
+
+    def chain(self):
+        limiter = self
+        while limiter is not None:
+            yield limiter
+            limiter = limiter.parent
+
+    @contextmanager
+    def running(self, copies):
+        """Count copies run at the same time by a job, the shares of this
+        limiter and its parents are split between them"""
+        with SHARES:
+            for limiter in self.chain():
+                limiter.copies += copies
+        try:
+            yield
+        finally:
+            with SHARES:
+                for limiter in self.chain():
+                    limiter.copies -= copies
+                SHARES.notify_all()
+
+    def _share(self, index):
+        """Return share of a copy of limit index, 0 for bytes and 1 for
+        operations, and the limiters having this limit now"""
+        limiters = [limiter for limiter in self.chain() if limiter.limits()[index]]
+        share = min((max(1, limiter.limits()[index] // max(limiter.copies, 1)) for limiter in limiters), default=0)
+        return share, limiters
+
+    @contextmanager
+    def share(self):
+        """Reserve for the copy of a subprocess a share of each limit of this
+        limiter and its parents, waits while other copies reserve the limit
+        Returns:
+            bytes and operations per second of the copy, 0 for no limit
+        """
+        with SHARES:
+            while True:
+                shares = [self._share(index) for index in range(2)]
+                if all(limiter.reserved[index] + share <= limiter.limits()[index]
+                       for index, (share, limiters) in enumerate(shares) for limiter in limiters):
+                    break
+                SHARES.wait()
+            for index, (share, limiters) in enumerate(shares):
+                for limiter in limiters:
+                    limiter.reserved[index] += share
+        try:
+            yield tuple(share for share, _ in shares)
+        finally:
+            with SHARES:
+                for index, (share, limiters) in enumerate(shares):
+                    for limiter in limiters:
+                        limiter.reserved[index] -= share
+                SHARES.notify_all()
+
+    def limited(self):
+        """Return True when this limiter or a parent has a limit now"""
+        return any(any(limiter.limits()) for limiter in self.chain())
+
+    def disk(self):
+        """Return limiter of a disk of this job"""
+        return Limiter(*self.disk_limit, parent=self)
+
+
+AGENT = Limiter()
+
+
+def joblimiter(job_limit=None, disk_limit=None):
+    """Return limiter of a job charging the agent limiter
+    Parameters:
+        job_limit: limit of the job as RATE[,IOPS]
+        disk_limit: limit of each disk of the job as RATE[,IOPS]
+    """
+    limiter = Limiter(*parselimit(job_limit), parent=AGENT)
+    limiter.disk_limit = parselimit(disk_limit)
+    return limiter
+
+
+def configure(agent_limit=None, profiles=(), ionice=None, cgroup=None):
+    """Set the limits of the agent, the I/O class of this process and its
+    subprocesses and the cgroup of the subprocesses
+    Parameters:
+        agent_limit: limit of every job together as RATE[,IOPS]
+        profiles: limits of the agent as HH:MM-HH:MM=RATE[,IOPS]
+        ionice: I/O class as idle, best-effort[:LEVEL] or realtime[:LEVEL]
+        cgroup: cgroup v2 directory, created if missing
+    """
+    global CGROUP
+    AGENT.bps, AGENT.iops = parselimit(agent_limit)
+    AGENT.profiles = [parseprofile(profile) for profile in profiles]
+    if ionice:
+        IONICE[:] = ionicecommand(ionice)
+        # threads started later inherit the I/O priority of this thread
+        subprocess.call(IONICE + ['-p', str(os.getpid())])
+    if cgroup:
+        CGROUP = Cgroup(cgroup)
+
+
+def ionicecommand(spec):
+    name, _, level = spec.partition(':')
+    if name not in IONICE_CLASSES:
+        raise ValueError('invalid I/O class {}, expected one of {}'.format(name, ', '.join(IONICE_CLASSES)))
+    command = ['ionice', '-c', IONICE_CLASSES[name]]
+    if level and name != 'idle':
+        command += ['-n', level]
+    return command
+
+
+def popen(args, devices=(), limits=None, **kwargs):
+    """Start a subprocess with the I/O class of the agent, in the cgroup of
+    the agent with limits on devices
+    Parameters:
+        limits: bytes and operations per second of the share of the copy,
+            see Limiter.share
+    """
+    if CGROUP is None:
+        return subprocess.Popen(IONICE + args, **kwargs)
+    if limits is not None:
+        for device in devices:
+            try:
+                CGROUP.limit(device, *limits)
+            except OSError as e:
+                logging.warning('Error limiting device {} in cgroup {}: {}'.format(device, CGROUP.path, e))
+    # the shell joins the cgroup before running the command, so the command
+    # never runs outside of it
+    return subprocess.Popen(['sh', '-c', CGROUP.JOIN, CGROUP.procs] + IONICE + args, **kwargs)
+
+
+class Cgroup:
+    """cgroup v2 of the subprocesses, io.max limits the devices they read
+    and write
+    Parameters:
+        path: directory of the cgroup, created if missing
+    """
+
+    JOIN = 'echo $$ 2>/dev/null >"$0" || echo "Error moving process $$ to cgroup $0" >&2; exec "$@"'
+
+    def __init__(self, path):
+        self.path = path
+        self.procs = os.path.join(path, 'cgroup.procs')
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def limit(self, device, bps=0, iops=0):
+        """Limit reads and writes of a block device, 0 for no limit"""
+        mode = os.stat(device).st_mode
+        if not stat.S_ISBLK(mode):
+            return
+        rdev = os.stat(device).st_rdev
+        values = ['{}={}'.format(key, value or 'max') for key, value in
+                  (('rbps', bps), ('wbps', bps), ('riops', iops), ('wiops', iops))]
+        with self._lock, open(os.path.join(self.path, 'io.max'), 'w') as fd:
+            fd.write('{}:{} {}\n'.format(os.major(rdev), os.minor(rdev), ' '.join(values)))
+
+
+class Reader(io.RawIOBase):
+    """File object whose reads are charged to a limiter"""
+
+    def __init__(self, fileobj, limiter):
+        self.fileobj = fileobj
+        self.limiter = limiter
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        length = self.fileobj.readinto(buf)
+        if length:
+            self.limiter.take(length)
+        return length
@@ -0,0 +1,121 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from time import monotonic
+
+
+class JobReport:
+    """Timing and throughput of the phases and disks of a job
+    Parameters:
+        kind: backup or restore
+        vm_name: name of virtual machine
+        event_id: id of job
+    """
+
+    def __init__(self, kind, vm_name, event_id):
+        self.kind = kind
+        self.vm_name = vm_name
+        self.event_id = event_id
+        self.started = time.time()
+        self.phases = []
+        self.disks = {}
+        self.code = None
+        self.duration = None
+        self._start = monotonic()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, nbytes=None):
+        """Time the phase of the block, nbytes is a function returning the
+        bytes moved by the phase"""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            phase = {'phase': name, 'seconds': round(monotonic() - start, 3)}
+            if nbytes is not None:
+                try:
+                    phase['bytes'] = nbytes()
+                except OSError:
+                    pass
+            with self._lock:
+                self.phases.append(phase)
+
+    def disk(self, uuid, seconds, read=0, written=0, phase=None):
+        """Record bytes and time of a disk"""
+        mib = read / 2**20
+        with self._lock:
+            self.disks[uuid] = {
+                'phase': phase,
+                'seconds': round(seconds, 3),
+                'bytes_read': read,
+                'bytes_written': written,
+                'mib_per_second': round(mib / seconds, 1) if seconds > 0 else None,
+            }
+
+    def finish(self, code):
+        self.code = code
+        self.duration = round(monotonic() - self._start, 3)
+
+    def todict(self):
+        with self._lock:
+            return {
+                'kind': self.kind,
+                'vm': self.vm_name,
+                'event_id': self.event_id,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+                'seconds': self.duration,
+                'return_code': self.code,
+                'phases': list(self.phases),
+                'disks': dict(self.disks),
+            }
+
+    def write(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self.todict(), fd, indent=2)
+        os.replace(tmp, path)
+        return path
+
+    def prometheus(self, directory):
+        """Write metrics for the textfile collector of node exporter"""
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', self.vm_name)
+        labels = 'kind="{}",vm="{}"'.format(self.kind, self.vm_name)
+        lines = [
+            '# TYPE cliobr_job_success gauge',
+            'cliobr_job_success{{{}}} {}'.format(labels, int(self.code == 0)),
+            '# TYPE cliobr_job_last_run_timestamp_seconds gauge',
+            'cliobr_job_last_run_timestamp_seconds{{{}}} {}'.format(labels, int(self.started)),
+            '# TYPE cliobr_job_duration_seconds gauge',
+            'cliobr_job_duration_seconds{{{}}} {}'.format(labels, self.duration),
+            '# TYPE cliobr_phase_duration_seconds gauge',
+        ]
+        for phase in self.phases:
+            lines.append('cliobr_phase_duration_seconds{{{},phase="{}"}} {}'.format(
+                labels, phase['phase'], phase['seconds']))
+        lines.append('# TYPE cliobr_disk_bytes_read gauge')
+        for uuid, disk in self.disks.items():
+            lines.append('cliobr_disk_bytes_read{{{},disk="{}"}} {}'.format(
+                labels, uuid, disk['bytes_read']))
+        lines.append('# TYPE cliobr_disk_bytes_written gauge')
+        for uuid, disk in self.disks.items():
+            lines.append('cliobr_disk_bytes_written{{{},disk="{}"}} {}'.format(
+                labels, uuid, disk['bytes_written']))
+        lines.append('# TYPE cliobr_disk_duration_seconds gauge')
+        for uuid, disk in self.disks.items():
+            lines.append('cliobr_disk_duration_seconds{{{},disk="{}"}} {}'.format(
+                labels, uuid, disk['seconds']))
+        path = os.path.join(directory, 'cliobr_{}_{}.prom'.format(self.kind, name))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+        return path
+
+
+def allocated(path):
+    """Return bytes allocated on disk by a file"""
+    return os.stat(path).st_blocks * 512
@@ -0,0 +1,383 @@
+import bisect
+import io
+import json
+import os
+import struct
+import tarfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, time
+
+import checksum
+import imagetransfer
+import ratelimit
+import sparse
+
+# Seekable archive: a tar compressed in frames, each frame a gzip member of
+# at most FRAME_SIZE bytes of the tar, so gzip -dc and tar read it like any
+# .tar.gz. The last member of the tar is INDEX with the offsets of the frames
+# and members, the archive ends with an empty gzip member whose comment points
+# at the frame of the index.
+FRAME_SIZE = 16 * 2**20
+INDEX = '.index.json'
+MAGIC = b'CLIOBRSEEK1'
+POINTER = struct.Struct('<QQ')  # offset and length of the frame of the index
+# empty gzip member with FCOMMENT, the comment is MAGIC and POINTER in hex
+TRAILER_HEAD = b'\x1f\x8b\x08\x10\x00\x00\x00\x00\x00\xff'
+TRAILER_TAIL = b'\x00\x03\x00' + bytes(8)
+TRAILER_SIZE = len(TRAILER_HEAD) + len(MAGIC) + POINTER.size * 2 + len(TRAILER_TAIL)
+
+
+def compressframe(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Writer(io.RawIOBase):
+    """File object compressing what is written in independent frames, frames
+    are compressed in parallel and written in order
+    Parameters:
+        fileobj: file object of archive
+        level: compression level of zlib
+        threads: frames compressed at the same time, 0 for all cores
+    """
+
+    def __init__(self, fileobj, level=6, threads=0, frame_size=FRAME_SIZE):
+        self.fileobj = fileobj
+        self.level = 6 if level is None else level
+        self.frame_size = frame_size
+        self.frames = []  # compressed offset, uncompressed offset and size of frames
+        self._buf = bytearray()
+        self._position = 0
+        self._offset = fileobj.tell()
+        self._threads = threads or os.cpu_count()
+        self._executor = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._buf += data
+        self._position += len(data)
+        while len(self._buf) >= self.frame_size:
+            self._submit(bytes(self._buf[:self.frame_size]))
+            del self._buf[:self.frame_size]
+        return len(data)
+
+    def _submit(self, data):
+        self._pending.append((len(data), self._executor.submit(compressframe, data, self.level)))
+        while len(self._pending) > self._threads * 2:
+            self._drain()
+
+    def _drain(self):
+        length, future = self._pending.popleft()
+        frame = future.result()
+        uncompressed = self.frames[-1][1] + self.frames[-1][2] if self.frames else 0
+        self.frames.append((self._offset, uncompressed, length))
+        self.fileobj.write(frame)
+        self._offset += len(frame)
+
+    def flushframe(self):
+        """End the current frame, the next write starts a new frame"""
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf.clear()
+        while self._pending:
+            self._drain()
+
+    def finish(self, index_frame):
+        """Write the last frame and the trailer pointing at index_frame"""
+        self.flushframe()
+        self._executor.shutdown()
+        offset, _, _ = self.frames[index_frame]
+        end = self.frames[index_frame + 1][0] if index_frame + 1 < len(self.frames) else self._offset
+        self.fileobj.write(TRAILER_HEAD + MAGIC + POINTER.pack(offset, end - offset).hex().encode('ascii')
+                           + TRAILER_TAIL)
+
+
+def dataoffset(tar, member):
+    """Return offset in the tar of the data of member, the last member
+    added"""
+    return tar.offset - -(-member.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def writearchive(fileobj, arcname, files, level=6, threads=0, members=None, report=None, checksums=None,
+                 limiter=None, packed=()):
+    """Write a seekable archive
+    Parameters:
+        fileobj: file object of archive
+        arcname: name of the top directory in the archive
+        files: list of tuples of name in the directory and path of file,
+            device or image transfer url
+        members: dict filled with name and offset of data in the tar
+        report: function called with name, seconds and bytes of each file
+        checksums: Checksums filled while the raw images are read, written
+            after the files
+        limiter: ratelimit.Limiter of the job, each file is read with its
+            own limiter
+        packed: names of the files read as sparse images of their disk,
+            see sparse.Packer, the other raw images are GNU sparse members
+    """
+    writer = Writer(fileobj, level, threads)
+    index = {'members': {}}
+    with tarfile.open(fileobj=writer, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        directory = tarfile.TarInfo(arcname)
+        directory.type = tarfile.DIRTYPE
+        directory.mode = 0o755
+        directory.mtime = int(time())
+        tar.addfile(directory)
+        for name, path in files:
+            member = tarfile.TarInfo('{}/{}'.format(arcname, name))
+            disk_limiter = limiter.disk() if limiter is not None else None
+            entry = []
+            if name in packed or name.endswith('.raw'):
+                hasher = checksum.Hasher(os.path.splitext(name)[0]) if checksums is not None else None
+                layout = sparse.header if name in packed else sparse.tarmap
+                fd = source = sparse.opendisk(path, hasher, limiter=disk_limiter, layout=layout)
+                member.size = fd.length
+                if name not in packed:
+                    sparse.tarmember(member, fd.size)
+                    entry = [fd.size]
+            else:
+                fd = source = imagetransfer.opendisk(path)
+                member.size = imagetransfer.disksize(fd)
+                if disk_limiter is not None:
+                    source = ratelimit.Reader(fd, disk_limiter)
+                if checksums is not None:
+                    source = checksums.reader(name, source)
+            with fd:
+                member.mtime = int(time())
+                member.mode = 0o644
+                start = monotonic()
+                tar.addfile(member, source)
+                if checksums is not None:
+                    checksums.add(source)
+            offset = dataoffset(tar, member)
+            index['members']['{}/{}'.format(arcname, name)] = [offset, member.size] + entry
+            if members is not None:
+                members[name] = offset
+            if report is not None:
+                report(name, monotonic() - start, member.size)
+        if checksums is not None:
+            data = checksums.dumps()
+            member = tarfile.TarInfo('{}/{}'.format(arcname, checksum.MANIFEST))
+            member.size = len(data)
+            member.mtime = int(time())
+            tar.addfile(member, io.BytesIO(data))
+            index['members'][member.name] = [dataoffset(tar, member), member.size]
+        writer.flushframe()
+        index['frames'] = writer.frames
+        index_frame = len(writer.frames)
+        data = json.dumps(index).encode('utf-8')
+        member = tarfile.TarInfo('{}/{}'.format(arcname, INDEX))
+        member.size = len(data)
+        member.mtime = int(time())
+        tar.addfile(member, io.BytesIO(data))
+        writer.flushframe()
+    writer.finish(index_frame)
+
+
+def readpointer(fd):
+    """Return offset and length of the frame of the index, None when the file
+    is not a seekable archive"""
+    size = os.fstat(fd.fileno()).st_size
+    if size < TRAILER_SIZE:
+        return None
+    fd.seek(size - TRAILER_SIZE)
+    trailer = fd.read(TRAILER_SIZE)
+    head = TRAILER_HEAD + MAGIC
+    if not trailer.startswith(head) or not trailer.endswith(TRAILER_TAIL):
+        return None
+    try:
+        return POINTER.unpack(bytes.fromhex(trailer[len(head):-len(TRAILER_TAIL)].decode('ascii')))
+    except ValueError:
+        return None
+
+
+def isseekable(file):
+    if not os.path.isfile(file):
+        return False
+    with open(file, 'rb') as fd:
+        return readpointer(fd) is not None
+
+
+class Reader:
+    """Random access to the members of a seekable archive
+    Parameters:
+        file: path of archive
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._fd = open(file, 'rb')
+        pointer = readpointer(self._fd)
+        if pointer is None:
+            self._fd.close()
+            raise ValueError('{} is not a seekable archive'.format(file))
+        offset, length = pointer
+        self._fd.seek(offset)
+        data = zlib.decompressobj(31).decompress(self._fd.read(length))
+        # the frame holds only the index member, with a long name header
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+            index = json.load(tar.extractfile(tar.next()))
+        self.members = {name: tuple(value) for name, value in index['members'].items()}
+        self.frames = [tuple(frame) for frame in index['frames']]
+        self._starts = [frame[1] for frame in self.frames]
+        self._cache = (None, None)
+
+    def close(self):
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def frame(self, number):
+        """Return uncompressed data of frame"""
+        if self._cache[0] == number:
+            return self._cache[1]
+        offset = self.frames[number][0]
+        end = self.frames[number + 1][0] if number + 1 < len(self.frames) else None
+        self._fd.seek(offset)
+        data = self._fd.read(end - offset if end is not None else -1)
+        data = zlib.decompressobj(31).decompress(data)
+        self._cache = (number, data)
+        return data
+
+    def chunks(self, offset, length):
+        """Yield uncompressed data of the tar from offset, reading only the
+        frames of the range"""
+        number = bisect.bisect_right(self._starts, offset) - 1
+        while length > 0 and number < len(self.frames):
+            _, start, size = self.frames[number]
+            data = self.frame(number)
+            chunk = memoryview(data)[offset - start:min(size, offset - start + length)]
+            yield chunk
+            offset += len(chunk)
+            length -= len(chunk)
+            number += 1
+
+    def read(self, offset, length):
+        return b''.join(self.chunks(offset, length))
+
+    def member(self, name):
+        """Return offset and size of member, name without top directory is
+        looked up in any directory"""
+        if name in self.members:
+            return self.members[name]
+        for member, value in self.members.items():
+            if member.split('/', 1)[-1] == name:
+                return value
+        raise KeyError('{} not found in {}'.format(name, self.file))
+
+    def disksize(self, name):
+        """Return virtual size of the disk of a GNU sparse member, its data
+        starts with a sparse.tarmap(), None for other members"""
+        value = self.member(name)
+        return value[2] if len(value) > 2 else None
+
+    def open(self, name, stored=False):
+        """Return seekable file object of member, of the disk of a GNU
+        sparse member unless stored is set"""
+        offset, size = self.member(name)[:2]
+        member = MemberFile(self, offset, size)
+        disksize = self.disksize(name)
+        if disksize is None or stored:
+            return member
+        return DiskFile(member, disksize)
+
+
+class MemberFile(io.RawIOBase):
+    def __init__(self, reader, offset, size):
+        self.reader = reader
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buf):
+        length = min(len(buf), self.size - self.position)
+        if length <= 0:
+            return 0
+        done = 0
+        for chunk in self.reader.chunks(self.offset + self.position, length):
+            buf[done:done + len(chunk)] = chunk
+            done += len(chunk)
+        self.position += done
+        return done
+
+
+class DiskFile(io.RawIOBase):
+    """Seekable file object of the disk of a GNU sparse member, holes are
+    read as zeros"""
+
+    def __init__(self, member, size):
+        self.member = member
+        self.size = size
+        self.extents = sparse.readtarmap(member)
+        self.position = 0
+        self._starts = [start for start, _ in self.extents]
+        # offset in member of the data of each extent
+        self._data = []
+        offset = member.tell()
+        for start, end in self.extents:
+            self._data.append(offset)
+            offset += end - start
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        length = min(len(view), self.size - self.position)
+        if length <= 0:
+            return 0
+        number = bisect.bisect_right(self._starts, self.position) - 1
+        if number >= 0 and self.position < self.extents[number][1]:
+            start, end = self.extents[number]
+            length = min(length, end - self.position)
+            self.member.seek(self._data[number] + self.position - start)
+            length = self.member.readinto(view[:length])
+        else:
+            end = self._starts[number + 1] if number + 1 < len(self._starts) else self.size
+            length = min(length, end - self.position)
+            view[:length] = bytes(length)
+        self.position += length
+        return length
@@ -8,8 +8,9 @@ setup(
     name='cliobr',
     version='0.8.5',
     description='Script for backup and restore virtual machines in oVirt/RHV environment',
-    py_modules=['cliobr', 'helpers'],
+    py_modules=['agents', 'benchmark', 'catalog', 'checksum', 'chunkstore', 'cliobr', 'daemon', 'descriptor', 'directio', 'fakeovirt', 'fakes3', 'helpers', 'imagetransfer', 'incremental', 'inventory', 'jobs', 'journal', 'offload', 'ratelimit', 'report', 'seekable', 'sparse', 'verify', 'wait'],
     license='MIT',
+    python_requires='>=3.9',
     install_requires=[
         'Click',
         'ovirt-engine-sdk-python',
@@ -0,0 +1,292 @@
+import errno
+import io
+import os
+import stat
+import struct
+import tarfile
+from time import monotonic
+
+import directio
+import imagetransfer
+
+# Sparse image of a disk, <disk-id>.sparse: a header with the virtual size
+# and the extents of data of the disk, then the data of the extents in order.
+# Holes and zero extents are not stored, so a backup grows with the data
+# allocated in the disks and not with their provisioned size. Disks are read
+# for their extents with SEEK_DATA/SEEK_HOLE, from the zero extents reported
+# by an image transfer, or in full for block devices that report none.
+RAW = 'raw'
+SPARSE = 'sparse'
+FORMATS = (RAW, SPARSE)
+SUFFIX = '.sparse'
+# suffixes of the disk images of a backup
+SUFFIXES = ('.raw', SUFFIX)
+MAGIC = b'CLIOSPR1'
+HEADER = struct.Struct('<8sQQ')  # magic, virtual size and number of extents
+EXTENT = struct.Struct('<QQ')  # offset and length of extent
+CHUNK_SIZE = 8 * 2**20
+# Raw images streamed in a tar are GNU sparse members of format 1.0, like
+# tar -S writes them: the data of the member starts with the number of
+# extents and the offset and length of each extent in decimal, padded to a
+# tar block, then the data of the extents. tar and tarfile extract them with
+# holes and read the holes as zeros.
+TAR_SPARSE = {'GNU.sparse.major': '1', 'GNU.sparse.minor': '0'}
+
+
+class SparseError(ValueError):
+    pass
+
+
+def isimage(name):
+    return name.endswith(SUFFIXES)
+
+
+def dataextents(fd, size):
+    """Return list of (start, end) of data extents of a file, holes are
+    skipped with SEEK_DATA/SEEK_HOLE, the whole file when not supported"""
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # only a hole left
+                    break
+                raise
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, min(end, size)))
+            offset = end
+    except (OSError, AttributeError):
+        return [(0, size)] if size else []
+    return extents
+
+
+def header(size, extents):
+    """Return header of a sparse image with extents as (start, end)"""
+    return HEADER.pack(MAGIC, size, len(extents)) + b''.join(
+        EXTENT.pack(start, end - start) for start, end in extents)
+
+
+def readexactly(src, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = src.read(length - len(data))
+        if not chunk:
+            raise SparseError('sparse image ends after {} of {} bytes of header'.format(len(data), length))
+        data += chunk
+    return bytes(data)
+
+
+def tarmap(size, extents):
+    """Return sparse map of a GNU sparse member with extents as (start, end)
+    of a disk of size, an empty extent marks the end of a disk ending with a
+    hole"""
+    if not extents or extents[-1][1] < size:
+        extents = extents + [(size, size)]
+    fields = [len(extents)] + [value for start, end in extents for value in (start, end - start)]
+    data = ''.join('{}\n'.format(value) for value in fields).encode('ascii')
+    return data + bytes(-len(data) % tarfile.BLOCKSIZE)
+
+
+def tarmember(member, size):
+    """Make TarInfo member a GNU sparse member of a disk of size, its data
+    is a Packer with tarmap() as layout, the tar must be in PAX format"""
+    member.pax_headers = dict(TAR_SPARSE, **{'GNU.sparse.name': member.name, 'GNU.sparse.realsize': str(size)})
+    directory, name = os.path.split(member.name)
+    member.name = os.path.join(directory, 'GNUSparseFile.0', name)
+
+
+def readtarmap(src):
+    """Return extents as (start, end) of the sparse map of a GNU sparse
+    member read from file object src, src is left at the data"""
+    data = readexactly(src, tarfile.BLOCKSIZE)
+    while True:
+        fields = data.split(b'\n')[:-1]
+        if fields and len(fields) > 2 * int(fields[0]):
+            break
+        data += readexactly(src, tarfile.BLOCKSIZE)
+    values = [int(value) for value in fields[1:1 + 2 * int(fields[0])]]
+    return [(start, start + length) for start, length in zip(values[::2], values[1::2]) if length]
+
+
+def readheader(src):
+    """Return virtual size and extents as (start, end) of a sparse image
+    read from file object src"""
+    magic, size, count = HEADER.unpack(readexactly(src, HEADER.size))
+    if magic != MAGIC:
+        raise SparseError('not a sparse image')
+    table = readexactly(src, EXTENT.size * count)
+    extents = []
+    for number in range(count):
+        start, length = EXTENT.unpack_from(table, number * EXTENT.size)
+        extents.append((start, start + length))
+    return size, extents
+
+
+class Packer(io.RawIOBase):
+    """File object reading a disk as a sparse image
+    Parameters:
+        size: virtual size of disk
+        extents: list of (start, end) of the data of the disk
+        chunks: iterator of offset and data covering the extents in order
+        hasher: checksum.Hasher fed with the disk, holes as zeros
+        fileobj: file object of the disk closed with the packer
+        limiter: ratelimit.Limiter charged for the data read
+        layout: function returning what is read before the data from size
+            and extents, header() or tarmap()
+    """
+
+    def __init__(self, size, extents, chunks, hasher=None, fileobj=None, limiter=None, layout=header):
+        self.size = size
+        self.extents = extents
+        self.hasher = hasher
+        self.fileobj = fileobj
+        self.limiter = limiter
+        head = layout(size, extents)
+        self.length = len(head) + sum(end - start for start, end in extents)
+        self._chunks = chunks
+        self._view = memoryview(head)
+        self._offset = 0
+        if hasher is not None and not extents:
+            hasher.zeros(size)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast('B')
+        done = 0
+        while done < len(view):
+            if not self._view:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                offset, data = chunk
+                if self.limiter is not None:
+                    self.limiter.take(len(data))
+                if self.hasher is not None:
+                    self.hasher.zeros(offset - self._offset)
+                    self.hasher.update(data)
+                    if offset + len(data) == self.extents[-1][1]:
+                        # the reader stops at the end of the data
+                        self.hasher.zeros(self.size - offset - len(data))
+                self._offset = offset + len(data)
+                self._view = memoryview(data)
+            length = min(len(view) - done, len(self._view))
+            view[done:done + length] = self._view[:length]
+            self._view = self._view[length:]
+            done += length
+        return done
+
+    def close(self):
+        if self.fileobj is not None:
+            self.fileobj.close()
+        super().close()
+
+
+def opendisk(path, hasher=None, bufsize=None, limiter=None, layout=header):
+    """Return Packer reading a file, device or image transfer url as a
+    sparse image, or as the data of a GNU sparse member with tarmap() as
+    layout, only the data extents are read, in blocks of bufsize or of
+    directio.BLOCK_SIZE for files and devices"""
+    if imagetransfer.isurl(path):
+        reader = imagetransfer.Reader(path)
+        extents = []
+        for start, end, zero in reader.extents:
+            if zero:
+                continue
+            if extents and extents[-1][1] == start:
+                extents[-1] = (extents[-1][0], end)
+            else:
+                extents.append((start, end))
+        chunks = ((offset, data) for offset, _, data in reader.chunks() if data is not None)
+        return Packer(reader.size, extents, chunks, hasher, reader, limiter, layout)
+    fileobj = imagetransfer.opendisk(path)
+    extents = dataextents(fileobj.fileno(), fileobj.size)
+    return Packer(fileobj.size, extents, fileobj.chunks(extents, bufsize), hasher, fileobj, limiter, layout)
+
+
+def pack(src_path, dst_path, hasher=None, bufsize=CHUNK_SIZE, limiter=None):
+    """Write sparse image of a raw image, device or image transfer url
+    Parameters:
+        hasher: checksum.Hasher fed with the disk, holes as zeros
+        limiter: ratelimit.Limiter charged for the data read
+    Returns:
+        bytes of the sparse image
+    """
+    with opendisk(src_path, hasher, limiter=limiter) as src, open(dst_path, 'wb') as dst:
+        while True:
+            data = src.read(bufsize)
+            if not data:
+                break
+            dst.write(data)
+        dst.flush()
+        os.fsync(dst.fileno())
+        return dst.tell()
+
+
+def unpack(src, dst_path=None, bufsize=CHUNK_SIZE, hasher=None, limiter=None, start_offset=0, checkpoint=None,
+           interval=10, size=None):
+    """Write sparse image read from file object src to a device or raw
+    image, zero blocks are skipped and dst is not truncated so it can be a
+    block device
+    Parameters:
+        dst_path: path of device or raw image, None to only feed hasher
+        hasher: checksum.Hasher checking the data before it is written,
+            holes are hashed as zeros
+        limiter: ratelimit.Limiter charged for the data read
+        start_offset: bytes of dst written by a former copy, they are
+            hashed and not written again
+        checkpoint: function called with the offset written every interval
+            seconds, once dst is synced
+        size: virtual size of the disk of a GNU sparse member, src then
+            starts with its tarmap(), None for a sparse image
+    Returns:
+        tuple of bytes of data read and bytes written
+    """
+    if size is None:
+        size, extents = readheader(src)
+    else:
+        extents = readtarmap(src)
+    zero = bytes(bufsize)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    dst = os.open(dst_path, os.O_WRONLY | os.O_CREAT, 0o644) if dst_path is not None else None
+    behind = directio.WriteBehind(dst)
+    try:
+        done = written = offset = 0
+        last = monotonic()
+        for start, end in extents:
+            if hasher is not None:
+                hasher.zeros(start - offset)
+            offset = start
+            while offset < end:
+                length = src.readinto(view[:min(bufsize, end - offset)])
+                if not length:
+                    raise SparseError('sparse image ends at offset {} of extent {}-{}'.format(offset, start, end))
+                if limiter is not None:
+                    limiter.take(length)
+                if hasher is not None:
+                    hasher.update(view[:length])
+                if dst is not None and offset + length > start_offset and not zero.startswith(view[:length]):
+                    written += os.pwrite(dst, view[:length], offset)
+                    behind.add(offset, length)
+                offset += length
+                done += length
+                if checkpoint is not None and dst is not None and monotonic() - last >= interval:
+                    os.fsync(dst)
+                    checkpoint(offset)
+                    last = monotonic()
+        if hasher is not None:
+            hasher.zeros(size - offset)
+            hasher.result()
+        if dst is not None:
+            if stat.S_ISREG(os.fstat(dst).st_mode) and os.fstat(dst).st_size < size:
+                os.ftruncate(dst, size)
+            behind.flush()
+            os.fsync(dst)
+    finally:
+        if dst is not None:
+            os.close(dst)
+    return done, written
@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The modules of the repository import ovirtsdk4, the tests run them against
+# the fake manager of fakeovirt installed before they are imported.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeovirt  # noqa: E402
+
+ENGINE = fakeovirt.Engine(tempfile.mkdtemp(prefix='cliobr-test-'))
+fakeovirt.install(ENGINE)
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """Fake manager with the devices of attached disks found by helpers"""
+    import helpers
+    monkeypatch.setattr(helpers, 'DEVICE_PATH', ENGINE.device_path + '/')
+    yield ENGINE
+    for target in ENGINE.targets.values():
+        if os.path.exists(target):
+            os.remove(target)
+    ENGINE.targets.clear()
@@ -0,0 +1,52 @@
+import threading
+
+import agents
+from fakeovirt import Obj
+
+
+def agent(name, slots=2, storage_domains=()):
+    return agents.Agent(Obj(id=name, name=name), slots, storage_domains)
+
+
+def test_choose_prefers_local_storage_domain():
+    local = agent('local', storage_domains={'sd1'})
+    other = agent('other', storage_domains={'sd2'})
+    pool = agents.Pool([other, local])
+    assert pool.choose('sd1') is local
+    assert pool.choose('sd2') is other
+
+
+def test_choose_balances_load_and_skips_failed_agents():
+    first = agent('first', slots=4)
+    second = agent('second', slots=2)
+    pool = agents.Pool([first, second])
+    first.used = 2
+    assert pool.choose() is second
+    second.used = 1
+    assert pool.choose() is first
+    first.failures = 1
+    assert pool.choose() is second
+
+
+def test_choose_returns_none_when_full():
+    only = agent('only', slots=1)
+    pool = agents.Pool([only])
+    only.used = 1
+    assert pool.choose() is None
+
+
+def test_acquire_spreads_disks_and_waits_for_a_slot():
+    first = agent('first', slots=1)
+    second = agent('second', slots=1)
+    pool = agents.Pool([first, second])
+    taken = {pool.acquire(), pool.acquire()}
+    assert taken == {first, second}
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+    assert not got
+    pool.release(second)
+    waiter.join(5)
+    assert got == [second]
+    assert second.placed == 2 and second.used == 1
@@ -0,0 +1,74 @@
+import json
+import logging
+import io
+import os
+import tarfile
+
+import catalog
+import incremental
+import journal
+
+VM_ID = '00000000-0000-4000-8000-00000000beef'
+
+
+def name(timestamp, vm='vm'):
+    return '{}-{}-{}'.format(vm, timestamp, VM_ID)
+
+
+def entry(timestamp, parent=None, kind=catalog.FULL):
+    return {'name': name(timestamp), 'vm': 'vm', 'vm_id': VM_ID, 'timestamp': timestamp,
+            'file': name(timestamp) + '.tar.gz', 'kind': kind, 'parent': parent and name(parent)}
+
+
+def test_retained_keeps_periods_and_parents():
+    backups = [
+        entry('20240101120000'),
+        entry('20240102120000', '20240101120000', catalog.INCREMENTAL),
+        entry('20240115120000'),
+        entry('20240201090000'),
+        entry('20240201180000', '20240201090000', catalog.INCREMENTAL),
+    ]
+    assert catalog.retained(backups, keep_last=1) == {name('20240201180000'), name('20240201090000')}
+    assert catalog.retained(backups, keep_daily=2) == {
+        name('20240201180000'), name('20240201090000'), name('20240115120000')}
+    assert catalog.retained(backups, keep_monthly=2) == {
+        name('20240201180000'), name('20240201090000'), name('20240115120000')}
+    assert catalog.retained(backups, keep_weekly=4) == {
+        name('20240201180000'), name('20240201090000'), name('20240115120000'),
+        name('20240102120000'), name('20240101120000')}
+
+
+def test_scan_prune_and_lookup(tmp_path):
+    backup_path = str(tmp_path)
+    for timestamp in ('20240101120000', '20240102120000', '20240103120000'):
+        with tarfile.open(os.path.join(backup_path, name(timestamp) + '.tar.gz'), 'w:gz') as tar:
+            member = tarfile.TarInfo(name(timestamp) + '/disk.raw')
+            member.size = 4
+            tar.addfile(member, io.BytesIO(b'disk'))
+        with open(os.path.join(backup_path, name(timestamp) + '.report.json'), 'w') as fd:
+            fd.write('{}')
+    incremental_dir = os.path.join(backup_path, name('20240104120000'))
+    os.makedirs(incremental_dir)
+    with open(os.path.join(incremental_dir, incremental.MANIFEST), 'w') as fd:
+        json.dump({'parent': name('20240103120000'), 'disks': {}}, fd)
+    # a failed backup is left to resume
+    journal.create(backup_path, name('20240105120000'), journal.BACKUP).unlock()
+    os.makedirs(os.path.join(backup_path, name('20240105120000')))
+    store = catalog.Catalog(backup_path)
+    try:
+        assert catalog.scan(store, backup_path, logging) == 4
+        assert catalog.scan(store, backup_path, logging) == 0
+        assert [backup['kind'] for backup in store.list(vm='vm')] == [catalog.INCREMENTAL] + [catalog.FULL] * 3
+        assert store.list(since='20240103000000', limit=1)[0]['name'] == name('20240104120000')
+        removed = catalog.prune(store, backup_path, logging, vm='vm', dry_run=True, keep_last=1)
+        assert [backup['name'] for backup in removed] == [name('20240101120000'), name('20240102120000')]
+        assert len(store.list()) == 4
+        catalog.prune(store, backup_path, logging, vm='vm', keep_last=1)
+        assert [backup['name'] for backup in store.list()] == [name('20240104120000'), name('20240103120000')]
+        assert not os.path.exists(os.path.join(backup_path, name('20240101120000') + '.tar.gz'))
+        assert not os.path.exists(os.path.join(backup_path, name('20240101120000') + '.report.json'))
+        assert os.path.exists(os.path.join(backup_path, name('20240103120000') + '.tar.gz'))
+    finally:
+        store.close()
+    assert catalog.lookup(backup_path, name('20240103120000') + '.tar.gz')['name'] == name('20240103120000')
+    assert catalog.lookup(backup_path, name('20240101120000')) is None
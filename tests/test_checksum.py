@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import checksum
+import fakeovirt
+import incremental
+import sparse
+import verify
+
+
+def test_hasher_matches_blocks_of_file(tmp_path):
+    image = str(tmp_path / 'disk.raw')
+    fakeovirt.makeimage(image, 2 * checksum.BLOCK_SIZE + 4096, seed=1)
+    sums = checksum.hashfile(image)
+    with open(image, 'rb') as fd:
+        data = fd.read()
+    digests = b''.join(checksum.blockdigest(data[i:i + checksum.BLOCK_SIZE])
+                       for i in range(0, len(data), checksum.BLOCK_SIZE))
+    assert sums == checksum.fromdigests(len(data), digests)
+    # holes are hashed as zeros without reading them
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        extents = sparse.dataextents(fd, len(data))
+    finally:
+        os.close(fd)
+    assert checksum.hashfile(image, extents, len(data)) == sums
+
+
+def test_hasher_checks_expected_blocks(tmp_path):
+    image = str(tmp_path / 'disk.raw')
+    fakeovirt.makeimage(image, checksum.BLOCK_SIZE * 2, seed=2, data=1.0)
+    expected = checksum.hashfile(image)
+    checksum.hashfile(image, hasher=checksum.Hasher('disk', expected))
+    with open(image, 'r+b') as fd:
+        fd.seek(checksum.BLOCK_SIZE + 10)
+        fd.write(b'changed')
+    with pytest.raises(checksum.ChecksumError, match='block 1'):
+        checksum.hashfile(image, hasher=checksum.Hasher('disk', expected))
+
+
+def test_manifest_round_trip(tmp_path):
+    sums = checksum.Checksums({'disk': checksum.fromdigests(5, checksum.blockdigest(b'hello'))})
+    sums.write(str(tmp_path))
+    assert checksum.readmanifest(str(tmp_path)).disks == sums.disks
+
+
+def test_delta_round_trip(tmp_path):
+    device = str(tmp_path / 'device')
+    fakeovirt.makeimage(device, 5 * checksum.BLOCK_SIZE + 4096, seed=4, block=checksum.BLOCK_SIZE)
+    full = str(tmp_path / 'full.delta')
+    hashes = str(tmp_path / 'hashes')
+    incremental.deltadisk(device, full, b'', hashes)
+    with open(hashes, 'rb') as fd:
+        old_hashes = fd.read()
+    with open(device, 'r+b') as fd:
+        fd.seek(3 * checksum.BLOCK_SIZE + 100)
+        fd.write(os.urandom(1000))
+        fd.seek(checksum.BLOCK_SIZE)
+        fd.write(bytes(checksum.BLOCK_SIZE))
+    delta = str(tmp_path / 'changed.delta')
+    size, written = incremental.deltadisk(device, delta, old_hashes, hashes)
+    assert written <= 2
+    raw = str(tmp_path / 'rebuilt.raw')
+    incremental.applydelta(full, raw)
+    incremental.applydelta(delta, raw)
+    with open(device, 'rb') as expected, open(raw, 'rb') as got:
+        assert expected.read() == got.read()
+    # both deltas check against the checksums of the whole disk
+    with open(hashes, 'rb') as fd:
+        expected = checksum.fromdigests(size, fd.read())
+    with open(delta, 'rb') as src:
+        verify.hashdelta(src, 'disk', expected, False)
+    with open(full, 'rb') as src, pytest.raises(checksum.ChecksumError):
+        verify.hashdelta(src, 'disk', expected, True)
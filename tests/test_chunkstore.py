@@ -0,0 +1,78 @@
+import logging
+import os
+
+import chunkstore
+import fakeovirt
+
+
+class GcLimiter:
+    """Limiter running gc of another store before a chunk is stored"""
+
+    def __init__(self, backup_path, before):
+        self.backup_path = backup_path
+        self.before = before
+        self.reads = 0
+        self.freed = None
+
+    def take(self, nbytes):
+        self.reads += 1
+        if self.reads == self.before:
+            store = chunkstore.ChunkStore(self.backup_path)
+            try:
+                self.freed = store.gc(self.backup_path, logging)
+            finally:
+                store.close()
+
+
+def image(path, seed, data=0.6, zeros=0.1, text=0.3):
+    fakeovirt.makeimage(path, 6 * chunkstore.CHUNK_SIZE, seed, data=data, zeros=zeros, text=text,
+                        block=chunkstore.CHUNK_SIZE)
+    return path
+
+
+def test_store_and_rebuild_deduplicated_disks(tmp_path):
+    backup_path = str(tmp_path)
+    disk = image(str(tmp_path / 'disk.img'), 1)
+    store = chunkstore.ChunkStore(backup_path)
+    try:
+        for backup in ('first', 'second'):
+            os.makedirs(str(tmp_path / backup))
+            manifest = str(tmp_path / backup / ('disk' + chunkstore.SUFFIX))
+            size, digests, written = chunkstore.storedisk(store, disk, manifest, backup=backup)
+            raw = str(tmp_path / backup / 'disk.raw')
+            chunkstore.rebuilddisk(store, manifest, raw)
+            with open(disk, 'rb') as expected, open(raw, 'rb') as got:
+                assert expected.read() == got.read()
+            if backup == 'second':
+                assert written == 0
+    finally:
+        store.close()
+
+
+def test_gc_keeps_chunks_of_a_running_backup(tmp_path):
+    backup_path = str(tmp_path)
+    disk = image(str(tmp_path / 'disk.img'), 2, data=1, zeros=0, text=0)
+    os.makedirs(str(tmp_path / 'old'))
+    store = chunkstore.ChunkStore(backup_path)
+    try:
+        chunkstore.storedisk(store, disk, str(tmp_path / 'old' / ('disk' + chunkstore.SUFFIX)), backup='old')
+        # the old backup is removed, the new one finds its chunks in the store
+        # and gc runs in the middle of the copy
+        os.remove(str(tmp_path / 'old' / ('disk' + chunkstore.SUFFIX)))
+        os.rmdir(str(tmp_path / 'old'))
+        os.makedirs(str(tmp_path / 'new'))
+        limiter = GcLimiter(backup_path, before=4)
+        manifest = str(tmp_path / 'new' / ('disk' + chunkstore.SUFFIX))
+        size, digests, written = chunkstore.storedisk(store, disk, manifest, limiter=limiter, backup='new')
+        # chunks put before gc are referenced, the last three are freed and stored again
+        assert limiter.freed[0] == 3
+        for digest in filter(None, digests):
+            assert os.path.exists(store.chunkpath(digest))
+        raw = str(tmp_path / 'new' / 'disk.raw')
+        chunkstore.rebuilddisk(store, manifest, raw)
+        with open(disk, 'rb') as expected, open(raw, 'rb') as got:
+            assert expected.read() == got.read()
+        # chunks of the new backup stay until it is removed
+        assert store.gc(backup_path, logging) == (0, 0)
+    finally:
+        store.close()
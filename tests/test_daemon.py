@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+import pytest
+
+import daemon
+import fakeovirt
+import jobs
+
+
+@pytest.fixture
+def server(tmp_path):
+    queue = daemon.JobQueue(':memory:')
+    servers = []
+
+    def start(listen, **kwargs):
+        server = daemon.serve(listen, queue, str(tmp_path), **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        if listen.startswith('/'):
+            return listen
+        return '127.0.0.1:{}'.format(server.server_address[1])
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    queue.close()
+
+
+def test_queue_orders_by_priority_and_serializes_targets(tmp_path):
+    path = str(tmp_path / 'queue.db')
+    queue = daemon.JobQueue(path)
+    ids = queue.submit([{'kind': 'backup', 'target': 'a'}, {'kind': 'backup', 'target': 'b', 'priority': 5},
+                        {'kind': 'backup', 'target': 'a', 'priority': 9}])
+    first = queue.take(0)
+    assert first['id'] == ids[2] and first['state'] == daemon.RUNNING
+    # the other job of a waits for the running one
+    second = queue.take(0)
+    assert second['id'] == ids[1]
+    assert queue.take(0) is None
+    queue.finish(first['id'], 0)
+    assert queue.take(0)['id'] == ids[0]
+    queue.finish(second['id'], 2)
+    assert queue.get(second['id'])['state'] == daemon.FAILED
+    assert [job['id'] for job in queue.list(daemon.DONE)] == [ids[2]]
+    queue.close()
+    # the job left running is queued again by the next daemon
+    queue = daemon.JobQueue(path)
+    assert queue.recover() == 1
+    assert queue.take(0)['id'] == ids[0]
+    queue.close()
+
+
+def test_checkjob():
+    assert daemon.checkjob({'kind': 'backup', 'target': 'vm', 'options': {'codec': 'zstd'}}) is None
+    assert 'kind' in daemon.checkjob({'kind': 'copy', 'target': 'vm'})
+    assert 'target' in daemon.checkjob({'kind': 'backup', 'target': ''})
+    assert 'unknown options' in daemon.checkjob({'kind': 'restore', 'target': 'f', 'options': {'codec': 'gzip'}})
+    assert 'job_limit' in daemon.checkjob({'kind': 'backup', 'target': 'vm', 'options': {'job_limit': 'fast'}})
+    assert 'backend' in daemon.checkjob({'kind': 'backup', 'target': 'vm', 'options': {'backend': 'nfs'}})
+    assert daemon.checkjob({'kind': 'backup', 'target': 'vm', 'options': {'codec': 'zstd', 'level': 19}}) is None
+    assert 'level' in daemon.checkjob({'kind': 'backup', 'target': 'vm', 'options': {'level': 10}})
+    assert 'level' in daemon.checkjob({'kind': 'backup', 'target': 'vm', 'options': {'codec': 'none', 'level': 1}})
+    assert 'codec' in daemon.checkjob({'kind': 'backup', 'target': 'vm', 'options': {'codec': 'xz'}})
+
+
+def test_api_on_unix_socket(server, tmp_path):
+    listen = server(str(tmp_path / 'api.sock'))
+    status, body = daemon.request(listen, 'POST', '/jobs', [{'kind': 'backup', 'target': 'vm'}])
+    assert status == 201 and len(body['ids']) == 1
+    status, job = daemon.request(listen, 'GET', '/jobs/{}'.format(body['ids'][0]))
+    assert status == 200 and job['target'] == 'vm' and job['state'] == daemon.PENDING
+    assert daemon.request(listen, 'GET', '/jobs?state=pending')[1][0]['id'] == job['id']
+    assert daemon.request(listen, 'GET', '/jobs/999')[0] == 404
+    status, body = daemon.request(listen, 'POST', '/jobs', {'kind': 'backup'})
+    assert status == 400 and 'target' in body['error']
+    assert daemon.request(listen, 'POST', '/tasks', {'kind': 'convert'})[0] == 400
+
+
+def test_api_on_tcp_needs_the_token(server):
+    with pytest.raises(ValueError):
+        daemon.serve('127.0.0.1:0', None)
+    listen = server('127.0.0.1:0', token='secret')
+    assert daemon.request(listen, 'GET', '/jobs')[0] == 401
+    assert daemon.request(listen, 'GET', '/jobs', token='wrong')[0] == 401
+    assert daemon.request(listen, 'GET', '/jobs', token='secret') == (200, [])
+
+
+def test_daemon_runs_queued_backups(engine, tmp_path):
+    image = str(tmp_path / 'disk.img')
+    fakeovirt.makeimage(image, 3 * 2**20, seed=11)
+    engine.addvm('daemonvm', {'00000000-0000-4000-8000-00000000d001': image})
+    backup_path = str(tmp_path / 'backups')
+    os.makedirs(backup_path)
+    queue = daemon.JobQueue(':memory:')
+    session = daemon.Session('https://engine.test/ovirt-engine/api', 'admin', 'password', None,
+                             agent_name='agent')
+    # restores need a storage domain and a cluster, from the job or the daemon
+    worker = daemon.Daemon(session, queue, backup_path, False, 2, jobs.Limits())
+    worker.start()
+    try:
+        ids = queue.submit([{'kind': 'backup', 'target': 'daemonvm', 'options': {'stream': True}},
+                            {'kind': 'restore', 'target': 'daemonvm.tar.gz'}])
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and any(queue.get(i)['state'] in (daemon.PENDING, daemon.RUNNING)
+                                                  for i in ids):
+            time.sleep(0.1)
+    finally:
+        worker.stop()
+        session.close()
+    assert [queue.get(i)['state'] for i in ids] == [daemon.DONE, daemon.FAILED]
+    assert [name for name in os.listdir(backup_path) if name.startswith('daemonvm-') and name.endswith('.tar.gz')]
+    queue.close()
@@ -0,0 +1,51 @@
+import io
+import json
+import logging
+import os
+import tarfile
+
+import descriptor
+import fakeovirt
+import helpers
+
+DISKS = {'00000000-0000-4000-8000-0000000b0001': 2, '00000000-0000-4000-8000-0000000b0002': 1}
+
+
+def test_parse_keeps_the_disks_of_the_ovf():
+    ovf = fakeovirt.makeovf('descvm', '00000000-0000-4000-8000-0000000b0000', DISKS)
+    parsed = descriptor.fromstring(ovf)
+    assert parsed['vm'] == 'descvm' and parsed['version'] == descriptor.VERSION
+    assert [(disk['id'], disk['size'], disk['boot'], disk['parent']) for disk in parsed['disks']] == [
+        ('00000000-0000-4000-8000-0000000b0001', 2 * 2**30, True, None),
+        ('00000000-0000-4000-8000-0000000b0002', 2**30, False, None)]
+    assert parsed['disks'][0]['alias'] == 'descvm_Disk1' and parsed['disks'][0]['format'] == 'RAW'
+
+
+def test_load_writes_the_descriptor_once(tmp_path):
+    base = str(tmp_path / 'backup')
+    ovf_file = str(tmp_path / 'vm.ovf')
+    with open(ovf_file, 'w') as fd:
+        fd.write(fakeovirt.makeovf('descvm', '00000000-0000-4000-8000-0000000b0000', DISKS))
+    assert descriptor.read(base) is None
+    loaded = descriptor.load(base, ovf_file)
+    assert descriptor.read(base) == loaded
+    # the OVF is not read again
+    os.remove(ovf_file)
+    assert descriptor.load(base, ovf_file) == loaded
+    with open(descriptor.sidecar(base), 'w') as fd:
+        json.dump(dict(loaded, version=descriptor.VERSION + 1), fd)
+    assert descriptor.read(base) is None
+
+
+def test_metadata_is_read_before_the_disk_images(tmp_path):
+    archive = str(tmp_path / 'vm.tar.gz')
+    ovf = fakeovirt.makeovf('descvm', '00000000-0000-4000-8000-0000000b0000', DISKS).encode('utf-8')
+    with tarfile.open(archive, 'w:gz') as tar:
+        for name, data in (('vm/vm.ovf', ovf), ('vm/disk.raw', bytes(4096)), ('vm/late.json', b'{}')):
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    destination = str(tmp_path / 'metadata')
+    assert helpers.unpack_metadata(archive, destination, logging, 1) == 0
+    assert os.listdir(os.path.join(destination, 'vm')) == ['vm.ovf']
+    assert descriptor.parse(os.path.join(destination, 'vm', 'vm.ovf'))['vm'] == 'descvm'
@@ -0,0 +1,90 @@
+import logging
+import os
+
+import ovirtsdk4.types as types
+import pytest
+
+import checksum
+import fakeovirt
+import helpers
+import imagetransfer
+import jobs
+import verify
+
+DISK = '00000000-0000-4000-8000-0000000a0001'
+
+
+@pytest.fixture
+def transfer(engine, tmp_path):
+    image = str(tmp_path / 'disk.img')
+    fakeovirt.makeimage(image, 5 * 2**20 + 4096, seed=40, data=0.4, zeros=0.2, text=0.2, block=2**19)
+    engine.addvm('transfervm', {DISK: image})
+    system_service = jobs.SharedConnection(url='x').system_service()
+    transfers = imagetransfer.starttransfers(system_service, [engine.disks[DISK]], types, logging)
+    yield image, imagetransfer.transferurl(transfers[DISK])
+    imagetransfer.finishtransfers(system_service, transfers, logging)
+
+
+def test_download_is_sparse_and_hashed(transfer, tmp_path):
+    image, url = transfer
+    raw = str(tmp_path / 'disk.raw')
+    hasher = checksum.Hasher(DISK)
+    size, written = imagetransfer.download(url, raw, 2, chunk_size=2**19, hasher=hasher)
+    assert size == os.path.getsize(image) == os.path.getsize(raw)
+    with open(image, 'rb') as expected, open(raw, 'rb') as got:
+        assert expected.read() == got.read()
+    assert hasher.result() == checksum.hashfile(image)
+    assert os.stat(raw).st_blocks * 512 <= os.stat(image).st_blocks * 512
+    # a resumed download hashes the bytes already written
+    with open(raw, 'r+b') as fd:
+        fd.truncate(2**20)
+    hasher = checksum.Hasher(DISK)
+    imagetransfer.download(url, raw, 2, chunk_size=2**19, hasher=hasher, offset=2**20)
+    with open(image, 'rb') as expected, open(raw, 'rb') as got:
+        assert expected.read() == got.read()
+    assert hasher.result() == checksum.hashfile(image)
+
+
+def test_reader_reads_in_order(transfer):
+    image, url = transfer
+    with imagetransfer.opendisk(url) as reader, open(image, 'rb') as expected:
+        assert imagetransfer.disksize(reader) == os.path.getsize(image)
+        buf = bytearray(3 * 2**19 + 5)
+        while True:
+            length = reader.readinto(buf)
+            if not length:
+                break
+            assert bytes(buf[:length]) == expected.read(length)
+        assert expected.read() == b''
+
+
+def test_finished_transfer_can_not_be_read(engine, transfer, tmp_path):
+    _, url = transfer
+    system_service = jobs.SharedConnection(url='x').system_service()
+    imagetransfer.finishtransfers(system_service, {DISK: engine.transfers[url.rsplit('/', 1)[1]]}, logging)
+    with pytest.raises(imagetransfer.TransferError):
+        imagetransfer.download(url, str(tmp_path / 'disk.raw'))
+
+
+def test_backup_with_transfer_backend(engine, tmp_path):
+    images = {}
+    for index in range(2):
+        disk_id = '00000000-0000-4000-8000-0000000a010{}'.format(index)
+        images[disk_id] = str(tmp_path / (disk_id + '.img'))
+        fakeovirt.makeimage(images[disk_id], 3 * 2**20, seed=41 + index)
+    vm = engine.addvm('transferbackupvm', images)
+    system_service = jobs.SharedConnection(url='x').system_service()
+    agent = helpers.vmobj(system_service.vms_service(), 'agent')
+    backup_path = str(tmp_path / 'backups')
+    os.makedirs(backup_path)
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 1, False, unarchive=True,
+                         backend=imagetransfer.TRANSFER) == 0
+    backup, = [name for name in os.listdir(backup_path) if name.startswith('transferbackupvm-')
+               and os.path.isdir(os.path.join(backup_path, name))]
+    for disk_id, image in images.items():
+        with open(image, 'rb') as expected, open(os.path.join(backup_path, backup, disk_id + '.raw'), 'rb') as got:
+            assert expected.read() == got.read()
+    assert [result[2] for result in verify.verifybackups([os.path.join(backup_path, backup)], logging)] == [
+        verify.OK, verify.OK]
+    # the disks were not attached to the agent
+    assert not engine.attachments
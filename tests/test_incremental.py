@@ -0,0 +1,75 @@
+import logging
+import os
+
+import fakeovirt
+import helpers
+import incremental
+
+VM_ID = '00000000-0000-4000-8000-00000000cafe'
+DISK = '00000000-0000-4000-8000-000000000001'
+
+
+def backup(backup_path, device, name, checkpoint):
+    """Write the deltas and manifest of a backup and save its checkpoint"""
+    directory = os.path.join(backup_path, name)
+    os.makedirs(directory)
+    converter = incremental.DeltaConverter(backup_path, VM_ID, checkpoint['disks'] if checkpoint else ())
+    assert converter(1, DISK, device, directory + '/', False, logging, None) == 0
+    incremental.writemanifest(directory, {
+        'vm': VM_ID,
+        'parent': checkpoint['backup'] if checkpoint else None,
+        'block_size': converter.block_size,
+        'disks': converter.disks,
+    })
+    incremental.savecheckpoint(backup_path, VM_ID, name, list(converter.disks),
+                               checkpoint['depth'] + 1 if checkpoint else 0)
+    return directory, converter
+
+
+def change(device, offset, data):
+    with open(device, 'r+b') as fd:
+        fd.seek(offset)
+        fd.write(data)
+
+
+def test_chain_of_backups_rebuilds_the_disk(tmp_path):
+    backup_path = str(tmp_path / 'backups')
+    device = str(tmp_path / DISK)
+    fakeovirt.makeimage(device, 8 * incremental.BLOCK_SIZE, seed=5, block=incremental.BLOCK_SIZE)
+    assert incremental.parentbackup(backup_path, VM_ID, 5) is None
+    full, converter = backup(backup_path, device, 'full', None)
+    assert not converter.disks[DISK]['incremental']
+    change(device, 2 * incremental.BLOCK_SIZE + 7, os.urandom(100))
+    checkpoint = incremental.parentbackup(backup_path, VM_ID, 5)
+    assert checkpoint['backup'] == 'full'
+    first, converter = backup(backup_path, device, 'first', checkpoint)
+    assert converter.disks[DISK] == dict(converter.disks[DISK], incremental=True, blocks=1)
+    # a zeroed block is a record without data
+    change(device, 5 * incremental.BLOCK_SIZE, bytes(incremental.BLOCK_SIZE))
+    second, converter = backup(backup_path, device, 'second', incremental.parentbackup(backup_path, VM_ID, 5))
+    assert converter.disks[DISK]['written'] < incremental.BLOCK_SIZE
+    # the parents are found as directories and as archives
+    assert helpers.make_archive(backup_path, full, False, 1, logging) == 0
+    assert incremental.findbackup(backup_path, 'full') == helpers.archivename(full, 'gzip')
+    assert incremental.rebuild(second, backup_path, logging, 1) == 0
+    with open(device, 'rb') as expected, open(os.path.join(second, DISK + '.raw'), 'rb') as got:
+        assert expected.read() == got.read()
+    assert not os.path.exists(full)
+
+
+def test_chain_length_and_missing_parent_start_a_full_backup(tmp_path):
+    backup_path = str(tmp_path / 'backups')
+    device = str(tmp_path / DISK)
+    fakeovirt.makeimage(device, 2 * incremental.BLOCK_SIZE, seed=6, block=incremental.BLOCK_SIZE)
+    full, _ = backup(backup_path, device, 'full', None)
+    assert incremental.parentbackup(backup_path, VM_ID, 0) is None
+    second, _ = backup(backup_path, device, 'second', incremental.parentbackup(backup_path, VM_ID, 1))
+    assert incremental.parentbackup(backup_path, VM_ID, 1) is None
+    os.remove(os.path.join(second, DISK + '.delta'))
+    os.remove(os.path.join(second, incremental.MANIFEST))
+    os.rmdir(second)
+    assert incremental.parentbackup(backup_path, VM_ID, 5) is None
+    # a failed backup leaves no hashes for the next one
+    open(os.path.join(incremental.checkpointdir(backup_path, VM_ID), DISK + '.hashes.new'), 'w').close()
+    incremental.dropcheckpoint(backup_path, VM_ID)
+    assert not os.path.exists(os.path.join(incremental.checkpointdir(backup_path, VM_ID), DISK + '.hashes.new'))
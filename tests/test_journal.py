@@ -0,0 +1,99 @@
+import logging
+import os
+import time
+
+import pytest
+
+import fakeovirt
+import helpers
+import incremental
+import jobs
+import journal
+
+DISKS = ['00000000-0000-4000-8000-0000000e0001', '00000000-0000-4000-8000-0000000e0002']
+
+
+@pytest.fixture
+def vm(engine, tmp_path, request):
+    images = {}
+    for index, disk_id in enumerate(DISKS):
+        images[disk_id] = str(tmp_path / (disk_id + '.img'))
+        fakeovirt.makeimage(images[disk_id], 2 * incremental.BLOCK_SIZE, seed=20 + index)
+    vm = engine.addvm(request.node.name.replace('_', '-'), images)
+    system_service = jobs.SharedConnection(url='x').system_service()
+    agent = helpers.vmobj(system_service.vms_service(), 'agent')
+    backup_path = str(tmp_path / 'backups')
+    os.makedirs(backup_path)
+    return system_service, vm, agent, backup_path, images
+
+
+def nextsecond():
+    """Backup names have a timestamp in seconds"""
+    time.sleep(1.01 - time.time() % 1)
+
+
+def failsecond(monkeypatch):
+    """Make the copy of the second disk fail once"""
+    deltadisk = incremental.deltadisk
+
+    def failing(device, *args, **kwargs):
+        if device.endswith(DISKS[1]):
+            monkeypatch.setattr(incremental, 'deltadisk', deltadisk)
+            raise OSError('read error')
+        return deltadisk(device, *args, **kwargs)
+
+    monkeypatch.setattr(incremental, 'deltadisk', failing)
+
+
+def test_failed_backup_is_resumed(vm, monkeypatch):
+    system_service, vm, agent, backup_path, images = vm
+    failsecond(monkeypatch)
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 1, False, incremental_chain=3) == 1
+    failed, = journal.journals(backup_path)
+    assert failed.done() == {DISKS[0]} and failed.get('snapshot')
+    # a new backup of the vm is refused while the block hashes are kept
+    nextsecond()
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 2, False, incremental_chain=3) == 1
+    assert [j.name for j in journal.journals(backup_path)] == [failed.name]
+    assert jobs.resumejob(system_service, agent, backup_path, failed, 3, False) == 0
+    assert journal.journals(backup_path) == []
+    assert incremental.loadcheckpoint(backup_path, vm.id)['backup'] == failed.name
+    archive = helpers.archivename(os.path.join(backup_path, failed.name), 'gzip')
+    assert not helpers.unpack_archive(archive, backup_path, logging, 3)
+    directory = os.path.join(backup_path, failed.name)
+    assert incremental.rebuild(directory, backup_path, logging, 3) == 0
+    for disk_id, image in images.items():
+        with open(image, 'rb') as expected, open(os.path.join(directory, disk_id + '.raw'), 'rb') as got:
+            assert expected.read() == got.read()
+
+
+def test_new_backups_keep_or_abandon_failed_backups(vm, monkeypatch):
+    system_service, vm, agent, backup_path, _ = vm
+    failsecond(monkeypatch)
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 1, False, incremental_chain=3) == 1
+    failed, = journal.journals(backup_path)
+    snapshots_service = system_service.vms_service().vm_service(vm.id).snapshots_service()
+    # backups without block hashes run next to the failed one
+    nextsecond()
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 2, False, dedup=True) == 0
+    assert [j.name for j in journal.journals(backup_path)] == [failed.name]
+    assert helpers.findsnapshot(snapshots_service, failed.get('snapshot')) is not None
+    nextsecond()
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 3, False, incremental_chain=3,
+                         abandon_failed=True) == 0
+    assert journal.journals(backup_path) == []
+    assert helpers.findsnapshot(snapshots_service, failed.get('snapshot')) is None
+    assert not os.path.exists(os.path.join(backup_path, failed.name))
+
+
+def test_journal_lock_and_steps(tmp_path):
+    job_journal = journal.create(str(tmp_path), 'job', journal.BACKUP, vm='vm')
+    job_journal.setdisk('disk', offset=10)
+    job_journal.setdisk('other', done=True)
+    loaded = journal.find(str(tmp_path), 'job')
+    assert loaded.disk('disk') == {'offset': 10} and loaded.done() == {'other'}
+    assert not loaded.lock()
+    job_journal.unlock()
+    assert loaded.lock()
+    loaded.remove()
+    assert journal.find(str(tmp_path), 'job') is None
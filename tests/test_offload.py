@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+import pytest
+
+import catalog
+import fakeovirt
+import fakes3
+import helpers
+import jobs
+import offload
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    server = fakes3.Server(str(tmp_path / 's3'), fail_every=4)
+    monkeypatch.setattr(offload, 'POLL', 0.01)
+    monkeypatch.setattr(offload, 'PART_SIZE', 2**20)
+    # the retries of the failed parts do not wait
+    monkeypatch.setattr(offload, 'sleep', lambda delay: None)
+    yield offload.Target(server.url + '/bucket/prefix', 'access', 'secret')
+    server.shutdown()
+    server.server_close()
+
+
+def test_upload_while_the_file_is_written(bucket, tmp_path):
+    path = str(tmp_path / 'archive')
+    data = os.urandom(5 * 2**20 + 1234)
+
+    def writer():
+        with open(path, 'wb') as fd:
+            for offset in range(0, len(data), 300 * 1024):
+                fd.write(data[offset:offset + 300 * 1024])
+                fd.flush()
+                time.sleep(0.01)
+
+    upload = offload.Upload(bucket, path, bucket.key('archive'), workers=2)
+    thread = threading.Thread(target=writer)
+    thread.start()
+    thread.join()
+    url = upload.finish()
+    assert url == bucket.objecturl('prefix/archive') and bucket.keyof(url) == 'prefix/archive'
+    assert upload.size == len(data) and bucket.size('prefix/archive') == len(data)
+    fetched = str(tmp_path / 'fetched')
+    assert offload.fetch(bucket, 'prefix/archive', fetched, workers=3, chunk_size=2**20 - 7) == len(data)
+    with open(fetched, 'rb') as fd:
+        assert fd.read() == data
+
+
+def test_aborted_upload_leaves_no_object(bucket, tmp_path):
+    path = str(tmp_path / 'archive')
+    with open(path, 'wb') as fd:
+        fd.write(os.urandom(2**20 + 1))
+    upload = offload.Upload(bucket, path, bucket.key('archive'))
+    upload.abort()
+    assert isinstance(upload.error, offload.OffloadError)
+    with pytest.raises(offload.OffloadError):
+        bucket.size('prefix/archive')
+
+
+def test_backups_are_evicted_and_fetched_for_restore(engine, bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(offload, 'TARGET', bucket)
+    monkeypatch.setattr(offload, 'KEEP_LOCAL', 1)
+    disk_id = '00000000-0000-4000-8000-0000000f0001'
+    image = str(tmp_path / 'disk.img')
+    fakeovirt.makeimage(image, 3 * 2**20, seed=30)
+    vm = engine.addvm('offloadvm', {disk_id: image})
+    system_service = jobs.SharedConnection(url='x').system_service()
+    agent = helpers.vmobj(system_service.vms_service(), 'agent')
+    backup_path = str(tmp_path / 'backups')
+    os.makedirs(backup_path)
+    for event_id in (1, 2):
+        time.sleep(1.01 - time.time() % 1)
+        assert jobs.backupvm(system_service, vm, agent, backup_path, event_id, False, stream=True) == 0
+    store = catalog.Catalog(backup_path)
+    try:
+        backups = store.list(vm='offloadvm')
+    finally:
+        store.close()
+    assert all(backup['remote'] for backup in backups)
+    old = os.path.join(backup_path, backups[-1]['file'])
+    assert not os.path.exists(old) and os.path.exists(os.path.join(backup_path, backups[0]['file']))
+    assert jobs.restorevm(system_service, agent, old, 'sd-bench', 'Default', 3, False) == 0
+    target, = engine.targets.values()
+    with open(image, 'rb') as expected, open(target, 'rb') as got:
+        data = expected.read()
+        assert got.read(len(data)) == data
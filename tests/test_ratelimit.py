@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+import ratelimit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, 'monotonic', clock)
+    return clock
+
+
+def test_parselimit():
+    assert ratelimit.parselimit('100M,2000') == (100 * 2**20, 2000)
+    assert ratelimit.parselimit(',500') == (0, 500)
+    assert ratelimit.parselimit('4KiB') == (4096, 0)
+    assert ratelimit.parselimit(None) == (0, 0)
+    with pytest.raises(ValueError):
+        ratelimit.parselimit('fast')
+
+
+def test_parseprofile_crosses_midnight():
+    assert ratelimit.parseprofile('22:00-06:30=1G') == (22 * 60, 6 * 60 + 30, (2**30, 0))
+    with pytest.raises(ValueError):
+        ratelimit.parseprofile('25:00-06:00=1G')
+
+
+def test_bucket_waits_for_missing_tokens(clock):
+    bucket = ratelimit.Bucket()
+    assert bucket.reserve(50, 100) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.reserve(100, 100) == pytest.approx(1.0)
+    # at most one second of tokens is saved
+    clock.now += 10
+    assert bucket.reserve(100, 100) == 0
+    assert bucket.reserve(100, 100) == pytest.approx(1.0)
+    assert bucket.reserve(10**9, 0) == 0
+
+
+def test_limiter_charges_its_parent(clock, monkeypatch):
+    waits = []
+    monkeypatch.setattr(ratelimit, 'sleep', waits.append)
+    agent = ratelimit.Limiter(1000)
+    job = ratelimit.Limiter(0, 4, parent=agent)
+    # one operation of the 4 per second of the job, 500 bytes of the agent
+    job.take(500)
+    # two more operations and bytes, the clock has not moved
+    job.take(2 * ratelimit.OP_SIZE)
+    assert waits == [pytest.approx(0.25), pytest.approx(0.5), pytest.approx(0.75),
+                     pytest.approx((500 + 2 * ratelimit.OP_SIZE) / 1000)]
+
+
+def test_share_splits_limits_between_copies():
+    agent = ratelimit.Limiter(400)
+    job = ratelimit.Limiter(200, 10, parent=agent)
+    with job.running(4):
+        with job.disk().share() as first, job.disk().share() as second:
+            assert first == second == (50, 2)
+            assert job.reserved == [100, 4] and agent.reserved == [100, 0]
+            # buffers charged by take get what the copies leave
+            assert job.free() == (100, 6)
+    assert job.reserved == [0, 0] and agent.copies == 0
+
+
+def test_share_waits_for_a_reserved_limit():
+    agent = ratelimit.Limiter(100)
+    first = ratelimit.Limiter(parent=agent)
+    second = ratelimit.Limiter(parent=agent)
+    got = []
+    with first.running(1), first.share() as limits:
+        assert limits == (100, 0)
+        with second.running(1):
+            waiter = threading.Thread(target=lambda: got.append(second.share().__enter__()))
+            waiter.start()
+            waiter.join(0.2)
+            assert not got
+    waiter.join(5)
+    assert got == [(100, 0)]
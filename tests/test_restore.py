@@ -0,0 +1,101 @@
+import logging
+import os
+import shutil
+import time
+
+import pytest
+
+import catalog
+import descriptor
+import fakeovirt
+import helpers
+import imagetransfer
+import jobs
+import journal
+import sparse
+
+CODECS = [codec for codec in sorted(helpers.CODECS)
+          if helpers.CODECS[codec]['compress'] is None or shutil.which(helpers.CODECS[codec]['compress'][0])]
+
+
+@pytest.fixture
+def vm(engine, tmp_path, request):
+    images = {}
+    for index in range(2):
+        disk_id = '00000000-0000-4000-8000-0000000c000{}'.format(index)
+        images[disk_id] = str(tmp_path / (disk_id + '.img'))
+        fakeovirt.makeimage(images[disk_id], (3 + index) * 2**20 + 4096, seed=50 + index, data=0.3, zeros=0.2,
+                            text=0.2, block=2**18)
+    vm = engine.addvm('restorevm', images)
+    system_service = jobs.SharedConnection(url='x').system_service()
+    agent = helpers.vmobj(system_service.vms_service(), 'agent')
+    backup_path = str(tmp_path / 'backups')
+    os.makedirs(backup_path)
+    return system_service, vm, agent, backup_path, images
+
+
+def roundtrip(engine, vm, restore_stream=False, disk_ids=None, **options):
+    """Backup the vm, restore the backup and check the restored disks"""
+    system_service, vm, agent, backup_path, images = vm
+    time.sleep(1.01 - time.time() % 1)
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 1, False, **options) == 0
+    backup, = [name for name in os.listdir(backup_path)
+               if name.startswith('restorevm-') and not name.endswith('.json')]
+    assert jobs.restorevm(system_service, agent, os.path.join(backup_path, backup), 'sd-bench', 'Default', 2,
+                          False, stream=restore_stream, disk_ids=disk_ids) == 0
+    assert sorted(engine.targets) == sorted(disk_ids or images)
+    for disk_id, target in engine.targets.items():
+        with open(images[disk_id], 'rb') as expected, open(target, 'rb') as got:
+            data = expected.read()
+            assert got.read(len(data)) == data
+            # restored disks are larger than the images and end with zeros
+            for start, end in sparse.dataextents(got.fileno(), os.path.getsize(target)):
+                if end > len(data):
+                    got.seek(max(start, len(data)))
+                    assert got.read(end - max(start, len(data))).count(0) == end - max(start, len(data))
+
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_stream_backup_and_restore_per_codec(engine, vm, codec):
+    roundtrip(engine, vm, stream=True, codec=codec)
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'seekable'])
+@pytest.mark.parametrize('restore_stream', [False, True])
+def test_restore_extracted_or_streamed(engine, vm, codec, restore_stream):
+    if codec not in CODECS:
+        pytest.skip('{} not found'.format(codec))
+    roundtrip(engine, vm, restore_stream, stream=True, codec=codec)
+
+
+@pytest.mark.parametrize('backend', imagetransfer.BACKENDS)
+@pytest.mark.parametrize('disk_format', sparse.FORMATS)
+def test_full_backup_and_restore_per_backend(engine, vm, backend, disk_format):
+    if backend == imagetransfer.ATTACH and not shutil.which('qemu-img'):
+        pytest.skip('qemu-img not found')
+    roundtrip(engine, vm, backend=backend, disk_format=disk_format)
+
+
+@pytest.mark.parametrize('mode', ['incremental_chain', 'dedup'])
+def test_incremental_and_dedup_restore(engine, vm, mode):
+    roundtrip(engine, vm, **{mode: 3 if mode == 'incremental_chain' else True})
+
+
+def test_restore_of_one_disk(engine, vm):
+    disk_id = sorted(vm[4])[1]
+    roundtrip(engine, vm, restore_stream=True, disk_ids=[disk_id], stream=True, codec='seekable')
+
+
+def test_restore_of_unknown_disks_fails(engine, vm):
+    system_service, vm_obj, agent, backup_path, images = vm
+    assert jobs.backupvm(system_service, vm_obj, agent, backup_path, 1, False, stream=True) == 0
+    archive, = [name for name in os.listdir(backup_path) if name.endswith('.tar.gz')]
+    path = os.path.join(backup_path, archive)
+    # refused before the archive is read
+    assert jobs.restorevm(system_service, agent, path, 'sd-bench', 'Default', 2, False, disk_ids=['unknown']) == 1
+    assert not os.path.exists(helpers.archivebase(path)) and not journal.journals(backup_path)
+    os.remove(descriptor.sidecar(helpers.archivebase(path)))
+    os.remove(os.path.join(backup_path, catalog.CATALOG))
+    assert jobs.restorevm(system_service, agent, path, 'sd-bench', 'Default', 3, False, disk_ids=['unknown']) == 1
+    assert os.path.exists(helpers.archivebase(path) + '.restore-3.json')
+    assert not engine.targets
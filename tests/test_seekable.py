@@ -0,0 +1,73 @@
+import logging
+import os
+import tarfile
+
+import pytest
+
+import checksum
+import fakeovirt
+import helpers
+import seekable
+
+BIG = '00000000-0000-4000-8000-000000000001'
+SMALL = '00000000-0000-4000-8000-000000000002'
+
+
+@pytest.fixture
+def archive(tmp_path):
+    images = {BIG: str(tmp_path / (BIG + '.raw')), SMALL: str(tmp_path / (SMALL + '.raw'))}
+    # the first disk spans several frames
+    fakeovirt.makeimage(images[BIG], seekable.FRAME_SIZE + 3 * 2**20, seed=7, data=0.8)
+    fakeovirt.makeimage(images[SMALL], 2**20 + 512, seed=8, data=1.0)
+    path = str(tmp_path / 'vm.tar.gz')
+    checksums = checksum.Checksums()
+    members = {}
+    with open(path, 'wb') as fd:
+        seekable.writearchive(fd, 'vm', [(uuid + '.raw', image) for uuid, image in images.items()], level=1,
+                              members=members, checksums=checksums)
+    return path, images, checksums, members
+
+
+def test_members_are_read_across_frames(archive):
+    path, images, checksums, members = archive
+    assert seekable.isseekable(path)
+    with seekable.Reader(path) as reader, open(images[BIG], 'rb') as src:
+        assert len(reader.frames) == 2
+        assert reader.member('vm/' + BIG + '.raw')[0] == members[BIG + '.raw']
+        member = reader.open(BIG + '.raw')
+        for offset in (0, seekable.FRAME_SIZE - 100, seekable.FRAME_SIZE + 3 * 2**20 - 10):
+            member.seek(offset)
+            src.seek(offset)
+            assert member.read(1000) == src.read(1000)
+        assert checksum.loads(reader.open(checksum.MANIFEST).read()).disks == checksums.disks
+        with pytest.raises(KeyError):
+            reader.member('missing.raw')
+
+
+def test_archive_is_a_plain_tar_gz(archive, tmp_path):
+    path, images, _, _ = archive
+    with tarfile.open(path, 'r:gz') as tar:
+        names = tar.getnames()
+    assert names[:3] == ['vm', 'vm/' + BIG + '.raw', 'vm/' + SMALL + '.raw']
+    assert names[-1] == 'vm/' + seekable.INDEX
+    assert helpers.detectcodec(path) == 'gzip'
+    assert not seekable.isseekable(images[SMALL])
+
+
+def test_single_disk_restore_with_checksums(archive, tmp_path):
+    path, images, checksums, _ = archive
+    device = str(tmp_path / 'device')
+    with open(device, 'wb') as fd:
+        fd.truncate(2**21)
+    results = helpers.seekable_restore(path, {SMALL: device}, 1, False, logging, None, 1, checksums=checksums)
+    assert results == {SMALL: 0}
+    with open(images[SMALL], 'rb') as expected, open(device, 'rb') as got:
+        data = expected.read()
+        assert got.read(len(data)) == data
+    # a disk differing from its checksums fails the restore
+    checksums.disks[SMALL] = checksums.disks[BIG]
+    assert helpers.seekable_restore(path, {SMALL: device}, 1, False, logging, None, 1,
+                                    checksums=checksums) == {SMALL: 1}
+    metadata = str(tmp_path / 'metadata')
+    assert helpers.seekable_metadata(path, metadata, logging, 1) == 0
+    assert os.listdir(os.path.join(metadata, 'vm')) == [checksum.MANIFEST]
@@ -0,0 +1,89 @@
+import io
+import logging
+import os
+import subprocess
+import tarfile
+
+import pytest
+
+import checksum
+import fakeovirt
+import helpers
+import sparse
+
+
+def test_header_round_trip():
+    extents = [(0, 4096), (2**20, 3 * 2**20), (2**30, 2**30 + 512)]
+    size, read = sparse.readheader(io.BytesIO(sparse.header(2**31, extents)))
+    assert size == 2**31
+    assert read == extents
+
+
+def test_readheader_rejects_other_files():
+    with pytest.raises(sparse.SparseError):
+        sparse.readheader(io.BytesIO(b'x' * sparse.HEADER.size))
+    with pytest.raises(sparse.SparseError):
+        sparse.readheader(io.BytesIO(sparse.header(10, [(0, 10)])[:-1]))
+
+
+def test_pack_unpack_round_trip(tmp_path):
+    image = str(tmp_path / 'disk.raw')
+    fakeovirt.makeimage(image, 6 * 2**20 + 512, seed=3, data=0.3, zeros=0.1, text=0.1)
+    packed = str(tmp_path / ('disk' + sparse.SUFFIX))
+    sparse.pack(image, packed)
+    assert os.path.getsize(packed) < os.path.getsize(image)
+    restored = str(tmp_path / 'restored.raw')
+    with open(restored, 'wb') as fd:
+        fd.truncate(os.path.getsize(image))
+    with open(packed, 'rb') as src:
+        sparse.unpack(src, restored)
+    with open(image, 'rb') as expected, open(restored, 'rb') as got:
+        assert expected.read() == got.read()
+
+
+def test_tar_member_keeps_holes(tmp_path):
+    image = str(tmp_path / 'disk.raw')
+    fakeovirt.makeimage(image, 32 * 2**20 + 512, seed=5, data=0.2, zeros=0.1, text=0.1)
+    path = str(tmp_path / 'vm.tar')
+    with tarfile.open(path, 'w', format=tarfile.PAX_FORMAT) as tar, \
+            sparse.opendisk(image, layout=sparse.tarmap) as reader:
+        member = tarfile.TarInfo('vm/disk.raw')
+        member.size = reader.length
+        sparse.tarmember(member, reader.size)
+        tar.addfile(member, reader)
+    assert os.path.getsize(path) < os.path.getsize(image) // 2
+    with tarfile.open(path) as tar, open(image, 'rb') as expected:
+        member = tar.getmember('vm/disk.raw')
+        assert member.size == os.path.getsize(image)
+        assert tar.extractfile(member).read() == expected.read()
+    # tar -x writes the holes as holes
+    subprocess.run(['tar', '-C', str(tmp_path), '-xf', path], check=True)
+    restored = str(tmp_path / 'vm' / 'disk.raw')
+    with open(image, 'rb') as expected, open(restored, 'rb') as got:
+        assert expected.read() == got.read()
+    assert os.stat(restored).st_blocks * 512 < os.path.getsize(image) // 2
+
+
+def test_unpack_of_tar_member(tmp_path):
+    image = str(tmp_path / 'disk.raw')
+    fakeovirt.makeimage(image, 4 * 2**20 + 512, seed=6, data=0.5, zeros=0.2, text=0)
+    with sparse.opendisk(image, layout=sparse.tarmap) as reader:
+        data = reader.read()
+        size = reader.size
+    restored = str(tmp_path / 'restored.raw')
+    sparse.unpack(io.BytesIO(data), restored, size=size)
+    with open(image, 'rb') as expected, open(restored, 'rb') as got:
+        assert expected.read() == got.read()
+
+
+def test_pack_converter_writes_no_raw_image(tmp_path):
+    image = str(tmp_path / 'disk.img')
+    fakeovirt.makeimage(image, 8 * 2**20 + 512, seed=4, data=0.3)
+    backup = tmp_path / 'backup'
+    backup.mkdir()
+    converter = helpers.PackConverter()
+    assert converter(1, 'disk', image, str(backup) + '/', False, logging, None) == 0
+    assert os.listdir(str(backup)) == ['disk' + sparse.SUFFIX]
+    assert converter.checksums['disk'] == checksum.hashfile(image)
+    assert converter.disks['disk'] == {'size': os.path.getsize(image),
+                                       'written': os.path.getsize(str(backup / ('disk' + sparse.SUFFIX)))}
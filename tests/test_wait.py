@@ -0,0 +1,90 @@
+import itertools
+import os
+import threading
+
+import pytest
+
+import fakeovirt
+import helpers
+import jobs
+import journal
+import wait
+from fakeovirt import Obj
+
+
+class ListService:
+    """List service whose objects reach their status after some queries"""
+
+    def __init__(self, ready_after):
+        self.ready_after = ready_after
+        self.queries = []
+
+    def list(self, search):
+        self.queries.append(search)
+        return [Obj(id=object_id, status='ok' if len(self.queries) > after else 'locked')
+                for object_id, after in self.ready_after.items()]
+
+
+def test_backoff_grows_to_maximum():
+    assert list(itertools.islice(wait.backoff(0.5, 3), 5)) == [0.5, 1, 2, 3, 3]
+
+
+def test_waitfor_returns_value_or_times_out():
+    calls = iter([None, 0, 'done'])
+    assert wait.waitfor(lambda: next(calls), 5, 'value', initial=0.01) == 'done'
+    with pytest.raises(TimeoutError, match='nothing'):
+        wait.waitfor(lambda: False, 0.05, 'nothing', initial=0.01)
+
+
+def test_waitpath_sees_files_created_in_new_directories(tmp_path):
+    path = str(tmp_path / 'by-id' / 'disk')
+    timer = threading.Timer(0.1, lambda: (os.makedirs(os.path.dirname(path)), open(path, 'w').close()))
+    timer.start()
+    try:
+        assert wait.waitpath(path, 10)
+    finally:
+        timer.join()
+    assert not wait.waitpath(str(tmp_path / 'missing'), 0.1)
+
+
+def test_iterstatuses_queries_pending_objects(monkeypatch):
+    monkeypatch.setattr(wait, 'sleep', lambda delay: None)
+    service = ListService({'a': 0, 'b': 2})
+    assert [obj.id for obj in wait.iterstatuses(service, ['a', 'b'], 'ok', 10, 'disks')] == ['a', 'b']
+    assert service.queries == ['id=a or id=b', 'id=b', 'id=b']
+    with pytest.raises(TimeoutError):
+        wait.waitstatuses(ListService({'c': 10**6}), ['c'], 'ok', 0, 'disks')
+
+
+def test_ready_yields_values_as_they_are_set():
+    ready = wait.Ready(['a', 'b', 'c'])
+    got = []
+    reader = threading.Thread(target=lambda: got.extend(ready.items()))
+    reader.start()
+    ready.set('b', 2)
+    ready.fail('c')
+    ready.set('a', 1)
+    reader.join(5)
+    assert sorted(got) == [('a', 1), ('b', 2)]
+    assert ready.get('c', 'failed') == 'failed'
+    late = wait.Ready(['x'])
+    late.close()
+    assert late.get('x') is None and late.failed == {'x'}
+
+
+def test_backup_fails_when_the_snapshot_is_not_ready(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, 'snapshot_delay', 3600)
+    waitfor = wait.waitfor
+    monkeypatch.setattr(wait, 'waitfor', lambda check, timeout, *args, **kwargs: waitfor(check, 0.1, *args, **kwargs))
+    image = str(tmp_path / 'disk.img')
+    fakeovirt.makeimage(image, 2**20, seed=60)
+    vm = engine.addvm('slowsnapshotvm', {'00000000-0000-4000-8000-0000000d0001': image})
+    system_service = jobs.SharedConnection(url='x').system_service()
+    agent = helpers.vmobj(system_service.vms_service(), 'agent')
+    backup_path = str(tmp_path / 'backups')
+    os.makedirs(backup_path)
+    assert jobs.backupvm(system_service, vm, agent, backup_path, 1, False, stream=True) == 1
+    # the backup waits for its snapshot again when it is resumed
+    failed, = journal.journals(backup_path)
+    assert failed.get('snapshot') and not failed.get('attachments')
+    assert os.path.exists(os.path.join(backup_path, failed.name + '.report.json'))
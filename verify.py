@@ -0,0 +1,336 @@
+import json
+import os
+import sqlite3
+import tarfile
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import checksum
+import chunkstore
+import helpers
+import incremental
+import seekable
+import sparse
+
+# Check of backups against the checksums written next to their OVF. Disks of
+# backup directories and seekable archives are hashed in parallel, other
+# archives are one stream each and are checked in parallel with each other.
+# Delta files of incremental backups are checked block by block against the
+# checksums of the whole disk, blocks they do not carry are checked with the
+# backup that changed them last.
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def hashstream(src, hasher, bufsize=8 * 2**20):
+    """Feed hasher with file object until its end
+    Returns:
+        checksums of the data
+    """
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    while True:
+        length = src.readinto(buf)
+        if not length:
+            break
+        hasher.update(view[:length])
+    return hasher.result()
+
+
+def checkdisk(uuid, checksums, hash_disk):
+    """Return status and message of a disk hashed by hash_disk(hasher)"""
+    expected = checksums.expected(uuid)
+    if expected is None:
+        return uuid, SKIPPED, 'no checksums for disk'
+    try:
+        hash_disk(checksum.Hasher(uuid, expected))
+    except checksum.ChecksumError as e:
+        return uuid, FAILED, str(e)
+    except (OSError, ValueError, KeyError, sqlite3.Error, tarfile.TarError, zlib.error) as e:
+        return uuid, FAILED, 'error reading disk: {}'.format(e)
+    return uuid, OK, expected['digest']
+
+
+def deltadigests(src, name):
+    """Read a delta file
+    Parameters:
+        src: file object of the delta file
+        name: disk id of the delta
+    Returns:
+        tuple of disk size, block size and dict of hex digests of the blocks
+        carried by the delta by block index
+    """
+    magic, block_size, size = incremental.HEADER.unpack(src.read(incremental.HEADER.size))
+    if magic != incremental.MAGIC or not block_size:
+        raise ValueError('delta of disk {} is not a delta file'.format(name))
+    digests = {}
+    while True:
+        record = src.read(incremental.RECORD.size)
+        if not record:
+            break
+        if len(record) < incremental.RECORD.size:
+            raise ValueError('delta of disk {} is truncated'.format(name))
+        index, length, kind = incremental.RECORD.unpack(record)
+        if length != min(block_size, size - index * block_size):
+            raise ValueError('invalid block {} in delta of disk {}'.format(index, name))
+        if kind == incremental.DATA:
+            block = src.read(length)
+            if len(block) < length:
+                raise ValueError('delta of disk {} is truncated'.format(name))
+        else:
+            block = bytes(length)
+        digests[index] = checksum.blockdigest(block).hex()
+    return size, block_size, digests
+
+
+def checkdelta(name, expected, delta, full):
+    """Check the blocks of a delta file against the checksums of its disk
+    Parameters:
+        expected: checksums of the whole disk
+        delta: tuple of deltadigests()
+        full: the delta is a full copy, the blocks it does not carry are
+            zeros
+    Returns:
+        expected checksums
+    """
+    size, block_size, digests = delta
+    count = -(-size // block_size)
+    if block_size != checksum.BLOCK_SIZE or size != expected['size'] or count != len(expected['blocks']):
+        raise checksum.ChecksumError('disk {} has {} blocks of {} bytes, expected {} blocks of {} bytes'.format(
+            name, count, block_size, len(expected['blocks']), checksum.BLOCK_SIZE))
+    if digests and max(digests) >= count:
+        raise ValueError('block {} of delta of disk {} is past its end'.format(max(digests), name))
+    for index, digest in enumerate(expected['blocks']):
+        if index in digests:
+            found = digests[index]
+        elif full:
+            found = checksum.blockdigest(bytes(min(block_size, size - index * block_size))).hex()
+        else:
+            # checked with the backup that changed it last
+            continue
+        if found != digest:
+            raise checksum.ChecksumError('checksum mismatch in block {} at offset {} of disk {}'.format(
+                index, index * block_size, name))
+    return expected
+
+
+def hashdelta(src, name, expected, full):
+    """Check the blocks of a delta file read from src, see checkdelta"""
+    return checkdelta(name, expected, deltadigests(src, name), full)
+
+
+def checkdeltadisk(uuid, checksums, manifest, open_delta):
+    """Return status and message of the delta file of a disk opened by
+    open_delta()
+    Parameters:
+        manifest: manifest of the incremental backup
+    """
+    disk = manifest['disks'].get(uuid)
+    if disk is None:
+        return uuid, FAILED, 'disk missing in backup'
+
+    def hash_disk(hasher):
+        with open_delta(disk['file']) as src:
+            return hashdelta(src, uuid, checksums.expected(uuid), not disk['incremental'])
+    return checkdisk(uuid, checksums, hash_disk)
+
+
+def directorytasks(path):
+    """Return functions checking the disks of a backup directory"""
+    checksums = checksum.readmanifest(path)
+    if checksums is None:
+        return [lambda: [(None, SKIPPED, 'backup has no checksums')]]
+    if os.path.exists(os.path.join(path, incremental.MANIFEST)):
+        manifest = incremental.readmanifest(path)
+        return [lambda uuid=uuid: [checkdeltadisk(uuid, checksums, manifest, lambda file: open(
+            os.path.join(path, file), 'rb'))] for uuid in checksums.disks]
+    backup_path = os.path.dirname(os.path.abspath(path))
+    tasks = []
+    for uuid in checksums.disks:
+        raw = os.path.join(path, uuid + '.raw')
+        packed = os.path.join(path, uuid + sparse.SUFFIX)
+        chunks = os.path.join(path, uuid + chunkstore.SUFFIX)
+        if os.path.exists(raw):
+            tasks.append(lambda uuid=uuid, raw=raw: [checkdisk(
+                uuid, checksums, lambda hasher: hashraw(raw, hasher))])
+        elif os.path.exists(packed):
+            tasks.append(lambda uuid=uuid, packed=packed: [checkdisk(
+                uuid, checksums, lambda hasher: hashsparse(packed, hasher))])
+        elif os.path.exists(chunks):
+            tasks.append(lambda uuid=uuid, chunks=chunks: [checkdisk(
+                uuid, checksums, lambda hasher: hashchunks(backup_path, chunks, hasher))])
+        else:
+            tasks.append(lambda uuid=uuid: [(uuid, FAILED, 'disk missing in backup')])
+    return tasks
+
+
+def hashraw(raw, hasher):
+    """Feed hasher with a raw image, holes are hashed without reading them"""
+    fd = os.open(raw, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        extents = sparse.dataextents(fd, size)
+    finally:
+        os.close(fd)
+    return checksum.hashfile(raw, extents, size, hasher)
+
+
+def hashsparse(file, hasher):
+    """Feed hasher with a sparse image, holes are hashed without reading
+    them"""
+    with open(file, 'rb') as src:
+        sparse.unpack(src, hasher=hasher)
+    return hasher.result()
+
+
+def hashchunks(backup_path, manifest_file, hasher):
+    """Feed hasher with a disk of the chunk store"""
+    store = chunkstore.ChunkStore(backup_path)
+    try:
+        with open(manifest_file) as fd:
+            manifest = json.load(fd)
+        for index, digest in enumerate(manifest['chunks']):
+            if digest is None:
+                # the last chunk can be partial
+                hasher.zeros(min(manifest['chunk_size'], manifest['size'] - index * manifest['chunk_size']))
+            else:
+                hasher.update(store.get(digest))
+    finally:
+        store.close()
+    return hasher.result()
+
+
+def seekabletasks(file):
+    """Return functions checking the disks of a seekable archive, each disk
+    is read with its own reader"""
+    with seekable.Reader(file) as reader:
+        try:
+            with reader.open(checksum.MANIFEST) as src:
+                checksums = checksum.loads(src.read())
+        except KeyError:
+            return [lambda: [(None, SKIPPED, 'backup has no checksums')]]
+        names = {Path(name).stem: name for name in reader.members if sparse.isimage(name)}
+        try:
+            with reader.open(incremental.MANIFEST) as src:
+                manifest = json.loads(src.read())
+        except KeyError:
+            manifest = None
+
+    @contextmanager
+    def open_delta(name):
+        with seekable.Reader(file) as disk_reader:
+            yield disk_reader.open(name)
+
+    def check(uuid):
+        if manifest is not None:
+            return [checkdeltadisk(uuid, checksums, manifest, open_delta)]
+        if uuid not in names:
+            return [(uuid, FAILED, 'disk missing in backup')]
+
+        def hash_disk(hasher):
+            with seekable.Reader(file) as disk_reader:
+                if names[uuid].endswith(sparse.SUFFIX) or disk_reader.disksize(names[uuid]) is not None:
+                    sparse.unpack(disk_reader.open(names[uuid], True), hasher=hasher,
+                                  size=disk_reader.disksize(names[uuid]))
+                    return hasher.result()
+                return hashstream(disk_reader.open(names[uuid]), hasher)
+        return [checkdisk(uuid, checksums, hash_disk)]
+
+    return [lambda uuid=uuid: check(uuid) for uuid in checksums.disks]
+
+
+def hashmember(tar, member, hasher):
+    """Feed hasher with the raw or sparse image of a member of a tar
+    stream"""
+    if member.name.endswith(sparse.SUFFIX):
+        sparse.unpack(tar.extractfile(member), hasher=hasher)
+        return hasher.result()
+    return hashstream(tar.extractfile(member), hasher)
+
+
+def checkstream(file):
+    """Check the disks of an archive read as one stream, the checksums can
+    follow the disks"""
+    checksums = None
+    manifest = None
+    hashed = {}
+    deltas = {}
+    results = {}
+    try:
+        with helpers.tarstream(file) as tar:
+            for member in tar:
+                if member.name.endswith('/' + checksum.MANIFEST):
+                    checksums = checksum.loads(tar.extractfile(member).read())
+                elif member.name.endswith('/' + incremental.MANIFEST):
+                    manifest = json.load(tar.extractfile(member))
+                elif member.name.endswith('.delta'):
+                    uuid = Path(member.name).stem
+                    deltas[uuid] = deltadigests(tar.extractfile(member), uuid)
+                elif sparse.isimage(member.name):
+                    uuid = Path(member.name).stem
+                    if checksums is not None:
+                        results[uuid] = checkdisk(uuid, checksums, lambda hasher: hashmember(
+                            tar, member, hasher))
+                    else:
+                        hashed[uuid] = hashmember(tar, member, checksum.Hasher(uuid))
+    except (OSError, ValueError, tarfile.TarError) as e:
+        return list(results.values()) + [(None, FAILED, 'error reading archive: {}'.format(e))]
+    if checksums is None:
+        return [(None, SKIPPED, 'backup has no checksums')]
+    for uuid, sums in hashed.items():
+        expected = checksums.expected(uuid)
+        if expected is None:
+            results[uuid] = (uuid, SKIPPED, 'no checksums for disk')
+        elif expected['digest'] != sums['digest']:
+            results[uuid] = (uuid, FAILED, 'checksum mismatch of disk {}'.format(uuid))
+        else:
+            results[uuid] = (uuid, OK, sums['digest'])
+    for uuid, delta in deltas.items():
+        disk = manifest['disks'].get(uuid) if manifest is not None else None
+        if disk is None:
+            results[uuid] = (uuid, FAILED, 'disk missing in manifest of backup')
+        else:
+            results[uuid] = checkdisk(uuid, checksums, lambda hasher: checkdelta(
+                uuid, checksums.expected(uuid), delta, not disk['incremental']))
+    for uuid in checksums.disks:
+        if uuid not in results:
+            results[uuid] = (uuid, FAILED, 'disk missing in backup')
+    return list(results.values())
+
+
+def tasks(path):
+    """Return functions checking a backup, each returning a list of disk id,
+    status and message"""
+    try:
+        if os.path.isdir(path):
+            return directorytasks(path)
+        if seekable.isseekable(path):
+            return seekabletasks(path)
+    except (OSError, ValueError, tarfile.TarError, zlib.error) as e:
+        message = 'error reading backup: {}'.format(e)
+        return [lambda: [(None, FAILED, message)]]
+    return [lambda: checkstream(path)]
+
+
+def verifybackups(paths, log, workers=0):
+    """Check backups against their checksums on workers threads
+    Parameters:
+        paths: backup archives or directories
+        workers: disks or archives read at the same time, 0 for all cores
+    Returns:
+        list of tuples of path, disk id, status and message
+    """
+    results = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [(path, executor.submit(task)) for path in paths for task in tasks(path)]
+        for path, future in futures:
+            for uuid, status, message in future.result():
+                if status == FAILED:
+                    log.error('Verify of {} disk {} failed: {}'.format(path, uuid, message))
+                else:
+                    log.info('Verify of {} disk {}: {} {}'.format(path, uuid, status, message))
+                results.append((path, uuid, status, message))
+    return results
@@ -0,0 +1,234 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import threading
+from time import monotonic, sleep
+
+# inotify flags from <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def backoff(initial=0.5, maximum=10, factor=2):
+    """Yield growing delays from initial up to maximum"""
+    delay = initial
+    while True:
+        yield delay
+        delay = min(delay * factor, maximum)
+
+
+def waitfor(check, timeout, what, log=None, initial=0.5, maximum=10):
+    """Call check with adaptive backoff until it returns a true value
+    Parameters:
+        check: function without arguments
+        timeout: seconds to wait, None to wait forever
+        what: description of the wait for logs and errors
+        log: logger for the elapsed time
+    Returns:
+        last value of check
+    Raises:
+        TimeoutError: check is not true after timeout
+    """
+    start = monotonic()
+    for delay in backoff(initial, maximum):
+        value = check()
+        if value:
+            if log is not None:
+                log.info('Waited {:.1f}s for {}'.format(monotonic() - start, what))
+            return value
+        if timeout is not None:
+            left = timeout - (monotonic() - start)
+            if left <= 0:
+                raise TimeoutError('Timeout after {}s waiting for {}'.format(timeout, what))
+            delay = min(delay, left)
+        sleep(delay)
+
+
+def _inotify():
+    """Return libc with inotify, None when not available"""
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+def _ancestor(path):
+    """Return nearest existing directory of path"""
+    parent = os.path.dirname(path)
+    while parent and not os.path.isdir(parent):
+        parent = os.path.dirname(parent)
+    return parent or '/'
+
+
+def waitpath(path, timeout, log=None):
+    """Wait for path to exist, watching the nearest existing directory with
+    inotify, polling with backoff when inotify is not available
+    Returns:
+        True if path exists, False on timeout
+    """
+    if os.path.exists(path):
+        return True
+    libc = _inotify()
+    if libc is None:
+        try:
+            return waitfor(lambda: os.path.exists(path), timeout, path, log, initial=0.1, maximum=2)
+        except TimeoutError:
+            return False
+    start = monotonic()
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        try:
+            return waitfor(lambda: os.path.exists(path), timeout, path, log, initial=0.1, maximum=2)
+        except TimeoutError:
+            return False
+    try:
+        while True:
+            watched = _ancestor(path)
+            wd = libc.inotify_add_watch(fd, os.fsencode(watched), IN_CREATE | IN_MOVED_TO | IN_DELETE_SELF)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', watched)
+            # the path may appear between the first check and the watch
+            if os.path.exists(path):
+                break
+            left = None if timeout is None else timeout - (monotonic() - start)
+            if left is not None and left <= 0:
+                return False
+            ready, _, _ = select.select([fd], [], [], left)
+            if not ready:
+                return os.path.exists(path)
+            try:
+                os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                pass
+            libc.inotify_rm_watch(fd, wd)
+            if os.path.exists(path):
+                break
+    finally:
+        os.close(fd)
+    if log is not None:
+        log.info('Waited {:.1f}s for {}'.format(monotonic() - start, path))
+    return True
+
+
+def iterstatuses(list_service, ids, status, timeout, what, log=None, attribute='status'):
+    """Yield objects as they reach a status, with one list query per check
+    of the objects still pending
+    Parameters:
+        list_service: service with list(search=...), e.g. disks service
+        ids: ids of objects
+        status: wanted value of attribute
+        timeout: seconds to wait for all objects, None to wait forever
+    Raises:
+        TimeoutError: objects are still pending after timeout
+    """
+    pending = list(ids)
+    start = monotonic()
+    delays = backoff()
+    while pending:
+        search = ' or '.join('id={}'.format(object_id) for object_id in pending)
+        ready = [obj for obj in list_service.list(search=search)
+                 if obj.id in pending and getattr(obj, attribute) == status]
+        for obj in ready:
+            pending.remove(obj.id)
+            if log is not None:
+                log.info('Waited {:.1f}s for {} of {}'.format(monotonic() - start, obj.id, what))
+            yield obj
+        if not pending:
+            return
+        if ready:
+            # check the others again soon, they were created together
+            delays = backoff()
+        if log is not None:
+            log.info('Waiting for {} of {} {}'.format(len(pending), len(ids), what))
+        delay = next(delays)
+        if timeout is not None:
+            left = timeout - (monotonic() - start)
+            if left <= 0:
+                raise TimeoutError('Timeout after {}s waiting for {}'.format(timeout, what))
+            delay = min(delay, left)
+        sleep(delay)
+
+
+def waitstatuses(list_service, ids, status, timeout, what, log=None, attribute='status'):
+    """Wait for several objects to reach a status with one list query per
+    check
+    Parameters:
+        list_service: service with list(search=...), e.g. disks service
+        ids: ids of objects
+        status: wanted value of attribute
+        timeout: seconds to wait, None to wait forever
+    Returns:
+        dict of id and object
+    """
+    return {obj.id: obj for obj in iterstatuses(list_service, ids, status, timeout, what, log, attribute)}
+
+
+class Ready:
+    """Values of keys published by another thread as they become ready,
+    readers wait for the keys they need
+    Parameters:
+        keys: keys expected
+    """
+
+    def __init__(self, keys):
+        self._keys = list(keys)
+        self._values = {}
+        self.failed = set()
+        self._condition = threading.Condition()
+
+    def set(self, key, value):
+        with self._condition:
+            self._values[key] = value
+            self._condition.notify_all()
+
+    def fail(self, key):
+        """Mark a key that will never be ready"""
+        with self._condition:
+            if key not in self._values:
+                self.failed.add(key)
+            self._condition.notify_all()
+
+    def close(self):
+        """Mark the keys not ready yet as failed"""
+        with self._condition:
+            self.failed.update(key for key in self._keys if key not in self._values)
+            self._condition.notify_all()
+
+    def _resolved(self, key):
+        return key in self._values or key in self.failed
+
+    def get(self, key, default=None):
+        """Return value of key once it is ready, default if it failed"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._resolved(key))
+            return self._values.get(key, default)
+
+    def items(self):
+        """Yield key and value of each key in the order they become ready,
+        failed keys are skipped"""
+        given = set()
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: any(key not in given for key in self._values)
+                                         or all(self._resolved(key) for key in self._keys))
+                ready = [(key, value) for key, value in self._values.items() if key not in given]
+                if not ready:
+                    return
+                given.update(key for key, _ in ready)
+            yield from ready
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)